@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+
+# Alerts raised from inside the collector.  An "alerts" entry in a host block
+# of temp_to_thing_speak.conf lists threshold rules, e.g.
+#
+#   "alerts":{
+#     "rules":[
+#       {"name":"frig too warm", "sensor":"frig", "quantity":"temp_f",
+#        "above":37.0, "hysteresis":1.0, "min_duration":600},
+#       {"name":"freezer thawing", "sensor":"freezer", "quantity":"temp_f",
+#        "above":15.0, "hysteresis":2.0, "min_duration":300},
+#       ],
+#     "repeat":3600,
+#     "coalesce":60,
+#     "max_per_hour":6,
+#     "smtp":{"host":"smtp.gmail.com", "port":465, "ssl":True,
+#             "credentials_file":"~/.ssh/temp_warning_email"},
+#     }
+#
+# A rule fires once its sensor has been beyond "above" (or "below") for
+# "min_duration" seconds, reminds every "repeat" seconds while it stays
+# there and resolves once the value is back inside the threshold by
+# "hysteresis".  Each sample costs a couple of comparisons per rule of its
+# sensor; nothing is kept per sample.
+#
+# Notifications are handed to the SmtpNotifier's worker thread, which waits
+# "coalesce" seconds to gather everything raised meanwhile into one message,
+# sends at most "max_per_hour" messages and keeps its SMTP connection open
+# between messages.  The credentials file holds a dictionary with "user",
+# "app_password" and "to", the same file yagmail used.  For testing, point
+# "smtp" at smtpStub.py with "ssl":False.
+#
+#   ./alertEngine.py --testEmail             # send a test message
+#   ./alertEngine.py --testEmail --smtpServer 127.0.0.1:8025
+
+import os
+import sys
+import time
+import queue
+import random
+import threading
+import collections
+from optparse import OptionParser
+
+from collectorMetrics import registry
+from collectorConfig import ConfigError
+
+defaultSmtpHost          = "smtp.gmail.com"
+defaultSmtpPort          = 465
+defaultCredentialsFile   = "~/.ssh/temp_warning_email"
+defaultRepeatSeconds     = 3600
+defaultCoalesceSeconds   = 60
+defaultMaxPerHour        = 6
+defaultIdleSeconds       = 240
+defaultSmtpTimeout       = 30
+defaultRetrySeconds      = 30
+defaultMaxRetrySeconds   = 900
+defaultQueueLength       = 1000
+
+alertsFired = registry.counter(
+  "collector_alerts_fired_total", "Alert rules that started firing")
+notificationsSent = registry.counter(
+  "collector_alert_notifications_sent_total",
+  "Alert messages accepted by the mail server")
+notificationFailures = registry.counter(
+  "collector_alert_notification_failures_total",
+  "Attempts to send an alert message that failed")
+alertEventsDropped = registry.counter(
+  "collector_alert_events_dropped_total",
+  "Alert events dropped because the notifier queue was full")
+
+class AlertEvent(object):
+
+  def __init__(self, kind, rule, value, timestamp):
+    # kind is "firing", "repeat" or "resolved"
+    self.kind      = kind
+    self.rule      = rule
+    self.value     = value
+    self.timestamp = timestamp
+
+  def describe(self):
+    rule = self.rule
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.timestamp))
+    if self.kind == "resolved":
+      state = "RESOLVED"
+    elif self.kind == "repeat":
+      state = "STILL FIRING"
+    else:
+      state = "FIRING"
+    return "%s %s %s: %s %s = %.2f, %s %.2f" %\
+      (when, state, rule.name, rule.sensor, rule.quantity, self.value,
+       rule.direction, rule.threshold)
+
+class AlertRule(object):
+
+  def __init__(self, name, sensor, quantity, above=None, below=None,
+               hysteresis=0.0, minDurationSeconds=0,
+               repeatSeconds=defaultRepeatSeconds):
+    assert (above is None) != (below is None),\
+      "Alert rule '%s' needs exactly one of 'above' and 'below'" % name
+
+    self.name               = name
+    self.sensor             = sensor
+    self.quantity           = quantity
+    self.above              = above is not None
+    self.threshold          = above if above is not None else below
+    self.direction          = "above" if self.above else "below"
+    self.hysteresis         = hysteresis
+    self.minDurationSeconds = minDurationSeconds
+    self.repeatSeconds      = repeatSeconds
+
+    # "ok", "pending" or "firing"
+    self.state              = "ok"
+    self.pendingSince       = None
+    self.lastNotified       = None
+
+  def breached(self, value):
+    if self.above:
+      return value > self.threshold
+    return value < self.threshold
+
+  def cleared(self, value):
+    if self.above:
+      return value <= self.threshold - self.hysteresis
+    return value >= self.threshold + self.hysteresis
+
+  def evaluate(self, value, now):
+    # Returns an AlertEvent when the rule fires, reminds or resolves
+    if self.state == "firing":
+      if self.cleared(value):
+        self.state = "ok"
+        return AlertEvent("resolved", self, value, now)
+      if self.repeatSeconds and now - self.lastNotified >= self.repeatSeconds:
+        self.lastNotified = now
+        return AlertEvent("repeat", self, value, now)
+      return None
+
+    if not self.breached(value):
+      self.state = "ok"
+      return None
+
+    if self.state == "ok":
+      self.state        = "pending"
+      self.pendingSince = now
+    if now - self.pendingSince >= self.minDurationSeconds:
+      self.state        = "firing"
+      self.lastNotified = now
+      alertsFired.inc()
+      return AlertEvent("firing", self, value, now)
+    return None
+
+class AlertEngine(object):
+
+  def __init__(self, rules, notifier):
+    self.rules    = []
+    self.notifier = notifier
+    self.verbose  = False
+    self.updateRules(rules)
+
+  def updateRules(self, rules):
+    # Replaces the rules after a config change.  A rule keeping its name
+    # keeps its state, so a rule that is firing does not fire again.
+    oldRules = dict((rule.name, rule) for rule in self.rules)
+    self.rules = list(rules)
+    self.rulesBySensor = collections.defaultdict(list)
+    for rule in self.rules:
+      oldRule = oldRules.get(rule.name)
+      if oldRule is not None:
+        rule.state        = oldRule.state
+        rule.pendingSince = oldRule.pendingSince
+        rule.lastNotified = oldRule.lastNotified
+      self.rulesBySensor[rule.sensor].append(rule)
+
+  def evaluate(self, reading):
+    # reading["quantities"] is {sensorName:{quantity:value}} for the sensors
+    # that delivered a usable sample.
+    now = reading["created_at"]
+    for (sensorName, quantities) in reading.get("quantities", {}).items():
+      for rule in self.rulesBySensor.get(sensorName, ()):
+        value = quantities.get(rule.quantity)
+        if value is None:
+          continue
+        event = rule.evaluate(value, now)
+        if event is not None:
+          if self.verbose:
+            print("Alert:", event.describe())
+          self.notifier.notify(event)
+
+  def close(self, timeout=None):
+    self.notifier.stop(timeout)
+
+def addEvent(events, event):
+  # Coalesces a reminder into the rule's previous reminder, if that is the
+  # latest event gathered for the rule, so a long outage of the mail server
+  # leaves one line per rule rather than one per repeat period.
+  if event.kind == "repeat":
+    for index in range(len(events) - 1, -1, -1):
+      if events[index].rule is event.rule:
+        if events[index].kind == "repeat":
+          events[index] = event
+          return
+        break
+  events.append(event)
+
+class SmtpNotifier(object):
+
+  def __init__(self, to, user=None, password=None, host=defaultSmtpHost,
+               port=defaultSmtpPort, useSsl=True, startTls=False,
+               coalesceSeconds=defaultCoalesceSeconds,
+               maxPerHour=defaultMaxPerHour,
+               timeout=defaultSmtpTimeout,
+               idleSeconds=defaultIdleSeconds,
+               retrySeconds=defaultRetrySeconds,
+               maxRetrySeconds=defaultMaxRetrySeconds,
+               maxQueueLength=defaultQueueLength):
+    self.to              = to
+    self.user            = user
+    self.password        = password
+    self.host            = host
+    self.port            = port
+    self.useSsl          = useSsl
+    self.startTls        = startTls
+    self.coalesceSeconds = coalesceSeconds
+    self.maxPerHour      = maxPerHour
+    self.timeout         = timeout
+    self.idleSeconds     = idleSeconds
+    self.retrySeconds    = retrySeconds
+    self.maxRetrySeconds = maxRetrySeconds
+    self.retryDelay      = retrySeconds
+
+    self.inbox           = queue.Queue(maxQueueLength)
+    self.stopping        = threading.Event()
+    self.thread          = None
+    self.connection      = None
+    self.lastUsed        = 0.0
+    self.sendTimes       = collections.deque()
+    self.sentCount       = 0
+    self.connectCount    = 0
+    self.droppedCount    = 0
+    self.verbose         = False
+
+  def notify(self, event):
+    # Never blocks: when the worker has fallen this far behind, the event
+    # is dropped and counted.
+    try:
+      self.inbox.put_nowait(event)
+    except queue.Full:
+      self.droppedCount += 1
+      alertEventsDropped.inc()
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name="alerts",
+                                   daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=None):
+    # Anything gathered or queued but not yet sent is sent before the worker
+    # exits.  With the queue full the worker has events to take anyway, and
+    # sees stopping after the next one.
+    self.stopping.set()
+    try:
+      self.inbox.put_nowait(None)
+    except queue.Full:
+      pass
+    if self.thread:
+      self.thread.join(timeout)
+
+  def connect(self):
+    # smtplib and email only load once there is an alert to send
+    import smtplib
+    if self.useSsl:
+      connection = smtplib.SMTP_SSL(self.host, self.port,
+                                    timeout=self.timeout)
+    else:
+      connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+      if self.startTls:
+        connection.starttls()
+    if self.user:
+      connection.login(self.user, self.password)
+    self.connectCount += 1
+    return connection
+
+  def disconnect(self):
+    if self.connection is not None:
+      try:
+        self.connection.quit()
+      except Exception:
+        try:
+          self.connection.close()
+        except Exception:
+          pass
+      self.connection = None
+
+  def getConnection(self):
+    # Servers drop idle clients, so probe a connection that sat unused for
+    # a while before trusting it.
+    import smtplib
+    if (self.connection is not None
+        and time.monotonic() - self.lastUsed > self.idleSeconds):
+      try:
+        if self.connection.noop()[0] != 250:
+          self.disconnect()
+      except (smtplib.SMTPException, OSError):
+        self.connection = None
+    if self.connection is None:
+      self.connection = self.connect()
+    return self.connection
+
+  def makeMessage(self, events):
+    from email.message import EmailMessage
+    message = EmailMessage()
+    if len(events) == 1:
+      event = events[0]
+      prefix = "RESOLVED" if event.kind == "resolved" else "WARNING"
+      subject = "%s: %s" % (prefix, event.rule.name)
+    else:
+      subject = "WARNING: %s temperature alerts" % len(events)
+    message["Subject"] = subject
+    message["From"]    = self.user or "collector@localhost"
+    message["To"]      = self.to
+    message.set_content("\n".join(event.describe() for event in events)
+                        + "\n")
+    return message
+
+  def send(self, events):
+    import smtplib
+    message = self.makeMessage(events)
+    try:
+      self.getConnection().send_message(message)
+    except (smtplib.SMTPServerDisconnected, OSError):
+      # The kept connection went stale; one fresh connection gets a retry
+      self.connection = None
+      self.getConnection().send_message(message)
+    self.lastUsed = time.monotonic()
+
+  def rateLimitWait(self):
+    # Seconds until another message may go out under maxPerHour
+    now = time.monotonic()
+    while self.sendTimes and now - self.sendTimes[0] >= 3600:
+      self.sendTimes.popleft()
+    if not self.maxPerHour or len(self.sendTimes) < self.maxPerHour:
+      return 0.0
+    return 3600 - (now - self.sendTimes[0])
+
+  def gather(self, events, seconds):
+    # Adds events arriving within seconds; returns False once stopping,
+    # after adding the events still queued
+    deadline = time.monotonic() + seconds
+    while not self.stopping.is_set():
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        return True
+      try:
+        event = self.inbox.get(timeout=remaining)
+      except queue.Empty:
+        return True
+      if event is None:
+        break
+      addEvent(events, event)
+    while True:
+      try:
+        event = self.inbox.get_nowait()
+      except queue.Empty:
+        return False
+      if event is not None:
+        addEvent(events, event)
+
+  def run(self):
+    events  = []
+    running = True
+    while running:
+      if not events:
+        event = self.inbox.get()
+        if event is None:
+          break
+        addEvent(events, event)
+
+      running = self.gather(events, max(self.coalesceSeconds,
+                                        self.rateLimitWait()))
+      try:
+        self.send(events)
+      except Exception as e:
+        notificationFailures.inc()
+        print("Sending alert email failed:")
+        try:
+          print("Error msg:",str(e))
+        except:
+          print("  Sorry, could not print alert email error.")
+        self.disconnect()
+        if running:
+          delay = self.retryDelay * random.uniform(0.8, 1.2)
+          self.retryDelay = min(self.retryDelay * 2, self.maxRetrySeconds)
+          print("Retrying in %.0f seconds..." % delay)
+          running = self.gather(events, delay)
+        continue
+
+      self.retryDelay = self.retrySeconds
+      self.sendTimes.append(time.monotonic())
+      self.sentCount += 1
+      notificationsSent.inc()
+      if self.verbose:
+        print("Sent alert email with %s events" % len(events))
+      events = []
+
+    self.disconnect()
+
+def readCredentials(credentialsFileName):
+  with open(os.path.expanduser(credentialsFileName)) as credentialsStream:
+    import ast
+    try:
+      credentials = ast.literal_eval(credentialsStream.read())
+    except (SyntaxError, ValueError) as e:
+      raise ConfigError("Could not parse '%s': %s" % (credentialsFileName, e))
+  if not isinstance(credentials, dict):
+    raise ConfigError("The credentials file '%s' must hold a dictionary"
+                      % credentialsFileName)
+  return credentials
+
+def makeSmtpNotifier(alertsConfig, smtpServer=None):
+  # smtpServer is an optional "host:port" of a plain SMTP server, such as
+  # smtpStub.py, overriding the configured one
+  smtpConfig = dict(alertsConfig.get("smtp", {}))
+  if smtpServer:
+    (host, port) = smtpServer.rsplit(":", 1)
+    smtpConfig.update({"host":host, "port":int(port), "ssl":False,
+                       "starttls":False})
+
+  credentials = {}
+  credentialsFile = smtpConfig.get("credentials_file", defaultCredentialsFile)
+  if os.path.exists(os.path.expanduser(credentialsFile)):
+    credentials = readCredentials(credentialsFile)
+  for key in ("user", "app_password", "to"):
+    if key in smtpConfig:
+      credentials[key] = smtpConfig[key]
+  if smtpServer:
+    credentials.setdefault("to", "alerts@localhost")
+  if not credentials.get("to"):
+    raise ConfigError("No alert recipient: add 'to' to '%s' or to the "
+                      "alerts smtp config" % credentialsFile)
+
+  # Without a server override, log in to the real server as configured
+  user = credentials.get("user") if not smtpServer else None
+  return SmtpNotifier(credentials["to"],
+                      user=user,
+                      password=credentials.get("app_password"),
+                      host=smtpConfig.get("host", defaultSmtpHost),
+                      port=smtpConfig.get("port", defaultSmtpPort),
+                      useSsl=smtpConfig.get("ssl", True),
+                      startTls=smtpConfig.get("starttls", False),
+                      coalesceSeconds=alertsConfig.get(
+                        "coalesce", defaultCoalesceSeconds),
+                      maxPerHour=alertsConfig.get(
+                        "max_per_hour", defaultMaxPerHour))
+
+def makeAlertRules(alertsConfig):
+  repeatSeconds = alertsConfig.get("repeat", defaultRepeatSeconds)
+  rules = []
+  for ruleConfig in alertsConfig.get("rules", []):
+    rules.append(AlertRule(ruleConfig["name"],
+                           ruleConfig["sensor"],
+                           ruleConfig.get("quantity", "temp_f"),
+                           above=ruleConfig.get("above"),
+                           below=ruleConfig.get("below"),
+                           hysteresis=ruleConfig.get("hysteresis", 0.0),
+                           minDurationSeconds=ruleConfig.get(
+                             "min_duration", 0),
+                           repeatSeconds=ruleConfig.get(
+                             "repeat", repeatSeconds)))
+  return rules
+
+def makeAlertEngine(configDataDict, smtpServer=None):
+  # Returns None when the host block has no alert rules
+  alertsConfig = configDataDict.get("alerts")
+  if not alertsConfig or not alertsConfig.get("rules"):
+    return None
+  rules = makeAlertRules(alertsConfig)
+  return AlertEngine(rules, makeSmtpNotifier(alertsConfig, smtpServer))
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] [options]
+       where:
+         -h|--help to see options
+"""
+  parser = OptionParser(usage)
+  help="Send one test alert message and exit"
+  parser.add_option("--testEmail",
+                    action="store_true",
+                    default=False,
+                    dest="testEmail",
+                    help=help)
+  help ="File holding the 'user', 'app_password' and 'to' dictionary.  "
+  help+="Default is '%s'" % defaultCredentialsFile
+  parser.add_option("--credentialsFile",
+                    action="store", type="string",
+                    default=defaultCredentialsFile,
+                    dest="credentialsFile",
+                    help=help)
+  help ="host:port of a plain SMTP server to use instead of "
+  help+="%s, e.g. smtpStub.py on 127.0.0.1:8025" % defaultSmtpHost
+  parser.add_option("--smtpServer",
+                    action="store", type="string",
+                    default=None,
+                    dest="smtpServer",
+                    help=help)
+
+  (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
+
+  if len(cmdLineArgs) != 0:
+    parser.error("All command-line arguments require a flag. "+\
+                 "Found the following without flags: %s" % cmdLineArgs)
+
+  if not cmdLineOptions.testEmail:
+    parser.error("Nothing to do, try --testEmail")
+
+  return (cmdLineOptions, cmdLineArgs)
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+
+  alertsConfig = {"coalesce":0,
+                  "smtp":{"credentials_file":clo.credentialsFile}}
+  notifier = makeSmtpNotifier(alertsConfig, clo.smtpServer)
+  notifier.verbose = True
+  rule = AlertRule("test alert", "test", "temp_f", above=37.0)
+  notifier.start()
+  notifier.notify(AlertEvent("firing", rule, 37.0, time.time()))
+  notifier.stop()
+  if notifier.sentCount:
+    print("Sent email successfully")
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
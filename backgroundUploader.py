@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Runs the ReadingBatcher on its own thread so a slow or hung upload never
+# delays the next sensor read.  The sampling loop only hands readings over
+# through a queue; the worker thread owns the batcher, does the HTTP calls
+# and acknowledges uploaded readings in the spool.
+#
+# The thread looks at the batch every pollSeconds and whenever poke() is
+# called, which the ThingSpeak sink does for every reading.  Without a
+# pollSeconds (None) it only runs when poked, so uploads, and retries of
+# failed ones, happen right after a sample.  closeAfterUpload closes the
+# HTTP connection after each upload rather than keeping it alive.
+#
+# The spool is only acknowledged up to the last reading before which every
+# reading was sent.  Should the batcher drop readings during a long outage,
+# they stay unacknowledged and are replayed from the spool on the next
+# start, rather than being acknowledged along with those sent after them.
+
+import queue
+import threading
+
+defaultPollSeconds = 1.0
+
+class BackgroundUploader(object):
+
+  def __init__(self, batcher, spool=None, pollSeconds=defaultPollSeconds,
+               closeAfterUpload=False):
+    self.batcher          = batcher
+    self.spool            = spool
+    self.pollSeconds      = pollSeconds
+    self.closeAfterUpload = closeAfterUpload
+    self.inbox            = queue.SimpleQueue()
+    self.wakeup           = threading.Event()
+    self.stopping         = threading.Event()
+    self.forceFlush       = False
+    self.sentCount        = 0
+    self.sentAhead        = set()
+    self.thread           = None
+
+  def add(self, reading):
+    self.inbox.put(reading)
+
+  def poke(self):
+    # Has the thread check for a due batch now
+    self.wakeup.set()
+
+  def flushNow(self):
+    self.forceFlush = True
+    self.wakeup.set()
+
+  def queuedCount(self):
+    return self.inbox.qsize() + len(self.batcher)
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name="uploader",
+                                   daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=None):
+    # Readings still queued are safe in the spool and are replayed on the
+    # next start, so there is no need to wait for the network here.
+    self.stopping.set()
+    self.wakeup.set()
+    if self.thread:
+      self.thread.join(timeout)
+
+  def drainInbox(self):
+    while True:
+      try:
+        self.batcher.add(self.inbox.get_nowait())
+      except queue.Empty:
+        return
+
+  def acknowledgeSent(self, flushed):
+    # Sequence numbers sent past a gap wait in sentAhead until the gap is
+    # sent too, or is evicted from the spool
+    firstUnsent = self.spool.readSeq
+    sent = set(seq for seq in self.sentAhead if seq >= firstUnsent)
+    sent.update(reading["seq"] for reading in flushed)
+    while firstUnsent in sent:
+      sent.discard(firstUnsent)
+      firstUnsent += 1
+    self.sentAhead = sent
+    if firstUnsent > self.spool.readSeq:
+      self.spool.acknowledge(firstUnsent - 1)
+
+  def run(self):
+    while not self.stopping.is_set():
+      self.wakeup.wait(self.pollSeconds)
+      self.wakeup.clear()
+      if self.stopping.is_set():
+        break
+
+      self.drainInbox()
+      try:
+        if self.forceFlush:
+          self.forceFlush = False
+          flushed = self.batcher.flush()
+        else:
+          flushed = self.batcher.flushIfDue()
+      except Exception as e:
+        print("Uploader flush failed:")
+        try:
+          print("Error msg:",str(e))
+        except:
+          print("  Sorry, could not print uploader flush error.")
+        print("Continuing...")
+        continue
+      finally:
+        # Closing a pool with no idle connections costs nothing
+        if self.closeAfterUpload:
+          self.batcher.client.close()
+
+      if flushed:
+        self.sentCount += len(flushed)
+        if self.spool is not None:
+          self.acknowledgeSent(flushed)
+        print("Bulk update sent %s readings, %s still queued"
+              % (len(flushed), self.queuedCount()))
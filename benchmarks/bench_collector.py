@@ -0,0 +1,598 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the collector pipeline, run off a Pi with a synthetic sensor
+# and a local stand-in for ThingSpeak:
+#
+#   ./benchmarks/bench_collector.py -o results.json
+#   ./benchmarks/bench_collector.py -o new.json --compare results.json
+#
+# The stage benchmarks time each step of a sample on its own (sensor read,
+# conversion, channelDict build, derived metrics, window aggregation,
+# upload).  The pipeline benchmark runs the whole CollectorEngine as fast as
+# it will go for a few seconds.  Results are written as JSON so two versions
+# can be compared; --compare exits non-zero when any tracked number got
+# worse by more than --tolerance.
+#
+# The startup benchmark times importing temp_to_thing_speak in a fresh
+# interpreter, which every restart under collectorSupervisor.py pays.  It
+# fails when the import takes longer than --importBudget times starting a
+# bare interpreter on the same machine, or when it loads one of the modules
+# that only some code paths need (asyncio, http.client, smtplib, ...).
+#
+#   ./benchmarks/bench_collector.py --startupOnly
+#
+# The power benchmark runs the collector for an hour of simulated time in
+# normal and in power-saving mode, with the default update frequency and
+# batching and every timer sped up by --timeScale, and reports the wakeups
+# and CPU seconds each mode costs per simulated hour.  Wakeups include a
+# couple a second of the ThingSpeak stand-in's own, which does not run on
+# the sped-up clock.
+#
+#   ./benchmarks/bench_collector.py --powerOnly
+
+import os
+import sys
+import json
+import time
+import asyncio
+import platform
+import subprocess
+import resource
+import tempfile
+import contextlib
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from sensorBackends import makeSensor
+from sensorScheduler import SensorScheduler
+from sensorReader import makeSensorReader
+from thingSpeakStub import ThingSpeakStub
+from thingSpeakClient import ThingSpeakBulkClient, makeReading
+from readingBatcher import ReadingBatcher
+from readingSpool import ReadingSpool
+from backgroundUploader import BackgroundUploader
+from readingSinks import SinkWorker, ThingSpeakSink
+from collectorLog import CollectorLog
+from collectorConfig import ConfigWatcher
+from collectorConfig import defaultPollSeconds as configPollSeconds
+from readingBatcher import defaultBatchSize as hostBatchSize
+from readingBatcher import defaultBatchMaxAgeSeconds
+from backgroundUploader import defaultPollSeconds as uploaderPollSeconds
+from collectorLog import defaultFlushSeconds
+from powerSaving import measureUsage, ratesPerHour
+from collectorEngine import CollectorEngine
+from windowAggregator import WindowAggregator
+from derivedMetrics import DerivedMetrics, metricTypes
+import temp_to_thing_speak
+
+defaultSampleCount     = 20000
+defaultUploadCount     = 200
+defaultBatchSize       = 100
+defaultPipelineSeconds = 5.0
+defaultTolerance       = 0.25
+defaultStartupRuns     = 7
+defaultImportBudget    = 5.0
+defaultPowerSeconds    = 10.0
+defaultTimeScale       = 360.0
+powerUpdateFrequency   = 300.0
+
+repoDirName = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Modules importing temp_to_thing_speak must not load, because only some
+# code paths need them
+lazyModules = ("asyncio", "concurrent.futures", "http.client", "http.server",
+               "ssl", "smtplib", "email.message", "ast", "calendar",
+               "urllib.parse", "Adafruit_DHT", "numpy")
+
+sensorConfig = {"name":"bench", "type":"synthetic", "seed":1,
+                "failure_rate":0.0,
+                "fields":{1:"temp_f", 2:"humidity", 3:"temp_f", 4:"humidity"}}
+
+# Numbers where bigger is better; everything else tracked is a cost
+higherIsBetter = ("samples_per_second", "upload_round_trips_per_second",
+                  "readings_uploaded_per_second")
+
+def percentiles(valuesNs):
+  values = sorted(valuesNs)
+  count = len(values)
+  def pick(fraction):
+    return values[min(count - 1, int(fraction * count))] / 1000.0
+  return {"count":count,
+          "p50_us":pick(0.50),
+          "p90_us":pick(0.90),
+          "p99_us":pick(0.99),
+          "max_us":values[-1] / 1000.0,
+          "mean_us":sum(values) / count / 1000.0}
+
+def currentRssKb():
+  with open("/proc/self/statm") as statm:
+    pages = int(statm.read().split()[1])
+  return pages * resource.getpagesize() // 1024
+
+def maxRssKb():
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+@contextlib.contextmanager
+def quietStdout():
+  # The collector prints every reading.  Keep the cost of the print calls in
+  # the measurement but not the cost of a terminal scrolling.
+  with open(os.devnull, "w") as devnull:
+    with contextlib.redirect_stdout(devnull):
+      yield
+
+def benchStages(sampleCount):
+  sensor  = makeSensor(sensorConfig)
+  sensors = [sensor]
+  reader  = makeSensorReader(sensor, sensorConfig)
+  timer   = time.perf_counter_ns
+  # One window for the whole run: the cost of adding a sample to a window
+  # must not grow with the number of samples in it
+  aggregator = WindowAggregator(float(sampleCount + 1))
+  derivedMetrics = DerivedMetrics([dict(sensorConfig,
+                                        derived=dict((name, {}) for name
+                                                     in metricTypes))])
+
+  readNs      = []
+  convertNs   = []
+  buildNs     = []
+  aggregateNs = []
+  deriveNs    = []
+
+  cpuStart = time.process_time()
+  with quietStdout():
+    for i in range(sampleCount):
+      t0 = timer()
+      sample = reader.read()
+      t1 = timer()
+      quantities = temp_to_thing_speak.convertSample(sample)
+      t2 = timer()
+      temp_to_thing_speak.makeChannelReading({sensor.name:sample}, sensors,
+                                             time.time())
+      t3 = timer()
+      if quantities is not None:
+        derivedMetrics.update(sensor.name, quantities, i + 1)
+      t4 = timer()
+      if quantities is not None:
+        aggregator.add({sensor.name:quantities}, i + 1)
+      t5 = timer()
+      readNs.append(t1 - t0)
+      convertNs.append(t2 - t1)
+      buildNs.append(t3 - t2)
+      deriveNs.append(t4 - t3)
+      aggregateNs.append(t5 - t4)
+  cpuSeconds = time.process_time() - cpuStart
+
+  return {"sensor_read":percentiles(readNs),
+          "conversion":percentiles(convertNs),
+          "channel_dict":percentiles(buildNs),
+          "derived":percentiles(deriveNs),
+          "aggregation":percentiles(aggregateNs),
+          "cpu_us_per_sample":cpuSeconds / sampleCount * 1e6}
+
+def benchUpload(stub, uploadCount, batchSize):
+  client = ThingSpeakBulkClient("1", "BENCH", baseUrl=stub.getBaseUrl())
+  readings = [makeReading({1:70.0 + i * 0.01, 2:45.0, "status":"bench"},
+                          1.6e9 + i)
+              for i in range(batchSize)]
+
+  uploadNs = []
+  start = time.perf_counter()
+  for i in range(uploadCount):
+    t0 = time.perf_counter_ns()
+    client.bulkUpdate(readings)
+    uploadNs.append(time.perf_counter_ns() - t0)
+  elapsed = time.perf_counter() - start
+
+  result = {"upload":percentiles(uploadNs),
+            "batch_size":batchSize,
+            "upload_round_trips_per_second":uploadCount / elapsed,
+            "readings_uploaded_per_second":uploadCount * batchSize / elapsed,
+            "connections_opened":client.pool.connectCount}
+  client.close()
+  return result
+
+def benchPipeline(stub, seconds, batchSize):
+  sensors   = [makeSensor(sensorConfig)]
+  scheduler = SensorScheduler(sensors)
+  client    = ThingSpeakBulkClient("1", "BENCH", baseUrl=stub.getBaseUrl())
+  batcher   = ReadingBatcher(client, maxBatchSize=batchSize)
+
+  with tempfile.TemporaryDirectory() as tmpDir:
+    spool    = ReadingSpool(os.path.join(tmpDir, "bench.spool"))
+    uploader = BackgroundUploader(batcher, spool, pollSeconds=0.05).start()
+
+    def makeSampleReading(samples, timestamp):
+      return temp_to_thing_speak.makeChannelReading(samples, sensors,
+                                                    timestamp)
+
+    def publish(reading):
+      reading["seq"] = spool.append(reading)
+      uploader.add(reading)
+
+    # A tiny interval means every deadline has already passed, so the
+    # engine samples back to back.
+    engine = CollectorEngine(scheduler.readAll, makeSampleReading, 1e-6)
+    engine.addOutput(publish)
+
+    async def runFor():
+      try:
+        await asyncio.wait_for(engine.main(), seconds)
+      except asyncio.TimeoutError:
+        pass
+
+    rssBefore = currentRssKb()
+    cpuStart  = time.process_time()
+    requestsBefore = client.pool.requestCount
+    with quietStdout():
+      start = time.perf_counter()
+      asyncio.run(runFor())
+      elapsed = time.perf_counter() - start
+    cpuSeconds = time.process_time() - cpuStart
+    requests = client.pool.requestCount - requestsBefore
+
+    uploader.stop()
+    spool.close()
+    scheduler.shutdown()
+    client.close()
+
+  samples = engine.sampleCount
+  return {"seconds":elapsed,
+          "samples":samples,
+          "samples_per_second":samples / elapsed,
+          "upload_round_trips_per_second":requests / elapsed,
+          "cpu_us_per_sample":cpuSeconds / max(samples, 1) * 1e6,
+          "rss_growth_kb":currentRssKb() - rssBefore}
+
+def benchPower(stub, seconds, timeScale, powerSave):
+  # Wired up like runCollectorEngine(), with every period divided by
+  # timeScale, so seconds of real time stand for seconds * timeScale
+  sensors   = [makeSensor(sensorConfig)]
+  scheduler = SensorScheduler(sensors)
+  client    = ThingSpeakBulkClient("1", "BENCH", baseUrl=stub.getBaseUrl())
+  batcher   = ReadingBatcher(client, maxBatchSize=hostBatchSize,
+                             maxBatchAgeSeconds=(defaultBatchMaxAgeSeconds
+                                                 / timeScale))
+
+  with tempfile.TemporaryDirectory() as tmpDir:
+    spool = ReadingSpool(os.path.join(tmpDir, "bench.spool"))
+    configFilename = os.path.join(tmpDir, "bench.conf")
+    with open(configFilename, "w") as configStream:
+      configStream.write("{}\n")
+    watcher = ConfigWatcher(configFilename, None, None,
+                            pollSeconds=configPollSeconds / timeScale)
+    if powerSave:
+      uploader = BackgroundUploader(batcher, spool, pollSeconds=None,
+                                    closeAfterUpload=True)
+      collectorLog = CollectorLog(os.path.join(tmpDir, "bench"),
+                                  flushSeconds=None)
+    else:
+      uploader = BackgroundUploader(batcher, spool,
+                                    pollSeconds=uploaderPollSeconds
+                                    / timeScale)
+      collectorLog = CollectorLog(os.path.join(tmpDir, "bench"),
+                                  flushSeconds=defaultFlushSeconds / timeScale)
+    sinkWorker = SinkWorker(ThingSpeakSink(spool, uploader),
+                            backpressure="block")
+
+    def makeSampleReading(samples, timestamp):
+      return temp_to_thing_speak.makeChannelReading(samples, sensors,
+                                                    timestamp)
+
+    engine = CollectorEngine(scheduler.readAll, makeSampleReading,
+                             powerUpdateFrequency / timeScale)
+    engine.addOutput(sinkWorker.makeOutput(),
+                     lossless=sinkWorker.isLossless())
+    engine.addOutput(lambda reading:
+                       collectorLog.log("reading", reading["created_at"],
+                                        quantities=reading["quantities"]))
+    if powerSave:
+      engine.addCycleHook(watcher.check)
+      engine.addCycleHook(collectorLog.flush)
+
+    async def runFor():
+      try:
+        await asyncio.wait_for(engine.main(), seconds)
+      except asyncio.TimeoutError:
+        pass
+
+    with quietStdout():
+      uploader.start()
+      collectorLog.start()
+      sinkWorker.start()
+      if not powerSave:
+        watcher.start()
+      start = measureUsage()
+      asyncio.run(runFor())
+      end = measureUsage()
+      watcher.stop()
+      sinkWorker.stop()
+      collectorLog.stop()
+      uploader.stop()
+    spool.close()
+    scheduler.shutdown()
+    client.close()
+
+  (wakeups, cpuSeconds) = ratesPerHour(start, end, timeScale)
+  return {"samples":engine.sampleCount,
+          "uploads":client.pool.requestCount,
+          "wakeups_per_hour":wakeups,
+          "cpu_seconds_per_hour":cpuSeconds}
+
+def timeInterpreter(code, runs):
+  # Median wall time in ms of a fresh interpreter running code
+  times = []
+  for run in range(runs):
+    start = time.perf_counter()
+    subprocess.check_call([sys.executable, "-c", code], cwd=repoDirName)
+    times.append((time.perf_counter() - start) * 1000.0)
+  return sorted(times)[len(times) // 2]
+
+def benchStartup(runs):
+  baseMs   = timeInterpreter("pass", runs)
+  importMs = timeInterpreter("import temp_to_thing_speak", runs)
+  loaded = subprocess.check_output(
+    [sys.executable, "-c",
+     "import sys, temp_to_thing_speak\n"
+     "print(' '.join(name for name in %r if name in sys.modules))"
+     % (lazyModules,)],
+    cwd=repoDirName).decode("UTF-8").split()
+  return {"interpreter_ms":baseMs,
+          "import_ms":importMs - baseMs,
+          "lazy_modules_loaded":loaded}
+
+def checkStartup(startup, importBudget):
+  # Returns the list of budget violations as printable lines
+  problems = []
+  budgetMs = startup["interpreter_ms"] * importBudget
+  if startup["import_ms"] > budgetMs:
+    problems.append("importing temp_to_thing_speak took %.1f ms, budget is "
+                    "%.1f ms (%s x %.1f ms for a bare interpreter)"
+                    % (startup["import_ms"], budgetMs, importBudget,
+                       startup["interpreter_ms"]))
+  for name in startup["lazy_modules_loaded"]:
+    problems.append("importing temp_to_thing_speak loaded '%s'" % name)
+  return problems
+
+def flatten(results, prefix=""):
+  flat = {}
+  for (key, value) in results.items():
+    name = prefix + key
+    if isinstance(value, dict):
+      flat.update(flatten(value, name + "."))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+      flat[name] = value
+  return flat
+
+def isTracked(name):
+  # Tail latencies of sub-microsecond stages are too noisy to compare
+  return name.endswith(("p50_us", "p90_us", "mean_us", "_per_second",
+                        "_per_sample", "_per_hour", "_kb", "import_ms"))
+
+def compareResults(current, previous, tolerance):
+  # Returns the list of regressions as printable lines
+  regressions = []
+  currentFlat  = flatten(current["results"])
+  previousFlat = flatten(previous["results"])
+  for name in sorted(currentFlat):
+    if name not in previousFlat or not isTracked(name):
+      continue
+    old = previousFlat[name]
+    new = currentFlat[name]
+    if not old:
+      continue
+    change = (new - old) / abs(old)
+    if name.endswith(higherIsBetter):
+      change = -change
+    if change > tolerance:
+      regressions.append("%-50s %12.2f -> %12.2f (%+.0f%% worse)"
+                         % (name, old, new, change * 100))
+  return regressions
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] [options]
+       where:
+         -h|--help to see options
+"""
+  parser = OptionParser(usage)
+  help="Verbose mode, print the full results."
+  parser.add_option("-v", "--verbose",
+                    action="store_true",
+                    default=False,
+                    dest="verbose",
+                    help=help)
+  help="Samples for the stage benchmarks.  Default is %s" % defaultSampleCount
+  parser.add_option("-n", "--samples",
+                    action="store", type="int",
+                    default=defaultSampleCount,
+                    dest="sampleCount",
+                    help=help)
+  help="Bulk updates for the upload benchmark.  Default is %s" %\
+    defaultUploadCount
+  parser.add_option("-u", "--uploads",
+                    action="store", type="int",
+                    default=defaultUploadCount,
+                    dest="uploadCount",
+                    help=help)
+  help="Readings per bulk update.  Default is %s" % defaultBatchSize
+  parser.add_option("-b", "--batchSize",
+                    action="store", type="int",
+                    default=defaultBatchSize,
+                    dest="batchSize",
+                    help=help)
+  help="Seconds to run the whole pipeline.  Default is %s" %\
+    defaultPipelineSeconds
+  parser.add_option("-s", "--seconds",
+                    action="store", type="float",
+                    default=defaultPipelineSeconds,
+                    dest="pipelineSeconds",
+                    help=help)
+  help="Write the results as JSON to this file"
+  parser.add_option("-o", "--output",
+                    action="store", type="string",
+                    default=None,
+                    dest="outputFilename",
+                    help=help)
+  help="Fresh interpreters to start for the startup benchmark.  "
+  help+="Default is %s" % defaultStartupRuns
+  parser.add_option("-r", "--startupRuns",
+                    action="store", type="int",
+                    default=defaultStartupRuns,
+                    dest="startupRuns",
+                    help=help)
+  help ="Most the import of temp_to_thing_speak may take, as a multiple of "
+  help+="the time a bare interpreter takes to start.  "
+  help+="Default is %s" % defaultImportBudget
+  parser.add_option("-i", "--importBudget",
+                    action="store", type="float",
+                    default=defaultImportBudget,
+                    dest="importBudget",
+                    help=help)
+  help="Real seconds to run each mode of the power benchmark.  "
+  help+="Default is %s" % defaultPowerSeconds
+  parser.add_option("--powerSeconds",
+                    action="store", type="float",
+                    default=defaultPowerSeconds,
+                    dest="powerSeconds",
+                    help=help)
+  help ="Simulated seconds per real second in the power benchmark.  "
+  help+="Default is %s, an hour in %s secs"\
+    % (defaultTimeScale, 3600 / defaultTimeScale)
+  parser.add_option("--timeScale",
+                    action="store", type="float",
+                    default=defaultTimeScale,
+                    dest="timeScale",
+                    help=help)
+  help="Only run the power benchmark"
+  parser.add_option("--powerOnly",
+                    action="store_true",
+                    default=False,
+                    dest="powerOnly",
+                    help=help)
+  help="Only run the startup benchmark"
+  parser.add_option("--startupOnly",
+                    action="store_true",
+                    default=False,
+                    dest="startupOnly",
+                    help=help)
+  help="Compare against results previously written with --output"
+  parser.add_option("-c", "--compare",
+                    action="store", type="string",
+                    default=None,
+                    dest="compareFilename",
+                    help=help)
+  help="Fraction a number may get worse before --compare reports it.  "
+  help+="Default is %s" % defaultTolerance
+  parser.add_option("-t", "--tolerance",
+                    action="store", type="float",
+                    default=defaultTolerance,
+                    dest="tolerance",
+                    help=help)
+
+  (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
+
+  if len(cmdLineArgs) != 0:
+    parser.error("All command-line arguments require a flag. "+\
+                 "Found the following without flags: %s" % cmdLineArgs)
+
+  if cmdLineOptions.startupOnly and cmdLineOptions.powerOnly:
+    parser.error("Cannot specify both --startupOnly and --powerOnly")
+
+  return (cmdLineOptions, cmdLineArgs)
+
+def printSummary(current):
+  results = current["results"]
+  if "startup" in results:
+    startup = results["startup"]
+    print("startup        import %.1f ms on top of %.1f ms for the "
+          "interpreter" % (startup["import_ms"], startup["interpreter_ms"]))
+  if "power" in results:
+    for mode in ("normal", "power_save"):
+      power = results["power"][mode]
+      print("%-14s %8.0f wakeups/hour  %6.2f CPU secs/hour  (%s uploads)"
+            % (mode, power["wakeups_per_hour"], power["cpu_seconds_per_hour"],
+               power["uploads"]))
+  if "stages" not in results:
+    return
+  for stage in ("sensor_read", "conversion", "channel_dict",
+                "derived", "aggregation"):
+    stats = results["stages"][stage]
+    print("%-14s p50 %8.1f us  p90 %8.1f us  p99 %8.1f us"
+          % (stage, stats["p50_us"], stats["p90_us"], stats["p99_us"]))
+  stats = results["upload"]["upload"]
+  print("%-14s p50 %8.1f us  p90 %8.1f us  p99 %8.1f us  (%s readings each)"
+        % ("upload", stats["p50_us"], stats["p90_us"], stats["p99_us"],
+           results["upload"]["batch_size"]))
+  pipeline = results["pipeline"]
+  print("pipeline       %.0f samples/sec, %.1f uploads/sec, %.1f us CPU/sample"
+        % (pipeline["samples_per_second"],
+           pipeline["upload_round_trips_per_second"],
+           pipeline["cpu_us_per_sample"]))
+  print("memory         %s kB RSS, %s kB max RSS"
+        % (results["rss_kb"], results["max_rss_kb"]))
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+
+  results = {}
+  if not clo.powerOnly:
+    results["startup"] = benchStartup(clo.startupRuns)
+  if not clo.startupOnly:
+    stub = ThingSpeakStub().start()
+    try:
+      if not clo.powerOnly:
+        results["stages"]   = benchStages(clo.sampleCount)
+        results["upload"]   = benchUpload(stub, clo.uploadCount,
+                                          clo.batchSize)
+        results["pipeline"] = benchPipeline(stub, clo.pipelineSeconds,
+                                            clo.batchSize)
+      results["power"] = dict((mode, benchPower(stub, clo.powerSeconds,
+                                                clo.timeScale,
+                                                mode == "power_save"))
+                              for mode in ("normal", "power_save"))
+    finally:
+      stub.stop()
+
+  results["rss_kb"]     = currentRssKb()
+  results["max_rss_kb"] = maxRssKb()
+
+  current = {"timestamp":time.strftime("%Y-%m-%dT%H:%M:%S"),
+             "host":platform.node(),
+             "machine":platform.machine(),
+             "python":platform.python_version(),
+             "results":results}
+
+  printSummary(current)
+  if clo.verbose:
+    print(json.dumps(current, indent=2))
+
+  if clo.outputFilename:
+    with open(clo.outputFilename, "w") as outputStream:
+      json.dump(current, outputStream, indent=2)
+      outputStream.write("\n")
+
+  problems = []
+  if "startup" in results:
+    problems = checkStartup(results["startup"], clo.importBudget)
+  if problems:
+    print("Startup over budget:")
+    for line in problems:
+      print("  " + line)
+
+  if clo.compareFilename:
+    with open(clo.compareFilename) as compareStream:
+      previous = json.load(compareStream)
+    regressions = compareResults(current, previous, clo.tolerance)
+    if regressions:
+      print("Regressions against '%s':" % clo.compareFilename)
+      for line in regressions:
+        print("  " + line)
+      sys.exit(1)
+    print("No regressions against '%s'" % clo.compareFilename)
+
+  if problems:
+    sys.exit(1)
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
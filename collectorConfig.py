@@ -0,0 +1,481 @@
+#!/usr/bin/env python3
+
+# Loads temp_to_thing_speak.conf.  The whole fleet's config is validated
+# once and compiled into one HostConfig per host block.  The compiled result
+# is cached next to the config file ("<config>.cache") together with the
+# config file's mtime and size, so a later start with an unchanged config
+# skips parsing and validation.
+#
+#   ./collectorConfig.py -c temp_to_thing_speak.conf    # check the fleet
+#
+# A HostConfig is a namedtuple holding the settings every host needs, plus
+# "data", a read-only view of the whole host block for the options that
+# other modules read themselves (publish mode, alerts, sensor filters).
+#
+# ConfigWatcher polls the config file's mtime and size and calls back with
+# the old and new HostConfig when the host's block changed, so the
+# collector can apply changes without a restart.
+
+import os
+import sys
+import time
+import marshal
+import socket
+import threading
+import collections
+from types import MappingProxyType
+from optparse import OptionParser
+
+from readingBatcher import defaultBatchSize, defaultBatchMaxAgeSeconds
+from readingSpool import defaultCapacity
+from httpConnectionPool import defaultConnectTimeoutSeconds,\
+  defaultReadTimeoutSeconds
+from sensorBackends import quantityNames
+from readingSinks import sinkTypes, backpressurePolicies
+from windowAggregator import isQuantity, statNames
+from derivedMetrics import metricTypes, derivedQuantityNames
+
+defaultConfigFilename = "temp_to_thing_speak.conf"
+defaultPollSeconds    = 5.0
+
+# Bumped whenever the compiled form changes, so stale caches are ignored
+cacheVersion = 1
+
+channelFields = range(1, 9)
+
+class ConfigError(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+HostConfig = collections.namedtuple("HostConfig",
+  ["hostKey", "channelId", "writeKey", "updateFrequency", "channelKeys",
+   "batchSize", "batchMaxAge", "spoolCapacity", "connectTimeout",
+   "readTimeout", "sensors", "data"])
+
+def freeze(value):
+  # Read-only copy of a literal_eval result: dicts become mapping proxies
+  # and lists become tuples
+  if isinstance(value, dict):
+    return MappingProxyType(dict((key, freeze(item))
+                                 for (key, item) in value.items()))
+  if isinstance(value, (list, tuple)):
+    return tuple(freeze(item) for item in value)
+  return value
+
+def requireNumber(block, hostKey, key, default=None, minimum=0):
+  value = block.get(key, default)
+  if (isinstance(value, bool) or not isinstance(value, (int, float))
+      or value <= minimum):
+    raise ConfigError("'%s' of host '%s' must be a number above %s, not %r"
+                      % (key, hostKey, minimum, value))
+  return value
+
+def checkFields(fields, channelKeys, hostKey, what):
+  for field in fields:
+    if field not in channelKeys:
+      raise ConfigError("%s of host '%s' uses field %r, which is not in "
+                        "its channel_keys %s"
+                        % (what, hostKey, field, list(channelKeys)))
+
+def checkAlerts(alerts, hostKey, sensorQuantities, aggregated):
+  # sensorQuantities is {sensorName:[quantity,...]} of the host's sensors
+  if not isinstance(alerts, dict):
+    raise ConfigError("alerts of host '%s' must be a dictionary, not %r"
+                      % (hostKey, alerts))
+  rules = alerts.get("rules", [])
+  if not isinstance(rules, (list, tuple)):
+    raise ConfigError("'rules' of the alerts of host '%s' must be a list, "
+                      "not %r" % (hostKey, rules))
+  for key in ("repeat", "coalesce", "max_per_hour"):
+    value = alerts.get(key, 0)
+    if (isinstance(value, bool) or not isinstance(value, (int, float))
+        or value < 0):
+      raise ConfigError("'%s' of the alerts of host '%s' must be a number "
+                        "of 0 or more, not %r" % (key, hostKey, value))
+  smtp = alerts.get("smtp", {})
+  if not isinstance(smtp, dict):
+    raise ConfigError("'smtp' of the alerts of host '%s' must be a "
+                      "dictionary, not %r" % (hostKey, smtp))
+  for key in ("to", "credentials_file"):
+    if key in smtp and not (isinstance(smtp[key], str) and smtp[key]):
+      raise ConfigError("'%s' of the alerts smtp config of host '%s' must "
+                        "be a string, not %r" % (key, hostKey, smtp[key]))
+  for rule in rules:
+    if not isinstance(rule, dict):
+      raise ConfigError("Alert rule %r of host '%s' must be a dictionary"
+                        % (rule, hostKey))
+    if not isinstance(rule.get("name"), str):
+      raise ConfigError("Alert rule %r of host '%s' needs a 'name'"
+                        % (rule, hostKey))
+    if rule.get("sensor") not in sensorQuantities:
+      raise ConfigError("Alert rule '%s' of host '%s' watches unknown "
+                        "sensor '%s'"
+                        % (rule["name"], hostKey, rule.get("sensor")))
+    quantity = rule.get("quantity", "temp_f")
+    if not isQuantity(quantity, aggregated,
+                      sensorQuantities[rule["sensor"]]):
+      raise ConfigError("Alert rule '%s' of host '%s' watches quantity %r, "
+                        "which sensor '%s' does not have. Known are %s"
+                        % (rule["name"], hostKey, quantity, rule["sensor"],
+                           sensorQuantities[rule["sensor"]]))
+    if ("above" in rule) == ("below" in rule):
+      raise ConfigError("Alert rule '%s' of host '%s' needs exactly one of "
+                        "'above' and 'below'" % (rule["name"], hostKey))
+    for key in ("above", "below", "hysteresis", "min_duration", "repeat"):
+      value = rule.get(key, 0)
+      if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ConfigError("'%s' of alert rule '%s' of host '%s' must be a "
+                          "number, not %r" % (key, rule["name"], hostKey,
+                                              value))
+
+def compileHost(hostKey, block):
+  # Returns the validated host block as plain data, ready to be cached
+  if not isinstance(block, dict):
+    raise ConfigError("Host block '%s' must be a dictionary" % hostKey)
+  block = dict(block)
+
+  for key in ("channel_id", "write_key", "update_frequency", "channel_keys"):
+    if key not in block:
+      raise ConfigError("Host block '%s' has no '%s'" % (hostKey, key))
+  requireNumber(block, hostKey, "update_frequency")
+  aggregated = "sample_interval" in block
+  if aggregated and (requireNumber(block, hostKey, "sample_interval")
+                     > block["update_frequency"]):
+    raise ConfigError("sample_interval of host '%s' must not be longer than "
+                      "its update_frequency" % hostKey)
+  for (key, default) in (("batch_size", defaultBatchSize),
+                         ("batch_max_age", defaultBatchMaxAgeSeconds),
+                         ("spool_capacity", defaultCapacity),
+                         ("connect_timeout", defaultConnectTimeoutSeconds),
+                         ("read_timeout", defaultReadTimeoutSeconds)):
+    block[key] = requireNumber(block, hostKey, key, default)
+
+  channelKeys = block["channel_keys"]
+  if (not channelKeys
+      or any(field not in channelFields for field in channelKeys)):
+    raise ConfigError("channel_keys of host '%s' must list fields 1-8, "
+                      "not %r" % (hostKey, channelKeys))
+
+  # Without a "sensors" list the host gets the original single DHT22 on
+  # GPIO 4, feeding whichever of fields 1-4 the channel has.
+  if not block.get("sensors"):
+    defaultFields = {1:"temp_f", 2:"humidity", 3:"temp_f", 4:"humidity"}
+    block["sensors"] = [{"name":"dht22", "type":"DHT22", "pin":4,
+                         "fields":dict((field, quantity)
+                                       for (field, quantity)
+                                       in defaultFields.items()
+                                       if field in channelKeys)}]
+
+  sensorQuantities = {}
+  for sensorConfig in block["sensors"]:
+    if not isinstance(sensorConfig, dict):
+      raise ConfigError("Each entry of 'sensors' of host '%s' must be a "
+                        "dictionary, not %r" % (hostKey, sensorConfig))
+    name = sensorConfig.get("name", "sensor")
+    if name in sensorQuantities:
+      raise ConfigError("Sensor name '%s' is used twice in host '%s'"
+                        % (name, hostKey))
+    fields = sensorConfig.get("fields")
+    if not fields:
+      raise ConfigError("Sensor '%s' of host '%s' has no fields"
+                        % (name, hostKey))
+    checkFields(fields, channelKeys, hostKey, "Sensor '%s'" % name)
+    derived = sensorConfig.get("derived", {})
+    if not isinstance(derived, dict) or any(
+        metricName not in metricTypes or not isinstance(options, dict)
+        for (metricName, options) in derived.items()):
+      raise ConfigError("'derived' of sensor '%s' of host '%s' must map "
+                        "metrics to their options, e.g. {\"dew_point\":{}}. "
+                        "Known metrics are %s"
+                        % (name, hostKey, sorted(metricTypes)))
+    quantities = quantityNames + derivedQuantityNames(derived)
+    for quantity in fields.values():
+      if not isQuantity(quantity, aggregated, quantities):
+        known = "%s" % (quantities,)
+        if aggregated:
+          known += ", optionally followed by one of .%s" % ", .".join(statNames)
+        raise ConfigError("Sensor '%s' of host '%s' publishes unknown "
+                          "quantity '%s'. Known are %s"
+                          % (name, hostKey, quantity, known))
+    sensorQuantities[name] = quantities
+
+  fields = [field for sensorConfig in block["sensors"]
+            for field in sensorConfig["fields"]]
+  if len(set(fields)) != len(fields):
+    raise ConfigError("Each field of host '%s' can only be fed by one "
+                      "sensor, found %s" % (hostKey, fields))
+
+  gatewayUrl = block.get("gateway_url")
+  if gatewayUrl is not None and not (isinstance(gatewayUrl, str)
+                                     and gatewayUrl.startswith("http")):
+    raise ConfigError("gateway_url of host '%s' must be an http URL, not %r"
+                      % (hostKey, gatewayUrl))
+
+  if block.get("publish_mode", "every") not in ("every", "deadband"):
+    raise ConfigError("Unknown publish_mode '%s' in host '%s', expected "
+                      "'every' or 'deadband'"
+                      % (block["publish_mode"], hostKey))
+  for key in ("deadband", "thresholds"):
+    checkFields(block.get(key, {}), channelKeys, hostKey, "'%s'" % key)
+  if not isinstance(block.get("power_save", False), bool):
+    raise ConfigError("power_save of host '%s' must be True or False, not %r"
+                      % (hostKey, block["power_save"]))
+
+  checkAlerts(block.get("alerts", {}), hostKey, sensorQuantities, aggregated)
+
+  sinkNames = set()
+  for sinkConfig in block.get("sinks", []):
+    if not isinstance(sinkConfig, dict):
+      raise ConfigError("Each entry of 'sinks' of host '%s' must be a "
+                        "dictionary, not %r" % (hostKey, sinkConfig))
+    if sinkConfig.get("type") not in sinkTypes:
+      raise ConfigError("Sink of host '%s' has unknown type %r. Known are %s"
+                        % (hostKey, sinkConfig.get("type"), sinkTypes))
+    name = sinkConfig.get("name", sinkConfig["type"])
+    if name in sinkNames or name in ("thingspeak", "store"):
+      raise ConfigError("Sink name '%s' is used twice in host '%s'"
+                        % (name, hostKey))
+    sinkNames.add(name)
+    if sinkConfig.get("backpressure",
+                      "drop-oldest") not in backpressurePolicies:
+      raise ConfigError("Sink '%s' of host '%s' has unknown backpressure "
+                        "policy '%s'. Known are %s"
+                        % (name, hostKey, sinkConfig["backpressure"],
+                           backpressurePolicies))
+    for key in ("queue_size", "max_batch"):
+      value = sinkConfig.get(key, 1)
+      if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ConfigError("'%s' of sink '%s' of host '%s' must be a whole "
+                          "number above 0, not %r"
+                          % (key, name, hostKey, value))
+
+  return block
+
+def compileConfig(configDataDict):
+  # Validates every host block of the file and returns
+  # {"hostnameToKeyMap":{...}, "hosts":{hostKey:block}}
+  if not isinstance(configDataDict, dict):
+    raise ConfigError("The config file must hold a dictionary")
+  hostnameToKeyMap = configDataDict.get("hostnameToKeyMap", {})
+  hosts = {}
+  for (hostKey, block) in configDataDict.items():
+    if hostKey != "hostnameToKeyMap":
+      hosts[hostKey] = compileHost(hostKey, block)
+  for (hostname, hostKey) in hostnameToKeyMap.items():
+    if hostKey not in hosts:
+      raise ConfigError("hostnameToKeyMap maps '%s' to missing host block "
+                        "'%s'" % (hostname, hostKey))
+  return {"hostnameToKeyMap":hostnameToKeyMap, "hosts":hosts}
+
+def getChannelKeys(compiled):
+  # Returns {channelId:writeKey} of the host blocks of a compiled config, for
+  # the gateway.  Blocks sharing a channel must share its write key.
+  channelKeys = {}
+  for (hostKey, block) in sorted(compiled["hosts"].items()):
+    channelId = str(block["channel_id"])
+    writeKey  = str(block["write_key"])
+    if channelKeys.setdefault(channelId, writeKey) != writeKey:
+      raise ConfigError("Host block '%s' has another write_key for channel "
+                        "%s than the other blocks of that channel"
+                        % (hostKey, channelId))
+  return channelKeys
+
+def makeCacheFileName(configFilename):
+  return configFilename + ".cache"
+
+def getFileStamp(fileName):
+  fileStat = os.stat(fileName)
+  return (fileStat.st_mtime_ns, fileStat.st_size)
+
+def readCache(configFilename, fileStamp):
+  try:
+    with open(makeCacheFileName(configFilename), "rb") as cacheStream:
+      cached = marshal.load(cacheStream)
+  except (OSError, EOFError, ValueError, TypeError):
+    return None
+  if (not isinstance(cached, dict)
+      or cached.get("version") != cacheVersion
+      or tuple(cached.get("stamp", ())) != fileStamp):
+    return None
+  return cached["compiled"]
+
+def writeCache(configFilename, fileStamp, compiled):
+  # The cache is only an optimization, so a read-only config directory
+  # just means parsing on every start.
+  cacheFileName = makeCacheFileName(configFilename)
+  tempFileName  = cacheFileName + ".tmp"
+  try:
+    with open(tempFileName, "wb") as cacheStream:
+      marshal.dump({"version":cacheVersion, "stamp":fileStamp,
+                    "compiled":compiled}, cacheStream)
+    os.replace(tempFileName, cacheFileName)
+  except (OSError, ValueError):
+    pass
+
+def loadConfig(configFilename, useCache=True):
+  # Returns the compiled config of the whole file
+  fileStamp = getFileStamp(configFilename)
+  if useCache:
+    compiled = readCache(configFilename, fileStamp)
+    if compiled is not None:
+      return compiled
+
+  # Only needed when the cache is stale
+  import ast
+  with open(configFilename, 'r') as configStream:
+    configData = configStream.read()
+  try:
+    configDataDict = ast.literal_eval(configData)
+  except (SyntaxError, ValueError) as e:
+    raise ConfigError("Could not parse '%s': %s" % (configFilename, e))
+
+  compiled = compileConfig(configDataDict)
+  if useCache:
+    writeCache(configFilename, fileStamp, compiled)
+  return compiled
+
+def getHostKey(hostnameToKeyMap, hostname=None):
+  if hostname is None:
+    hostname = socket.gethostname()
+  if hostname not in hostnameToKeyMap:
+    raise ConfigError("Could not match hostname '%s' to key in config file. "
+                      "Available keys are: %s"
+                      % (hostname, list(hostnameToKeyMap)))
+  return hostnameToKeyMap[hostname]
+
+def makeHostConfig(hostKey, block):
+  data = freeze(block)
+  return HostConfig(hostKey=hostKey,
+                    channelId=block["channel_id"],
+                    writeKey=block["write_key"],
+                    updateFrequency=block["update_frequency"],
+                    channelKeys=tuple(block["channel_keys"]),
+                    batchSize=block["batch_size"],
+                    batchMaxAge=block["batch_max_age"],
+                    spoolCapacity=block["spool_capacity"],
+                    connectTimeout=block["connect_timeout"],
+                    readTimeout=block["read_timeout"],
+                    sensors=data["sensors"],
+                    data=data)
+
+def loadHostConfig(configFilename, hostKey=None, useCache=True):
+  # hostKey defaults to the one hostnameToKeyMap gives for this host's name
+  compiled = loadConfig(configFilename, useCache)
+  if hostKey is None:
+    hostKey = getHostKey(compiled["hostnameToKeyMap"])
+  if hostKey not in compiled["hosts"]:
+    raise ConfigError("Could not find key '%s' in file '%s'. Keys in file "
+                      "are '%s'"
+                      % (hostKey, configFilename, list(compiled["hosts"])))
+  return makeHostConfig(hostKey, compiled["hosts"][hostKey])
+
+class ConfigWatcher(object):
+
+  # inotify is not in the standard library, and a config file changes
+  # rarely enough that one stat() every few seconds costs nothing.
+
+  def __init__(self, configFilename, hostConfig, onChange,
+               pollSeconds=defaultPollSeconds):
+    # onChange(oldHostConfig, newHostConfig) is called on the watcher thread
+    self.configFilename = configFilename
+    self.hostConfig     = hostConfig
+    self.onChange       = onChange
+    self.pollSeconds    = pollSeconds
+    self.fileStamp      = getFileStamp(configFilename)
+    self.stopping       = threading.Event()
+    self.thread         = None
+
+  def check(self):
+    try:
+      fileStamp = getFileStamp(self.configFilename)
+    except OSError:
+      return
+    if fileStamp == self.fileStamp:
+      return
+    self.fileStamp = fileStamp
+
+    try:
+      hostConfig = loadHostConfig(self.configFilename,
+                                  self.hostConfig.hostKey)
+    except (ConfigError, OSError) as e:
+      print("Ignoring changed config file '%s':" % self.configFilename)
+      print("Error msg:",str(e))
+      return
+    if hostConfig != self.hostConfig:
+      (oldHostConfig, self.hostConfig) = (self.hostConfig, hostConfig)
+      self.onChange(oldHostConfig, hostConfig)
+
+  def run(self):
+    while not self.stopping.wait(self.pollSeconds):
+      try:
+        self.check()
+      except Exception as e:
+        print("Applying changed config file '%s' failed:"
+              % self.configFilename)
+        try:
+          print("Error msg:",str(e))
+        except:
+          print("  Sorry, could not print config error.")
+        print("Continuing...")
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run, name="configWatcher",
+                                   daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.stopping.set()
+    if self.thread:
+      self.thread.join()
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] [options]
+       where:
+         -h|--help to see options
+"""
+  parser = OptionParser(usage)
+  help ="Config file to check and compile.  "
+  help+="Default is '%s'" % defaultConfigFilename
+  parser.add_option("-c", "--configFile",
+                    action="store", type="string",
+                    default=defaultConfigFilename,
+                    dest="configFilename",
+                    help=help)
+
+  (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
+
+  if len(cmdLineArgs) != 0:
+    parser.error("All command-line arguments require a flag. "+\
+                 "Found the following without flags: %s" % cmdLineArgs)
+
+  return (cmdLineOptions, cmdLineArgs)
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+
+  start = time.perf_counter()
+  try:
+    compiled = loadConfig(clo.configFilename, useCache=False)
+  except ConfigError as e:
+    print("Config file '%s' is invalid: %s" % (clo.configFilename, e))
+    sys.exit(1)
+  writeCache(clo.configFilename, getFileStamp(clo.configFilename), compiled)
+
+  hostnames = collections.defaultdict(list)
+  for (hostname, hostKey) in compiled["hostnameToKeyMap"].items():
+    hostnames[hostKey].append(hostname)
+  for (hostKey, block) in sorted(compiled["hosts"].items()):
+    print("%-14s channel %s, fields %s, every %s secs, sensors %s, hosts %s"
+          % (hostKey, block["channel_id"], block["channel_keys"],
+             block["update_frequency"],
+             [sensorConfig.get("name") for sensorConfig in block["sensors"]],
+             hostnames.get(hostKey, [])))
+  print("Compiled %s host blocks in %.1f ms"
+        % (len(compiled["hosts"]), (time.perf_counter() - start) * 1000))
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
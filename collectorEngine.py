@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+# asyncio engine that decouples sampling from publishing.  One sampler task
+# reads the sensor on a fixed schedule and hands each reading to every output
+# through that output's own bounded queue; one publisher task per output
+# drains its queue.  A slow output therefore never shifts the sampling
+# schedule, and one process can feed several outputs at once.
+#
+# The schedule runs on the event loop's monotonic clock and is anchored to
+# wall-clock multiples of updateFrequency, so with a 300 sec frequency the
+# samples land on :00, :05, :10, ...  The blocking sensor read runs in an
+# executor thread.
+#
+# Settings can be changed while running: callSoon() runs a function on the
+# event loop thread, where setUpdateFrequency() moves the schedule over to
+# a new frequency without touching the queued readings.
+#
+# An output's queue holds at most queueSize readings and drops its oldest
+# one when full, unless the output was added as lossless: its queue then
+# has no bound, so a stalled lossless output only ever costs memory.
+#
+# Cycle hooks run on the event loop thread after every sample, once the
+# outputs have picked up its reading, so periodic chores such as writing the
+# log can share the sample's wakeup instead of keeping timers of their own.
+
+import time
+import math
+import asyncio
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+
+from collectorMetrics import registry
+
+samplesTaken = registry.counter(
+  "collector_samples_total", "Samples taken by the sampler")
+samplesMissed = registry.counter(
+  "collector_samples_missed_total",
+  "Sample periods skipped because a read overran")
+readingsDropped = registry.counter(
+  "collector_readings_dropped_total",
+  "Readings dropped because an output queue was full")
+
+defaultQueueSize = 1000
+
+def wakeUp(waiter):
+  if not waiter.done():
+    waiter.set_result(None)
+
+class CollectorEngine(object):
+
+  def __init__(self, readSensor, makeReading, updateFrequency,
+               queueSize=defaultQueueSize):
+    # readSensor()                  -> sample, blocking, run in an executor
+    # makeReading(sample, timestamp) -> reading dictionary or None
+    self.readSensor      = readSensor
+    self.makeReading     = makeReading
+    self.updateFrequency = updateFrequency
+    self.queueSize       = queueSize
+    self.outputs         = []
+    self.lossless        = []
+    self.cycleHooks      = []
+    self.queues          = []
+    self.executor        = None
+    self.loop            = None
+    self.waiter          = None
+    self.rescheduled     = False
+    self.sampleCount     = 0
+    self.missedCount     = 0
+    self.droppedCount    = 0
+    self.verbose         = False
+
+  def addOutput(self, output, lossless=False):
+    # output(reading) may be a plain function or a coroutine function
+    self.outputs.append(output)
+    self.lossless.append(lossless)
+
+  def addCycleHook(self, hook):
+    # hook() is a plain function, run after every sample
+    self.cycleHooks.append(hook)
+
+  def runCycleHooks(self):
+    for hook in self.cycleHooks:
+      try:
+        hook()
+      except Exception as e:
+        print("Cycle hook failed:")
+        try:
+          print("Error msg:",str(e))
+        except:
+          print("  Sorry, could not print cycle hook error.")
+        print("Continuing...")
+
+  def callSoon(self, function, *args):
+    # Runs function(*args) on the event loop thread; safe to call from any
+    # thread.  Before the loop is running, it runs right away.
+    if self.loop is None:
+      function(*args)
+    else:
+      self.loop.call_soon_threadsafe(function, *args)
+
+  def setUpdateFrequency(self, updateFrequency):
+    # Call on the event loop thread, e.g. through callSoon()
+    self.updateFrequency = updateFrequency
+    self.rescheduled     = True
+    if self.waiter is not None and not self.waiter.done():
+      self.waiter.set_result(None)
+
+  async def sleepUntil(self, loop, deadline):
+    # Like asyncio.sleep(), but setUpdateFrequency() can cut it short
+    self.waiter = loop.create_future()
+    handle = loop.call_at(deadline, wakeUp, self.waiter)
+    try:
+      await self.waiter
+    finally:
+      handle.cancel()
+      self.waiter = None
+
+  def firstDeadline(self, loop):
+    # Monotonic time of the next wall-clock multiple of updateFrequency
+    wallNow = time.time()
+    wallNext = math.ceil(wallNow / self.updateFrequency) * self.updateFrequency
+    return (loop.time() + (wallNext - wallNow), wallNext)
+
+  def enqueue(self, reading):
+    for readingQueue in self.queues:
+      if readingQueue.full():
+        readingQueue.get_nowait()
+        self.droppedCount += 1
+        readingsDropped.inc()
+      readingQueue.put_nowait(reading)
+
+  async def sampler(self):
+    loop = asyncio.get_running_loop()
+    (deadline, wallDeadline) = self.firstDeadline(loop)
+
+    while True:
+      await self.sleepUntil(loop, deadline)
+      if self.rescheduled:
+        self.rescheduled = False
+        (deadline, wallDeadline) = self.firstDeadline(loop)
+        continue
+
+      sample = await loop.run_in_executor(self.executor, self.readSensor)
+      self.sampleCount += 1
+      samplesTaken.inc()
+      reading = self.makeReading(sample, wallDeadline)
+      if reading is not None:
+        self.enqueue(reading)
+      if self.cycleHooks:
+        # Queued behind the publishers that enqueue() just woke, so plain
+        # function outputs have had the reading by the time the hooks run
+        loop.call_soon(self.runCycleHooks)
+
+      # Skip whole periods if the read overran, rather than bursting
+      # samples to catch up.
+      periods = 1
+      overrun = loop.time() - deadline
+      if overrun >= self.updateFrequency:
+        periods = int(overrun // self.updateFrequency) + 1
+        self.missedCount += periods - 1
+        samplesMissed.inc(periods - 1)
+      deadline     += periods * self.updateFrequency
+      wallDeadline += periods * self.updateFrequency
+
+      if self.verbose:
+        print("Next sample in %.2f seconds"
+              % max(0.0, deadline - loop.time()))
+
+  async def publisher(self, output, readingQueue):
+    while True:
+      reading = await readingQueue.get()
+      try:
+        result = output(reading)
+        if inspect.isawaitable(result):
+          await result
+      except Exception as e:
+        print("Publishing reading failed:")
+        try:
+          print("Error msg:",str(e))
+        except:
+          print("  Sorry, could not print publishing error.")
+        print("Continuing...")
+
+  def makeQueues(self):
+    # One queue per output, without a bound for lossless outputs
+    return [asyncio.Queue(0 if lossless else self.queueSize)
+            for lossless in self.lossless]
+
+  async def main(self):
+    self.loop = asyncio.get_running_loop()
+    self.executor = ThreadPoolExecutor(max_workers=1,
+                                       thread_name_prefix="sensor")
+    self.queues = self.makeQueues()
+    for (index, readingQueue) in enumerate(self.queues):
+      registry.gauge("collector_output_queue_depth",
+                     "Readings waiting for an output", {"output":index},
+                     function=readingQueue.qsize)
+    tasks = [asyncio.create_task(self.sampler())]
+    for (output, readingQueue) in zip(self.outputs, self.queues):
+      tasks.append(asyncio.create_task(self.publisher(output, readingQueue)))
+
+    try:
+      await asyncio.gather(*tasks)
+    finally:
+      for task in tasks:
+        task.cancel()
+      self.executor.shutdown(wait=False)
+      self.loop = None
+
+  def run(self):
+    asyncio.run(self.main())
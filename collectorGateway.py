@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+
+# Gateway that collects the readings of many collectors and uploads them to
+# ThingSpeak on their behalf, so hosts sharing a channel no longer race each
+# other for the channel's rate limit.
+#
+#   ./temp_to_thing_speak.py --gateway --gatewayPort 8090     # on one host
+#   "gateway_url":"http://gatewayhost:8090"                   # in the others'
+#                                                             # host blocks
+#
+# The gateway speaks ThingSpeak's own bulk-update protocol, so a collector
+# forwards to it with the client, batcher and spool it already has.  Updates
+# for one channel whose created_at falls in the same mergeSeconds slot are
+# merged into one row, e.g. the fridge's fields 1-2 and the freezer's fields
+# 3-4 sampled at :30 become one entry with fields 1-4.  A slot is closed
+# lateSeconds after it ends, and every intervalSeconds each channel's closed
+# rows go out in one bulk update through that channel's own spool and
+# uploader.  Every update is also written to the channel's inbox spool, and
+# synced, before the collector is told it was accepted, since the collector
+# then drops it from its own spool.  An inbox entry is acknowledged once the
+# row it went into is synced to the channel's spool, and on a restart the
+# unacknowledged ones are merged again, so a gateway crash loses nothing; at
+# worst a row closed just before the crash is uploaded twice.
+#
+# Fields must be numbers, or strings of numbers as ThingSpeak allows, and
+# are spooled as numbers.  The gateway only serves the channels of the host
+# blocks in its config file, with their write keys: updates for any other
+# channel or with another key are refused, so restart the gateway after
+# adding a channel or rotating a channel's key.
+
+import os
+import re
+import json
+import math
+import time
+import threading
+
+from thingSpeakClient import ThingSpeakBulkClient, parseCreatedAt,\
+  defaultBaseUrl, bulkUpdateLimit
+from readingBatcher import ReadingBatcher
+from readingSpool import ReadingSpool, defaultCapacity
+from backgroundUploader import BackgroundUploader
+from collectorMetrics import registry
+
+defaultGatewayPort      = 8090
+defaultIntervalSeconds  = 60
+defaultMergeSeconds     = 15
+defaultLateSeconds      = 15
+
+updatesReceived = registry.counter(
+  "gateway_updates_received_total", "Updates received from collectors")
+rowsPublished = registry.counter(
+  "gateway_rows_published_total",
+  "Merged rows handed to the uploader of their channel")
+fieldConflicts = registry.counter(
+  "gateway_field_conflicts_total",
+  "Fields sent by more than one update for the same channel and slot")
+
+bulkUpdatePathPattern = re.compile(r"^/channels/([^/]+)/bulk_update\.json$")
+
+fieldNames = ["field%d" % i for i in range(1, 9)]
+
+def makeGatewaySpoolFileName(logFileRoot, channelId):
+  return "%s.gateway.%s.spool" % (logFileRoot, channelId)
+
+def makeGatewayInboxFileName(logFileRoot, channelId):
+  return "%s.gateway.%s.inbox.spool" % (logFileRoot, channelId)
+
+def cleanUpdate(update):
+  # Returns the update with its fields as numbers and its status as text,
+  # or raises ValueError, KeyError or TypeError for one that cannot be
+  # spooled
+  cleaned = {"created_at":update["created_at"]}
+  parseCreatedAt(cleaned["created_at"])
+  for name in fieldNames:
+    value = update.get(name)
+    if value is None:
+      continue
+    number = float(value)
+    if not math.isfinite(number):
+      raise ValueError("%s must be a finite number, not %r" % (name, value))
+    cleaned[name] = number
+  if update.get("status") is not None:
+    cleaned["status"] = str(update["status"])
+  return cleaned
+
+class GatewayChannel(object):
+
+  def __init__(self, channelId, writeKey, baseUrl, spoolFileName,
+               inboxFileName, mergeSeconds=defaultMergeSeconds):
+    self.channelId    = channelId
+    self.mergeSeconds = mergeSeconds
+    self.rows         = {}
+    # Lowest inbox seq merged into each open row
+    self.firstSeqs    = {}
+    self.lock         = threading.Lock()
+
+    self.client  = ThingSpeakBulkClient(channelId, writeKey, baseUrl=baseUrl)
+    # Flushes are driven by the gateway's interval, not by size or age
+    self.batcher = ReadingBatcher(self.client,
+                                  maxBatchSize=bulkUpdateLimit,
+                                  maxBatchAgeSeconds=float("inf"),
+                                  maxQueueLength=defaultCapacity)
+    self.spool    = ReadingSpool(spoolFileName)
+    self.uploader = BackgroundUploader(self.batcher, self.spool)
+    backlog = self.spool.pending()
+    if backlog:
+      print("Replaying %s unsent readings for channel %s"
+            % (len(backlog), channelId))
+      for (seq, reading) in backlog:
+        self.uploader.add(reading)
+      self.uploader.flushNow()
+    self.uploader.start()
+
+    self.inbox = ReadingSpool(inboxFileName)
+    inboxBacklog = self.inbox.pending()
+    if inboxBacklog:
+      print("Merging %s received updates again for channel %s"
+            % (len(inboxBacklog), channelId))
+      with self.lock:
+        for (seq, update) in inboxBacklog:
+          self.mergeLocked(update, seq)
+
+  def accept(self, updates):
+    # Merges cleaned updates once they are durable in the inbox
+    with self.lock:
+      for update in updates:
+        update = dict(update,
+                      created_at=parseCreatedAt(update["created_at"]))
+        self.mergeLocked(update, self.inbox.append(update))
+      self.inbox.sync()
+    updatesReceived.inc(len(updates))
+
+  def merge(self, update):
+    self.accept([update])
+
+  def mergeLocked(self, update, seq):
+    createdAt = parseCreatedAt(update["created_at"])
+    slot = int(createdAt // self.mergeSeconds)
+    row = self.rows.get(slot)
+    if row is None:
+      row = self.rows[slot] = {"created_at":createdAt}
+      self.firstSeqs[slot] = seq
+    for name in fieldNames:
+      if name in update:
+        if name in row:
+          fieldConflicts.inc()
+        row[name] = update[name]
+    if update.get("status"):
+      if row.get("status"):
+        row["status"] += "; " + update["status"]
+      else:
+        row["status"] = update["status"]
+
+  def closeRows(self, now, lateSeconds=defaultLateSeconds):
+    # Hands the rows of slots that ended lateSeconds ago (all of them when
+    # now is None) to the uploader and asks it for one bulk update
+    with self.lock:
+      closed = sorted(slot for slot in self.rows
+                      if now is None
+                      or (slot + 1) * self.mergeSeconds + lateSeconds <= now)
+      rows = [self.rows.pop(slot) for slot in closed]
+      for slot in closed:
+        del self.firstSeqs[slot]
+      # Inbox entries before the first one of a still open row are all in
+      # the rows closed here or earlier
+      ackSeq = min(self.firstSeqs.values(), default=self.inbox.writeSeq) - 1
+    for row in rows:
+      row["seq"] = self.spool.append(row)
+      self.uploader.add(row)
+    if rows:
+      self.spool.sync()
+      rowsPublished.inc(len(rows))
+      self.uploader.flushNow()
+    self.inbox.acknowledge(ackSeq)
+    return len(rows)
+
+  def close(self, timeout=None):
+    self.closeRows(None)
+    self.uploader.stop(timeout)
+    self.spool.close()
+    self.inbox.close()
+    self.client.close()
+
+def makeGatewayHandler():
+  # http.server is only imported when a gateway is started
+  from http.server import BaseHTTPRequestHandler
+
+  class GatewayHandler(BaseHTTPRequestHandler):
+
+    protocol_version        = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+      length = int(self.headers.get("Content-Length", 0))
+      body = self.rfile.read(length)
+
+      match = bulkUpdatePathPattern.match(self.path)
+      if not match:
+        self.sendJson(404, {"error":"Unknown path '%s'" % self.path})
+        return
+
+      try:
+        payload = json.loads(body.decode("UTF-8"))
+        writeKey = str(payload["write_api_key"])
+        updates = [cleanUpdate(update) for update in payload["updates"]]
+      except (ValueError, KeyError, TypeError) as e:
+        self.sendJson(400, {"error":"Bad update: %s" % e})
+        return
+
+      channelId = match.group(1)
+      if channelId not in self.server.gateway.channelKeys:
+        self.sendJson(404, {"error":"Channel %s is not in the gateway's "
+                                   "config" % channelId})
+        return
+      channel = self.server.gateway.getChannel(channelId, writeKey)
+      if channel is None:
+        self.sendJson(401, {"error":"Write key does not match the one "
+                                   "configured for channel %s" % channelId})
+        return
+      channel.accept(updates)
+      self.sendJson(202, {"success":True})
+
+    def sendJson(self, status, obj):
+      body = json.dumps(obj).encode("UTF-8")
+      self.send_response(status)
+      self.send_header("Content-Type", "application/json")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      if self.server.gateway.verbose:
+        BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  return GatewayHandler
+
+class CollectorGateway(object):
+
+  def __init__(self, logFileRoot, channelKeys, baseUrl=defaultBaseUrl,
+               port=defaultGatewayPort, host="",
+               intervalSeconds=defaultIntervalSeconds,
+               mergeSeconds=defaultMergeSeconds,
+               lateSeconds=defaultLateSeconds):
+    self.logFileRoot     = logFileRoot
+    self.channelKeys     = dict(channelKeys)
+    self.baseUrl         = baseUrl
+    self.port            = port
+    self.host            = host
+    self.intervalSeconds = intervalSeconds
+    self.mergeSeconds    = mergeSeconds
+    self.lateSeconds     = lateSeconds
+    self.channels        = {}
+    self.lock            = threading.Lock()
+    self.stopping        = threading.Event()
+    self.server          = None
+    self.thread          = None
+    self.verbose         = False
+
+  def getChannel(self, channelId, writeKey):
+    # Returns None when writeKey is not the channel's configured one
+    if self.channelKeys.get(channelId) != writeKey:
+      return None
+    with self.lock:
+      channel = self.channels.get(channelId)
+      if channel is None:
+        print("Gateway now serving channel %s" % channelId)
+        channel = GatewayChannel(channelId, writeKey, self.baseUrl,
+                                 makeGatewaySpoolFileName(self.logFileRoot,
+                                                          channelId),
+                                 makeGatewayInboxFileName(self.logFileRoot,
+                                                          channelId),
+                                 mergeSeconds=self.mergeSeconds)
+        self.channels[channelId] = channel
+        registry.gauge("gateway_open_rows", "Rows still open for merging",
+                       {"channel":channelId},
+                       function=channel.rows.__len__)
+    return channel
+
+  def replayBacklogs(self):
+    # Channels left with unsent rows or unmerged updates by an earlier run
+    # are opened right away rather than when a collector next reports
+    for (channelId, writeKey) in sorted(self.channelKeys.items()):
+      if (os.path.exists(makeGatewaySpoolFileName(self.logFileRoot,
+                                                  channelId))
+          or os.path.exists(makeGatewayInboxFileName(self.logFileRoot,
+                                                     channelId))):
+        self.getChannel(channelId, writeKey)
+
+  def closeRows(self, now):
+    with self.lock:
+      channels = list(self.channels.values())
+    for channel in channels:
+      count = channel.closeRows(now, self.lateSeconds)
+      if count and self.verbose:
+        print("Channel %s: %s merged rows queued for upload"
+              % (channel.channelId, count))
+
+  def run(self):
+    while not self.stopping.wait(self.intervalSeconds):
+      try:
+        self.closeRows(time.time())
+      except Exception as e:
+        print("Gateway flush failed:")
+        try:
+          print("Error msg:",str(e))
+        except:
+          print("  Sorry, could not print gateway flush error.")
+        print("Continuing...")
+
+  def start(self):
+    self.replayBacklogs()
+    from http.server import ThreadingHTTPServer
+    self.server = ThreadingHTTPServer((self.host, self.port),
+                                      makeGatewayHandler())
+    self.server.daemon_threads = True
+    self.server.gateway = self
+    self.port = self.server.server_address[1]
+    threading.Thread(target=self.server.serve_forever, name="gatewayHttp",
+                     daemon=True).start()
+    self.thread = threading.Thread(target=self.run, name="gateway",
+                                   daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=None):
+    # Open rows are spooled rather than dropped, and replayed by the next
+    # start
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+    self.stopping.set()
+    if self.thread:
+      self.thread.join()
+    with self.lock:
+      channels = list(self.channels.values())
+    for channel in channels:
+      channel.close(timeout)
@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+
+# Daily log files for the collector, one JSON record per line:
+#
+#   <logFileRoot>.2015-08-17.log      today's file, appended to
+#   <logFileRoot>.2015-08-16.log.gz   closed days, compressed
+#
+#   {"time":1439817600.123,"event":"reading","quantities":{...}}
+#   {"time":1439817601.456,"event":"console","text":"Uploader flush failed:"}
+#
+# log() only appends the record to a list.  A writer thread turns the list
+# into one write() per file every flushSeconds, or sooner once
+# maxBufferedRecords are waiting, so the SD card sees a handful of writes a
+# minute instead of one per line.  A record goes into the file of the local
+# date of its own time, so a batch straddling midnight is split between two
+# files.  When a day's file is closed it is gzipped on a thread of its own,
+# and the oldest files are deleted once all of them together take more than
+# maxTotalBytes.  ConsoleTee copies everything printed into the log as well,
+# so the messages that used to live only in screen's scrollback survive it.
+#
+# Records still buffered when the collector dies are lost, at most the last
+# flushSeconds of them.  Without a flushSeconds (None) the writer thread only
+# writes once maxBufferedRecords are waiting, and flush() is left to the
+# caller, e.g. after every sample in power-saving mode.
+
+import os
+import re
+import sys
+import glob
+import gzip
+import json
+import time
+import shutil
+import threading
+
+from timeSeriesStore import dateStampOf, dayStartOf
+from collectorMetrics import registry
+
+defaultFlushSeconds       = 5.0
+defaultMaxBufferedRecords = 500
+defaultMaxTotalBytes      = 100 * 1024 * 1024
+
+logFileDatePattern = re.compile(r"\.(\d{4}-\d{2}-\d{2})\.log(\.gz)?$")
+
+recordsLogged = registry.counter(
+  "collector_log_records_total", "Records added to the daily log")
+bytesWritten = registry.counter(
+  "collector_log_written_bytes_total", "Bytes written to the daily log files")
+logWrites = registry.counter(
+  "collector_log_writes_total", "Batched writes to the daily log files")
+filesRemoved = registry.counter(
+  "collector_log_files_removed_total",
+  "Old log files deleted to stay within the size limit")
+
+def makeLogFileName(logFileRoot, dateStamp):
+  return "%s.%s.log" % (logFileRoot, dateStamp)
+
+def findLogFiles(logFileRoot):
+  # Returns [(dateStamp, fileName)] of all daily log files, oldest first
+  logFiles = []
+  for fileName in glob.glob(glob.escape(logFileRoot) + ".*.log*"):
+    m = logFileDatePattern.search(fileName[len(logFileRoot):])
+    if m:
+      logFiles.append((m.group(1), fileName))
+  return sorted(logFiles)
+
+def compressLogFile(fileName):
+  # The .gz only appears once it is complete, so a crash part way through
+  # leaves the original in place to be compressed again next time.  A day
+  # that was already compressed, and then appended to again after the clock
+  # was set back, gets the new lines as another gzip member after the old
+  # ones; gzip and zcat read the members as one file.
+  gzFileName  = fileName + ".gz"
+  tmpFileName = gzFileName + ".tmp"
+  mode = "wb"
+  if os.path.exists(gzFileName):
+    shutil.copyfile(gzFileName, tmpFileName)
+    mode = "ab"
+  with open(fileName, "rb") as source:
+    with gzip.open(tmpFileName, mode) as target:
+      shutil.copyfileobj(source, target, 1024 * 1024)
+  os.replace(tmpFileName, gzFileName)
+  os.remove(fileName)
+
+class CollectorLog(object):
+
+  def __init__(self, logFileRoot, flushSeconds=defaultFlushSeconds,
+               maxBufferedRecords=defaultMaxBufferedRecords,
+               maxTotalBytes=defaultMaxTotalBytes, compress=True):
+    self.logFileRoot        = logFileRoot
+    self.flushSeconds       = flushSeconds
+    self.maxBufferedRecords = maxBufferedRecords
+    self.maxTotalBytes      = maxTotalBytes
+    self.compress           = compress
+    self.records            = []
+    self.lock               = threading.Lock()
+    self.flushLock          = threading.Lock()
+    self.wakeup             = threading.Event()
+    self.stopping           = threading.Event()
+    self.thread             = None
+    self.compressors        = []
+    self.dateStamp          = None
+    self.dayStart           = None
+    self.dayEnd             = None
+    self.stream             = None
+
+  def log(self, event, timestamp=None, **fields):
+    if timestamp is None:
+      timestamp = time.time()
+    record = {"time":round(timestamp, 3), "event":event}
+    record.update(fields)
+    line = json.dumps(record, separators=(",", ":"), default=str)
+    with self.lock:
+      self.records.append((timestamp, line))
+      count = len(self.records)
+    recordsLogged.inc()
+    if count >= self.maxBufferedRecords:
+      self.wakeup.set()
+
+  def setFlushSeconds(self, flushSeconds):
+    self.flushSeconds = flushSeconds
+    self.wakeup.set()
+
+  def start(self):
+    # Days left uncompressed by an earlier run are archived now
+    today = dateStampOf(time.time())
+    for (dateStamp, fileName) in findLogFiles(self.logFileRoot):
+      if dateStamp != today and fileName.endswith(".log"):
+        self.startCompression(fileName)
+    self.removeOldFiles()
+
+    self.thread = threading.Thread(target=self.run, name="collectorLog",
+                                   daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=None):
+    self.stopping.set()
+    self.wakeup.set()
+    if self.thread:
+      self.thread.join(timeout)
+    self.flush()
+    with self.flushLock:
+      if self.stream:
+        self.stream.close()
+        self.stream = None
+    for (fileName, compressor) in self.compressors:
+      compressor.join(timeout)
+
+  def run(self):
+    while not self.stopping.is_set():
+      self.wakeup.wait(self.flushSeconds)
+      self.wakeup.clear()
+      self.flush()
+
+  def flush(self):
+    # The batch is taken under flushLock so that two flushes, e.g. the
+    # writer thread's and a power-save cycle's, write their batches in the
+    # order they took them
+    with self.flushLock:
+      with self.lock:
+        (records, self.records) = (self.records, [])
+      if not records:
+        return
+
+      lines = []
+      for (timestamp, line) in records:
+        if self.dayStart is None or not (self.dayStart <= timestamp
+                                         < self.dayEnd):
+          self.write(lines)
+          lines = []
+          self.openDay(timestamp)
+        lines.append(line)
+      self.write(lines)
+
+  def write(self, lines):
+    if not lines:
+      return
+    text = "\n".join(lines) + "\n"
+    try:
+      self.stream.write(text)
+      self.stream.flush()
+    except Exception as e:
+      print("Writing to log file '%s' failed:" % self.stream.name)
+      try:
+        print("Error msg:",str(e))
+      except:
+        print("  Sorry, could not print log write error msg.")
+      print("Continuing...")
+      return
+    logWrites.inc()
+    bytesWritten.inc(len(text))
+
+  def openDay(self, timestamp):
+    # Going back to an earlier day, when the clock is set back, appends to
+    # that day's file again rather than starting a second one
+    dateStamp = dateStampOf(timestamp)
+    self.dayStart = dayStartOf(timestamp)
+    # 25 hours on is the next day even across a DST change
+    self.dayEnd = dayStartOf(self.dayStart + 25 * 3600)
+    if dateStamp == self.dateStamp:
+      return
+
+    closedFileName = None
+    if self.stream:
+      closedFileName = self.stream.name
+      self.stream.close()
+    self.dateStamp = dateStamp
+    fileName = makeLogFileName(self.logFileRoot, dateStamp)
+    # The compressor removes the file once done, taking with it anything
+    # appended meanwhile
+    for (compressedFileName, compressor) in self.compressors:
+      if compressedFileName == fileName:
+        compressor.join()
+    self.stream = open(fileName, "a")
+    if closedFileName:
+      self.startCompression(closedFileName)
+    self.removeOldFiles()
+
+  def startCompression(self, fileName):
+    if not self.compress:
+      return
+    self.compressors = [(compressedFileName, compressor)
+                        for (compressedFileName, compressor)
+                        in self.compressors if compressor.is_alive()]
+    compressor = threading.Thread(target=self.compressFile, args=(fileName,),
+                                  name="collectorLogGzip", daemon=True)
+    self.compressors.append((fileName, compressor))
+    compressor.start()
+
+  def compressFile(self, fileName):
+    try:
+      compressLogFile(fileName)
+    except Exception as e:
+      print("Compressing log file '%s' failed:" % fileName)
+      try:
+        print("Error msg:",str(e))
+      except:
+        print("  Sorry, could not print log compression error msg.")
+      print("Continuing...")
+      return
+    self.removeOldFiles()
+
+  def removeOldFiles(self):
+    # Deletes the oldest days until all files fit in maxTotalBytes.  The file
+    # being written is never deleted, however large it grows.
+    sizes = []
+    for (dateStamp, fileName) in findLogFiles(self.logFileRoot):
+      try:
+        sizes.append((fileName, os.path.getsize(fileName)))
+      except OSError:
+        pass
+    total = sum(size for (fileName, size) in sizes)
+    current = self.stream.name if self.stream else None
+    for (fileName, size) in sizes:
+      if total <= self.maxTotalBytes:
+        break
+      if fileName == current:
+        continue
+      try:
+        os.remove(fileName)
+      except OSError:
+        continue
+      total -= size
+      filesRemoved.inc()
+      print("Removed old log file '%s' to stay within %s bytes"
+            % (fileName, self.maxTotalBytes))
+
+class ConsoleTee(object):
+  # Stands in for sys.stdout, passing output through and adding each
+  # complete line to the log as a "console" record.  Every thread prints
+  # through it, so the partial line is only touched under a lock.
+
+  def __init__(self, stream, collectorLog):
+    self.stream       = stream
+    self.collectorLog = collectorLog
+    self.partial      = ""
+    self.lock         = threading.Lock()
+
+  def write(self, text):
+    self.stream.write(text)
+    with self.lock:
+      lines = (self.partial + text).split("\n")
+      self.partial = lines.pop()
+    for line in lines:
+      self.collectorLog.log("console", text=line)
+    return len(text)
+
+  def flush(self):
+    self.stream.flush()
+
+  def __getattr__(self, name):
+    return getattr(self.stream, name)
+
+def setupCmdLineArgs(cmdLineArgs):
+  from optparse import OptionParser
+  usage = """\
+usage: %prog [-h|--help] [options] logFileRoot
+       where:
+         -h|--help to see options
+"""
+  parser = OptionParser(usage)
+  help ="Print the records of the given day, e.g. 2015-08-17, compressed "
+  help+="or not.  Default is today"
+  parser.add_option("-d", "--date",
+                    action="store", type="string",
+                    default=None,
+                    dest="dateStamp",
+                    help=help)
+  help="Only print records of this event, e.g. 'console' or 'reading'"
+  parser.add_option("-e", "--event",
+                    action="store", type="string",
+                    default=None,
+                    dest="event",
+                    help=help)
+  help="List the daily log files and their sizes instead"
+  parser.add_option("-l", "--list",
+                    action="store_true",
+                    default=False,
+                    dest="list",
+                    help=help)
+  (clo, cla) = parser.parse_args(cmdLineArgs)
+  if len(cla) != 1:
+    parser.error("Expected the log file root, e.g. "
+                 "~/.local/state/temp_to_thing_speak/temp_to_thing_speak")
+  return (clo, cla)
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+  logFileRoot = os.path.expanduser(cla[0])
+  logFiles = findLogFiles(logFileRoot)
+
+  if clo.list:
+    for (dateStamp, fileName) in logFiles:
+      print("%s  %10d  %s" % (dateStamp, os.path.getsize(fileName), fileName))
+    return
+
+  dateStamp = clo.dateStamp or dateStampOf(time.time())
+  for (fileDateStamp, fileName) in logFiles:
+    if fileDateStamp != dateStamp:
+      continue
+    opener = gzip.open if fileName.endswith(".gz") else open
+    with opener(fileName, "rt") as stream:
+      for line in stream:
+        if clo.event and json.loads(line).get("event") != clo.event:
+          continue
+        sys.stdout.write(line)
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+# Counters, gauges and histograms for the collector, exposed in the
+# Prometheus text exposition format on a local HTTP port and/or Unix socket:
+#
+#   curl http://localhost:9101/metrics
+#   curl --unix-socket /tmp/temp_to_thing_speak.metrics http://x/metrics
+#
+# Updating a metric is a couple of integer operations with no locking and no
+# I/O; all formatting happens when somebody scrapes.  Gauges whose value is
+# cheap to compute on demand, like queue depths, take a callback instead of
+# being updated on the hot path.
+#
+# Every collector module imports this one for the registry, so the HTTP
+# server modules are only imported once a MetricsServer is started.
+
+import os
+import time
+import bisect
+import threading
+
+defaultLatencyBuckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                         1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def formatLabels(labels, extra=None):
+  items = list(labels)
+  if extra:
+    items.append(extra)
+  if not items:
+    return ""
+  return "{%s}" % ",".join('%s="%s"' % (key, str(value).replace('"', '\\"'))
+                           for (key, value) in items)
+
+def formatValue(value):
+  if value == float("inf"):
+    return "+Inf"
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter(object):
+
+  metricType = "counter"
+
+  def __init__(self, labels):
+    self.labels = labels
+    self.value  = 0
+
+  def inc(self, amount=1):
+    self.value += amount
+
+  def render(self, name):
+    return ["%s%s %s" % (name, formatLabels(self.labels),
+                         formatValue(self.value))]
+
+class Gauge(object):
+
+  metricType = "gauge"
+
+  def __init__(self, labels, function=None):
+    self.labels   = labels
+    self.value    = 0
+    self.function = function
+
+  def set(self, value):
+    self.value = value
+
+  def render(self, name):
+    value = self.value
+    if self.function is not None:
+      try:
+        value = self.function()
+      except Exception:
+        return []
+    return ["%s%s %s" % (name, formatLabels(self.labels), formatValue(value))]
+
+class Histogram(object):
+
+  metricType = "histogram"
+
+  def __init__(self, labels, buckets=defaultLatencyBuckets):
+    self.labels  = labels
+    self.buckets = tuple(buckets)
+    self.counts  = [0] * (len(self.buckets) + 1)
+    self.sum     = 0.0
+    self.count   = 0
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum   += value
+    self.count += 1
+
+  def time(self):
+    return HistogramTimer(self)
+
+  def render(self, name):
+    lines = []
+    cumulative = 0
+    for (bound, count) in zip(self.buckets + (float("inf"),), self.counts):
+      cumulative += count
+      lines.append("%s_bucket%s %s" %
+                   (name, formatLabels(self.labels, ("le", formatValue(bound))),
+                    cumulative))
+    lines.append("%s_sum%s %s" % (name, formatLabels(self.labels),
+                                  formatValue(self.sum)))
+    lines.append("%s_count%s %s" % (name, formatLabels(self.labels),
+                                    self.count))
+    return lines
+
+class HistogramTimer(object):
+
+  def __init__(self, histogram):
+    self.histogram = histogram
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.histogram.observe(time.perf_counter() - self.start)
+    return False
+
+class MetricsRegistry(object):
+
+  def __init__(self):
+    self.families = {}
+    self.lock     = threading.Lock()
+
+  def getMetric(self, metricClass, name, help, labels, **kwargs):
+    labelItems = tuple(sorted((labels or {}).items()))
+    with self.lock:
+      if name not in self.families:
+        self.families[name] = (metricClass, help, {})
+      (familyClass, familyHelp, series) = self.families[name]
+      assert familyClass is metricClass,\
+        "Metric '%s' already registered as a %s" %\
+        (name, familyClass.metricType)
+      if labelItems not in series:
+        series[labelItems] = metricClass(labelItems, **kwargs)
+      return series[labelItems]
+
+  def counter(self, name, help, labels=None):
+    return self.getMetric(Counter, name, help, labels)
+
+  def gauge(self, name, help, labels=None, function=None):
+    gauge = self.getMetric(Gauge, name, help, labels)
+    if function is not None:
+      gauge.function = function
+    return gauge
+
+  def histogram(self, name, help, labels=None,
+                buckets=defaultLatencyBuckets):
+    return self.getMetric(Histogram, name, help, labels, buckets=buckets)
+
+  def render(self):
+    lines = []
+    with self.lock:
+      families = sorted(self.families.items())
+      families = [(name, metricClass, help, list(series.values()))
+                  for (name, (metricClass, help, series)) in families]
+    for (name, metricClass, help, seriesList) in families:
+      lines.append("# HELP %s %s" % (name, help))
+      lines.append("# TYPE %s %s" % (name, metricClass.metricType))
+      for metric in seriesList:
+        lines.extend(metric.render(name))
+    return "\n".join(lines) + "\n"
+
+# The registry every collector module records into
+registry = MetricsRegistry()
+
+def makeMetricsHandler():
+  from http.server import BaseHTTPRequestHandler
+
+  class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+      if self.path.split("?")[0] not in ("/metrics", "/"):
+        self.send_error(404)
+        return
+      body = self.server.registry.render().encode("UTF-8")
+      self.send_response(200)
+      self.send_header("Content-Type", "text/plain; version=0.0.4")
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+
+    def address_string(self):
+      # Unix socket clients have no (host, port) address
+      if isinstance(self.client_address, tuple):
+        return self.client_address[0]
+      return "unix"
+
+    def log_message(self, format, *args):
+      pass
+
+  return MetricsHandler
+
+class MetricsServer(object):
+
+  def __init__(self, metricsRegistry=registry, port=None, socketPath=None,
+               host="127.0.0.1"):
+    self.registry   = metricsRegistry
+    self.port       = port
+    self.socketPath = socketPath
+    self.host       = host
+    self.servers    = []
+
+  def startServer(self, server):
+    server.registry = self.registry
+    thread = threading.Thread(target=server.serve_forever, name="metrics",
+                              daemon=True)
+    thread.start()
+    self.servers.append(server)
+
+  def start(self):
+    import socketserver
+    from http.server import ThreadingHTTPServer
+    handlerClass = makeMetricsHandler()
+    if self.port is not None:
+      server = ThreadingHTTPServer((self.host, self.port), handlerClass)
+      server.daemon_threads = True
+      self.port = server.server_address[1]
+      self.startServer(server)
+    if self.socketPath:
+      if os.path.exists(self.socketPath):
+        os.unlink(self.socketPath)
+      server = socketserver.ThreadingUnixStreamServer(self.socketPath,
+                                                      handlerClass)
+      server.daemon_threads = True
+      self.startServer(server)
+    return self
+
+  def stop(self):
+    for server in self.servers:
+      server.shutdown()
+      server.server_close()
+    self.servers = []
+    if self.socketPath and os.path.exists(self.socketPath):
+      os.unlink(self.socketPath)
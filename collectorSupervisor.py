@@ -0,0 +1,499 @@
+#!/usr/bin/env python3
+
+# Runs collectors as child processes and restarts them when they exit.
+#
+#   ./collectorSupervisor.py -- ./temp_to_thing_speak.py -k frig
+#   ./collectorSupervisor.py --run "frig=./temp_to_thing_speak.py -k frig" \
+#                            --run "gateway=./temp_to_thing_speak.py --gateway"
+#
+# A child that exits is started again right away.  A child that keeps
+# exiting within stableSeconds of being started is restarted after an
+# exponentially growing delay (up to maxBackoffSeconds), so a collector
+# that cannot start does not spin.  With --stallSeconds, each child also
+# gets a --metricsSocket, and a child whose collector_samples_total has
+# not moved for that long is killed and restarted.  A --gateway child takes
+# no samples of its own, so it is only restarted when it exits.
+#
+# Between events the supervisor sleeps: it is woken by SIGCHLD, a control
+# command or a signal through a wakeup pipe, and otherwise only when the
+# next restart, kill or health check is due.
+#
+# The supervisor listens on a Unix control socket for one-line commands:
+#
+#   status | start [name] | stop [name] | restart [name]
+#
+#   ./collectorSupervisor.py --control status
+#
+# SIGTERM or SIGINT stop all children (SIGTERM, then SIGKILL after
+# terminateSeconds) and then the supervisor.
+
+import os
+import sys
+import json
+import time
+import shlex
+import signal
+import select
+import socket
+import threading
+import subprocess
+import http.client
+import socketserver
+from optparse import OptionParser
+
+execDir = os.path.dirname(os.path.realpath(__file__))
+
+defaultControlSocket     = "/tmp/collectorSupervisor.sock"
+defaultMinBackoffSeconds = 0.5
+defaultMaxBackoffSeconds = 60.0
+defaultStableSeconds     = 60.0
+defaultTerminateSeconds  = 10.0
+maxSleepSeconds          = 60.0
+pollSeconds              = 0.05
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+  def __init__(self, socketPath, timeout=5.0):
+    http.client.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+    self.socketPath = socketPath
+
+  def connect(self):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(self.timeout)
+    self.sock.connect(self.socketPath)
+
+def scrapeMetric(socketPath, metricName):
+  # Sum of all series of a metric served by collectorMetrics on a Unix
+  # socket, or None if it could not be read
+  connection = UnixHTTPConnection(socketPath)
+  try:
+    connection.request("GET", "/metrics")
+    body = connection.getresponse().read().decode("UTF-8")
+  except (OSError, http.client.HTTPException):
+    return None
+  finally:
+    connection.close()
+
+  total = None
+  for line in body.splitlines():
+    if line.startswith(metricName) and line[len(metricName):][:1] in " {":
+      total = (total or 0.0) + float(line.rsplit(" ", 1)[1])
+  return total
+
+class ChildProcess(object):
+
+  def __init__(self, name, argv, stallSeconds=None, socketDir="/tmp"):
+    self.name           = name
+    self.argv           = list(argv)
+    self.stallSeconds   = stallSeconds
+    self.metricsSocket  = None
+    if stallSeconds:
+      self.metricsSocket = os.path.join(socketDir,
+                                        "%s.supervised.metrics" % name)
+      self.argv += ["--metricsSocket", self.metricsSocket]
+
+    # "running", "waiting" (to be restarted), "stopping" or "stopped"
+    self.state          = "waiting"
+    self.process        = None
+    self.startTime      = None
+    self.nextStartTime  = 0.0
+    self.stopDeadline   = None
+    self.finalState     = None
+    self.backoffSeconds = 0.0
+    self.startCount     = 0
+    self.lastExitCode   = None
+    self.healthKills    = 0
+    self.lastProgress   = None
+    self.lastHealth     = 0.0
+
+  def start(self, now):
+    self.process      = subprocess.Popen(self.argv, cwd=execDir)
+    self.state        = "running"
+    self.startTime    = now
+    self.startCount  += 1
+    self.lastProgress = (None, now)
+    self.lastHealth   = now
+    print("%s: started %s (pid %s): %s"
+          % (time.asctime(), self.name, self.process.pid,
+             " ".join(self.argv)))
+
+  def terminate(self, now, terminateSeconds, finalState):
+    # finalState is what the child becomes once it has exited: "stopped",
+    # or "waiting" to have it started again
+    if self.process is None:
+      self.state = finalState
+      return
+    self.state        = "stopping"
+    self.finalState   = finalState
+    self.stopDeadline = now + terminateSeconds
+    try:
+      self.process.terminate()
+    except OSError:
+      pass
+
+  def describe(self, now):
+    description = {"name":self.name,
+                   "state":self.state,
+                   "pid":self.process.pid if self.process else None,
+                   "starts":self.startCount,
+                   "last_exit_code":self.lastExitCode,
+                   "health_kills":self.healthKills}
+    if self.state == "running":
+      description["uptime_seconds"] = round(now - self.startTime, 3)
+    if self.state == "waiting":
+      description["restart_in_seconds"] = round(
+        max(0.0, self.nextStartTime - now), 3)
+    return description
+
+class CollectorSupervisor(object):
+
+  def __init__(self, children, controlSocket=defaultControlSocket,
+               minBackoffSeconds=defaultMinBackoffSeconds,
+               maxBackoffSeconds=defaultMaxBackoffSeconds,
+               stableSeconds=defaultStableSeconds,
+               terminateSeconds=defaultTerminateSeconds):
+    self.children          = dict((child.name, child) for child in children)
+    self.controlSocket     = controlSocket
+    self.minBackoffSeconds = minBackoffSeconds
+    self.maxBackoffSeconds = maxBackoffSeconds
+    self.stableSeconds     = stableSeconds
+    self.terminateSeconds  = terminateSeconds
+    self.lock              = threading.Lock()
+    self.stopping          = threading.Event()
+    self.server            = None
+
+    (self.wakeupRead, self.wakeupWrite) = os.pipe()
+    os.set_blocking(self.wakeupRead, False)
+    os.set_blocking(self.wakeupWrite, False)
+
+  def reaped(self, child, now):
+    # Decides when a child that exited on its own is started again
+    child.lastExitCode = child.process.returncode
+    child.process = None
+    ranSeconds = now - child.startTime
+    if ranSeconds >= self.stableSeconds:
+      child.backoffSeconds = 0.0
+    delay = self.backOff(child, now)
+    print("%s: %s exited with code %s after %.1f secs, "
+          "restarting in %.1f secs"
+          % (time.asctime(), child.name, child.lastExitCode, ranSeconds,
+             delay))
+
+  def backOff(self, child, now):
+    # The first restart after a stable run is immediate; each further one
+    # waits twice as long as the previous one
+    delay = child.backoffSeconds
+    child.backoffSeconds = min(max(self.minBackoffSeconds,
+                                   child.backoffSeconds * 2),
+                               self.maxBackoffSeconds)
+    child.state = "waiting"
+    child.nextStartTime = now + delay
+    return delay
+
+  def nextHealthCheck(self, child):
+    return max(child.startTime + child.stallSeconds,
+               child.lastHealth + child.stallSeconds / 3.0)
+
+  def healthCheckDue(self, child, now):
+    if not child.stallSeconds or now < self.nextHealthCheck(child):
+      return False
+    child.lastHealth = now
+    return True
+
+  def checkHealth(self, child, value, now):
+    # Kills a running child whose sample counter, scraped as value, has
+    # stalled
+    (lastValue, lastTime) = child.lastProgress
+    if value is not None and value != lastValue:
+      child.lastProgress = (value, now)
+      return
+    if now - lastTime >= child.stallSeconds:
+      print("%s: %s made no progress for %.0f secs, killing it"
+            % (time.asctime(), child.name, now - lastTime))
+      child.healthKills += 1
+      child.terminate(now, self.terminateSeconds, "waiting")
+
+  def step(self, now):
+    due = []
+    with self.lock:
+      for child in self.children.values():
+        if child.process is not None and child.process.poll() is not None:
+          if child.state == "stopping":
+            child.lastExitCode = child.process.returncode
+            child.process = None
+            child.state = child.finalState
+            child.nextStartTime = now
+          else:
+            self.reaped(child, now)
+
+        if child.state == "waiting" and now >= child.nextStartTime:
+          try:
+            child.start(now)
+          except OSError as e:
+            print("Starting %s failed: %s" % (child.name, e))
+            self.backOff(child, now)
+        elif child.state == "stopping" and now >= child.stopDeadline:
+          child.process.kill()
+        elif child.state == "running" and self.healthCheckDue(child, now):
+          due.append((child, child.process, child.metricsSocket))
+
+    # A scrape can wait on a hung child for the whole socket timeout, so it
+    # runs without the lock, leaving the control socket answering meanwhile
+    scraped = [(child, process,
+                scrapeMetric(metricsSocket, "collector_samples_total"))
+               for (child, process, metricsSocket) in due]
+    with self.lock:
+      for (child, process, value) in scraped:
+        # Unless it was stopped or restarted while being scraped
+        if child.state == "running" and child.process is process:
+          self.checkHealth(child, value, now)
+
+  def secondsToNextEvent(self, now):
+    # How long run() may sleep before a restart, kill or health check is
+    # due; child exits and commands wake it up earlier
+    times = [now + maxSleepSeconds]
+    with self.lock:
+      for child in self.children.values():
+        if child.state == "waiting":
+          times.append(child.nextStartTime)
+        elif child.state == "stopping":
+          times.append(child.stopDeadline)
+        elif child.state == "running" and child.stallSeconds:
+          times.append(self.nextHealthCheck(child))
+    return max(0.0, min(times) - now)
+
+  def wakeUp(self):
+    try:
+      os.write(self.wakeupWrite, b"\0")
+    except BlockingIOError:
+      pass
+
+  def sleep(self, seconds):
+    select.select([self.wakeupRead], [], [], seconds)
+    try:
+      while os.read(self.wakeupRead, 4096):
+        pass
+    except BlockingIOError:
+      pass
+
+  def getChildren(self, name):
+    if not name:
+      return list(self.children.values())
+    if name not in self.children:
+      raise KeyError("No child named '%s', known are %s"
+                     % (name, list(self.children)))
+    return [self.children[name]]
+
+  def command(self, line):
+    # Runs one control command and returns the reply as a dictionary
+    words = line.split()
+    if not words:
+      return {"error":"Empty command"}
+    (verb, name) = (words[0], words[1] if len(words) > 1 else None)
+    now = time.monotonic()
+    with self.lock:
+      try:
+        children = self.getChildren(name)
+      except KeyError as e:
+        return {"error":str(e.args[0])}
+
+      if verb == "status":
+        pass
+      elif verb == "stop":
+        for child in children:
+          if child.state != "stopped":
+            child.terminate(now, self.terminateSeconds, "stopped")
+      elif verb == "start":
+        for child in children:
+          if child.state == "stopped":
+            child.state = "waiting"
+            child.backoffSeconds = 0.0
+            child.nextStartTime = now
+      elif verb == "restart":
+        for child in children:
+          child.backoffSeconds = 0.0
+          child.terminate(now, self.terminateSeconds, "waiting")
+      else:
+        return {"error":"Unknown command '%s', expected status, start, "
+                        "stop or restart" % verb}
+      reply = {"children":[child.describe(now) for child in children]}
+    if verb != "status":
+      self.wakeUp()
+    return reply
+
+  def startControlServer(self):
+    supervisor = self
+
+    class ControlHandler(socketserver.StreamRequestHandler):
+      def handle(self):
+        line = self.rfile.readline().decode("UTF-8", "replace")
+        reply = supervisor.command(line)
+        self.wfile.write((json.dumps(reply) + "\n").encode("UTF-8"))
+
+    if os.path.exists(self.controlSocket):
+      os.unlink(self.controlSocket)
+    self.server = socketserver.ThreadingUnixStreamServer(self.controlSocket,
+                                                         ControlHandler)
+    self.server.daemon_threads = True
+    threading.Thread(target=self.server.serve_forever, name="control",
+                     daemon=True).start()
+
+  def stopAll(self):
+    now = time.monotonic()
+    with self.lock:
+      for child in self.children.values():
+        child.terminate(now, self.terminateSeconds, "stopped")
+    # Waits on each child in turn, up to its kill deadline
+    while any(child.process is not None
+              for child in self.children.values()):
+      for child in list(self.children.values()):
+        process = child.process
+        if process is None:
+          continue
+        try:
+          process.wait(max(child.stopDeadline - time.monotonic(),
+                           pollSeconds))
+        except subprocess.TimeoutExpired:
+          pass
+        self.step(time.monotonic())
+
+  def run(self):
+    def handleSignal(signum, frame):
+      self.stopping.set()
+    def handleChildExit(signum, frame):
+      pass
+    # Every signal with a Python handler also writes to the wakeup pipe
+    signal.set_wakeup_fd(self.wakeupWrite)
+    signal.signal(signal.SIGTERM, handleSignal)
+    signal.signal(signal.SIGINT, handleSignal)
+    signal.signal(signal.SIGCHLD, handleChildExit)
+
+    self.startControlServer()
+    print("Supervising %s, control socket '%s'"
+          % (", ".join(self.children), self.controlSocket))
+    try:
+      while not self.stopping.is_set():
+        now = time.monotonic()
+        self.step(now)
+        self.sleep(self.secondsToNextEvent(now))
+    finally:
+      print("Stopping %s" % ", ".join(self.children))
+      self.stopAll()
+      self.server.shutdown()
+      self.server.server_close()
+      if os.path.exists(self.controlSocket):
+        os.unlink(self.controlSocket)
+      signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+      signal.set_wakeup_fd(-1)
+      os.close(self.wakeupRead)
+      os.close(self.wakeupWrite)
+
+def sendControlCommand(controlSocket, line):
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    client.connect(controlSocket)
+    client.sendall((line + "\n").encode("UTF-8"))
+    reply = b""
+    while not reply.endswith(b"\n"):
+      data = client.recv(65536)
+      if not data:
+        break
+      reply += data
+  finally:
+    client.close()
+  return json.loads(reply.decode("UTF-8"))
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] [options] [--] [command_to_run [arguments]]
+       %prog [-h|--help] [options] --control status|start|stop|restart [name]
+       where:
+         -h|--help to see options
+
+         command_to_run =
+          One command to supervise, named after the command's file name.
+          Use -r|--run for more than one.
+"""
+  parser = OptionParser(usage)
+  parser.disable_interspersed_args()
+  help ="Supervise a command given as 'name=command arguments'.  Can be "
+  help+="given several times"
+  parser.add_option("-r", "--run",
+                    action="append", type="string",
+                    default=[],
+                    dest="runList",
+                    help=help)
+  help="Unix control socket.  Default is '%s'" % defaultControlSocket
+  parser.add_option("-s", "--controlSocket",
+                    action="store", type="string",
+                    default=defaultControlSocket,
+                    dest="controlSocket",
+                    help=help)
+  help ="Send the command given on the command line to a running "
+  help+="supervisor and print its reply"
+  parser.add_option("--control",
+                    action="store_true",
+                    default=False,
+                    dest="control",
+                    help=help)
+  help ="Restart a child whose collector_samples_total has not increased "
+  help+="for this many seconds.  Default is to only restart children "
+  help+="that exit"
+  parser.add_option("--stallSeconds",
+                    action="store", type="float",
+                    default=None,
+                    dest="stallSeconds",
+                    help=help)
+  help ="Longest delay between restarts of a child that keeps exiting.  "
+  help+="Default is %s" % defaultMaxBackoffSeconds
+  parser.add_option("--maxBackoffSeconds",
+                    action="store", type="float",
+                    default=defaultMaxBackoffSeconds,
+                    dest="maxBackoffSeconds",
+                    help=help)
+
+  (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
+
+  if cmdLineOptions.control:
+    if not cmdLineArgs:
+      parser.error("--control needs a command, e.g. status")
+  elif not (cmdLineArgs or cmdLineOptions.runList):
+    parser.error("Give a command to supervise or at least one -r|--run")
+
+  return (cmdLineOptions, cmdLineArgs)
+
+def makeChildren(clo, cla):
+  commands = []
+  if cla:
+    commands.append((os.path.splitext(os.path.basename(cla[0]))[0], cla))
+  for run in clo.runList:
+    (name, command) = run.split("=", 1)
+    commands.append((name.strip(), shlex.split(command)))
+
+  names = [name for (name, argv) in commands]
+  assert len(set(names)) == len(names),\
+    "Supervised commands need unique names, found %s" % names
+
+  # The gateway's samples_total never moves, so it has no stall check
+  return [ChildProcess(name, argv,
+                       stallSeconds=None if "--gateway" in argv
+                                    else clo.stallSeconds)
+          for (name, argv) in commands]
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+
+  if clo.control:
+    reply = sendControlCommand(clo.controlSocket, " ".join(cla))
+    print(json.dumps(reply, indent=2))
+    if "error" in reply:
+      sys.exit(1)
+    return
+
+  supervisor = CollectorSupervisor(makeChildren(clo, cla),
+                                   controlSocket=clo.controlSocket,
+                                   maxBackoffSeconds=clo.maxBackoffSeconds)
+  supervisor.run()
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
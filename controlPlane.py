@@ -0,0 +1,323 @@
+#!/usr/bin/env python3
+
+# Local control plane of a running collector.  It takes one-line commands
+# from a Unix socket, a serial console and the collector's own stdin (e.g.
+# typed into its screen session), and answers each with one line of JSON:
+#
+#   latest            the latest reading
+#   publish           upload the readings waiting to be batched right away
+#   interval <secs>   publish every secs from the next sample on, over
+#                     update_frequency from the config file, like -f
+#   flush             write the buffered log records and sync the spool
+#   help              list the commands
+#
+#   ./temp_to_thing_speak.py --controlSocket /tmp/frig.control ...
+#   ./controlPlane.py -s /tmp/frig.control latest
+#
+# One selectors loop on a thread of its own multiplexes all sources.  It
+# waits in select() without a timeout, so it costs no wakeups until a
+# command arrives, and commands never run on the sampling path: they read
+# what the collector already keeps, or hand the work to the thread that
+# owns it (engine.callSoon(), the uploader's flushNow()) and answer without
+# waiting for it.  Socket clients and the serial console are served without
+# blocking, their replies buffered until the selector finds them writable,
+# so a slow one cannot hold up the others.  The serial console needs
+# pyserial (pip3 install pyserial), which is only imported once a serial
+# port is given.
+
+import os
+import sys
+import json
+import math
+import socket
+import threading
+from optparse import OptionParser
+
+from collectorMetrics import registry
+
+defaultSerialBaud  = 9600
+maxLineBytes       = 4096
+maxIntervalSeconds = 86400
+
+class ControlError(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+class ControlChannel(object):
+
+  # One source of commands, with its partial input line and, for socket
+  # clients and the serial console, the reply bytes not yet sent
+
+  def __init__(self, kind, stream):
+    self.kind     = kind
+    self.stream   = stream
+    self.inBytes  = b""
+    self.outBytes = b""
+
+class ControlPlane(object):
+
+  def __init__(self, commands, socketPath=None, serialDevice=None,
+               serialBaud=defaultSerialBaud, useStdin=False):
+    # commands is {name:function(args)}, returning the reply as a dictionary
+    # or raising ControlError.  They run on the control thread.
+    self.commands     = commands
+    self.socketPath   = socketPath
+    self.serialDevice = serialDevice
+    self.serialBaud   = serialBaud
+    self.useStdin     = useStdin
+    self.selectors    = None
+    self.selector     = None
+    self.listener     = None
+    self.serialPort   = None
+    self.wakeupFds    = None
+    self.stopping     = False
+    self.thread       = None
+    self.verbose      = False
+
+  def start(self):
+    import selectors
+    self.selectors = selectors
+    self.selector  = selectors.DefaultSelector()
+    self.wakeupFds = os.pipe()
+    os.set_blocking(self.wakeupFds[0], False)
+    self.selector.register(self.wakeupFds[0], selectors.EVENT_READ,
+                           ControlChannel("wakeup", None))
+
+    if self.socketPath:
+      if os.path.exists(self.socketPath):
+        os.unlink(self.socketPath)
+      self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.listener.bind(self.socketPath)
+      # Commands change how the collector runs, so only its user may send
+      # them
+      os.chmod(self.socketPath, 0o600)
+      self.listener.listen(8)
+      self.listener.setblocking(False)
+      self.selector.register(self.listener, selectors.EVENT_READ,
+                             ControlChannel("listener", self.listener))
+
+    if self.serialDevice:
+      try:
+        import serial
+      except ImportError:
+        raise ControlError("A serial control port needs pyserial: "
+                           "pip3 install pyserial")
+      # pyserial opens the port non-blocking; replies are written to its
+      # file descriptor directly, as much as it takes at a time
+      self.serialPort = serial.Serial(self.serialDevice, self.serialBaud,
+                                      timeout=0)
+      self.selector.register(self.serialPort.fileno(), selectors.EVENT_READ,
+                             ControlChannel("serial", self.serialPort))
+
+    if self.useStdin:
+      try:
+        self.selector.register(sys.stdin.fileno(), selectors.EVENT_READ,
+                               ControlChannel("stdin", sys.stdin))
+      except (OSError, ValueError):
+        # e.g. /dev/null under a supervisor, which epoll cannot watch
+        print("Not reading control commands from stdin, which is not a "
+              "terminal or pipe")
+
+    self.thread = threading.Thread(target=self.run, name="control",
+                                   daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=None):
+    self.stopping = True
+    if self.wakeupFds:
+      os.write(self.wakeupFds[1], b"\0")
+    if self.thread:
+      self.thread.join(timeout)
+
+    for key in list(self.selector.get_map().values()):
+      if key.data.kind == "client":
+        key.data.stream.close()
+    self.selector.close()
+    for fd in self.wakeupFds:
+      os.close(fd)
+    if self.listener:
+      self.listener.close()
+      if os.path.exists(self.socketPath):
+        os.unlink(self.socketPath)
+    if self.serialPort:
+      self.serialPort.close()
+
+  def run(self):
+    while not self.stopping:
+      for (key, mask) in self.selector.select():
+        channel = key.data
+        try:
+          if channel.kind == "wakeup":
+            os.read(self.wakeupFds[0], 64)
+          elif channel.kind == "listener":
+            self.accept()
+          elif mask & self.selectors.EVENT_WRITE:
+            self.send(channel)
+          else:
+            self.receive(channel)
+        except Exception as e:
+          print("Control %s failed:" % channel.kind)
+          try:
+            print("Error msg:",str(e))
+          except:
+            print("  Sorry, could not print control error.")
+          print("Continuing...")
+          self.drop(channel)
+
+  def accept(self):
+    try:
+      (connection, address) = self.listener.accept()
+    except BlockingIOError:
+      return
+    connection.setblocking(False)
+    self.selector.register(connection, self.selectors.EVENT_READ,
+                           ControlChannel("client", connection))
+
+  def drop(self, channel):
+    # Stops listening to a channel that failed or reached end of input
+    if channel.kind in ("wakeup", "listener"):
+      return
+    try:
+      self.selector.unregister(self.fileOf(channel))
+    except (KeyError, ValueError):
+      pass
+    if channel.kind == "client":
+      channel.stream.close()
+
+  def fileOf(self, channel):
+    if channel.kind == "client":
+      return channel.stream
+    return channel.stream.fileno()
+
+  def receive(self, channel):
+    if channel.kind == "client":
+      try:
+        data = channel.stream.recv(maxLineBytes)
+      except BlockingIOError:
+        return
+      except ConnectionResetError:
+        data = b""
+    elif channel.kind == "serial":
+      data = channel.stream.read(channel.stream.in_waiting or 1)
+    else:
+      data = os.read(channel.stream.fileno(), maxLineBytes)
+    if not data and channel.kind != "serial":
+      self.drop(channel)
+      return
+
+    channel.inBytes += data
+    while b"\n" in channel.inBytes:
+      (line, channel.inBytes) = channel.inBytes.split(b"\n", 1)
+      line = line.decode("UTF-8", "replace").strip()
+      if line:
+        self.reply(channel, self.command(line))
+    if len(channel.inBytes) > maxLineBytes:
+      channel.inBytes = b""
+      self.reply(channel, {"error":"Command longer than %s bytes"
+                                   % maxLineBytes})
+
+  def reply(self, channel, reply):
+    text = json.dumps(reply, separators=(",", ":"), default=str) + "\n"
+    if channel.kind == "stdin":
+      print(text, end="")
+    else:
+      channel.outBytes += text.encode("UTF-8")
+      self.send(channel)
+
+  def send(self, channel):
+    if channel.stream.fileno() < 0:
+      # Dropped while answering an earlier line of the same read
+      return
+    try:
+      if channel.kind == "client":
+        sent = channel.stream.send(channel.outBytes)
+      else:
+        sent = os.write(channel.stream.fileno(), channel.outBytes)
+    except BlockingIOError:
+      sent = 0
+    except (BrokenPipeError, ConnectionResetError):
+      # The client went away without waiting for its reply
+      self.drop(channel)
+      return
+    channel.outBytes = channel.outBytes[sent:]
+    # Only ask for writability while there is something left to send
+    events = self.selectors.EVENT_READ
+    if channel.outBytes:
+      events |= self.selectors.EVENT_WRITE
+    self.selector.modify(self.fileOf(channel), events, channel)
+
+  def command(self, line):
+    # Runs one command and returns the reply as a dictionary
+    words = line.split()
+    (name, args) = (words[0].lower(), words[1:])
+    if name == "help":
+      return {"commands":sorted(self.commands) + ["help"]}
+    if name not in self.commands:
+      return {"error":"Unknown command '%s', expected %s or help"
+                      % (name, ", ".join(sorted(self.commands)))}
+    registry.counter("collector_control_commands_total",
+                     "Commands run through the control plane",
+                     {"command":name}).inc()
+    if self.verbose:
+      print("Control command: %s" % line)
+    try:
+      return self.commands[name](args)
+    except ControlError as e:
+      return {"error":e.value}
+
+def parseIntervalArgs(args):
+  # The secs of an "interval <secs>" command
+  try:
+    seconds = float(args[0])
+  except (IndexError, ValueError):
+    raise ControlError("interval needs the secs between readings, "
+                       "e.g. 'interval 60'")
+  if not (math.isfinite(seconds) and 0 < seconds <= maxIntervalSeconds):
+    raise ControlError("interval must be above 0 and at most %s secs"
+                       % maxIntervalSeconds)
+  return seconds
+
+def makeControlSocketName(logFileRoot):
+  return logFileRoot + ".control"
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] -s|--controlSocket socket command [arguments]
+       where:
+         -h|--help to see options
+
+         command =
+          latest, publish, interval <secs>, flush or help
+"""
+  parser = OptionParser(usage)
+  parser.disable_interspersed_args()
+  help ="Control socket of the collector, as given to its --controlSocket"
+  parser.add_option("-s", "--controlSocket",
+                    action="store", type="string",
+                    default=None,
+                    dest="controlSocket",
+                    help=help)
+
+  (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
+
+  if not cmdLineOptions.controlSocket:
+    parser.error("Give the collector's control socket with -s")
+  if not cmdLineArgs:
+    parser.error("Give a command, e.g. latest")
+
+  return (cmdLineOptions, cmdLineArgs)
+
+def main(cmdLineArgs):
+  from collectorSupervisor import sendControlCommand
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+
+  reply = sendControlCommand(clo.controlSocket, " ".join(cla))
+  print(json.dumps(reply, indent=2))
+  if "error" in reply:
+    sys.exit(1)
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
@@ -0,0 +1,510 @@
+#!/usr/bin/env python3
+
+# Read-only web dashboard of the local history kept by timeSeriesStore.py.
+# Needs nothing but this package: the page draws its charts itself on a
+# canvas, so it works on a Pi without internet access.
+#
+#   ./dashboardServer.py -p 8081              # then browse to the Pi:8081
+#   ./temp_to_thing_speak.py --dashboardPort 8081
+#
+#   GET /                          the page
+#   GET /api/columns               {"columns":["frig.temp_c", ...]}
+#   GET /api/history?start=1439769600&end=1439856000&width=800
+#                                  &columns=frig.temp_c,frig.humidity
+#
+# A history query reads the coarsest of the store's raw, 1-minute and
+# 1-hour series that still gives pointsPerPixel points per pixel of width,
+# so a year is 8760 hourly rollups rather than millions of samples.  It is
+# then thinned to width points with Largest-Triangle-Three-Buckets, which
+# keeps the shape of the curve, plus the min and max of each bucket so a
+# short spike is still drawn as a band.  The browser only ever gets about
+# width points per column.
+#
+# start and end are rounded down to whole pixels, so a page reloading the
+# same view asks for the same range, and the encoded responses are kept in
+# an LRU cache.  A range that ends more than a pixel ago never changes and
+# stays cached until evicted; one reaching up to now is kept for a pixel's
+# worth of seconds.  Queries are run one at a time, which with the cache
+# keeps the dashboard's share of the Pi's CPU small next to the collector.
+# The range read is clamped to the days that have segments, from the oldest
+# one to tomorrow, so a request for years past or to come costs no more
+# than one for the history there is.
+
+import os
+import sys
+import glob
+import json
+import math
+import time
+import threading
+import collections
+from optparse import OptionParser
+
+from timeSeriesStore import TimeSeriesStore, makeSegmentFileName,\
+  dateStampOf
+from collectorMetrics import registry
+
+defaultLogFileRoot   = os.path.expanduser(
+  "~/.local/state/temp_to_thing_speak/temp_to_thing_speak")
+defaultDashboardPort = 8081
+defaultWidth         = 800
+maxWidth             = 4000
+defaultRangeSeconds  = 86400
+pointsPerPixel       = 10
+defaultCacheEntries  = 128
+defaultCacheBytes    = 8 * 1024 * 1024
+minCacheSeconds      = 10
+
+dashboardRequests = registry.counter(
+  "dashboard_requests_total", "Requests served by the dashboard")
+cacheHits = registry.counter(
+  "dashboard_cache_hits_total", "History queries answered from the cache")
+queryTime = registry.histogram(
+  "dashboard_query_seconds", "Seconds to read and downsample a history query")
+
+def lttbBuckets(count, threshold):
+  # The first and last points are buckets of their own; the rest are split
+  # into threshold - 2 buckets of (nearly) equal size.  Returns
+  # [(first, end)] index ranges.
+  every = (count - 2) / (threshold - 2)
+  return [(int(i * every) + 1, int((i + 1) * every) + 1)
+          for i in range(threshold - 2)]
+
+def lttb(xs, ys, buckets):
+  # Largest-Triangle-Three-Buckets: from each bucket keeps the point making
+  # the largest triangle with the point kept from the previous bucket and
+  # the average of the next one.  Returns the indices of the kept points.
+  count    = len(xs)
+  indices  = [0]
+  previous = 0
+  for (bucket, (first, end)) in enumerate(buckets):
+    if bucket + 1 < len(buckets):
+      (nextFirst, nextEnd) = buckets[bucket + 1]
+    else:
+      (nextFirst, nextEnd) = (count - 1, count)
+    averageX = sum(xs[nextFirst:nextEnd]) / (nextEnd - nextFirst)
+    averageY = sum(ys[nextFirst:nextEnd]) / (nextEnd - nextFirst)
+
+    (ax, ay) = (xs[previous], ys[previous])
+    dx = ax - averageX
+    dy = averageY - ay
+    bestArea  = -1.0
+    bestIndex = first
+    for index in range(first, end):
+      area = abs(dx * (ys[index] - ay) - (ax - xs[index]) * dy)
+      if area > bestArea:
+        bestArea  = area
+        bestIndex = index
+    indices.append(bestIndex)
+    previous = bestIndex
+  indices.append(count - 1)
+  return indices
+
+def downsample(times, values, mins, maxs, width):
+  # Returns {"time":[...], "value":[...], "min":[...], "max":[...]} with at
+  # most width points, leaving out missing values
+  points = [point for point in zip(times, values, mins, maxs)
+            if point[1] is not None]
+  if len(points) > width >= 3:
+    (xs, ys, lows, highs) = zip(*points)
+    buckets = [(0, 1)] + lttbBuckets(len(points), width)\
+              + [(len(points) - 1, len(points))]
+    indices = lttb(xs, ys, buckets[1:-1])
+    points = [(xs[index], ys[index], min(lows[first:end]),
+               max(highs[first:end]))
+              for (index, (first, end)) in zip(indices, buckets)]
+
+  series = {"time":[], "value":[], "min":[], "max":[]}
+  for (timestamp, value, low, high) in points:
+    series["time"].append(round(timestamp, 3))
+    series["value"].append(round(value, 2))
+    series["min"].append(round(low, 2))
+    series["max"].append(round(high, 2))
+  return series
+
+class ResponseCache(object):
+
+  # LRU cache of encoded responses, bounded by entries and total bytes
+
+  def __init__(self, maxEntries=defaultCacheEntries,
+               maxBytes=defaultCacheBytes):
+    self.maxEntries = maxEntries
+    self.maxBytes   = maxBytes
+    self.entries    = collections.OrderedDict()
+    self.size       = 0
+    self.lock       = threading.Lock()
+
+  def get(self, key, now):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      (body, expires) = entry
+      if expires is not None and now >= expires:
+        self.remove(key)
+        return None
+      self.entries.move_to_end(key)
+      return body
+
+  def put(self, key, body, expires=None):
+    with self.lock:
+      if key in self.entries:
+        self.remove(key)
+      if len(body) > self.maxBytes:
+        return
+      self.entries[key] = (body, expires)
+      self.size += len(body)
+      while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+        self.remove(next(iter(self.entries)))
+
+  def remove(self, key):
+    (body, expires) = self.entries.pop(key)
+    self.size -= len(body)
+
+  def __len__(self):
+    return len(self.entries)
+
+class HistoryQuery(object):
+
+  # Answers history queries from the store files, with a response cache
+
+  def __init__(self, logFileRoot, cache=None):
+    self.logFileRoot = logFileRoot
+    # Enough open maps for a year of one resolution
+    self.store       = TimeSeriesStore(logFileRoot, [], maxReaders=400)
+    self.cache       = cache if cache is not None else ResponseCache()
+    self.lock        = threading.Lock()
+    self.firstDay    = None
+
+  def firstDayStart(self):
+    # Start of the oldest day with a raw segment, or None before the first
+    # reading.  Segments are never deleted, so once found it is kept.
+    if self.firstDay is None:
+      pattern = glob.escape(self.logFileRoot) + ".*.raw.tsd"
+      dateStamps = sorted(fileName[len(self.logFileRoot) + 1:-len(".raw.tsd")]
+                          for fileName in glob.glob(pattern))
+      for dateStamp in dateStamps:
+        try:
+          self.firstDay = time.mktime(time.strptime(dateStamp, "%Y-%m-%d"))
+          break
+        except ValueError:
+          continue
+    return self.firstDay
+
+  def clampRange(self, start, end, now):
+    # The part of [start, end) that can have data
+    firstDay = self.firstDayStart()
+    if firstDay is None:
+      return (end, end)
+    end = min(end, now + 86400)
+    return (min(max(start, firstDay), end), end)
+
+  def columns(self):
+    # Columns of the newest raw segment of the last year, or [] before the
+    # first reading
+    now = time.time()
+    for daysAgo in range(0, 366):
+      dateStamp = dateStampOf(now - daysAgo * 86400)
+      if os.path.exists(makeSegmentFileName(self.logFileRoot, dateStamp,
+                                            "raw")):
+        with self.lock:
+          return self.store.getSegment(dateStamp, "raw").columns
+    return []
+
+  def history(self, start, end, width, columns):
+    # Returns the encoded JSON response
+    now   = time.time()
+    width = max(3, min(maxWidth, int(width)))
+    step  = max(1, int((end - start) / width))
+    start = int(start) // step * step
+    end   = int(end) // step * step
+    key   = (start, end, width, tuple(columns))
+
+    body = self.cache.get(key, now)
+    if body is not None:
+      cacheHits.inc()
+      return body
+
+    with queryTime.time():
+      with self.lock:
+        resolution = self.store.chooseResolution(start, end,
+                                                 width * pointsPerPixel)
+        (first, last) = self.clampRange(start, end, now)
+        data = self.store.query(first, last, columns, resolution)
+      series = {}
+      for column in columns:
+        if resolution == "raw":
+          values = data[column]
+          series[column] = downsample(data["time"], values, values, values,
+                                      width)
+        else:
+          stats = data[column]
+          series[column] = downsample(data["time"], stats["mean"],
+                                      stats["min"], stats["max"], width)
+      body = json.dumps({"start":start, "end":end, "resolution":resolution,
+                         "series":series},
+                        separators=(",", ":")).encode("UTF-8")
+
+    expires = None
+    if end > now - step:
+      expires = now + max(step, minCacheSeconds)
+    self.cache.put(key, body, expires)
+    return body
+
+  def close(self):
+    with self.lock:
+      self.store.close()
+
+dashboardPage = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Collector history</title>
+<style>
+body { font-family: sans-serif; margin: 1em; color: #222; }
+button { margin-right: 0.3em; }
+button.on { font-weight: bold; }
+.chart { margin-top: 1em; }
+.chart h3 { margin: 0; font-size: 1em; }
+canvas { width: 100%; height: 220px; border: 1px solid #ccc; }
+#status { color: #666; margin-left: 1em; }
+</style></head>
+<body>
+<div id="ranges"></div><span id="status"></span>
+<div id="charts"></div>
+<script>
+var ranges = [["6 hours", 6*3600], ["Day", 86400], ["Week", 7*86400],
+              ["Month", 31*86400], ["Year", 366*86400]];
+var rangeSeconds = 86400;
+
+function get(url, done) {
+  var request = new XMLHttpRequest();
+  request.onload = function() {
+    if (request.status == 200) done(JSON.parse(request.responseText));
+    else status("Request failed: " + request.status);
+  };
+  request.onerror = function() { status("Collector not reachable"); };
+  request.open("GET", url);
+  request.send();
+}
+
+function status(text) { document.getElementById("status").textContent = text; }
+
+function draw(canvas, series, start, end) {
+  var ratio = window.devicePixelRatio || 1;
+  var width = canvas.clientWidth, height = canvas.clientHeight;
+  canvas.width = width * ratio; canvas.height = height * ratio;
+  var g = canvas.getContext("2d");
+  g.scale(ratio, ratio);
+  g.font = "11px sans-serif";
+  if (!series.time.length) { g.fillText("No data", 10, 20); return; }
+  var low = Math.min.apply(null, series.min);
+  var high = Math.max.apply(null, series.max);
+  if (high == low) { high += 1; low -= 1; }
+  var left = 40, bottom = height - 16;
+  function x(t) { return left + (t - start) / (end - start) * (width - left); }
+  function y(v) { return 4 + (high - v) / (high - low) * (bottom - 8); }
+
+  g.fillStyle = "#666";
+  for (var i = 0; i <= 4; i++) {
+    var v = low + (high - low) * i / 4;
+    g.fillText(v.toFixed(1), 2, y(v) + 4);
+  }
+  for (var i = 0; i <= 4; i++) {
+    var t = start + (end - start) * i / 4;
+    var label = new Date(t * 1000);
+    label = end - start > 2*86400 ? label.toLocaleDateString()
+                                  : label.toLocaleTimeString();
+    g.fillText(label, Math.min(x(t), width - 70), height - 3);
+  }
+
+  g.fillStyle = "rgba(70,130,180,0.25)";
+  g.beginPath();
+  for (var i = 0; i < series.time.length; i++)
+    g.lineTo(x(series.time[i]), y(series.max[i]));
+  for (var i = series.time.length - 1; i >= 0; i--)
+    g.lineTo(x(series.time[i]), y(series.min[i]));
+  g.fill();
+
+  g.strokeStyle = "steelblue";
+  g.beginPath();
+  for (var i = 0; i < series.time.length; i++)
+    g.lineTo(x(series.time[i]), y(series.value[i]));
+  g.stroke();
+}
+
+function load() {
+  var end = Date.now() / 1000, start = end - rangeSeconds;
+  get("api/columns", function(info) {
+    var charts = document.getElementById("charts");
+    if (!info.columns.length) { status("No history yet"); return; }
+    var width = Math.round(charts.clientWidth || 800);
+    var url = "api/history?start=" + start + "&end=" + end + "&width=" +
+              width + "&columns=" + info.columns.join(",");
+    var began = Date.now();
+    get(url, function(history) {
+      charts.innerHTML = "";
+      info.columns.forEach(function(column) {
+        var div = document.createElement("div");
+        div.className = "chart";
+        div.innerHTML = "<h3></h3><canvas></canvas>";
+        div.firstChild.textContent = column;
+        charts.appendChild(div);
+        draw(div.lastChild, history.series[column], history.start,
+             history.end);
+      });
+      status(history.resolution + " data, " + (Date.now() - began) + " ms");
+    });
+  });
+}
+
+ranges.forEach(function(range) {
+  var button = document.createElement("button");
+  button.textContent = range[0];
+  button.onclick = function() {
+    rangeSeconds = range[1];
+    document.querySelectorAll("button").forEach(function(other) {
+      other.className = other == button ? "on" : "";
+    });
+    load();
+  };
+  if (range[1] == rangeSeconds) button.className = "on";
+  document.getElementById("ranges").appendChild(button);
+});
+load();
+setInterval(load, 60000);
+</script>
+</body></html>
+"""
+
+def makeDashboardHandler():
+  # http.server and urllib.parse are only imported when a dashboard is
+  # started
+  from http.server import BaseHTTPRequestHandler
+  from urllib.parse import urlsplit, parse_qs
+
+  class DashboardHandler(BaseHTTPRequestHandler):
+
+    protocol_version        = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+      dashboardRequests.inc()
+      url = urlsplit(self.path)
+      query = self.server.dashboard.query
+      if url.path == "/":
+        self.send(200, dashboardPage.encode("UTF-8"), "text/html")
+      elif url.path == "/api/columns":
+        self.send(200, json.dumps({"columns":query.columns()})
+                           .encode("UTF-8"))
+      elif url.path == "/api/history":
+        params = parse_qs(url.query)
+        try:
+          end   = float(params.get("end", [time.time()])[0])
+          start = float(params.get("start",
+                                   [end - defaultRangeSeconds])[0])
+          width = int(params.get("width", [defaultWidth])[0])
+          if not (math.isfinite(start) and math.isfinite(end)):
+            raise ValueError("start and end must be finite")
+          if end <= start:
+            raise ValueError("end must be after start")
+        except ValueError as e:
+          self.send(400, json.dumps({"error":str(e)}).encode("UTF-8"))
+          return
+        columns = params.get("columns", [""])[0].split(",")
+        columns = [column for column in columns if column]\
+                  or query.columns()
+        self.send(200, query.history(start, end, width, columns))
+      else:
+        self.send(404, json.dumps({"error":"Unknown path '%s'" % url.path})
+                           .encode("UTF-8"))
+
+    def send(self, status, body, contentType="application/json"):
+      self.send_response(status)
+      self.send_header("Content-Type", contentType)
+      self.send_header("Content-Length", str(len(body)))
+      self.send_header("Cache-Control", "no-cache")
+      self.end_headers()
+      self.wfile.write(body)
+
+    def log_message(self, format, *args):
+      if self.server.dashboard.verbose:
+        BaseHTTPRequestHandler.log_message(self, format, *args)
+
+  return DashboardHandler
+
+class DashboardServer(object):
+
+  def __init__(self, logFileRoot, port=defaultDashboardPort, host=""):
+    self.query   = HistoryQuery(logFileRoot)
+    self.port    = port
+    self.host    = host
+    self.server  = None
+    self.verbose = False
+
+  def start(self):
+    from http.server import ThreadingHTTPServer
+    self.server = ThreadingHTTPServer((self.host, self.port),
+                                      makeDashboardHandler())
+    self.server.daemon_threads = True
+    self.server.dashboard = self
+    self.port = self.server.server_address[1]
+    threading.Thread(target=self.server.serve_forever, name="dashboardHttp",
+                     daemon=True).start()
+    return self
+
+  def stop(self):
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+    self.query.close()
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] [options]
+       where:
+         -h|--help to see options
+"""
+  parser = OptionParser(usage)
+  help="Verbose mode, logging every request."
+  parser.add_option("-v", "--verbose",
+                    action="store_true",
+                    default=False,
+                    dest="verbose",
+                    help=help)
+  help ="Root name of the collector's log files, whose .tsd history is "
+  help+="shown.  Default is '%s'" % defaultLogFileRoot
+  parser.add_option("-l", "--logFileRoot",
+                    action="store", type="string",
+                    default=defaultLogFileRoot,
+                    dest="logFileRoot",
+                    help=help)
+  help="Port to serve the dashboard on.  Default is %s" % defaultDashboardPort
+  parser.add_option("-p", "--port",
+                    action="store", type="int",
+                    default=defaultDashboardPort,
+                    dest="port",
+                    help=help)
+
+  (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
+
+  if len(cmdLineArgs) != 0:
+    parser.error("All command-line arguments require a flag. "+\
+                 "Found the following without flags: %s" % cmdLineArgs)
+
+  return (cmdLineOptions, cmdLineArgs)
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+
+  dashboard = DashboardServer(clo.logFileRoot, port=clo.port)
+  dashboard.verbose = clo.verbose
+  dashboard.start()
+  print("Dashboard of '%s' on port %s" % (clo.logFileRoot, dashboard.port))
+
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    dashboard.stop()
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+# Quantities derived from a sensor's samples as they come in.  A sensor
+# entry turns them on with "derived", mapping each metric to its options:
+#
+#   {"name":"frig", "type":"DHT22", "pin":4,
+#    "fields":{1:"temp_f", 2:"humidity", 3:"duty_cycle", 4:"dew_point_f"},
+#    "derived":{"dew_point":{}, "duty_cycle":{"window":7200}, "door":{}}}
+#
+# Each metric adds its quantities to the sensor's temp_c/temp_f/humidity,
+# so they can be published in fields, watched by alert rules, sent to the
+# MQTT sink and, with a sample_interval, summarized per window like any
+# other quantity (e.g. "door_openings.max"):
+#
+#   dew_point   dew_point_c, dew_point_f   Magnus formula
+#               dew_point_spread_c         temp_c - dew_point_c; near 0 means
+#                                          condensation or frost
+#   duty_cycle  compressor_on              1 while the temperature falls
+#               duty_cycle                 % of time on, averaged over about
+#                                          "window" secs
+#   door        door_open                  1 from a sudden rise in
+#                                          temperature or humidity until the
+#                                          temperature is back down
+#               door_openings              openings seen since the start
+#               recovery_seconds           how long the last one took to
+#                                          recover
+#
+# The compressor's state is inferred from the temperature trend, since the
+# collector has no other view of it: the slope of the temperature smoothed
+# over "smoothing" secs switches it on below -on_rate and off above
+# off_rate (C per minute).  The duty cycle is an exponentially weighted time
+# average of that state.  A door opening is a temperature at least "rise" C,
+# or a humidity at least "humidity_rise" %, above their average over the
+# last "baseline" secs; it has recovered once the temperature is back within
+# "margin" C of that average.  Every metric keeps a fixed handful of numbers
+# and does constant work per sample, whatever the window or sample rate.
+#
+# A new metric is a class with a "quantities" tuple and an update(quantities,
+# timestamp) method adding them, listed in metricTypes.
+
+import math
+
+from collectorMetrics import registry
+
+doorOpenings = registry.counter(
+  "collector_door_openings_total",
+  "Door openings detected from temperature and humidity jumps")
+
+def decayFactor(seconds, timeConstant):
+  # Weight left on the old value after seconds, for an exponential moving
+  # average with the given time constant
+  if timeConstant <= 0:
+    return 0.0
+  return math.exp(-seconds / timeConstant)
+
+class DewPoint(object):
+
+  quantities = ("dew_point_c", "dew_point_f", "dew_point_spread_c")
+
+  # Magnus coefficients over water, good to about 0.1 C from -45 to 60 C
+  b = 17.62
+  c = 243.12
+
+  def __init__(self, options):
+    pass
+
+  def update(self, quantities, timestamp):
+    temp_c   = quantities["temp_c"]
+    humidity = max(quantities["humidity"], 0.1)
+    gamma    = math.log(humidity / 100.0) + self.b * temp_c / (self.c + temp_c)
+    dewPoint = self.c * gamma / (self.b - gamma)
+    quantities["dew_point_c"]        = dewPoint
+    quantities["dew_point_f"]        = dewPoint * 9.0 / 5.0 + 32.0
+    quantities["dew_point_spread_c"] = temp_c - dewPoint
+
+class SmoothedLevel(object):
+
+  # Exponential moving average of a value sampled at uneven intervals
+
+  def __init__(self, timeConstant):
+    self.timeConstant = timeConstant
+    self.value        = None
+
+  def update(self, value, seconds):
+    if self.value is None:
+      self.value = value
+    else:
+      keep = decayFactor(seconds, self.timeConstant)
+      self.value = keep * self.value + (1.0 - keep) * value
+    return self.value
+
+class DutyCycle(object):
+
+  quantities = ("compressor_on", "duty_cycle")
+
+  def __init__(self, options):
+    self.window   = options.get("window", 3600.0)
+    self.level    = SmoothedLevel(options.get("smoothing", 120.0))
+    self.trend    = SmoothedLevel(options.get("smoothing", 120.0))
+    self.onRate   = options.get("on_rate", 0.05) / 60.0
+    self.offRate  = options.get("off_rate", 0.02) / 60.0
+    self.lastTime = None
+    self.on       = False
+    self.duty     = None
+
+  def update(self, quantities, timestamp):
+    temp_c = quantities["temp_c"]
+    if self.lastTime is None:
+      self.level.update(temp_c, 0.0)
+    elif timestamp > self.lastTime:
+      # The slope of the smoothed temperature rather than of the samples:
+      # sensor noise over a short interval would otherwise look like a
+      # steep slope
+      seconds = timestamp - self.lastTime
+      lastLevel = self.level.value
+      slope = (self.level.update(temp_c, seconds) - lastLevel) / seconds
+      slope = self.trend.update(slope, seconds)
+      # The state held since the last sample counts for the time between
+      wasOn = 1.0 if self.on else 0.0
+      if self.duty is None:
+        self.duty = wasOn
+      keep = decayFactor(seconds, self.window)
+      self.duty = keep * self.duty + (1.0 - keep) * wasOn
+      if slope <= -self.onRate:
+        self.on = True
+      elif slope >= self.offRate:
+        self.on = False
+    self.lastTime = timestamp
+    quantities["compressor_on"] = 1 if self.on else 0
+    quantities["duty_cycle"]    = 100.0 * (self.duty or 0.0)
+
+class DoorDetector(object):
+
+  quantities = ("door_open", "door_openings", "recovery_seconds")
+
+  def __init__(self, options):
+    self.rise          = options.get("rise", 1.0)
+    self.humidityRise  = options.get("humidity_rise", 10.0)
+    self.margin        = options.get("margin", 0.5)
+    self.maxRecovery   = options.get("max_recovery", 7200.0)
+    self.tempLevel     = SmoothedLevel(options.get("baseline", 300.0))
+    self.humidityLevel = SmoothedLevel(options.get("baseline", 300.0))
+    self.lastTime      = None
+    self.openedAt      = None
+    self.baseline      = None
+    self.openings      = 0
+    self.recovery      = 0.0
+
+  def update(self, quantities, timestamp):
+    temp_c   = quantities["temp_c"]
+    humidity = quantities["humidity"]
+    seconds  = 0.0
+    if self.lastTime is not None:
+      seconds = max(0.0, timestamp - self.lastTime)
+    if self.lastTime is not None and self.openedAt is None:
+      # A jump well above the recent level, which a compressor switching
+      # off does not produce
+      if (temp_c - self.tempLevel.value >= self.rise
+          or humidity - self.humidityLevel.value >= self.humidityRise):
+        self.openedAt = self.lastTime
+        self.baseline = self.tempLevel.value
+        self.openings += 1
+        doorOpenings.inc()
+    elif self.openedAt is not None:
+      if temp_c <= self.baseline + self.margin:
+        self.recovery = timestamp - self.openedAt
+        self.openedAt = None
+      elif timestamp - self.openedAt >= self.maxRecovery:
+        # Never got back down, e.g. after a defrost or a new setpoint.
+        # Whatever it settled at is the new normal.
+        self.openedAt = None
+    self.tempLevel.update(temp_c, seconds)
+    self.humidityLevel.update(humidity, seconds)
+    self.lastTime = timestamp
+    quantities["door_open"]        = 0 if self.openedAt is None else 1
+    quantities["door_openings"]    = self.openings
+    quantities["recovery_seconds"] = self.recovery
+
+metricTypes = {"dew_point":DewPoint, "duty_cycle":DutyCycle,
+               "door":DoorDetector}
+
+def derivedQuantityNames(derivedConfig):
+  # Quantities the metrics of a sensor's "derived" entry add
+  names = []
+  for metricName in derivedConfig or {}:
+    if metricName in metricTypes:
+      names.extend(metricTypes[metricName].quantities)
+  return tuple(names)
+
+class DerivedMetrics(object):
+
+  # The metrics of all sensors, by sensor name
+
+  def __init__(self, sensorConfigs):
+    self.metrics = {}
+    self.configure(sensorConfigs)
+
+  def configure(self, sensorConfigs):
+    # Sets up the metrics of a new config.  A metric whose options did not
+    # change keeps its state, so a reload does not restart its averages.
+    metrics = {}
+    for sensorConfig in sensorConfigs:
+      sensorName = sensorConfig.get("name", "sensor")
+      oldMetrics = dict((key, metric) for (key, metric)
+                        in self.metrics.get(sensorName, ()))
+      sensorMetrics = []
+      for (metricName, options) in (sensorConfig.get("derived") or {}).items():
+        key = (metricName, repr(sorted(dict(options).items())))
+        metric = oldMetrics.get(key)
+        if metric is None:
+          metric = metricTypes[metricName](dict(options))
+        sensorMetrics.append((key, metric))
+      if sensorMetrics:
+        metrics[sensorName] = sensorMetrics
+    self.metrics = metrics
+
+  def update(self, sensorName, quantities, timestamp):
+    # Adds the sensor's derived quantities to quantities
+    for (key, metric) in self.metrics.get(sensorName, ()):
+      metric.update(quantities, timestamp)
+
+  def __bool__(self):
+    return bool(self.metrics)
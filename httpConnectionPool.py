@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# Small keep-alive HTTP(S) connection pool for one host.  Connections are
+# reused across requests so the TCP and TLS handshakes are paid once instead
+# of on every upload.  The connect timeout only covers establishing the
+# connection, the read timeout covers each blocking read of the response.
+# http.client and ssl are imported when the first pool is made, not when
+# the collector starts.
+
+import socket
+import threading
+
+defaultConnectTimeoutSeconds = 10
+defaultReadTimeoutSeconds    = 30
+defaultMaxConnections        = 2
+
+class HttpConnectionPool(object):
+
+  def __init__(self, baseUrl,
+               connectTimeout=defaultConnectTimeoutSeconds,
+               readTimeout=defaultReadTimeoutSeconds,
+               maxConnections=defaultMaxConnections):
+    from urllib.parse import urlsplit
+    parts = urlsplit(baseUrl)
+    assert parts.scheme in ("http", "https"),\
+      "Unsupported URL scheme in '%s'" % baseUrl
+
+    self.scheme         = parts.scheme
+    self.host           = parts.hostname
+    self.port           = parts.port
+    self.pathPrefix     = parts.path.rstrip("/")
+    self.connectTimeout = connectTimeout
+    self.readTimeout    = readTimeout
+    self.idle           = []
+    self.lock           = threading.Lock()
+    self.slots          = threading.BoundedSemaphore(maxConnections)
+    self.sslContext     = None
+    self.connectCount   = 0
+    self.requestCount   = 0
+
+    if self.scheme == "https":
+      import ssl
+      self.sslContext = ssl.create_default_context()
+
+  def newConnection(self):
+    import http.client
+    if self.scheme == "https":
+      conn = http.client.HTTPSConnection(self.host, self.port,
+                                         timeout=self.connectTimeout,
+                                         context=self.sslContext)
+    else:
+      conn = http.client.HTTPConnection(self.host, self.port,
+                                        timeout=self.connectTimeout)
+    conn.connect()
+    conn.sock.settimeout(self.readTimeout)
+    conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    self.connectCount += 1
+    return conn
+
+  def getConnection(self):
+    # An idle connection whose socket is readable has been closed (or
+    # written to) by the server while it sat in the pool, so it is dropped
+    # here rather than found out about after a request was sent on it.
+    import select
+    while True:
+      with self.lock:
+        if not self.idle:
+          break
+        conn = self.idle.pop()
+      (readable, _, _) = select.select([conn.sock], [], [], 0)
+      if not readable:
+        return (conn, True)
+      conn.close()
+    return (self.newConnection(), False)
+
+  def releaseConnection(self, conn):
+    with self.lock:
+      self.idle.append(conn)
+
+  def request(self, method, path, body=None, headers=None):
+    # Returns (status, responseBody).  A request is only retried, once and on
+    # a fresh connection, when sending it on a kept-alive connection failed.
+    # Once the request is out the server may have acted on it, so a failure
+    # while waiting for the response is raised: resending a bulk update
+    # could post its rows twice, and the caller's retry logic decides.
+    import http.client
+    if headers is None:
+      headers = {}
+
+    with self.slots:
+      for attempt in range(2):
+        (conn, reused) = self.getConnection()
+        try:
+          conn.request(method, self.pathPrefix + path, body=body,
+                       headers=headers)
+        except (ConnectionResetError, BrokenPipeError,
+                http.client.CannotSendRequest):
+          conn.close()
+          if reused and attempt == 0:
+            continue
+          raise
+        except Exception:
+          conn.close()
+          raise
+
+        try:
+          response = conn.getresponse()
+          responseBody = response.read()
+        except Exception:
+          conn.close()
+          raise
+
+        self.requestCount += 1
+        if response.will_close:
+          conn.close()
+        else:
+          self.releaseConnection(conn)
+
+        return (response.status, responseBody)
+
+  def close(self):
+    with self.lock:
+      for conn in self.idle:
+        conn.close()
+      self.idle = []
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+# Local stand-in for an MQTT broker, for exercising the collector's mqtt
+# sink without a real one.  It speaks just enough MQTT 3.1.1 for a
+# publisher: CONNECT (any credentials are accepted), PUBLISH with QoS 0, 1
+# and 2, PINGREQ and DISCONNECT.  Nothing is forwarded to subscribers.
+#
+#   ./mqttStub.py --port 1883
+
+import sys
+import time
+import struct
+import threading
+import socketserver
+from optparse import OptionParser
+
+defaultPort = 1883
+
+CONNECT    = 1
+CONNACK    = 2
+PUBLISH    = 3
+PUBACK     = 4
+PUBREC     = 5
+PUBREL     = 6
+PUBCOMP    = 7
+PINGREQ    = 12
+PINGRESP   = 13
+DISCONNECT = 14
+
+class MqttStubHandler(socketserver.StreamRequestHandler):
+
+  def readPacket(self):
+    # Returns (packetType, flags, body), or None at end of stream
+    first = self.rfile.read(1)
+    if not first:
+      return None
+    length = 0
+    shift  = 0
+    while True:
+      byte = self.rfile.read(1)
+      if not byte:
+        return None
+      length |= (byte[0] & 0x7f) << shift
+      shift += 7
+      if not byte[0] & 0x80:
+        break
+    body = self.rfile.read(length)
+    if len(body) < length:
+      return None
+    return (first[0] >> 4, first[0] & 0x0f, body)
+
+  def sendPacket(self, packetType, body=b"", flags=0):
+    self.wfile.write(bytes([packetType << 4 | flags, len(body)]) + body)
+
+  def handle(self):
+    stub = self.server.stub
+    stub.connectionCount += 1
+    while True:
+      packet = self.readPacket()
+      if packet is None:
+        return
+      (packetType, flags, body) = packet
+
+      if packetType == CONNECT:
+        self.sendPacket(CONNACK, b"\0\0")
+      elif packetType == PUBLISH:
+        qos = (flags >> 1) & 3
+        (topicLength,) = struct.unpack(">H", body[:2])
+        topic = body[2:2 + topicLength].decode("UTF-8")
+        offset = 2 + topicLength
+        packetId = None
+        if qos:
+          packetId = body[offset:offset + 2]
+          offset += 2
+        stub.recordMessage(topic, body[offset:].decode("UTF-8", "replace"),
+                           qos)
+        if stub.delaySeconds:
+          time.sleep(stub.delaySeconds)
+        if qos == 1:
+          self.sendPacket(PUBACK, packetId)
+        elif qos == 2:
+          self.sendPacket(PUBREC, packetId)
+      elif packetType == PUBREL:
+        self.sendPacket(PUBCOMP, body[:2])
+      elif packetType == PINGREQ:
+        self.sendPacket(PINGRESP)
+      elif packetType == DISCONNECT:
+        return
+      else:
+        # SUBSCRIBE and the rest are not implemented
+        return
+
+class MqttStub(object):
+
+  def __init__(self, port=0, host="127.0.0.1"):
+    self.host            = host
+    self.port            = port
+    self.delaySeconds    = 0.0
+    self.verbose         = False
+    self.messages        = []
+    self.connectionCount = 0
+    self.lock            = threading.Lock()
+    self.server          = None
+
+  def recordMessage(self, topic, payload, qos):
+    with self.lock:
+      self.messages.append((topic, payload))
+    if self.verbose:
+      print("QoS %s message on '%s': %s" % (qos, topic, payload))
+
+  def start(self):
+    self.server = socketserver.ThreadingTCPServer((self.host, self.port),
+                                                  MqttStubHandler)
+    self.server.daemon_threads = True
+    self.server.stub = self
+    self.port = self.server.server_address[1]
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] [options]
+       where:
+         -h|--help to see options
+"""
+  parser = OptionParser(usage)
+  help="Port to listen on.  Default is %s" % defaultPort
+  parser.add_option("-p", "--port",
+                    action="store", type="int",
+                    default=defaultPort,
+                    dest="port",
+                    help=help)
+  help="Seconds to wait before acknowledging each message"
+  parser.add_option("-d", "--delaySeconds",
+                    action="store", type="float",
+                    default=0.0,
+                    dest="delaySeconds",
+                    help=help)
+
+  (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
+
+  if len(cmdLineArgs) != 0:
+    parser.error("All command-line arguments require a flag. "+\
+                 "Found the following without flags: %s" % cmdLineArgs)
+
+  return (cmdLineOptions, cmdLineArgs)
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+
+  stub = MqttStub(port=clo.port)
+  stub.delaySeconds = clo.delaySeconds
+  stub.verbose      = True
+  stub.start()
+  print("MQTT stand-in listening on %s:%s" % (stub.host, stub.port))
+
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    stub.stop()
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
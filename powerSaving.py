@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+# Power saving for collectors that run off a battery or UPS.  Normally every
+# part of the collector keeps a timer of its own: the uploader looks at its
+# batch every second, the daily log is written and the config file polled
+# every 5 secs, and the sampler wakes for each sample, so an idle collector
+# wakes the CPU several thousand times an hour.  With "power_save" in the
+# host block, or --powerSave, those chores ride along with the sample:
+#
+#   "update_frequency":300,
+#   "power_save":True,
+#   "batch_size":6,
+#
+# At each sample the sensors are read, the reading goes to the spool and the
+# sinks, the uploader checks its batch and sends whatever is due in one
+# burst, the log records are written and the config file is checked.  Then
+# nothing runs until the next sample.  A failed upload is retried at the
+# next sample rather than on a timer, and the HTTP connection is closed
+# after each burst, so the radio can idle in between instead of being woken
+# by the server timing out a kept-alive connection.  A batch_size spanning
+# several samples makes for fewer, bigger bursts.  Config changes are
+# noticed at the next sample rather than within 5 secs.
+#
+# Still on timers of their own: the metrics and dashboard servers poll twice
+# a second and the MQTT client once a second, so leave them off on battery,
+# and a sink retrying a failed write backs off on its own schedule.
+#
+# PowerMonitor reports what the collector costs, in both modes, so the
+# savings can be checked: wakeups per hour, counted as the voluntary context
+# switches of all of the process's threads, and CPU seconds per hour.  They
+# are printed once an hour and served as collector_wakeups_per_hour and
+# collector_cpu_seconds_per_hour.  benchmarks/bench_collector.py --powerOnly
+# compares the two modes with a synthetic sensor on a sped-up clock.
+
+import time
+import resource
+
+from collectorMetrics import registry
+
+defaultReportSeconds = 3600
+
+def measureUsage():
+  # (monotonic time, wakeups, CPU seconds) of the whole process so far
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return (time.monotonic(), usage.ru_nvcsw, usage.ru_utime + usage.ru_stime)
+
+def ratesPerHour(start, end, timeScale=1.0):
+  # (wakeups, CPU seconds) per hour between two measureUsage() results.
+  # With a sped-up clock, timeScale simulated seconds pass per real second.
+  hours = max(end[0] - start[0], 1e-9) * timeScale / 3600.0
+  return ((end[1] - start[1]) / hours, (end[2] - start[2]) / hours)
+
+class PowerMonitor(object):
+
+  def __init__(self, reportSeconds=defaultReportSeconds):
+    self.reportSeconds = reportSeconds
+    self.lastUsage     = measureUsage()
+    self.lastRates     = None
+    registry.gauge("collector_wakeups_per_hour",
+                   "Thread wakeups of the collector per hour, over the last "
+                   "report period", function=lambda: self.rates()[0])
+    registry.gauge("collector_cpu_seconds_per_hour",
+                   "CPU seconds used by the collector per hour, over the "
+                   "last report period", function=lambda: self.rates()[1])
+
+  def rates(self):
+    # The last full report period's, or so far before the first one ends
+    if self.lastRates is not None:
+      return self.lastRates
+    return ratesPerHour(self.lastUsage, measureUsage())
+
+  def check(self):
+    # Call regularly, e.g. after every sample; prints a report once every
+    # reportSeconds
+    usage = measureUsage()
+    if usage[0] - self.lastUsage[0] < self.reportSeconds:
+      return
+    self.lastRates = ratesPerHour(self.lastUsage, usage)
+    self.lastUsage = usage
+    print("Power: %.0f wakeups/hour, %.2f CPU secs/hour" % self.lastRates)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Change-driven publishing.  The collector samples every update_frequency
+# seconds as usual, but with "publish_mode":"deadband" in the host block a
+# reading is only uploaded when
+#
+#   - some field moved at least its deadband away from the value last
+#     uploaded for it ("deadband", {field:delta}, default_deadband otherwise),
+#   - nothing was uploaded for "heartbeat" seconds, or
+#   - some field crossed one of its "thresholds" ({field:[value, ...]})
+#     since the previous sample.  Threshold crossings are urgent: they are
+#     flushed to ThingSpeak right away instead of waiting for the batch.
+#
+# Every sample still goes to the local store.
+
+from collectorMetrics import registry
+
+defaultDeadband         = 0.5
+defaultHeartbeatSeconds = 1800
+
+readingsPublished = registry.counter(
+  "collector_readings_published_total",
+  "Readings passed on for upload by the publish policy")
+readingsSuppressed = registry.counter(
+  "collector_readings_suppressed_total",
+  "Readings held back by the publish policy")
+thresholdCrossings = registry.counter(
+  "collector_threshold_crossings_total",
+  "Readings published immediately because a field crossed a threshold")
+
+class DeadbandPolicy(object):
+
+  def __init__(self, deadbands=None, defaultDeadband=defaultDeadband,
+               heartbeatSeconds=defaultHeartbeatSeconds, thresholds=None):
+    self.deadbands        = dict(deadbands or {})
+    self.defaultDeadband  = defaultDeadband
+    self.heartbeatSeconds = heartbeatSeconds
+    self.thresholds       = dict((field, sorted(values))
+                                 for (field, values)
+                                 in (thresholds or {}).items())
+    self.lastPublished    = {}
+    self.lastPublishTime  = None
+    self.previous         = {}
+
+  def takeStateFrom(self, policy):
+    # Carries what was last published over from the policy this one
+    # replaces after a config change
+    self.lastPublished   = policy.lastPublished
+    self.lastPublishTime = policy.lastPublishTime
+    self.previous        = policy.previous
+
+  def fieldValues(self, reading):
+    values = {}
+    for field in range(1, 9):
+      value = reading.get("field%d" % field)
+      if value is not None:
+        values[field] = value
+    return values
+
+  def crossedThreshold(self, field, value):
+    previous = self.previous.get(field)
+    if previous is None:
+      return False
+    for threshold in self.thresholds.get(field, ()):
+      if (previous < threshold) != (value < threshold):
+        return True
+    return False
+
+  def outsideDeadband(self, field, value):
+    published = self.lastPublished.get(field)
+    if published is None:
+      return True
+    return abs(value - published) >= self.deadbands.get(field,
+                                                        self.defaultDeadband)
+
+  def decide(self, reading):
+    # Returns (publish, urgent) for the reading and remembers it
+    values  = self.fieldValues(reading)
+    now     = reading["created_at"]
+    urgent  = any(self.crossedThreshold(field, value)
+                  for (field, value) in values.items())
+    publish = (urgent
+               or self.lastPublishTime is None
+               or now - self.lastPublishTime >= self.heartbeatSeconds
+               or any(self.outsideDeadband(field, value)
+                      for (field, value) in values.items()))
+
+    self.previous.update(values)
+    if publish:
+      self.lastPublished.update(values)
+      self.lastPublishTime = now
+      readingsPublished.inc()
+      if urgent:
+        thresholdCrossings.inc()
+    else:
+      readingsSuppressed.inc()
+
+    return (publish, urgent)
+
+def makePublishPolicy(configDataDict):
+  # Returns None for the default mode of publishing every reading
+  mode = configDataDict.get("publish_mode", "every")
+  if mode == "every":
+    return None
+  assert mode == "deadband",\
+    "Unknown publish_mode '%s', expected 'every' or 'deadband'" % mode
+
+  return DeadbandPolicy(
+    deadbands=configDataDict.get("deadband"),
+    defaultDeadband=configDataDict.get("default_deadband", defaultDeadband),
+    heartbeatSeconds=configDataDict.get("heartbeat", defaultHeartbeatSeconds),
+    thresholds=configDataDict.get("thresholds"))
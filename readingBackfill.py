@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+
+# Uploads readings from the collector's local history (the daily
+# '<logFileRoot>.<date>.raw.tsd' segments written by timeSeriesStore.py) to
+# ThingSpeak, e.g. to fill the gap an outage left in a channel:
+#
+#   ./readingBackfill.py -k frig_freezer --start 2015-08-17 --end 2015-08-19
+#   ./readingBackfill.py -k frig_freezer -o payloads.json     # look first
+#
+# A day's segment is memory-mapped as a NumPy record array and converted in
+# a few whole-array operations: scaling, missing values, temp_f, the host
+# block's field mapping and thinning to one row per everySeconds.  A field
+# gets the mean of the slot's samples, or for "<quantity>.<stat>" fields
+# (see windowAggregator.py) that stat of them.  Dew point is derived from
+# the stored temp_c and humidity; duty cycle and door openings depend on
+# every sample before them, so their fields are left out with a warning.
+# Only building the JSON payloads touches individual rows, so a week of
+# 2-second samples costs seconds of CPU.  Rows carry their own created_at;
+# the status line is left out.
+#
+# Bulk updates go out at most once every minIntervalSeconds, ThingSpeak's
+# rate limit for free accounts, and failed ones are retried with backoff.
+# After each accepted update the created_at of its last row is saved in a
+# checkpoint file, and a later run with the same checkpoint skips everything
+# up to it, so an interrupted backfill resumes where it stopped.
+
+import os
+import sys
+import glob
+import json
+import time
+
+from timeSeriesStore import Segment, headerSize, missingValue, valueScale,\
+  dateStampOf
+from thingSpeakClient import ThingSpeakBulkClient, ThingSpeakError,\
+  defaultBaseUrl, bulkUpdateLimit
+from readingBatcher import defaultRetrySeconds, defaultMaxRetrySeconds
+from sensorBackends import makeSensors
+from collectorConfig import loadHostConfig, defaultConfigFilename
+from collectorMetrics import registry
+from windowAggregator import splitQuantity
+from derivedMetrics import DewPoint, DutyCycle, DoorDetector
+
+from optparse import OptionParser
+
+# Where temp_to_thing_speak.py keeps its files unless told otherwise
+defaultLogFileRoot        = os.path.expanduser(
+  "~/.local/state/temp_to_thing_speak/temp_to_thing_speak")
+defaultMinIntervalSeconds = 15.0
+
+# What mapFields() can make from a sensor's stored temp_c and humidity.
+# The other derived quantities (see derivedMetrics.py) follow the samples
+# before them, which a thinned or partial range of rows cannot reproduce.
+backfillQuantities = (("temp_c", "temp_f", "humidity")
+                      + DewPoint.quantities)
+statefulQuantities = DutyCycle.quantities + DoorDetector.quantities
+
+rowsBackfilled = registry.counter(
+  "backfill_rows_sent_total", "Rows accepted by ThingSpeak from a backfill")
+
+def importNumpy():
+  # NumPy is only needed here, so the collector itself runs without it
+  try:
+    import numpy
+  except ImportError:
+    print("readingBackfill.py needs NumPy.  Install it with "
+          "'sudo apt-get install python3-numpy' or 'pip3 install numpy'.")
+    sys.exit(1)
+  return numpy
+
+def makeCheckpointFileName(logFileRoot, channelId):
+  return "%s.backfill.%s.checkpoint" % (logFileRoot, channelId)
+
+def readCheckpoint(checkpointFileName):
+  # Returns the created_at of the last row ThingSpeak accepted, or None
+  try:
+    with open(checkpointFileName) as stream:
+      return json.load(stream)["created_at"]
+  except FileNotFoundError:
+    return None
+
+def writeCheckpoint(checkpointFileName, channelId, createdAt):
+  tmpFileName = checkpointFileName + ".tmp"
+  with open(tmpFileName, "w") as stream:
+    json.dump({"channel_id":channelId, "created_at":createdAt}, stream)
+  os.replace(tmpFileName, checkpointFileName)
+
+def findRawSegments(logFileRoot):
+  # Returns [(dateStamp, fileName)] of the raw segments, oldest first
+  segments = []
+  for fileName in glob.glob(glob.escape(logFileRoot) + ".*.raw.tsd"):
+    dateStamp = fileName[len(logFileRoot) + 1:-len(".raw.tsd")]
+    segments.append((dateStamp, fileName))
+  return sorted(segments)
+
+def readRawSegment(np, fileName):
+  # Returns (times, values, columns): times in seconds since the epoch and
+  # values as a (rows, columns) float array with NaN for missing values
+  segment = Segment(fileName)
+  (count, dayStart, columns, recordWords) = (segment.count, segment.dayStart,
+                                             segment.columns,
+                                             segment.recordWords)
+  segment.close()
+  if not count:
+    return (np.empty(0), np.empty((0, len(columns))), columns)
+
+  slots = (recordWords - 1) * 2
+  recordType = np.dtype([("time", "<u4"), ("values", "<i2", (slots,))])
+  records = np.memmap(fileName, dtype=recordType, mode="r",
+                      offset=headerSize, shape=(count,))
+  scaled = records["values"][:, :len(columns)]
+  values = scaled / float(valueScale)
+  values[scaled == missingValue] = np.nan
+  times = dayStart + records["time"] / 1000.0
+  return (times, values, columns)
+
+def makeSlots(np, times, everySeconds):
+  # Returns (slotTimes, inverse): the time of each everySeconds slot's first
+  # sample and the slot of every row.  Without everySeconds every row is a
+  # slot of its own and inverse is None.
+  if not everySeconds:
+    return (times, None)
+  slots = np.floor(times / everySeconds).astype(np.int64)
+  (unique, first, inverse) = np.unique(slots, return_index=True,
+                                       return_inverse=True)
+  return (times[first], inverse.reshape(-1))
+
+def slotStat(np, values, inverse, slotCount, stat):
+  # One of windowAggregator's statNames of values over each slot, leaving
+  # out NaN.  Slots without values get NaN, except for "count".
+  present = ~np.isnan(values)
+  if inverse is None:
+    if stat == "count":
+      return present.astype(float)
+    if stat == "stddev":
+      return np.where(present, 0.0, np.nan)
+    return values
+
+  counts = np.bincount(inverse, weights=present, minlength=slotCount)
+  if stat == "count":
+    return counts
+  known = np.where(present, values, 0.0)
+  with np.errstate(invalid="ignore", divide="ignore"):
+    means = np.bincount(inverse, weights=known,
+                        minlength=slotCount) / counts
+    if stat == "mean":
+      return means
+    if stat == "stddev":
+      # Sample standard deviation like RunningStats, 0.0 for one sample
+      deviations = np.where(present, values - means[inverse], 0.0)
+      squares = np.bincount(inverse, weights=deviations ** 2,
+                            minlength=slotCount)
+      stddevs = np.sqrt(squares / np.maximum(counts - 1, 1))
+      return np.where(counts > 0, stddevs, np.nan)
+  if stat in ("min", "max"):
+    result = np.full(slotCount, np.inf if stat == "min" else -np.inf)
+    reduce = np.fmin if stat == "min" else np.fmax
+    reduce.at(result, inverse[present], values[present])
+    result[counts == 0] = np.nan
+    return result
+  if stat == "last":
+    lastRow = np.full(slotCount, -1)
+    np.maximum.at(lastRow, inverse[present], np.nonzero(present)[0])
+    return np.where(lastRow >= 0, values[np.maximum(lastRow, 0)], np.nan)
+  raise ValueError("Unknown stat '%s'" % stat)
+
+def dewPoints(np, temp_c, humidity):
+  # Vectorized DewPoint.update()
+  (b, c) = (DewPoint.b, DewPoint.c)
+  gamma = (np.log(np.maximum(humidity, 0.1) / 100.0)
+           + b * temp_c / (c + temp_c))
+  dewPoint = c * gamma / (b - gamma)
+  return {"dew_point_c":dewPoint,
+          "dew_point_f":dewPoint * 9.0 / 5.0 + 32.0,
+          "dew_point_spread_c":temp_c - dewPoint}
+
+def mapFields(np, columns, values, sensors, inverse=None, slotCount=None):
+  # Returns {fieldNumber:array} the way makeChannelReading() fills a
+  # channel from a sensor's quantities, one value per slot of makeSlots().
+  # A "<quantity>.<stat>" field gets that stat of the quantity's samples in
+  # the slot and a plain quantity their mean, like a WindowAggregator
+  # window does.
+  rows = values.shape[0]
+  if inverse is None:
+    slotCount = rows
+
+  def column(name):
+    if name in columns:
+      return values[:, columns.index(name)]
+    return np.full(rows, np.nan)
+
+  fields = {}
+  for sensor in sensors:
+    temp_c = column(sensor.name + ".temp_c")
+    quantities = {"temp_c":temp_c,
+                  "temp_f":temp_c * 9.0 / 5.0 + 32.0,
+                  "humidity":column(sensor.name + ".humidity")}
+    for (field, quantity) in sensor.fields.items():
+      (name, stat) = splitQuantity(quantity)
+      if name not in backfillQuantities:
+        continue
+      if name not in quantities:
+        quantities.update(dewPoints(np, temp_c, quantities["humidity"]))
+      fields[field] = np.round(slotStat(np, quantities[name], inverse,
+                                        slotCount, stat or "mean"), 2)
+  return fields
+
+def skippedFields(sensors):
+  # Returns [(sensorName, field, quantity)] of the fields mapFields() leaves
+  # out, because the store does not keep what they are made from
+  skipped = []
+  for sensor in sensors:
+    for (field, quantity) in sensor.fields.items():
+      if splitQuantity(quantity)[0] not in backfillQuantities:
+        skipped.append((sensor.name, field, quantity))
+  return skipped
+
+def formatCreatedAts(np, times):
+  # Vectorized thingSpeakClient.formatCreatedAt()
+  seconds = np.floor(times).astype(np.int64).astype("datetime64[s]")
+  return np.char.add(np.datetime_as_string(seconds, unit="s"), "Z")
+
+def makeUpdates(createdAts, fields):
+  # The only per-row step: one dict per row, leaving out NaN fields
+  names  = ["field%d" % field for field in sorted(fields)]
+  series = [fields[field].tolist() for field in sorted(fields)]
+  updates = []
+  for (row, createdAt) in enumerate(createdAts.tolist()):
+    update = {"created_at":createdAt}
+    for (name, values) in zip(names, series):
+      value = values[row]
+      if value == value:
+        update[name] = value
+    updates.append(update)
+  return updates
+
+class ReadingBackfill(object):
+
+  def __init__(self, logFileRoot, sensors, channelId, writeKey,
+               everySeconds=None, checkpointFileName=None):
+    self.np                 = importNumpy()
+    self.logFileRoot        = logFileRoot
+    self.sensors            = sensors
+    self.channelId          = channelId
+    self.writeKey           = writeKey
+    self.everySeconds       = everySeconds
+    self.checkpointFileName = checkpointFileName
+    self.verbose            = False
+    for (sensorName, field, quantity) in skippedFields(sensors):
+      reason = "is not in the stored history"
+      if splitQuantity(quantity)[0] in statefulQuantities:
+        reason = "depends on all the samples before it"
+      print("Warning: leaving out field %s of sensor '%s': %s %s"
+            % (field, sensorName, quantity, reason))
+
+  def readRows(self, fileName, start, end):
+    # Returns (times, fields) of one day's segment, restricted to
+    # [start, end) and to rows with at least one field
+    np = self.np
+    (times, values, columns) = readRawSegment(np, fileName)
+    inRange = (times >= start) & (times < end)
+    (times, values) = (times[inRange], values[inRange])
+    (times, inverse) = makeSlots(np, times, self.everySeconds)
+
+    fields = mapFields(np, columns, values, self.sensors, inverse, len(times))
+    if fields:
+      present = np.zeros(len(times), dtype=bool)
+      for array in fields.values():
+        present |= ~np.isnan(array)
+      times  = times[present]
+      fields = dict((field, array[present])
+                    for (field, array) in fields.items())
+    return (times, fields)
+
+  def payloads(self, start, end):
+    # Yields (createdAt of the last row, payload) for bulk updates of up to
+    # bulkUpdateLimit rows covering [start, end)
+    for (dateStamp, fileName) in findRawSegments(self.logFileRoot):
+      if dateStamp < dateStampOf(start) or dateStamp > dateStampOf(end):
+        continue
+      (times, fields) = self.readRows(fileName, start, end)
+      if self.verbose:
+        print("%s: %s rows from '%s'" % (dateStamp, len(times), fileName))
+
+      createdAts = formatCreatedAts(self.np, times)
+      for first in range(0, len(times), bulkUpdateLimit):
+        last = first + bulkUpdateLimit
+        updates = makeUpdates(createdAts[first:last],
+                              dict((field, array[first:last])
+                                   for (field, array) in fields.items()))
+        yield (float(times[first:last][-1]),
+               {"write_api_key":self.writeKey, "updates":updates})
+
+  def upload(self, client, start, end,
+             minIntervalSeconds=defaultMinIntervalSeconds):
+    # Returns the number of rows accepted.  Without a checkpoint file every
+    # run starts from the beginning.
+    if self.checkpointFileName:
+      checkpoint = readCheckpoint(self.checkpointFileName)
+      if checkpoint is not None and checkpoint >= start:
+        print("Resuming after checkpoint %s"
+              % time.asctime(time.localtime(checkpoint)))
+        start = checkpoint + 1e-3
+        if self.everySeconds:
+          # The checkpoint's slot was sent whole
+          start = (checkpoint // self.everySeconds + 1) * self.everySeconds
+
+    sentRows = 0
+    lastSendTime = None
+    for (lastCreatedAt, payload) in self.payloads(start, end):
+      retryDelay = defaultRetrySeconds
+      while True:
+        if lastSendTime is not None:
+          wait = lastSendTime + minIntervalSeconds - time.monotonic()
+          if wait > 0:
+            time.sleep(wait)
+        lastSendTime = time.monotonic()
+        try:
+          client.postPayload(payload)
+          break
+        except ThingSpeakError as e:
+          print("Backfill bulk update of %s rows failed, retrying in %s secs:"
+                % (len(payload["updates"]), retryDelay))
+          print("Error msg:", str(e))
+          time.sleep(retryDelay)
+          retryDelay = min(retryDelay * 2, defaultMaxRetrySeconds)
+
+      sentRows += len(payload["updates"])
+      rowsBackfilled.inc(len(payload["updates"]))
+      if self.checkpointFileName:
+        writeCheckpoint(self.checkpointFileName, self.channelId,
+                        lastCreatedAt)
+      print("Sent %s rows, through %s"
+            % (sentRows, time.asctime(time.localtime(lastCreatedAt))))
+    return sentRows
+
+  def write(self, outputStream, start, end):
+    # Writes the payloads as JSON, one per line, instead of sending them
+    rows = 0
+    for (lastCreatedAt, payload) in self.payloads(start, end):
+      outputStream.write(json.dumps(payload) + "\n")
+      rows += len(payload["updates"])
+    return rows
+
+def parseTime(text):
+  # A local date, or date and time, e.g. '2015-08-17' or '2015-08-17 06:30'
+  for timeFormat in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+    try:
+      return time.mktime(time.strptime(text, timeFormat))
+    except ValueError:
+      pass
+  raise ValueError("Cannot parse time '%s', expected e.g. '2015-08-17' or "
+                   "'2015-08-17 06:30'" % text)
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] [options]
+       where:
+         -h|--help to see options
+"""
+  parser = OptionParser(usage)
+  help="Verbose mode."
+  parser.add_option("-v", "--verbose",
+                    action="store_true",
+                    default=False,
+                    dest="verbose",
+                    help=help)
+  help ="Root name of the collector's log files, whose segments are read.  "
+  help+="Default is '%s'" % defaultLogFileRoot
+  parser.add_option("-l", "--logFileRoot",
+                    action="store", type="string",
+                    default=defaultLogFileRoot,
+                    dest="logFileRoot",
+                    help=help)
+  help ="Name of the collector's config file.  "
+  help+="Default is '%s'" % defaultConfigFilename
+  parser.add_option("-c", "--configFile",
+                    action="store", type="string",
+                    default=defaultConfigFilename,
+                    dest="configFilename",
+                    help=help)
+  help ="Key of the host block whose channel and field mapping to use.  "
+  help+="Default is the one for this host"
+  parser.add_option("-k", "--hostKey",
+                    action="store", type="string",
+                    default=None,
+                    dest="hostKey",
+                    help=help)
+  help="First local time to send, e.g. '2015-08-17 06:30'.  Default is the "
+  help+="start of the oldest segment"
+  parser.add_option("--start",
+                    action="store", type="string",
+                    default=None,
+                    dest="start",
+                    help=help)
+  help="Local time to stop before.  Default is now"
+  parser.add_option("--end",
+                    action="store", type="string",
+                    default=None,
+                    dest="end",
+                    help=help)
+  help ="Send one row, the mean of its samples, per this many seconds.  "
+  help+="Default is the host block's update_frequency; 0 sends every sample"
+  parser.add_option("-e", "--everySeconds",
+                    action="store", type="float",
+                    default=None,
+                    dest="everySeconds",
+                    help=help)
+  help ="Seconds between bulk updates.  "
+  help+="Default is %s" % defaultMinIntervalSeconds
+  parser.add_option("-i", "--minInterval",
+                    action="store", type="float",
+                    default=defaultMinIntervalSeconds,
+                    dest="minIntervalSeconds",
+                    help=help)
+  help ="Checkpoint file recording how far the backfill got.  Default is "
+  help+="'<logFileRoot>.backfill.<channel>.checkpoint'"
+  parser.add_option("--checkpointFile",
+                    action="store", type="string",
+                    default=None,
+                    dest="checkpointFilename",
+                    help=help)
+  help="Start from --start even if a checkpoint says otherwise"
+  parser.add_option("--ignoreCheckpoint",
+                    action="store_true",
+                    default=False,
+                    dest="ignoreCheckpoint",
+                    help=help)
+  help ="Base URL of the ThingSpeak server.  "
+  help+="Default is '%s'" % defaultBaseUrl
+  parser.add_option("-u", "--thingspeakUrl",
+                    action="store", type="string",
+                    default=defaultBaseUrl,
+                    dest="thingspeakUrl",
+                    help=help)
+  help="Write the payloads to this file, one per line, instead of sending"
+  parser.add_option("-o", "--outputFile",
+                    action="store", type="string",
+                    default=None,
+                    dest="outputFilename",
+                    help=help)
+  (clo, cla) = parser.parse_args(cmdLineArgs)
+  return (clo, cla)
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+  hostConfig = loadHostConfig(clo.configFilename, clo.hostKey)
+  sensors = makeSensors(hostConfig.data)
+
+  segments = findRawSegments(clo.logFileRoot)
+  if not segments:
+    print("No segments '%s.<date>.raw.tsd' to backfill from"
+          % clo.logFileRoot)
+    sys.exit(1)
+  if clo.start:
+    start = parseTime(clo.start)
+  else:
+    start = parseTime(segments[0][0])
+  end = parseTime(clo.end) if clo.end else time.time()
+
+  everySeconds = clo.everySeconds
+  if everySeconds is None:
+    everySeconds = hostConfig.updateFrequency
+
+  checkpointFilename = clo.checkpointFilename or makeCheckpointFileName(
+    clo.logFileRoot, hostConfig.channelId)
+  if clo.ignoreCheckpoint and os.path.exists(checkpointFilename):
+    os.remove(checkpointFilename)
+
+  backfill = ReadingBackfill(clo.logFileRoot, sensors, hostConfig.channelId,
+                             hostConfig.writeKey, everySeconds=everySeconds,
+                             checkpointFileName=checkpointFilename)
+  backfill.verbose = clo.verbose
+
+  cpuStart = time.process_time()
+  if clo.outputFilename:
+    with open(clo.outputFilename, "w") as outputStream:
+      rows = backfill.write(outputStream, start, end)
+    print("Wrote %s rows to '%s'" % (rows, clo.outputFilename))
+  else:
+    client = ThingSpeakBulkClient(hostConfig.channelId, hostConfig.writeKey,
+                                  baseUrl=clo.thingspeakUrl,
+                                  connectTimeout=hostConfig.connectTimeout,
+                                  readTimeout=hostConfig.readTimeout)
+    client.verbose = clo.verbose
+    try:
+      rows = backfill.upload(client, start, end, clo.minIntervalSeconds)
+    finally:
+      client.close()
+    print("Backfilled %s rows into channel %s"
+          % (rows, hostConfig.channelId))
+  if clo.verbose:
+    print("CPU time: %.2f secs" % (time.process_time() - cpuStart))
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+
+# Queues readings locally and sends them to ThingSpeak as bulk updates.
+# A flush happens when the queue holds maxBatchSize readings, when the oldest
+# queued reading is maxBatchAgeSeconds old, or, after a failed flush, as soon
+# as a retry gets through again.  Retries back off exponentially, with some
+# jitter so a fleet coming back online does not retry in lockstep.  Once the
+# network is back the whole backlog is sent, in chunks of at most
+# thingSpeakClient.bulkUpdateLimit readings.
+
+import time
+import random
+from collections import deque
+
+from thingSpeakClient import ThingSpeakError, bulkUpdateLimit
+
+defaultBatchSize           = 10
+defaultBatchMaxAgeSeconds  = 3600
+defaultRetrySeconds        = 15
+defaultMaxRetrySeconds     = 900
+defaultMaxQueueLength      = 20000
+
+class ReadingBatcher(object):
+
+  def __init__(self, client,
+               maxBatchSize=defaultBatchSize,
+               maxBatchAgeSeconds=defaultBatchMaxAgeSeconds,
+               retrySeconds=defaultRetrySeconds,
+               maxRetrySeconds=defaultMaxRetrySeconds,
+               maxQueueLength=defaultMaxQueueLength):
+    assert maxBatchSize >= 1, "maxBatchSize must be at least 1"
+
+    self.client             = client
+    self.maxBatchSize       = min(maxBatchSize, bulkUpdateLimit)
+    self.maxBatchAgeSeconds = maxBatchAgeSeconds
+    self.retrySeconds       = retrySeconds
+    self.maxRetrySeconds    = maxRetrySeconds
+    self.retryDelay         = retrySeconds
+    self.queue              = deque(maxlen=maxQueueLength)
+    self.networkUp          = True
+    self.nextRetryTime      = 0.0
+    self.droppedCount       = 0
+    self.flushCount         = 0
+    self.verbose            = False
+
+  def __len__(self):
+    return len(self.queue)
+
+  def add(self, reading):
+    if len(self.queue) == self.queue.maxlen:
+      self.droppedCount += 1
+    self.queue.append(reading)
+
+  def oldestAge(self, now=None):
+    if not self.queue:
+      return 0.0
+    if now is None:
+      now = time.time()
+    return now - self.queue[0]["created_at"]
+
+  def flushDue(self, now=None):
+    if not self.queue:
+      return False
+    if now is None:
+      now = time.time()
+
+    if not self.networkUp:
+      return now >= self.nextRetryTime
+
+    return (len(self.queue) >= self.maxBatchSize
+            or self.oldestAge(now) >= self.maxBatchAgeSeconds)
+
+  def flush(self, now=None):
+    # Returns the list of readings that were accepted by ThingSpeak.  Readings
+    # that could not be sent stay queued for the next attempt.
+    if now is None:
+      now = time.time()
+
+    flushed = []
+    while self.queue:
+      chunk = [self.queue[i]
+               for i in range(min(len(self.queue), bulkUpdateLimit))]
+      try:
+        self.client.bulkUpdate(chunk)
+      except ThingSpeakError as e:
+        if self.networkUp:
+          self.retryDelay = self.retrySeconds
+          print("Bulk update of %s readings failed, retrying with backoff:"
+                % len(chunk))
+          print("Error msg:", str(e))
+        else:
+          self.retryDelay = min(self.retryDelay * 2, self.maxRetrySeconds)
+        self.networkUp     = False
+        self.nextRetryTime = now + self.retryDelay * random.uniform(0.8, 1.2)
+        break
+
+      for i in range(len(chunk)):
+        self.queue.popleft()
+      flushed.extend(chunk)
+      self.flushCount += 1
+
+      if not self.networkUp:
+        print("Bulk update succeeded again, %s readings left in backlog"
+              % len(self.queue))
+        self.networkUp = True
+
+      if self.verbose:
+        print("Bulk update sent %s readings" % len(chunk))
+
+    return flushed
+
+  def flushIfDue(self, now=None):
+    if self.flushDue(now):
+      return self.flush(now)
+    return []
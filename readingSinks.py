@@ -0,0 +1,620 @@
+#!/usr/bin/env python3
+
+# Destinations for the collector's readings.  Each sink is fed by its own
+# SinkWorker: a bounded queue and a thread that writes whatever has piled
+# up, up to maxBatch readings at a time.  A slow or failing sink only ever
+# fills its own queue, so it cannot hold up the other sinks or the sampler.
+# What happens once a queue is full is the sink's backpressure policy:
+#
+#   "drop-oldest"  the oldest queued reading makes room for the new one
+#   "block"        the engine's publisher for this sink waits for room.  The
+#                  sampler keeps going: the sink's output is added to the
+#                  engine as lossless, so readings pile up in the engine's
+#                  unbounded queue for it rather than being dropped.
+#   "spill"        new readings go to '<logFileRoot>.sink.<name>.spill', one
+#                  JSON reading per line, and are read back in order once
+#                  the sink catches up.  Whatever is left in the file at exit
+#                  is sent on the next start.
+#
+# A failed write is retried with backoff until it succeeds, so sinks deliver
+# at least once: after a failure part way through a batch, the part that
+# did get through is sent again.
+#
+# Built in are ThingSpeakSink and StoreSink, which temp_to_thing_speak.py
+# always sets up, and the optional sinks listed in a host block:
+#
+#   "sinks":[{"type":"mqtt", "host":"localhost", "port":1883,
+#             "topic":"home/frig_freezer", "qos":1,
+#             "backpressure":"spill"},
+#            {"type":"csv", "queue_size":5000},
+#            {"type":"parquet", "backpressure":"drop-oldest"}]
+#
+# The MQTT sink needs paho-mqtt (pip3 install paho-mqtt) and the Parquet
+# sink pyarrow; both are only imported once such a sink is made.
+# mqttStub.py stands in for a broker when testing.
+
+import os
+import csv
+import json
+import time
+import threading
+import collections
+
+from thingSpeakClient import formatCreatedAt
+from timeSeriesStore import dateStampOf
+from collectorMetrics import registry
+
+sinkTypes            = ("mqtt", "csv", "parquet")
+backpressurePolicies = ("drop-oldest", "block", "spill")
+quantityColumns      = ("temp_c", "temp_f", "humidity")
+
+defaultSinkQueueSize   = 1000
+defaultMaxBatch        = 100
+defaultRetrySeconds    = 1.0
+defaultMaxRetrySeconds = 60.0
+defaultMqttPort        = 1883
+defaultMqttKeepalive   = 60
+defaultPublishTimeout  = 10.0
+
+class SinkError(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+def makeSpillFileName(logFileRoot, sinkName):
+  return "%s.sink.%s.spill" % (logFileRoot, sinkName)
+
+class ReadingSink(object):
+
+  # Subclasses set name and implement write() or writeBatch().  All three
+  # methods are only called on the sink's worker thread.
+
+  name = "sink"
+
+  def writeBatch(self, readings):
+    for reading in readings:
+      self.write(reading)
+
+  def write(self, reading):
+    raise NotImplementedError
+
+  def close(self):
+    pass
+
+class SpillFile(object):
+
+  # Overflow of one sink.  Readings are appended as JSON lines and read back
+  # oldest first; the file is emptied whenever the worker catches up.
+
+  def __init__(self, fileName):
+    self.fileName   = fileName
+    self.lock       = threading.Lock()
+    self.stream     = open(fileName, "ab")
+    self.size       = self.stream.tell()
+    self.readOffset = 0
+
+  def pending(self):
+    return self.size > self.readOffset
+
+  def append(self, reading):
+    data = (json.dumps(reading) + "\n").encode("UTF-8")
+    with self.lock:
+      self.stream.write(data)
+      self.stream.flush()
+      self.size += len(data)
+
+  def read(self, limit):
+    # Returns (readings, offset) of up to limit readings, to be passed to
+    # consume() once they are written
+    readings = []
+    with self.lock:
+      with open(self.fileName, "rb") as reader:
+        reader.seek(self.readOffset)
+        offset = self.readOffset
+        while len(readings) < limit and offset < self.size:
+          line = reader.readline()
+          offset += len(line)
+          try:
+            readings.append(json.loads(line.decode("UTF-8")))
+          except ValueError:
+            # The torn last line of a crash
+            pass
+    return (readings, offset)
+
+  def keep(self, readings):
+    # Puts readings ahead of those still in the file.  They are older than
+    # anything spilled, so this keeps the order at a restart.
+    if not readings:
+      return
+    with self.lock:
+      with open(self.fileName, "rb") as reader:
+        reader.seek(self.readOffset)
+        rest = reader.read(self.size - self.readOffset)
+      tmpFileName = self.fileName + ".tmp"
+      with open(tmpFileName, "wb") as stream:
+        for reading in readings:
+          stream.write((json.dumps(reading) + "\n").encode("UTF-8"))
+        stream.write(rest)
+      os.replace(tmpFileName, self.fileName)
+      self.stream.close()
+      self.stream     = open(self.fileName, "ab")
+      self.size       = self.stream.tell()
+      self.readOffset = 0
+
+  def consume(self, offset):
+    with self.lock:
+      self.readOffset = offset
+      if self.readOffset >= self.size:
+        self.stream.truncate(0)
+        self.size       = 0
+        self.readOffset = 0
+
+  def close(self):
+    with self.lock:
+      self.stream.close()
+
+class SinkWorker(object):
+
+  def __init__(self, sink, queueSize=defaultSinkQueueSize,
+               backpressure="drop-oldest", spillFileName=None,
+               maxBatch=defaultMaxBatch):
+    assert backpressure in backpressurePolicies,\
+      "Unknown backpressure policy '%s'" % backpressure
+    assert backpressure != "spill" or spillFileName,\
+      "The spill policy needs a spill file"
+
+    self.sink         = sink
+    self.queueSize    = queueSize
+    self.backpressure = backpressure
+    self.maxBatch     = maxBatch
+    self.queue        = collections.deque()
+    self.condition    = threading.Condition()
+    self.stopping     = threading.Event()
+    self.spill        = None
+    self.unwritten    = []
+    self.thread       = None
+    self.verbose      = False
+    if backpressure == "spill":
+      self.spill = SpillFile(spillFileName)
+
+    labels = {"sink":sink.name}
+    self.written = registry.counter(
+      "sink_readings_written_total", "Readings written by a sink", labels)
+    self.dropped = registry.counter(
+      "sink_readings_dropped_total",
+      "Readings dropped because a sink's queue was full", labels)
+    self.spilled = registry.counter(
+      "sink_readings_spilled_total",
+      "Readings sent to a sink's spill file because its queue was full",
+      labels)
+    self.failures = registry.counter(
+      "sink_write_failures_total", "Failed writes of a batch to a sink",
+      labels)
+    self.writeSeconds = registry.histogram(
+      "sink_write_seconds", "Time taken by one batch write of a sink",
+      labels)
+    registry.gauge("sink_queue_depth", "Readings queued for a sink", labels,
+                   function=self.queue.__len__)
+
+  def isLossless(self):
+    # Whether CollectorEngine.addOutput() must never drop for this sink
+    return self.backpressure == "block"
+
+  def makeOutput(self):
+    # What to hand to CollectorEngine.addOutput() for this sink
+    if self.backpressure == "block":
+      return self.putWhenRoom
+    return self.put
+
+  def put(self, reading):
+    with self.condition:
+      if self.spill is not None and (self.spill.pending()
+                                     or len(self.queue) >= self.queueSize):
+        # Once spilling, everything goes through the file to keep order
+        self.spill.append(reading)
+        self.spilled.inc()
+      else:
+        if len(self.queue) >= self.queueSize:
+          self.queue.popleft()
+          self.dropped.inc()
+        self.queue.append(reading)
+      self.condition.notify_all()
+
+  def putBlocking(self, reading):
+    with self.condition:
+      while len(self.queue) >= self.queueSize and not self.stopping.is_set():
+        self.condition.wait()
+    self.put(reading)
+
+  async def putWhenRoom(self, reading):
+    with self.condition:
+      if len(self.queue) < self.queueSize:
+        self.queue.append(reading)
+        self.condition.notify_all()
+        return
+    import asyncio
+    await asyncio.get_running_loop().run_in_executor(None, self.putBlocking,
+                                                     reading)
+
+  def start(self):
+    self.thread = threading.Thread(target=self.run,
+                                   name="sink-" + self.sink.name,
+                                   daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self, timeout=None):
+    # Lets the worker write what is queued, for at most timeout seconds.
+    # With the spill policy, whatever it could not get to is kept in the
+    # spill file for the next start.
+    self.stopping.set()
+    with self.condition:
+      self.condition.notify_all()
+    if self.thread:
+      self.thread.join(timeout)
+    with self.condition:
+      if self.spill is not None:
+        self.spill.keep(self.unwritten + list(self.queue))
+        self.queue.clear()
+    if self.thread is None or not self.thread.is_alive():
+      self.sink.close()
+      if self.spill is not None:
+        self.spill.close()
+
+  def take(self):
+    # Returns (readings, spillOffset), or None once stopping with nothing
+    # left to write
+    with self.condition:
+      while (not self.queue
+             and not (self.spill is not None and self.spill.pending())
+             and not self.stopping.is_set()):
+        self.condition.wait()
+      if self.queue:
+        count = min(len(self.queue), self.maxBatch)
+        readings = [self.queue.popleft() for i in range(count)]
+        self.condition.notify_all()
+        return (readings, None)
+      if self.spill is not None and self.spill.pending():
+        return self.spill.read(self.maxBatch)
+      return None
+
+  def run(self):
+    while True:
+      batch = self.take()
+      if batch is None:
+        return
+      (readings, spillOffset) = batch
+      if self.writeBatch(readings):
+        if spillOffset is not None:
+          self.spill.consume(spillOffset)
+        continue
+      # Still failing when told to stop.  stop() spills these along with
+      # the rest of the queue; readings read from the spill file are still
+      # in it.
+      if spillOffset is None:
+        self.unwritten = readings
+      return
+
+  def writeBatch(self, readings):
+    # Returns True once the sink took the readings, False if it still
+    # failed when the worker was told to stop
+    retryDelay = defaultRetrySeconds
+    failing    = False
+    while True:
+      start = time.perf_counter()
+      try:
+        self.sink.writeBatch(readings)
+      except Exception as e:
+        self.failures.inc()
+        if not failing:
+          print("Sink '%s' failed to write %s readings, retrying with "
+                "backoff:" % (self.sink.name, len(readings)))
+          try:
+            print("Error msg:",str(e))
+          except:
+            print("  Sorry, could not print sink error msg.")
+          failing = True
+        if self.stopping.wait(retryDelay):
+          return False
+        retryDelay = min(retryDelay * 2, defaultMaxRetrySeconds)
+        continue
+
+      self.writeSeconds.observe(time.perf_counter() - start)
+      self.written.inc(len(readings))
+      if failing:
+        print("Sink '%s' is writing again" % self.sink.name)
+      elif self.verbose:
+        print("Sink '%s' wrote %s readings" % (self.sink.name, len(readings)))
+      return True
+
+class ThingSpeakSink(ReadingSink):
+
+  # Hands readings to the uploader through the ThingSpeak spool.  The
+  # uploader thread does the network I/O, so writes here stay short.
+
+  name = "thingspeak"
+
+  def __init__(self, spool, uploader, publishPolicy=None):
+    self.spool         = spool
+    self.uploader      = uploader
+    self.publishPolicy = publishPolicy
+    self.lock          = threading.Lock()
+
+  def setPublishPolicy(self, publishPolicy):
+    # A new policy carries on from the state of the one it replaces
+    with self.lock:
+      if publishPolicy is not None and self.publishPolicy is not None:
+        publishPolicy.takeStateFrom(self.publishPolicy)
+      self.publishPolicy = publishPolicy
+
+  def write(self, reading):
+    urgent = False
+    with self.lock:
+      if self.publishPolicy is not None:
+        (publish, urgent) = self.publishPolicy.decide(reading)
+        if not publish:
+          # A batch may still be due, and without a poll interval this is
+          # the uploader's only chance to notice
+          self.uploader.poke()
+          return
+    # The other sinks share the reading and read it on their own threads,
+    # so the spool's seq goes on a copy
+    reading = dict(reading)
+    reading["seq"] = self.spool.append(reading)
+    self.uploader.add(reading)
+    self.uploader.poke()
+    if urgent:
+      print("Threshold crossed, publishing immediately")
+      self.uploader.flushNow()
+
+class StoreSink(ReadingSink):
+
+  name = "store"
+
+  def __init__(self, store, sensors):
+    self.store   = store
+    self.sensors = sensors
+
+  def write(self, reading):
+    values = []
+    for sensor in self.sensors:
+      humidity, temp_c = reading["samples"][sensor.name]
+      values.append(temp_c)
+      values.append(humidity)
+    self.store.append(reading["created_at"], values)
+
+  def close(self):
+    self.store.close()
+
+def getQuantityColumns(sensors):
+  return ["%s.%s" % (sensor.name, quantity) for sensor in sensors
+          for quantity in quantityColumns]
+
+def getQuantityRow(reading, sensors):
+  quantities = reading.get("quantities", {})
+  return [quantities.get(sensor.name, {}).get(quantity)
+          for sensor in sensors for quantity in quantityColumns]
+
+class CsvSink(ReadingSink):
+
+  # One '<root>.<date>.csv' file per day: created_at, then temp_c, temp_f
+  # and humidity of each sensor, empty where a sensor had no reading.
+
+  name = "csv"
+
+  def __init__(self, root, sensors):
+    self.root      = root
+    self.sensors   = sensors
+    self.columns   = ["created_at"] + getQuantityColumns(sensors)
+    self.dateStamp = None
+    self.stream    = None
+    self.writer    = None
+
+  def openDay(self, dateStamp):
+    self.close()
+    fileName = "%s.%s.csv" % (self.root, dateStamp)
+    newFile = not os.path.exists(fileName) or not os.path.getsize(fileName)
+    self.stream = open(fileName, "a", newline="")
+    self.writer = csv.writer(self.stream)
+    if newFile:
+      self.writer.writerow(self.columns)
+    self.dateStamp = dateStamp
+
+  def writeBatch(self, readings):
+    for reading in readings:
+      dateStamp = dateStampOf(reading["created_at"])
+      if dateStamp != self.dateStamp:
+        self.openDay(dateStamp)
+      self.writer.writerow([formatCreatedAt(reading["created_at"])]
+                           + getQuantityRow(reading, self.sensors))
+    self.stream.flush()
+
+  def close(self):
+    if self.stream:
+      self.stream.close()
+      self.stream = None
+      self.dateStamp = None
+
+class ParquetSink(ReadingSink):
+
+  # One '<root>.<date>.<n>.parquet' file per day and run, with a row group
+  # per batch.  A Parquet file is only readable once closed, which happens
+  # at midnight and when the collector stops.
+
+  name = "parquet"
+
+  def __init__(self, root, sensors):
+    try:
+      import pyarrow
+      import pyarrow.parquet
+    except ImportError:
+      raise SinkError("The parquet sink needs pyarrow: pip3 install pyarrow")
+    self.pyarrow   = pyarrow
+    self.root      = root
+    self.sensors   = sensors
+    self.columns   = getQuantityColumns(sensors)
+    self.schema    = pyarrow.schema(
+      [("created_at", pyarrow.timestamp("ms", tz="UTC"))]
+      + [(column, pyarrow.float64()) for column in self.columns])
+    self.dateStamp = None
+    self.writer    = None
+
+  def openDay(self, dateStamp):
+    self.close()
+    part = 0
+    while os.path.exists("%s.%s.%s.parquet" % (self.root, dateStamp, part)):
+      part += 1
+    fileName = "%s.%s.%s.parquet" % (self.root, dateStamp, part)
+    self.writer = self.pyarrow.parquet.ParquetWriter(fileName, self.schema)
+    self.dateStamp = dateStamp
+
+  def writeBatch(self, readings):
+    # A batch that straddles midnight is split between the two days' files
+    start = 0
+    while start < len(readings):
+      dateStamp = dateStampOf(readings[start]["created_at"])
+      end = start
+      while (end < len(readings)
+             and dateStampOf(readings[end]["created_at"]) == dateStamp):
+        end += 1
+      if dateStamp != self.dateStamp:
+        self.openDay(dateStamp)
+      self.writeRows(readings[start:end])
+      start = end
+
+  def writeRows(self, readings):
+    rows = [getQuantityRow(reading, self.sensors) for reading in readings]
+    data = {"created_at":[int(reading["created_at"] * 1000)
+                          for reading in readings]}
+    for (index, column) in enumerate(self.columns):
+      data[column] = [row[index] for row in rows]
+    self.writer.write_table(self.pyarrow.table(data, schema=self.schema))
+
+  def close(self):
+    if self.writer:
+      self.writer.close()
+      self.writer = None
+      self.dateStamp = None
+
+class MqttSink(ReadingSink):
+
+  # Publishes each reading as one JSON message:
+  #
+  #   {"created_at":"2015-08-17T06:30:00Z", "fields":{"field1":38.3, ...},
+  #    "sensors":{"frig":{"temp_c":3.5, "temp_f":38.3, "humidity":45.0}}}
+  #
+  # paho's network thread keeps the connection up and reconnects.  With
+  # qos 1 or 2 a write only succeeds once the broker has the message.
+
+  name = "mqtt"
+
+  def __init__(self, host, topic, port=defaultMqttPort, qos=0, retain=False,
+               username=None, password=None, clientId="",
+               keepalive=defaultMqttKeepalive,
+               publishTimeout=defaultPublishTimeout):
+    try:
+      import paho.mqtt.client
+    except ImportError:
+      raise SinkError("The mqtt sink needs paho-mqtt: pip3 install paho-mqtt")
+    self.mqtt           = paho.mqtt.client
+    self.connected      = threading.Event()
+    self.topic          = topic
+    self.qos            = qos
+    self.retain         = retain
+    self.publishTimeout = publishTimeout
+
+    if hasattr(self.mqtt, "CallbackAPIVersion"):
+      self.client = self.mqtt.Client(self.mqtt.CallbackAPIVersion.VERSION2,
+                                     client_id=clientId)
+    else:
+      self.client = self.mqtt.Client(client_id=clientId)
+    if username:
+      self.client.username_pw_set(username, password)
+    # The callbacks' signatures differ between paho 1.x and 2.x
+    self.client.on_connect    = lambda *args: self.connected.set()
+    self.client.on_disconnect = lambda *args: self.connected.clear()
+    self.client.connect_async(host, port, keepalive)
+    self.client.loop_start()
+
+  def makePayload(self, reading):
+    fields = dict((key, value) for (key, value) in reading.items()
+                  if key.startswith("field"))
+    return json.dumps({"created_at":formatCreatedAt(reading["created_at"]),
+                       "fields":fields,
+                       "sensors":reading.get("quantities", {})})
+
+  def writeBatch(self, readings):
+    # Publishing while disconnected would queue messages inside paho that
+    # the retry of this batch then sends a second time
+    if not self.connected.wait(self.publishTimeout):
+      raise SinkError("Not connected to the MQTT broker")
+    messages = []
+    for reading in readings:
+      message = self.client.publish(self.topic, self.makePayload(reading),
+                                    qos=self.qos, retain=self.retain)
+      if message.rc != self.mqtt.MQTT_ERR_SUCCESS:
+        raise SinkError("MQTT publish failed: %s"
+                        % self.mqtt.error_string(message.rc))
+      messages.append(message)
+    if self.qos:
+      deadline = time.monotonic() + self.publishTimeout
+      for message in messages:
+        try:
+          message.wait_for_publish(max(0.0, deadline - time.monotonic()))
+        except (RuntimeError, ValueError) as e:
+          raise SinkError("MQTT publish failed: %s" % e)
+        if not message.is_published():
+          raise SinkError("MQTT broker did not acknowledge within %s secs"
+                          % self.publishTimeout)
+
+  def close(self):
+    self.client.disconnect()
+    self.client.loop_stop()
+
+def makeSink(sinkConfig, hostConfig, sensors, logFileRoot):
+  sinkType = sinkConfig["type"]
+  name = sinkConfig.get("name", sinkType)
+  if sinkType == "mqtt":
+    sink = MqttSink(sinkConfig.get("host", "localhost"),
+                    sinkConfig.get("topic",
+                                   "collector/%s" % hostConfig.hostKey),
+                    port=sinkConfig.get("port", defaultMqttPort),
+                    qos=sinkConfig.get("qos", 0),
+                    retain=sinkConfig.get("retain", False),
+                    username=sinkConfig.get("username"),
+                    password=sinkConfig.get("password"),
+                    clientId=sinkConfig.get("client_id", ""))
+  elif sinkType == "csv":
+    sink = CsvSink(sinkConfig.get("root", logFileRoot), sensors)
+  elif sinkType == "parquet":
+    sink = ParquetSink(sinkConfig.get("root", logFileRoot), sensors)
+  else:
+    raise SinkError("Unknown sink type '%s'" % sinkType)
+  sink.name = name
+  return sink
+
+def makeSinkWorker(sink, sinkConfig, logFileRoot):
+  return SinkWorker(sink,
+                    queueSize=sinkConfig.get("queue_size",
+                                             defaultSinkQueueSize),
+                    backpressure=sinkConfig.get("backpressure",
+                                                "drop-oldest"),
+                    spillFileName=makeSpillFileName(logFileRoot, sink.name),
+                    maxBatch=sinkConfig.get("max_batch", defaultMaxBatch))
+
+def makeSinkWorkers(hostConfig, sensors, logFileRoot):
+  # Workers for the sinks listed in the host block.  A sink that cannot be
+  # made, e.g. for lack of paho-mqtt, is reported and left out.
+  workers = []
+  for sinkConfig in hostConfig.data.get("sinks", ()):
+    try:
+      sink = makeSink(sinkConfig, hostConfig, sensors, logFileRoot)
+    except SinkError as e:
+      print("Setting up sink '%s' failed:"
+            % sinkConfig.get("name", sinkConfig["type"]))
+      print("Error msg:",str(e))
+      print("Continuing...")
+      continue
+    workers.append(makeSinkWorker(sink, sinkConfig, logFileRoot))
+  return workers
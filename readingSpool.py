@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+
+# Durable on-disk spool of readings that have not yet been accepted by
+# ThingSpeak.  The spool is a fixed-capacity ring of fixed-size binary
+# records behind a small header:
+#
+#   header: magic, version, record size, capacity, read cursor, crc32
+#   record: sequence number, created_at, field mask, field1..field8,
+#           status, crc32
+#
+# Every reading gets the next sequence number and is written to slot
+# (seq % capacity), so an append is a single small write no matter how big
+# the spool is.  Records are never rewritten in place; a slot is only reused
+# once the ring wraps, which evicts the oldest unsent reading.  fsync() is
+# batched to spare the SD card.  The write position is not stored at all: on
+# open the records are scanned and the highest sequence number with a good
+# crc wins, so a crash can lose at most the records written since the last
+# fsync, never the whole spool.  The sampling loop appends while the upload
+# thread acknowledges, so the public methods hold a lock.
+#
+# The status is kept in a fixed 255-byte slot, so a longer one comes back
+# cut short; the status line of a few sensors fits easily.  Version 1 spools
+# had no status; their unsent readings are carried over into a version 2
+# spool on open, without one.
+
+import os
+import sys
+import time
+import struct
+import zlib
+import threading
+
+spoolMagic   = b"TSPL"
+spoolVersion = 2
+
+headerFormat = "<4sHHIQ"
+headerSize   = 64
+
+fieldCount   = 8
+statusBytes  = 255
+
+# Record layout of each spool version; the crc32 follows
+recordFormats = {1:"<QdHH%df" % fieldCount,
+                 2:"<QdHH%df%dp" % (fieldCount, statusBytes + 1)}
+recordSizes   = dict((version, struct.calcsize(recordFormat) + 4)
+                     for (version, recordFormat) in recordFormats.items())
+recordFormat  = recordFormats[spoolVersion]
+recordSize    = recordSizes[spoolVersion]
+
+defaultCapacity            = 50000
+defaultSyncEvery           = 16
+defaultSyncIntervalSeconds = 300.0
+
+def makeSpoolFileName(logFileRoot):
+  return logFileRoot + ".spool"
+
+def packRecord(seq, reading):
+  mask   = 0
+  values = [0.0] * fieldCount
+  for i in range(fieldCount):
+    value = reading.get("field%d" % (i+1))
+    if value is not None:
+      mask |= 1 << i
+      values[i] = value
+
+  status = (reading.get("status") or "").encode("UTF-8")[:statusBytes]
+  data = struct.pack(recordFormat, seq, reading["created_at"], mask, 0,
+                     *(values + [status]))
+  return data + struct.pack("<I", zlib.crc32(data))
+
+def unpackRecord(data, version=spoolVersion):
+  body = data[:-4]
+  (crc,) = struct.unpack("<I", data[-4:])
+  if crc != zlib.crc32(body):
+    return (None, None)
+
+  unpacked = struct.unpack(recordFormats[version], body)
+  (seq, createdAt, mask) = unpacked[:3]
+  values = unpacked[4:4 + fieldCount]
+
+  reading = {"created_at":createdAt, "seq":seq}
+  for i in range(fieldCount):
+    if mask & (1 << i):
+      reading["field%d" % (i+1)] = round(values[i], 4)
+  if version >= 2 and unpacked[-1]:
+    # A status cut short may end part way through a character
+    reading["status"] = unpacked[-1].decode("UTF-8", "ignore")
+
+  return (seq, reading)
+
+class ReadingSpool(object):
+
+  def __init__(self, fileName,
+               capacity=defaultCapacity,
+               syncEvery=defaultSyncEvery,
+               syncIntervalSeconds=defaultSyncIntervalSeconds):
+    self.fileName            = fileName
+    self.capacity            = capacity
+    self.syncEvery           = syncEvery
+    self.syncIntervalSeconds = syncIntervalSeconds
+    self.readSeq             = 1
+    self.writeSeq            = 1
+    self.unsyncedCount       = 0
+    self.lastSyncTime        = time.monotonic()
+    self.evictedCount        = 0
+    self.syncCount           = 0
+    self.version             = spoolVersion
+    self.recordSize          = recordSize
+    self.fd                  = None
+    self.lock                = threading.RLock()
+
+    self.open()
+
+  def __len__(self):
+    return self.writeSeq - self.readSeq
+
+  def open(self):
+    if not os.path.exists(self.fileName):
+      self.fd = self.create(self.fileName)
+      return
+
+    self.fd = os.open(self.fileName, os.O_RDWR)
+    capacity = self.readHeader()
+    if capacity == self.capacity and self.version == spoolVersion:
+      self.recover()
+      return
+
+    self.migrate(capacity)
+
+  def create(self, fileName):
+    fd = os.open(fileName, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    self.readSeq  = 1
+    self.writeSeq = 1
+    os.pwrite(fd, self.packHeader(), 0)
+    os.fsync(fd)
+    return fd
+
+  def packHeader(self):
+    data = struct.pack(headerFormat, spoolMagic, spoolVersion, recordSize,
+                       self.capacity, self.readSeq)
+    data += struct.pack("<I", zlib.crc32(data))
+    return data.ljust(headerSize, b"\0")
+
+  def readHeader(self):
+    # Returns the capacity recorded in the header, or None if the file is not
+    # a spool of a version we can read.  A header with a bad crc (torn write)
+    # falls back to a read cursor of 1, which at worst re-sends readings
+    # already uploaded.
+    length = struct.calcsize(headerFormat)
+    data = os.pread(self.fd, length + 4, 0)
+    if len(data) < length + 4:
+      return None
+
+    (magic, version, size, capacity, readSeq) =\
+      struct.unpack(headerFormat, data[:length])
+    if (magic != spoolMagic or version not in recordFormats
+        or size != recordSizes[version]):
+      return None
+    self.version    = version
+    self.recordSize = size
+
+    (crc,) = struct.unpack("<I", data[length:])
+    if crc == zlib.crc32(data[:length]):
+      self.readSeq = readSeq
+    else:
+      print("Spool '%s' header is damaged, replaying all records"
+            % self.fileName, file=sys.stderr)
+      self.readSeq = 1
+
+    return capacity
+
+  def slotOffset(self, seq):
+    return headerSize + (seq % self.capacity) * self.recordSize
+
+  def scanRecords(self):
+    # Yields (seq, reading) for every valid record in the file, in slot order
+    chunkRecords = 4096
+    for firstSlot in range(0, self.capacity, chunkRecords):
+      count = min(chunkRecords, self.capacity - firstSlot)
+      data = os.pread(self.fd, count * self.recordSize,
+                      headerSize + firstSlot * self.recordSize)
+      for i in range(len(data) // self.recordSize):
+        (seq, reading) = unpackRecord(
+          data[i*self.recordSize:(i+1)*self.recordSize], self.version)
+        if seq and seq % self.capacity == firstSlot + i:
+          yield (seq, reading)
+
+  def recover(self):
+    maxSeq = 0
+    for (seq, reading) in self.scanRecords():
+      maxSeq = max(maxSeq, seq)
+
+    self.writeSeq = maxSeq + 1
+    self.readSeq  = max(self.readSeq, self.writeSeq - self.capacity, 1)
+    self.readSeq  = min(self.readSeq, self.writeSeq)
+
+  def migrate(self, oldCapacity):
+    # The file was written with another capacity or an older version, or is
+    # not a spool at all.  Carry any unsent readings over into a fresh spool
+    # with the current capacity and version.
+    pending = []
+    if oldCapacity:
+      print("Spool '%s' changed from %s records of version %s to %s of "
+            % (self.fileName, oldCapacity, self.version, self.capacity) +
+            "version %s, migrating unsent readings" % spoolVersion,
+            file=sys.stderr)
+      capacity = self.capacity
+      self.capacity = oldCapacity
+      self.recover()
+      pending = self.pending()
+      self.capacity = capacity
+    else:
+      print("File '%s' is not a spool, replacing it" % self.fileName,
+            file=sys.stderr)
+    os.close(self.fd)
+
+    self.version    = spoolVersion
+    self.recordSize = recordSize
+    tmpFileName = self.fileName + ".tmp"
+    self.fd = self.create(tmpFileName)
+    for (seq, reading) in pending[-self.capacity:]:
+      self.append(reading)
+    self.sync()
+    os.replace(tmpFileName, self.fileName)
+
+  def append(self, reading):
+    with self.lock:
+      seq = self.writeSeq
+      os.pwrite(self.fd, packRecord(seq, reading), self.slotOffset(seq))
+      self.writeSeq += 1
+
+      if self.writeSeq - self.readSeq > self.capacity:
+        self.readSeq = self.writeSeq - self.capacity
+        self.evictedCount += 1
+
+      self.unsyncedCount += 1
+      self.maybeSync()
+    return seq
+
+  def acknowledge(self, seq):
+    # All readings up to and including seq have been uploaded
+    with self.lock:
+      if seq + 1 <= self.readSeq:
+        return
+      self.readSeq = min(seq + 1, self.writeSeq)
+      os.pwrite(self.fd, self.packHeader(), 0)
+      self.unsyncedCount += 1
+      self.maybeSync()
+
+  def pending(self, limit=None):
+    readings = []
+    with self.lock:
+      seq = self.readSeq
+      while seq < self.writeSeq and (limit is None or len(readings) < limit):
+        data = os.pread(self.fd, self.recordSize, self.slotOffset(seq))
+        (recordSeq, reading) = unpackRecord(data, self.version)
+        if recordSeq == seq:
+          readings.append((seq, reading))
+        seq += 1
+
+    return readings
+
+  def maybeSync(self):
+    if not self.unsyncedCount:
+      return
+    if (self.unsyncedCount >= self.syncEvery
+        or time.monotonic() - self.lastSyncTime >= self.syncIntervalSeconds):
+      self.sync()
+
+  def sync(self):
+    with self.lock:
+      if self.unsyncedCount:
+        os.fsync(self.fd)
+        self.syncCount += 1
+      self.unsyncedCount = 0
+      self.lastSyncTime  = time.monotonic()
+
+  def close(self):
+    with self.lock:
+      if self.fd is not None:
+        self.sync()
+        os.close(self.fd)
+        self.fd = None
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+# Sensors the collector can read.  Each sensor is built from one entry of the
+# "sensors" list of a host block in temp_to_thing_speak.conf, e.g.
+#
+#   {"name":"frig", "type":"DHT22", "pin":4, "fields":{1:"temp_f", 2:"humidity"}}
+#
+# "fields" maps ThingSpeak channel field numbers to the quantity published
+# in that field: "temp_c", "temp_f" or "humidity", a quantity derived from
+# them such as "dew_point_f" (derivedMetrics.py), or a statistic of one of
+# them such as "temp_f.max" when the host aggregates (windowAggregator.py).
+#
+# Besides the real DHT sensors there are two backends that run anywhere:
+#
+#   "synthetic" - deterministic generated readings with configurable rate,
+#                 noise and injected failures, for load tests
+#   "replay"    - readings played back from a CSV file of
+#                 created_at,humidity,temp_c lines
+#
+# Adafruit_DHT is only imported when a DHT sensor is actually read, so
+# everything else works off a Pi.
+#
+# A backend's read() is a single attempt; retries, the read time budget and
+# the plausibility checks are done by sensorReader.py.
+
+import csv
+import math
+import random
+
+from derivedMetrics import derivedQuantityNames
+
+quantityNames = ("temp_c", "temp_f", "humidity")
+
+class DHTSensor(object):
+
+  # Minimum seconds between two reads of the same sensor, per the datasheets
+  minReadIntervals = {"DHT11":1.0, "DHT22":2.0, "AM2302":2.0}
+
+  def __init__(self, name, sensorType, pin, fields):
+    assert sensorType in DHTSensor.minReadIntervals,\
+      "Unknown sensor type '%s' for sensor '%s'. Known types are %s" %\
+      (sensorType, name, list(DHTSensor.minReadIntervals))
+
+    self.name            = name
+    self.sensorType      = sensorType
+    self.pin             = pin
+    self.fields          = fields
+    self.minReadInterval = DHTSensor.minReadIntervals[sensorType]
+
+  def read(self):
+    # One attempt, returning (humidity, temp_c), either of which may be
+    # None.  Retrying within a time budget is up to the SensorReader.
+    import Adafruit_DHT
+    sensorId = getattr(Adafruit_DHT, self.sensorType)
+    humidity, temp_c = Adafruit_DHT.read(sensorId, self.pin)
+    return (humidity, temp_c)
+
+  def describe(self):
+    return "%s(%s on GPIO %s)" % (self.name, self.sensorType, self.pin)
+
+class SyntheticSensorError(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+class SyntheticSensor(object):
+
+  # Readings follow a sine wave around (temp_c, humidity) plus gaussian noise.
+  # The wave advances by 1/rate seconds per read, not by wall-clock time, so
+  # a given seed always produces the same sequence however fast it is read.
+  # failureRate is the fraction of reads that fail, half of them returning
+  # (None, None) like a DHT checksum error and half raising an exception.
+
+  def __init__(self, name, fields, rate=0.0, temp_c=4.0, humidity=45.0,
+               amplitude=1.5, period=1800.0, noise=0.1, failureRate=0.0,
+               seed=0):
+    self.name            = name
+    self.fields          = fields
+    self.rate            = rate
+    self.temp_c          = temp_c
+    self.humidity        = humidity
+    self.amplitude       = amplitude
+    self.period          = period
+    self.noise           = noise
+    self.failureRate     = failureRate
+    self.random          = random.Random(seed)
+    self.readCount       = 0
+    self.minReadInterval = 0.0
+    if rate:
+      self.minReadInterval = 1.0 / rate
+
+  def read(self):
+    self.readCount += 1
+    if self.failureRate and self.random.random() < self.failureRate:
+      if self.random.random() < 0.5:
+        return (None, None)
+      raise SyntheticSensorError("Injected failure on read %s"
+                                 % self.readCount)
+
+    elapsed = self.readCount * (self.minReadInterval or 1.0)
+    wave = math.sin(2.0 * math.pi * elapsed / self.period)
+    temp_c = (self.temp_c + self.amplitude * wave
+              + self.random.gauss(0.0, self.noise))
+    humidity = (self.humidity - 2.0 * self.amplitude * wave
+                + self.random.gauss(0.0, self.noise))
+    return (round(humidity, 1), round(temp_c, 1))
+
+  def describe(self):
+    return "%s(synthetic)" % self.name
+
+class ReplaySensor(object):
+
+  # Plays back created_at,humidity,temp_c lines from a CSV file, one line per
+  # read.  Empty humidity or temp_c columns replay as None.  With loop set,
+  # the file starts over at the end, otherwise reads return (None, None).
+
+  def __init__(self, name, fields, fileName, loop=True):
+    self.name            = name
+    self.fields          = fields
+    self.fileName        = fileName
+    self.loop            = loop
+    self.minReadInterval = 0.0
+    self.stream          = None
+    self.reader          = None
+    self.rewind()
+
+  def rewind(self):
+    if self.stream:
+      self.stream.close()
+    self.stream = open(self.fileName, newline="")
+    self.reader = csv.reader(self.stream)
+
+  def nextRow(self):
+    for row in self.reader:
+      if row and not row[0].startswith("#"):
+        return row
+    return None
+
+  def read(self):
+    row = self.nextRow()
+    if row is None and self.loop:
+      self.rewind()
+      row = self.nextRow()
+    if row is None:
+      return (None, None)
+
+    (createdAt, humidity, temp_c) = row[:3]
+    return (float(humidity) if humidity else None,
+            float(temp_c) if temp_c else None)
+
+  def describe(self):
+    return "%s(replay of '%s')" % (self.name, self.fileName)
+
+def makeSensor(sensorConfig, overrides=None):
+  # overrides replaces entries of the sensor's config, e.g. {"type":"synthetic"}
+  # to run a Pi's configuration with synthetic sensors on a desktop.
+  if overrides:
+    sensorConfig = dict(sensorConfig, **overrides)
+
+  name   = sensorConfig.get("name", "sensor")
+  fields = sensorConfig["fields"]
+  names  = quantityNames + derivedQuantityNames(sensorConfig.get("derived"))
+  for (field, quantity) in fields.items():
+    assert quantity.partition(".")[0] in names,\
+      "Unknown quantity '%s' for field %s of sensor '%s'. Known are %s" %\
+      (quantity, field, name, names)
+
+  sensorType = sensorConfig.get("type", "DHT22")
+  if sensorType == "synthetic":
+    sensor = SyntheticSensor(name, fields,
+                           rate=sensorConfig.get("rate", 0.0),
+                           temp_c=sensorConfig.get("temp_c", 4.0),
+                           humidity=sensorConfig.get("humidity", 45.0),
+                           amplitude=sensorConfig.get("amplitude", 1.5),
+                           period=sensorConfig.get("period", 1800.0),
+                           noise=sensorConfig.get("noise", 0.1),
+                           failureRate=sensorConfig.get("failure_rate", 0.0),
+                           seed=sensorConfig.get("seed", 0))
+  elif sensorType == "replay":
+    assert "file" in sensorConfig,\
+      "Replay sensor '%s' needs a \"file\" entry" % name
+    sensor = ReplaySensor(name, fields, sensorConfig["file"],
+                          loop=sensorConfig.get("loop", True))
+  else:
+    sensor = DHTSensor(name, sensorType, sensorConfig.get("pin", 4), fields)
+
+  # Kept for the read budget and filter options used by sensorReader.py
+  sensor.config = sensorConfig
+  return sensor
+
+def makeSensors(configDataDict, overrides=None):
+  # Host blocks without a "sensors" list get the original single DHT22 on
+  # GPIO 4 published to fields 1-4.
+  sensorConfigs = configDataDict.get("sensors")
+  if not sensorConfigs:
+    sensorConfigs = [{"name":"dht22", "type":"DHT22", "pin":4,
+                      "fields":{1:"temp_f", 2:"humidity",
+                                3:"temp_f", 4:"humidity"}}]
+
+  sensors = [makeSensor(sensorConfig, overrides)
+             for sensorConfig in sensorConfigs]
+
+  names = [sensor.name for sensor in sensors]
+  assert len(set(names)) == len(names),\
+    "Sensor names must be unique, found %s" % names
+
+  fields = [field for sensor in sensors for field in sensor.fields]
+  assert len(set(fields)) == len(fields),\
+    "Each channel field can only be fed by one sensor, found %s" % fields
+
+  return sensors
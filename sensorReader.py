@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# The read path between a sensor backend and the collector.  A SensorReader
+# retries a sensor only while it has time left in its latency budget and
+# returns as soon as a sample passes the plausibility checks, so a flaky DHT
+# costs at most "read_budget" seconds instead of the 15 x 2 sec of
+# Adafruit_DHT.read_retry().  Options come from the sensor's entry in the
+# config file:
+#
+#   {"name":"freezer", "type":"DHT22", "pin":17, "fields":{3:"temp_f"},
+#    "read_budget":6, "max_attempts":3,
+#    "filter":{"temp_c":[-40, 80], "humidity":[0, 100],
+#              "max_temp_c_rate":0.5, "max_humidity_rate":2.0,
+#              "median_of":3}}
+#
+# A sample is rejected when a value is missing (None, never merely 0.0), out
+# of its range, or changed faster than its max rate (units per second)
+# since the last accepted sample.  A step change that is still there after
+# spikeLimit rejections is real and becomes the new baseline.  With
+# median_of above 1 the reader returns the median of the last N accepted
+# samples.
+
+import time
+import collections
+
+from collectorMetrics import registry
+
+defaultReadBudgetSeconds = 10.0
+defaultMaxAttempts       = 5
+defaultTempRange         = (-40.0, 80.0)
+defaultHumidityRange     = (0.0, 100.0)
+defaultMaxTempRate       = 0.5
+defaultMaxHumidityRate   = 2.0
+defaultSpikeLimit        = 3
+
+# Rates are judged over at least this many seconds, so two reads in quick
+# succession may still differ by the sensor's own noise
+minRateSeconds = 2.0
+
+class SampleFilter(object):
+
+  def __init__(self, tempRange=defaultTempRange,
+               humidityRange=defaultHumidityRange,
+               maxTempRate=defaultMaxTempRate,
+               maxHumidityRate=defaultMaxHumidityRate,
+               medianOf=1, spikeLimit=defaultSpikeLimit):
+    self.tempRange       = tempRange
+    self.humidityRange   = humidityRange
+    self.maxTempRate     = maxTempRate
+    self.maxHumidityRate = maxHumidityRate
+    self.medianOf        = max(1, medianOf)
+    self.spikeLimit      = spikeLimit
+    self.history         = collections.deque(maxlen=self.medianOf)
+    self.lastAccepted    = None
+    self.lastTime        = None
+    self.spikeCount      = 0
+
+  def check(self, sample, now):
+    # Returns None if the sample is usable, otherwise why it is not:
+    # "missing", "range" or "spike"
+    humidity, temp_c = sample
+    if humidity is None or temp_c is None:
+      return "missing"
+    if not (self.tempRange[0] <= temp_c <= self.tempRange[1]
+            and self.humidityRange[0] <= humidity <= self.humidityRange[1]):
+      return "range"
+
+    if self.lastAccepted is not None and self.spikeCount < self.spikeLimit:
+      seconds = max(minRateSeconds, now - self.lastTime)
+      lastHumidity, lastTemp = self.lastAccepted
+      if ((self.maxTempRate is not None
+           and abs(temp_c - lastTemp) > self.maxTempRate * seconds)
+          or (self.maxHumidityRate is not None
+              and abs(humidity - lastHumidity)
+                  > self.maxHumidityRate * seconds)):
+        self.spikeCount += 1
+        return "spike"
+    return None
+
+  def accept(self, sample, now):
+    # Remembers a sample that passed check() and returns the value to
+    # report for it
+    self.lastAccepted = sample
+    self.lastTime     = now
+    self.spikeCount   = 0
+    self.history.append(sample)
+    if self.medianOf == 1:
+      return sample
+    return (median([humidity for (humidity, temp_c) in self.history]),
+            median([temp_c for (humidity, temp_c) in self.history]))
+
+def median(values):
+  values = sorted(values)
+  middle = len(values) // 2
+  if len(values) % 2:
+    return values[middle]
+  return (values[middle - 1] + values[middle]) / 2.0
+
+class SensorReader(object):
+
+  def __init__(self, sensor, readBudgetSeconds=defaultReadBudgetSeconds,
+               maxAttempts=defaultMaxAttempts, sampleFilter=None):
+    self.sensor            = sensor
+    self.readBudgetSeconds = readBudgetSeconds
+    self.maxAttempts       = maxAttempts
+    self.filter            = sampleFilter or SampleFilter()
+    self.lastReadTime      = None
+    self.lastAttempts      = 0
+
+    labels = {"sensor":sensor.name}
+    self.readSeconds = registry.histogram(
+      "collector_sensor_read_seconds",
+      "Time taken by one sensor read, including retries", labels)
+    self.attempts = registry.histogram(
+      "collector_sensor_read_attempts",
+      "Attempts needed by one sensor read", labels,
+      buckets=(1, 2, 3, 5, 10, 15))
+    self.retries = registry.counter(
+      "collector_sensor_read_retries_total",
+      "Sensor read attempts after the first one of a read", labels)
+    self.failures = registry.counter(
+      "collector_sensor_read_failures_total",
+      "Sensor reads that found no usable sample within their budget", labels)
+    self.rejected = dict(
+      (reason, registry.counter(
+        "collector_sensor_samples_rejected_total",
+        "Sensor samples discarded by the plausibility checks",
+        dict(labels, reason=reason)))
+      for reason in ("missing", "range", "spike", "error"))
+
+  def attempt(self):
+    try:
+      return self.sensor.read()
+    except Exception as e:
+      print("Reading sensor %s raised an exception:" % self.sensor.describe())
+      try:
+        print(str(e))
+      except:
+        print("  Sorry, could not print sensor read error msg.")
+      print("Continuing...")
+      return None
+
+  def read(self):
+    # Returns (humidity, temp_c), or (None, None) if no attempt within the
+    # budget produced a plausible sample.  The first attempt always waits
+    # out the sensor's minimum read interval; later ones are only started
+    # while they still fit in the budget.
+    start    = time.monotonic()
+    deadline = start + self.readBudgetSeconds
+    result   = (None, None)
+    attempt  = 0
+    try:
+      while attempt < self.maxAttempts:
+        now = time.monotonic()
+        wait = 0.0
+        if self.lastReadTime is not None:
+          wait = self.sensor.minReadInterval - (now - self.lastReadTime)
+        if attempt and now + max(0.0, wait) >= deadline:
+          break
+        if wait > 0:
+          time.sleep(wait)
+
+        attempt += 1
+        sample = self.attempt()
+        now = time.monotonic()
+        self.lastReadTime = now
+
+        reason = "error" if sample is None else self.filter.check(sample, now)
+        if reason is None:
+          result = self.filter.accept(sample, now)
+          break
+        self.rejected[reason].inc()
+    finally:
+      self.lastAttempts = attempt
+      self.readSeconds.observe(time.monotonic() - start)
+      self.attempts.observe(attempt)
+      if attempt > 1:
+        self.retries.inc(attempt - 1)
+      if result[0] is None:
+        self.failures.inc()
+
+    return result
+
+def makeSampleFilter(filterConfig):
+  return SampleFilter(
+    tempRange=tuple(filterConfig.get("temp_c", defaultTempRange)),
+    humidityRange=tuple(filterConfig.get("humidity", defaultHumidityRange)),
+    maxTempRate=filterConfig.get("max_temp_c_rate", defaultMaxTempRate),
+    maxHumidityRate=filterConfig.get("max_humidity_rate",
+                                     defaultMaxHumidityRate),
+    medianOf=filterConfig.get("median_of", 1),
+    spikeLimit=filterConfig.get("spike_limit", defaultSpikeLimit))
+
+def makeSensorReader(sensor, sensorConfig=None):
+  sensorConfig = sensorConfig or {}
+  return SensorReader(sensor,
+                      readBudgetSeconds=sensorConfig.get(
+                        "read_budget", defaultReadBudgetSeconds),
+                      maxAttempts=sensorConfig.get(
+                        "max_attempts", defaultMaxAttempts),
+                      sampleFilter=makeSampleFilter(
+                        sensorConfig.get("filter", {})))
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+# Reads several sensors from one process.  Reads are spread across a small
+# thread pool so a slow sensor does not hold up the others.  Each sensor is
+# read through its own SensorReader, which keeps to the sensor's minimum
+# read interval (2 secs for a DHT22), its retry budget and its plausibility
+# checks.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sensorReader import makeSensorReader
+
+defaultMaxWorkers = 2
+
+class SensorScheduler(object):
+
+  def __init__(self, sensors, maxWorkers=defaultMaxWorkers):
+    self.sensors  = sensors
+    self.executor = ThreadPoolExecutor(
+                      max_workers=max(1, min(maxWorkers, len(sensors))),
+                      thread_name_prefix="sensorRead")
+    self.readers  = dict((sensor.name,
+                          makeSensorReader(sensor,
+                                           getattr(sensor, "config", None)))
+                         for sensor in sensors)
+    self.locks    = dict((sensor.name, threading.Lock())
+                         for sensor in sensors)
+
+  def readSensor(self, sensor):
+    # The per-sensor lock keeps two reads of one sensor from overlapping
+    with self.locks[sensor.name]:
+      return self.readers[sensor.name].read()
+
+  def readAll(self):
+    # Returns {sensorName:(humidity, temp_c)} for all sensors
+    futures = [(sensor.name, self.executor.submit(self.readSensor, sensor))
+               for sensor in self.sensors]
+    return dict((name, future.result()) for (name, future) in futures)
+
+  def shutdown(self):
+    self.executor.shutdown(wait=False)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+# Local stand-in for an SMTP server, for exercising the alert notifier
+# without sending real mail.  It speaks just enough SMTP for smtplib:
+# EHLO/HELO, AUTH (any credentials are accepted), MAIL, RCPT, DATA, RSET,
+# NOOP and QUIT.  No TLS, so point the notifier at it with "ssl":False.
+#
+#   ./smtpStub.py --port 8025
+
+import sys
+import time
+import threading
+import socketserver
+from optparse import OptionParser
+
+defaultPort = 8025
+
+class SmtpStubHandler(socketserver.StreamRequestHandler):
+
+  def reply(self, line):
+    self.wfile.write((line + "\r\n").encode("UTF-8"))
+
+  def handle(self):
+    stub = self.server.stub
+    stub.connectionCount += 1
+    self.reply("220 localhost SMTP stand-in ready")
+
+    sender     = None
+    recipients = []
+    while True:
+      line = self.rfile.readline()
+      if not line:
+        return
+      command = line.decode("UTF-8", "replace").strip()
+      verb = command[:4].upper()
+
+      if verb in ("EHLO", "HELO"):
+        if verb == "EHLO":
+          self.reply("250-localhost")
+          self.reply("250 AUTH PLAIN LOGIN")
+        else:
+          self.reply("250 localhost")
+      elif verb == "AUTH":
+        if command.upper().startswith("AUTH LOGIN"):
+          parts = command.split()
+          if len(parts) < 3:
+            self.reply("334 VXNlcm5hbWU6")
+            self.rfile.readline()
+          self.reply("334 UGFzc3dvcmQ6")
+          self.rfile.readline()
+        elif len(command.split()) < 3:
+          self.reply("334 ")
+          self.rfile.readline()
+        self.reply("235 Authentication successful")
+      elif verb == "MAIL":
+        sender = command[10:].strip()
+        recipients = []
+        self.reply("250 OK")
+      elif verb == "RCPT":
+        recipients.append(command[8:].strip())
+        self.reply("250 OK")
+      elif verb == "DATA":
+        self.reply("354 End data with <CR><LF>.<CR><LF>")
+        lines = []
+        while True:
+          dataLine = self.rfile.readline()
+          if not dataLine or dataLine in (b".\r\n", b".\n"):
+            break
+          if dataLine.startswith(b".."):
+            dataLine = dataLine[1:]
+          lines.append(dataLine)
+        stub.recordMessage(sender, recipients,
+                           b"".join(lines).decode("UTF-8", "replace"))
+        if stub.delaySeconds:
+          time.sleep(stub.delaySeconds)
+        self.reply("250 OK: queued")
+      elif verb == "RSET":
+        sender = None
+        recipients = []
+        self.reply("250 OK")
+      elif verb == "NOOP":
+        self.reply("250 OK")
+      elif verb == "QUIT":
+        self.reply("221 Bye")
+        return
+      else:
+        self.reply("502 Command not implemented")
+
+class SmtpStub(object):
+
+  def __init__(self, port=0, host="127.0.0.1"):
+    self.host            = host
+    self.port            = port
+    self.delaySeconds    = 0.0
+    self.verbose         = False
+    self.messages        = []
+    self.connectionCount = 0
+    self.lock            = threading.Lock()
+    self.server          = None
+
+  def recordMessage(self, sender, recipients, data):
+    with self.lock:
+      self.messages.append((sender, recipients, data))
+    if self.verbose:
+      print("Message from %s to %s:" % (sender, recipients))
+      print(data)
+
+  def start(self):
+    self.server = socketserver.ThreadingTCPServer((self.host, self.port),
+                                                  SmtpStubHandler)
+    self.server.daemon_threads = True
+    self.server.stub = self
+    self.port = self.server.server_address[1]
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    return self
+
+  def stop(self):
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] [options]
+       where:
+         -h|--help to see options
+"""
+  parser = OptionParser(usage)
+  help="Port to listen on.  Default is %s" % defaultPort
+  parser.add_option("-p", "--port",
+                    action="store", type="int",
+                    default=defaultPort,
+                    dest="port",
+                    help=help)
+  help="Seconds to wait before accepting each message"
+  parser.add_option("-d", "--delaySeconds",
+                    action="store", type="float",
+                    default=0.0,
+                    dest="delaySeconds",
+                    help=help)
+
+  (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
+
+  if len(cmdLineArgs) != 0:
+    parser.error("All command-line arguments require a flag. "+\
+                 "Found the following without flags: %s" % cmdLineArgs)
+
+  return (cmdLineOptions, cmdLineArgs)
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+
+  stub = SmtpStub(port=clo.port)
+  stub.delaySeconds = clo.delaySeconds
+  stub.verbose      = True
+  stub.start()
+  print("SMTP stand-in listening on %s:%s" % (stub.host, stub.port))
+
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    stub.stop()
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
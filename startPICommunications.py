@@ -11,6 +11,9 @@ execDir = os.path.dirname(os.path.realpath(__file__))
 sleepSecondsDefault = 300
 screenNameDefault = "PIComms"
 
+def makeControlSocketName(screenName):
+  return "/tmp/%s.supervisor.sock" % screenName
+
 def setupCmdLineArgs(cmdLineArgs):
   usage =  "usage: %prog [-h|--help] [options] command_to_run\n"
   usage += "usage: %prog [-h|--help] -e|--exitScreen\n"
@@ -30,6 +33,8 @@ def setupCmdLineArgs(cmdLineArgs):
           If --noLoop is not used, the command is wrapped in an endless loop that
           re-runs the command after -s|--sleepSeconds seconds (default is %s secs) 
           when the command exits.
+          With --supervise, collectorSupervisor.py runs the command instead,
+          restarting it as soon as it exits.
 """ % (screenNameDefault, sleepSecondsDefault)
 
   parser = OptionParser(usage)
@@ -80,6 +85,17 @@ def setupCmdLineArgs(cmdLineArgs):
                     dest="noLoop",
                     help=help)
 
+  help ="Run the command under collectorSupervisor.py instead of in a "
+  help+="shell loop.  It is restarted immediately when it exits, with "
+  help+="exponential backoff if it keeps exiting, and can be controlled with "
+  help+="'./collectorSupervisor.py --controlSocket %s --control status'"\
+        % makeControlSocketName("<screenName>")
+  parser.add_option("--supervise",
+                    action="store_true",
+                    default=False,
+                    dest="supervise",
+                    help=help)
+
   help="Send command to screen even if screen is already running.  NOTE: Without the --noLoop option, commands run using this script are put in an endless loop. Sending a command to a screen with a looping command will not have any effect unless the loop for some reason exits."
   parser.add_option("-f", "--force",
                     action="store_true", 
@@ -116,6 +132,9 @@ def setupCmdLineArgs(cmdLineArgs):
       and not cmdLineOptions.listScreens):
     parser.error("A command to run must be given on the command line")
 
+  if cmdLineOptions.supervise and cmdLineOptions.noLoop:
+    parser.error("Cannot specify both --supervise and --noLoop")
+
   if (cmdLineOptions.exitScreen and cmdLineOptions.listScreens):
     parser.error("Cannot specify both --exitScreen and --listScreens")
 
@@ -195,6 +214,11 @@ def main(cmdLineArgs):
   if clo.noLoop:
     cmdList.append("date")
     cmdList.append(command)
+  elif clo.supervise:
+    cmdList.append("cd '%s'" % execDir)
+    cmdList.append("date")
+    cmdList.append("./collectorSupervisor.py --controlSocket '%s' -- %s"
+                   % (makeControlSocketName(clo.screenName), command))
   else:
     cmdList.append("cd '%s'" % execDir)
     cmdList.append("while :; do")
@@ -209,11 +233,12 @@ def main(cmdLineArgs):
     if clo.noOp:
       print("Would be executing the following in screen '%s':\n" \
             % clo.screenName, cmd)
-    else:
-      if clo.verbose:
-        print("Executing the following command in screen '%s':\n" \
-              % clo.screenName, cmd)
-        screen.executeCmdInScreen(cmd)
+    elif clo.verbose:
+      print("Executing the following command in screen '%s':\n" \
+            % clo.screenName, cmd)
+
+  if not clo.noOp:
+    screen.executeCmdsInScreen(cmdList)
 
 if (__name__ == '__main__'):
   main(sys.argv[1:])
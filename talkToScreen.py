@@ -10,6 +10,17 @@ class TalkToScreen(object):
 
   historyLengthDefault = 5000
 
+  # Sessions parsed from the last `screen -ls`, shared by all instances and
+  # trusted for sessionCacheSeconds.  Our own startScreen() and exitScreen()
+  # update it directly, so a launch script that checks, starts and then
+  # talks to a screen forks `screen -ls` only once.
+  sessionCacheSeconds = 2.0
+  sessionCache        = None
+  sessionCacheTime    = 0.0
+
+  # Lines of `screen -ls` look like "\t12345.PIComms\t(Detached)"
+  sessionPattern = re.compile(r"^\s*(\d+)\.(\S+)")
+
   def __init__ (self):
     self.screenName = None
     self.historyLength = TalkToScreen.historyLengthDefault
@@ -54,8 +65,13 @@ class TalkToScreen(object):
     cmdList = cmd.split()
     
     check_call(cmdList)
+    TalkToScreen.getSessions(self.verbose).add(self.screenName)
 
   def executeCmdInScreen(self, cmd):
+    self.executeCmdsInScreen([cmd])
+
+  def executeCmdsInScreen(self, cmdList):
+    # Sends all commands with a single `screen -X stuff`, one per line
     if not self.screenAlreadyRunning():
       print("Screen with name '%s' does not exists." % self.screenName,
             file=sys.stderr)
@@ -68,10 +84,13 @@ class TalkToScreen(object):
     
     cmdPrefix = self.getCmdPrefix()
 
-    if cmd[-1:] != "\n":
-      cmd += "\n"
+    script = ""
+    for cmd in cmdList:
+      script += cmd
+      if cmd[-1:] != "\n":
+        script += "\n"
 
-    fullCmdList = cmdPrefix + [cmd]
+    fullCmdList = cmdPrefix + [script]
     if self.verbose:
       print("cmd: %s" % fullCmdList)
 
@@ -81,6 +100,7 @@ class TalkToScreen(object):
     assert self.screenName, "startScreen() called before self.screenName set"
 
     self.executeCmdInScreen("exit")
+    TalkToScreen.getSessions(self.verbose).discard(self.screenName)
 
   @staticmethod
   def getScreenList(verbose=False):
@@ -99,8 +119,28 @@ class TalkToScreen(object):
       if isinstance(output, bytes):
         output = output.decode('UTF-8')
 
+    TalkToScreen.cacheSessions(output)
     return output
 
+  @staticmethod
+  def cacheSessions(output):
+    sessions = set()
+    for line in output.splitlines():
+      m = TalkToScreen.sessionPattern.match(line)
+      if m:
+        sessions.add(m.group(2))
+    TalkToScreen.sessionCache     = sessions
+    TalkToScreen.sessionCacheTime = time.monotonic()
+
+  @staticmethod
+  def getSessions(verbose=False):
+    # Names of the running screens, from the cache while it is fresh
+    age = time.monotonic() - TalkToScreen.sessionCacheTime
+    if (TalkToScreen.sessionCache is None
+        or age > TalkToScreen.sessionCacheSeconds):
+      TalkToScreen.getScreenList(verbose)
+    return TalkToScreen.sessionCache
+
   @staticmethod
   def printScreenList(verbose=False, stream=sys.stdout):
 
@@ -110,17 +150,9 @@ class TalkToScreen(object):
   def screenAlreadyRunning(self):
     assert self.screenName, "startScreen() called before self.screenName set"
 
-    output = TalkToScreen.getScreenList(self.verbose)
-
-    screenExists = False
-    for line in output.splitlines():
-      m = re.search('\d+\.%s' % self.screenName,line)
-      if m:
-        if self.verbose:
-          print("Found screen:")
-          print(line)
-        screenExists = True
-        break
+    screenExists = self.screenName in TalkToScreen.getSessions(self.verbose)
+    if screenExists and self.verbose:
+      print("Found screen:", self.screenName)
 
     return screenExists
 
@@ -219,8 +251,7 @@ def main(cmdLineArgs):
       screen.startScreen()
 
     if clo.runCmd:
-      for cmd in clo.runCmd:
-        screen.executeCmdInScreen(cmd)
+      screen.executeCmdsInScreen(clo.runCmd)
 
     if clo.exitScreen:
       screen.exitScreen()
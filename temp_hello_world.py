@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
+import sys
 import time
-import Adafruit_DHT
+from sensorBackends import makeSensor
+from sensorReader import makeSensorReader
 #-# from ISStreamer.Streamer import Streamer
 # --------- User Settings ---------
 #-# SENSOR_LOCATION_NAME = "Office"
@@ -11,10 +13,20 @@ import Adafruit_DHT
 
 MINUTES_BETWEEN_READS = .25 # DHt22 max read rate is every 2 seconds (.0334 min)
 METRIC_UNITS = False
+SENSOR_CONFIG = {"name":"hello", "type":"DHT22", "pin":4,
+                 "fields":{1:"temp_f", 2:"humidity"}}
+# Run with --simulate to use a synthetic sensor when not on a Pi
+if "--simulate" in sys.argv[1:]:
+  SENSOR_CONFIG["type"] = "synthetic"
 # ---------------------------------
+sensor = makeSensor(SENSOR_CONFIG)
+reader = makeSensorReader(sensor, SENSOR_CONFIG)
 #-# streamer = Streamer(bucket_name=BUCKET_NAME, bucket_key=BUCKET_KEY, access_key=ACCESS_KEY)
 while True:
-  humidity, temp_c = Adafruit_DHT.read_retry(Adafruit_DHT.DHT22, 4)
+  humidity, temp_c = reader.read()
+  if humidity is None or temp_c is None:
+    print (time.asctime(), ": No usable reading, trying again")
+    continue
   if not METRIC_UNITS:
     temp_f = format(temp_c * 9.0 / 5.0 + 32.0, ".2f")
   #-# streamer.log(SENSOR_LOCATION_NAME + " Temperature(F)", temp_f)
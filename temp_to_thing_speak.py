@@ -3,12 +3,33 @@
 import os
 import sys
 import time
-import ast
 import signal
 import socket
-import thingspeak
-import Adafruit_DHT
 
+from thingSpeakClient import ThingSpeakBulkClient, makeReading,\
+  defaultBaseUrl, bulkUpdateLimit
+from readingBatcher import ReadingBatcher
+from readingSpool import ReadingSpool, makeSpoolFileName
+from backgroundUploader import BackgroundUploader
+from sensorBackends import makeSensors
+from collectorMetrics import registry, MetricsServer
+from timeSeriesStore import TimeSeriesStore
+from publishPolicy import makePublishPolicy
+from readingSinks import SinkWorker, ThingSpeakSink, StoreSink,\
+  makeSinkWorkers
+from alertEngine import makeAlertEngine, makeAlertRules
+from windowAggregator import WindowAggregator, splitQuantity
+from derivedMetrics import DerivedMetrics
+from collectorConfig import loadHostConfig, ConfigWatcher, ConfigError,\
+  loadConfig, getChannelKeys
+from collectorGateway import CollectorGateway, defaultGatewayPort,\
+  defaultIntervalSeconds
+from collectorLog import CollectorLog, ConsoleTee, makeLogFileName,\
+  defaultMaxTotalBytes
+from dashboardServer import DashboardServer, defaultDashboardPort
+from powerSaving import PowerMonitor
+from controlPlane import ControlPlane, ControlError, defaultSerialBaud,\
+  parseIntervalArgs
 
 from optparse import OptionParser
 
@@ -16,17 +37,17 @@ from optparse import OptionParser
 (execDirName,execName) = os.path.split(sys.argv[0])
 execBaseName           = os.path.splitext(execName)[0]
 
-defaultLogFileRoot      = "/tmp/"+execBaseName
+# Not under /tmp, which is emptied on reboot along with the logs, spool and
+# history needed to find out what happened overnight
+defaultLogFileRoot      = os.path.expanduser(
+  "~/.local/state/%s/%s" % (execBaseName, execBaseName))
 defaultConfigFilename   = execBaseName + ".conf"
-thingspeakTimeoutSeconds = 120
 
 hostname = socket.gethostname()
 
-class MySignalCaughtException(Exception):
-  def __init__(self, value):
-    self.value = value
-  def __str__(self):
-    return repr(self.value)
+conversionFailures = registry.counter(
+  "collector_conversion_failures_total",
+  "Sensor samples that could not be converted into channel fields")
 
 def setupCmdLineArgs(cmdLineArgs):
   usage = """\
@@ -47,13 +68,43 @@ usage: %prog [-h|--help] [options]
                     default=False,
                     dest="noOp",
                     help=help)
+  help ="Check the config file and this host's block in it, then exit with "
+  help+="status 0 if it is valid and 1 if it is not"
+  parser.add_option("--checkConfig",
+                    action="store_true",
+                    default=False,
+                    dest="checkConfig",
+                    help=help)
   help="Root name of logfile.  Default is '%s', " % defaultLogFileRoot
-  help+="which produces the log file '%s.2015-08-17.log'" % defaultLogFileRoot
+  help+="which produces the log file '%s'" % makeOutputFileName(
+    defaultLogFileRoot, "2015-08-17")
   parser.add_option("-l", "--logFileRoot",
                     action="store", type="string", 
                     default=defaultLogFileRoot,
                     dest="logFileRoot",
                     help=help)
+  help ="Do not write the daily log files, only print to the terminal"
+  parser.add_option("--noLog",
+                    action="store_true",
+                    default=False,
+                    dest="noLog",
+                    help=help)
+  help ="Delete the oldest daily log files once all of them take more than "
+  help+="this many megabytes.  Default is %s" % (defaultMaxTotalBytes
+                                                 // (1024 * 1024))
+  parser.add_option("--logMaxMegabytes",
+                    action="store", type="float",
+                    default=defaultMaxTotalBytes / (1024 * 1024),
+                    dest="logMaxMegabytes",
+                    help=help)
+  help ="Name of the spool file holding readings not yet accepted by "
+  help+="ThingSpeak.  Default is the log file root with '.spool' appended, "
+  help+="e.g. '%s'" % makeSpoolFileName(defaultLogFileRoot)
+  parser.add_option("-s", "--spoolFile",
+                    action="store", type="string",
+                    default=None,
+                    dest="spoolFilename",
+                    help=help)
   help ="Name of file containing configuration data in the form of "
   help+="a dictionary.  Default is '%s'" % defaultConfigFilename
   parser.add_option("-c", "--configFile",
@@ -61,6 +112,136 @@ usage: %prog [-h|--help] [options]
                     default=defaultConfigFilename,
                     dest="configFilename",
                     help=help)
+  help ="Base URL of the ThingSpeak server.  Point this at a local "
+  help+="stand-in (see thingSpeakStub.py) for testing.  "
+  help+="Default is '%s'" % defaultBaseUrl
+  parser.add_option("-u", "--thingspeakUrl",
+                    action="store", type="string",
+                    default=defaultBaseUrl,
+                    dest="thingspeakUrl",
+                    help=help)
+  help ="Key of the host block in the config file to use, instead of the "
+  help+="one hostnameToKeyMap gives for this host's name ('%s')" % hostname
+  parser.add_option("-k", "--hostKey",
+                    action="store", type="string",
+                    default=None,
+                    dest="hostKey",
+                    help=help)
+  help ="Replace every configured sensor with a synthetic one, so the "
+  help+="collector can run without a DHT sensor attached"
+  parser.add_option("--simulate",
+                    action="store_true",
+                    default=False,
+                    dest="simulate",
+                    help=help)
+  help ="Replace every configured sensor with one replaying "
+  help+="created_at,humidity,temp_c lines from the given CSV file"
+  parser.add_option("--replayFile",
+                    action="store", type="string",
+                    default=None,
+                    dest="replayFilename",
+                    help=help)
+  help ="Seconds between samples, overriding update_frequency from the "
+  help+="config file.  Fractions are allowed, e.g. 0.001 for load tests"
+  parser.add_option("-f", "--updateFrequency",
+                    action="store", type="float",
+                    default=None,
+                    dest="updateFrequency",
+                    help=help)
+  help ="Serve collector metrics in Prometheus text format on this "
+  help+="localhost port.  Default is no metrics port"
+  parser.add_option("-m", "--metricsPort",
+                    action="store", type="int",
+                    default=None,
+                    dest="metricsPort",
+                    help=help)
+  help ="Serve collector metrics over HTTP on this Unix socket"
+  parser.add_option("--metricsSocket",
+                    action="store", type="string",
+                    default=None,
+                    dest="metricsSocket",
+                    help=help)
+  help ="Do not keep the local history of readings in the daily "
+  help+="'<logFileRoot>.<date>.*.tsd' time-series segment files"
+  parser.add_option("--noStore",
+                    action="store_true",
+                    default=False,
+                    dest="noStore",
+                    help=help)
+  help ="Serve a dashboard of the local history of readings on this port, "
+  help+="e.g. %s.  Default is no dashboard" % defaultDashboardPort
+  parser.add_option("--dashboardPort",
+                    action="store", type="int",
+                    default=None,
+                    dest="dashboardPort",
+                    help=help)
+  help ="Power-saving mode, as with 'power_save' in the host block: "
+  help+="uploads, log writes and config checks all happen right after a "
+  help+="sample, so the CPU and radio can idle in between"
+  parser.add_option("--powerSave",
+                    action="store_true",
+                    default=False,
+                    dest="powerSave",
+                    help=help)
+  help ="Take control commands (latest, publish, interval <secs>, flush) "
+  help+="on this Unix socket, e.g. with './controlPlane.py -s <socket> "
+  help+="latest'.  Default is no control socket"
+  parser.add_option("--controlSocket",
+                    action="store", type="string",
+                    default=None,
+                    dest="controlSocket",
+                    help=help)
+  help ="Take control commands on this serial port as well, e.g. "
+  help+="/dev/ttyUSB0.  Needs pyserial"
+  parser.add_option("--controlSerial",
+                    action="store", type="string",
+                    default=None,
+                    dest="controlSerial",
+                    help=help)
+  help="Baud rate of --controlSerial.  Default is %s" % defaultSerialBaud
+  parser.add_option("--controlBaud",
+                    action="store", type="int",
+                    default=defaultSerialBaud,
+                    dest="controlBaud",
+                    help=help)
+  help ="Take control commands typed on stdin as well, e.g. in the "
+  help+="collector's screen session"
+  parser.add_option("--controlStdin",
+                    action="store_true",
+                    default=False,
+                    dest="controlStdin",
+                    help=help)
+  help ="host:port of a plain SMTP server to send alert emails to instead "
+  help+="of the configured one, e.g. smtpStub.py on 127.0.0.1:8025"
+  parser.add_option("--smtpServer",
+                    action="store", type="string",
+                    default=None,
+                    dest="smtpServer",
+                    help=help)
+
+  help ="Run as a gateway: accept readings from other collectors, whose "
+  help+="host blocks point 'gateway_url' here, and upload them to "
+  help+="ThingSpeak merged into one bulk update per channel and interval.  "
+  help+="Only the channels and write keys of the config file's host blocks "
+  help+="are accepted.  No sensors are read in this mode"
+  parser.add_option("--gateway",
+                    action="store_true",
+                    default=False,
+                    dest="gateway",
+                    help=help)
+  help="Port the gateway listens on.  Default is %s" % defaultGatewayPort
+  parser.add_option("--gatewayPort",
+                    action="store", type="int",
+                    default=defaultGatewayPort,
+                    dest="gatewayPort",
+                    help=help)
+  help ="Seconds between the gateway's bulk updates of each channel.  "
+  help+="Default is %s" % defaultIntervalSeconds
+  parser.add_option("--gatewayInterval",
+                    action="store", type="float",
+                    default=defaultIntervalSeconds,
+                    dest="gatewayInterval",
+                    help=help)
 
   (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
 
@@ -73,177 +254,589 @@ usage: %prog [-h|--help] [options]
     parser.error("All command-line arguments require a flag. "+\
                  "Found the following without flags: %s" % cmdLineArgs)
 
-  return (cmdLineOptions, cmdLineArgs)
+  if cmdLineOptions.simulate and cmdLineOptions.replayFilename:
+    parser.error("Cannot specify both --simulate and --replayFile")
 
-def createDateStamp():
-  return time.strftime("%Y-%m-%d",time.localtime())
+  return (cmdLineOptions, cmdLineArgs)
 
-def makeOutputStream(outputFileName):
-  return open(outputFileName,'a')
+def getSensorOverrides(clo):
+  if clo.simulate:
+    return {"type":"synthetic"}
+  if clo.replayFilename:
+    return {"type":"replay", "file":clo.replayFilename}
+  return None
 
 def makeOutputFileName(logFileRoot, dateStamp):
-  return  logFileRoot + "." + createDateStamp() + ".log"
-
-def readConfigData(configFilename):
-  with open(configFilename,'r') as configStream:
-    configData = configStream.read()
-
-  configDataDict = ast.literal_eval(configData)
-
-  hostnameToKeyMap = configDataDict["hostnameToKeyMap"]
-
-  idKey = getIdKey(hostnameToKeyMap)
-  
-  assert idKey in configDataDict,\
-    "Could not find key '%s' in file '%s'. Keys in file are '%s'" %\
-    (idKey, configFilename, list(configDataDict.keys()))
-
-  return configDataDict[idKey]
-
-def handler(signum, frame):
-  raise MySignalCaughtException("Signal caught")
+  return makeLogFileName(logFileRoot, dateStamp)
 
-def getIdKey(hostnameToKeyMap):
-  idKey = None
-  if hostname in hostnameToKeyMap:
-    idKey = hostnameToKeyMap[hostname]
-  else:
-    assert idKey, \
-      "Could not match hostname '%s' to key in config file" % hostname +\
-      "Available keys are: %s" % list(hostnameToKeyMap)
-
-  print("Found idKey:", idKey)
-  return idKey
-
-def readInputFromTerminal(prompt,timeout):
-  inputLine=None
-  print("You have %s seconds to enter input..." % timeout)
-  print(prompt,end="")
-  sys.stdout.flush()
-  rlist, _, _ = select.select([sys.stdin], [], [], timeout)
-  if rlist:
-    inputLine = sys.stdin.readline().strip()
-    print("Read: %s\n" % inputLine)
-  return inputLine
-
-def processTerminalInput(timeout):
-  global mySerial
-  assert mySerial, "The varialble mySerial is null"
-  while True:
-    inputLine = readInputFromTerminal("Command [continue, quit]: ",timeout)
-    if not inputLine:
-      print("\nNo input read. Moving on...")
-      return
-    else:
-      if inputLine.lower() == 'continue':
-        return
-      if inputLine.lower() == 'quit':
-        sys.exit(0)
-      mySerial.write(inputLine)
-      buffer = mySerial.read(mySerial.inWaiting())
-      lines = buffer.split('\r\n')
-      for line in lines:
-        if line:
-          print(line)
-    timeout = 30
+def handleTerminate(signum, frame):
+  # SIGTERM, e.g. from collectorSupervisor.py, unwinds like Ctrl-C so the
+  # spool and store are closed cleanly
+  raise SystemExit(0)
 
 def main(cmdLineArgs):
-  global mySerial
   (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+  if clo.checkConfig:
+    checkConfig(clo)
+    return
+  signal.signal(signal.SIGTERM, handleTerminate)
   logFileRoot    = clo.logFileRoot
-  configFilename = clo.configFilename
+  spoolFilename  = clo.spoolFilename
+  if not spoolFilename:
+    spoolFilename = makeSpoolFileName(logFileRoot)
   
   if clo.verbose or clo.noOp:
     print("verbose        =", clo.verbose   )
     print("noOp           =", clo.noOp      )
-    print("configFilename =", configFilename)
+    print("configFilename =", clo.configFilename)
     print("logFileRoot    =", logFileRoot   )
-
-  configDataDict = readConfigData(configFilename)
+    print("spoolFilename  =", spoolFilename )
+
+  logDirName = os.path.dirname(logFileRoot)
+  if logDirName and not clo.noOp:
+    os.makedirs(logDirName, exist_ok=True)
+
+  collectorLog = None
+  if not (clo.noLog or clo.noOp):
+    collectorLog = CollectorLog(logFileRoot,
+                                maxTotalBytes=int(clo.logMaxMegabytes
+                                                  * 1024 * 1024)).start()
+    sys.stdout = ConsoleTee(sys.stdout, collectorLog)
+    collectorLog.log("start", argv=sys.argv, pid=os.getpid())
+  try:
+    if clo.gateway:
+      runGateway(clo)
+    else:
+      runCollector(clo, spoolFilename, collectorLog)
+  finally:
+    if collectorLog:
+      collectorLog.log("stop")
+      sys.stdout = sys.stdout.stream
+      collectorLog.stop()
+
+def checkConfig(clo):
+  # Does no more than loading the config takes, so it is quick enough to
+  # run before every (re)start, e.g. from startPICommunications.py
+  try:
+    hostConfig = loadHostConfig(clo.configFilename, clo.hostKey,
+                                useCache=False)
+    # The alert recipient can come from the credentials file, which only
+    # exists on the Pi itself
+    makeAlertEngine(hostConfig.data, clo.smtpServer)
+  except (ConfigError, OSError) as e:
+    print("Config file '%s' is invalid:" % clo.configFilename)
+    print("Error msg:",str(e))
+    sys.exit(1)
+  print("Config file '%s' is valid, using block '%s': channel %s, "
+        "every %s secs, %s sensors"
+        % (clo.configFilename, hostConfig.hostKey, hostConfig.channelId,
+           hostConfig.updateFrequency, len(hostConfig.sensors)))
+
+def runCollector(clo, spoolFilename, collectorLog=None):
+  hostConfig = loadHostConfig(clo.configFilename, clo.hostKey)
+  print("Found idKey:", hostConfig.hostKey)
 
   if clo.verbose or clo.noOp:
-    print("configDataDict:")
-    print(configDataDict)
+    print("hostConfig:")
+    print(hostConfig)
 
   if clo.noOp:
     sys.exit(0)
 
-  channel_id      = configDataDict["channel_id"]
-  write_key       = configDataDict["write_key"]
-  updateFrequency = configDataDict["update_frequency"]
-  channelKeys     = configDataDict["channel_keys"]
-
-  channel = thingspeak.Channel(id=channel_id,api_key=write_key)
-
-  currentDateStamp = None
-  outputStream     = None
-
-  # Register the signal function handler
-  signal.signal(signal.SIGALRM, handler)
-
-  while True:
-    humidity, temp_c = (None, None)
+  sensors = makeSensors(hostConfig.data, getSensorOverrides(clo))
+
+  # With a gateway, readings are forwarded one at a time as they are taken
+  # so the gateway can merge them with other hosts' readings of the same
+  # moment; batching happens at the gateway.
+  baseUrl   = clo.thingspeakUrl
+  batchSize = hostConfig.batchSize
+  if getGatewayUrl(clo, hostConfig):
+    baseUrl   = getGatewayUrl(clo, hostConfig)
+    batchSize = 1
+    print("Forwarding readings to gateway", baseUrl)
+
+  client = ThingSpeakBulkClient(hostConfig.channelId, hostConfig.writeKey,
+                                baseUrl=baseUrl,
+                                connectTimeout=hostConfig.connectTimeout,
+                                readTimeout=hostConfig.readTimeout)
+  # The batcher holds as many readings as the spool, so it never drops one
+  # the spool still keeps
+  batcher = ReadingBatcher(client,
+                           maxBatchSize=batchSize,
+                           maxBatchAgeSeconds=hostConfig.batchMaxAge,
+                           maxQueueLength=hostConfig.spoolCapacity)
+  if clo.verbose:
+    client.verbose  = True
+    batcher.verbose = True
+
+  # Readings go into the spool before they are queued for upload and are
+  # acknowledged once ThingSpeak accepts them, so anything left over from a
+  # previous run is still unsent.
+  spool = ReadingSpool(spoolFilename, capacity=hostConfig.spoolCapacity)
+  if isPowerSaving(clo, hostConfig):
+    uploader = BackgroundUploader(batcher, spool, pollSeconds=None,
+                                  closeAfterUpload=True)
+  else:
+    uploader = BackgroundUploader(batcher, spool)
+  backlog = spool.pending()
+  if backlog:
+    print("Replaying %s unsent readings from spool '%s'"
+          % (len(backlog), spoolFilename))
+    for (seq, reading) in backlog:
+      uploader.add(reading)
+    uploader.flushNow()
+  uploader.start()
+
+  registry.gauge("collector_upload_queue_depth",
+                 "Readings waiting to be uploaded",
+                 function=uploader.queuedCount)
+  registry.gauge("collector_spool_pending_readings",
+                 "Readings in the spool not yet accepted by ThingSpeak",
+                 function=spool.__len__)
+  try:
+    alertEngine = makeAlertEngine(hostConfig.data, clo.smtpServer)
+  except (ConfigError, OSError) as e:
+    print("Alert notifications are disabled:")
+    print("Error msg:",str(e))
+    print("Continuing...")
+    alertEngine = None
+  if alertEngine:
+    alertEngine.verbose = clo.verbose
+    alertEngine.notifier.start()
+
+  metricsServer = None
+  if clo.metricsPort is not None or clo.metricsSocket:
+    metricsServer = MetricsServer(port=clo.metricsPort,
+                                  socketPath=clo.metricsSocket).start()
+  dashboard = None
+  if clo.dashboardPort is not None and not clo.noStore:
+    dashboard = DashboardServer(clo.logFileRoot, port=clo.dashboardPort)
+    dashboard.verbose = clo.verbose
+    dashboard.start()
+    print("Dashboard on port %s" % dashboard.port)
+
+  try:
+    runCollectorEngine(clo, hostConfig, spool, uploader, sensors, alertEngine,
+                       collectorLog)
+  finally:
+    if dashboard:
+      dashboard.stop()
+    if metricsServer:
+      metricsServer.stop()
+    if alertEngine:
+      alertEngine.close(timeout=hostConfig.readTimeout)
+    uploader.stop(timeout=hostConfig.readTimeout)
+    spool.close()
+    client.close()
+
+def isPowerSaving(clo, hostConfig):
+  return clo.powerSave or hostConfig.data.get("power_save", False)
+
+def getGatewayUrl(clo, hostConfig):
+  # An explicit --thingspeakUrl wins over the host block's gateway_url
+  if clo.thingspeakUrl != defaultBaseUrl:
+    return None
+  return hostConfig.data.get("gateway_url")
+
+def runGateway(clo):
+  # The gateway serves the channels of all host blocks, with their keys
+  channelKeys = getChannelKeys(loadConfig(clo.configFilename))
+  print("Gateway serving channels %s" % ", ".join(sorted(channelKeys)))
+  gateway = CollectorGateway(clo.logFileRoot, channelKeys,
+                             baseUrl=clo.thingspeakUrl,
+                             port=clo.gatewayPort,
+                             intervalSeconds=clo.gatewayInterval)
+  gateway.verbose = clo.verbose
+  gateway.start()
+  print("Gateway listening on port %s, uploading to %s every %s secs"
+        % (gateway.port, clo.thingspeakUrl, clo.gatewayInterval))
+
+  metricsServer = None
+  if clo.metricsPort is not None or clo.metricsSocket:
+    metricsServer = MetricsServer(port=clo.metricsPort,
+                                  socketPath=clo.metricsSocket).start()
+  try:
+    while True:
+      time.sleep(3600)
+  finally:
+    if metricsServer:
+      metricsServer.stop()
+    gateway.stop()
+
+def convertSample(sample):
+  # Returns {quantity:value} for a (humidity, temp_c) sample, or None if the
+  # sensor did not deliver a usable reading.  A value of exactly 0.0, like
+  # a freezer at 0 C, is a valid reading.
+  humidity, temp_c = sample
+  if humidity is None or temp_c is None:
+    conversionFailures.inc()
+    return None
+
+  temp_f = None
+  try:
+    temp_f = temp_c * 9.0 / 5.0 + 32.0
+  except Exception as e:
+    print("Conversion of temp_c = '%s' to Fahrenheit failed" % temp_c)
+    try:
+      print("Error msg:",str(e))
+    except:
+      print("  Sorry, could not print conversion error.")
+    print("Continuing...")
+
+  if temp_f is None:
+    conversionFailures.inc()
+    return None
+
+  return {"temp_c":temp_c, "temp_f":temp_f, "humidity":humidity}
+
+def convertSamples(samples, sensors, timestamp, derivedMetrics=None):
+  # Returns {sensorName:{quantity:value}} for the sensors of samples that
+  # delivered a usable reading, with their derived quantities added
+  sensorReadings = {}
+  for sensor in sensors:
+    quantities = convertSample(samples[sensor.name])
+    if quantities is not None:
+      if derivedMetrics:
+        derivedMetrics.update(sensor.name, quantities, timestamp)
+      sensorReadings[sensor.name] = quantities
+  return sensorReadings
+
+def makeChannelReading(samples, sensors, timestamp, verbose=False,
+                       derivedMetrics=None, windowSample=False):
+  # samples is {sensorName:(humidity, temp_c)}.  All sensors' fields go into
+  # one reading so they are uploaded together.
+  sensorReadings = convertSamples(samples, sensors, timestamp, derivedMetrics)
+  reading = makeQuantitiesReading(sensorReadings, sensors, timestamp, verbose,
+                                  windowSample)
+  if reading is not None:
+    reading["samples"] = samples
+  return reading
+
+def describeQuantities(sensorName, quantities):
+  if "temp_f.count" not in quantities:
+    return ("%s temp_f = %.2f(F), humidity = %.2f%s" %
+            (sensorName, quantities["temp_f"], quantities["humidity"], "%"))
+  return ("%s temp_f = %.2f(F) (%.2f-%.2f), humidity = %.2f%s (%.2f-%.2f) "
+          "over %s samples" %
+          (sensorName, quantities["temp_f"], quantities["temp_f.min"],
+           quantities["temp_f.max"], quantities["humidity"], "%",
+           quantities["humidity.min"], quantities["humidity.max"],
+           quantities["temp_f.count"]))
+
+def makeQuantitiesReading(sensorReadings, sensors, timestamp, verbose=False,
+                          windowSample=False):
+  # sensorReadings is {sensorName:{quantity:value}} for the sensors that
+  # delivered a usable sample, or the summaries of a WindowAggregator with
+  # the plain quantities holding the window's means.  A windowSample is one
+  # sample of a window that is published as a summary: it leaves out the
+  # fields of stats, is kept even without fields and is only printed when
+  # verbose.
+  reading = None
+  try:
+    channelDict = {}
+    statusList  = []
+    samples     = {}
+    for sensor in sensors:
+      quantities = sensorReadings.get(sensor.name)
+      if quantities is None:
+        samples[sensor.name] = (None, None)
+        continue
+      samples[sensor.name] = (quantities["humidity"], quantities["temp_c"])
+      if verbose or not windowSample:
+        print("%s: humidity, temp_c:" % sensor.name,
+              quantities["humidity"], quantities["temp_c"])
+      statusList.append(describeQuantities(sensor.name, quantities))
+      for (field, quantity) in sensor.fields.items():
+        if windowSample and splitQuantity(quantity)[1] is not None:
+          continue
+        channelDict[field] = quantities[quantity]
+
+    if not (channelDict or (windowSample and statusList)):
+      return None
+
+    line = "%s: %s" % (time.asctime(time.localtime(timestamp)),
+                       ", ".join(statusList))
+    if verbose:
+      print("Status line:", line)
+
+    channelDict["status"] = line
+    if verbose or not windowSample:
+      print("channelDict =", channelDict)
+    reading = makeReading(channelDict, timestamp)
+    reading["samples"]    = samples
+    reading["quantities"] = sensorReadings
+  except Exception as e:
+    print("Creation of channelDict failed:")
     try:
-      humidity, temp_c = Adafruit_DHT.read_retry(Adafruit_DHT.DHT22, 4)
-    except Exception as e:
-      print("'Adafruit_DHT.read_retry(Adafruit_DHT.DHT22, 4)' exception:")
-      try:
-        print(str(e))
-      except:
-        print("  Sorry, could not print Adafruit_DHT.read_retry() error msg.")
+      print("Error msg:",str(e))
       print("Continuing...")
-
-    if humidity and temp_c:
-      temp_f = None
-      try:
-        temp_f = temp_c * 9.0 / 5.0 + 32.0
-      except Exception as e:
-        print("Conversion of temp_c = '%s' to Fahrenheit failed" % temp_c)
-        try:
-          print("Error msg:",str(e))
-        except:
-          print("  Sorry, could not print channel.update() error.")
-        print("Continuing...")
-
-      if temp_f:
-        try:
-          line = "%s: temp_f = %.2f(F), humidity = %.2f%s" % \
-            (time.asctime(),temp_f, humidity,"%")
-          print("humidity, temp_c:", humidity, temp_c)
-          if clo.verbose:
-            print("Status line:", line)
-
-          channelDict = {1:temp_f,
-                         2:humidity,
-                         3:temp_f,
-                         4:humidity,
-                         "status":line}
-          print("channelDict =", channelDict)
-          try:
-            signal.alarm(120) # Throw MySignalCaughtException in (n) secs
-            response = channel.update(channelDict)
-            signal.alarm(0) # Cancel alarm
-            print("Channel update response",response)
-          except MySignalCaughtException as e:
-            print("Signal alarm caught, channel.update(channelDict) timed out.  Continuing...")
-          except Exception as e:
-            print("channel.update(channelDict) failed:")
-            try:
-              print("Error msg:",str(e))
-            except:
-              print("  Sorry, could not print channel.update() error.")
-            print("Continuing...")
-        except Exception as e:
-          print("Creation of channelDict failed:")
-          try:
-            print("Error msg:",str(e))
-            print("Continuing...")
-          except:
-            print("  Sorry, could not print creation error.  Continuing...")
-
-    if clo.verbose:
-      print("Sleeping for %s seconds" % updateFrequency)
-    time.sleep(updateFrequency)
+    except:
+      print("  Sorry, could not print creation error.  Continuing...")
+
+  return reading
+
+def getStats(summaries):
+  # Only the "<quantity>.<stat>" entries of WindowAggregator summaries
+  return dict((sensorName, dict((quantity, value)
+                                for (quantity, value) in quantities.items()
+                                if splitQuantity(quantity)[1] is not None))
+              for (sensorName, quantities) in summaries.items())
+
+def getStoreColumns(sensors):
+  columns = []
+  for sensor in sensors:
+    columns.append(sensor.name + ".temp_c")
+    columns.append(sensor.name + ".humidity")
+  return columns
+
+def getRestartChanges(oldHostConfig, newHostConfig):
+  # Names the changed settings that only take effect after a restart
+  changes = [name for name in ("channelId", "writeKey", "spoolCapacity",
+                               "connectTimeout", "readTimeout")
+             if getattr(oldHostConfig, name) != getattr(newHostConfig, name)]
+
+  def withoutFields(sensorConfigs):
+    return dict((sensorConfig.get("name", "sensor"),
+                 dict((key, value) for (key, value) in sensorConfig.items()
+                      if key not in ("fields", "derived")))
+                for sensorConfig in sensorConfigs)
+  if (withoutFields(oldHostConfig.sensors)
+      != withoutFields(newHostConfig.sensors)):
+    changes.append("sensors")
+
+  for key in ("gateway_url", "sinks", "power_save"):
+    if oldHostConfig.data.get(key) != newHostConfig.data.get(key):
+      changes.append(key)
+
+  oldAlerts = oldHostConfig.data.get("alerts", {})
+  newAlerts = newHostConfig.data.get("alerts", {})
+  if (bool(oldAlerts.get("rules")) != bool(newAlerts.get("rules"))
+      or any(oldAlerts.get(key) != newAlerts.get(key)
+             for key in ("smtp", "coalesce", "max_per_hour"))):
+    changes.append("alerts")
+  return changes
+
+def runCollectorEngine(clo, hostConfig, spool, uploader, sensors,
+                       alertEngine=None, collectorLog=None):
+  # asyncio and concurrent.futures are the biggest imports by far, and only
+  # this path needs them
+  from collectorEngine import CollectorEngine
+  from sensorScheduler import SensorScheduler
+
+  scheduler = SensorScheduler(sensors)
+  updateFrequency = clo.updateFrequency or hostConfig.updateFrequency
+
+  # With a sample_interval the sensors are read that often.  Every sample
+  # goes to the local outputs, while ThingSpeak gets one summary reading
+  # per update_frequency window.
+  sampleInterval = hostConfig.data.get("sample_interval")
+  sampleSeconds  = min(sampleInterval or updateFrequency, updateFrequency)
+  aggregator     = None
+  if sampleInterval:
+    aggregator = WindowAggregator(updateFrequency)
+    print("Sampling every %s secs, publishing a summary every %s secs"
+          % (sampleSeconds, updateFrequency))
+
+  # Derived metrics see every sample, also those that are only aggregated
+  derivedMetrics = DerivedMetrics(hostConfig.sensors)
+
+  def makeSampleReading(samples, timestamp):
+    return makeChannelReading(samples, sensors, timestamp, clo.verbose,
+                              derivedMetrics,
+                              windowSample=aggregator is not None)
+
+  # Every sink gets its own queue and thread.  Nothing may be lost on the
+  # way to the ThingSpeak spool, so that sink blocks rather than drops, and
+  # the engine's queue in front of it has no bound.
+  thingSpeakSink = ThingSpeakSink(spool, uploader,
+                                  makePublishPolicy(hostConfig.data))
+  thingSpeakWorker = SinkWorker(thingSpeakSink, backpressure="block")
+  sinkWorkers = [thingSpeakWorker]
+  if not clo.noStore:
+    store = TimeSeriesStore(clo.logFileRoot, getStoreColumns(sensors))
+    sinkWorkers.append(SinkWorker(StoreSink(store, sensors)))
+  sinkWorkers.extend(makeSinkWorkers(hostConfig, sensors, clo.logFileRoot))
+
+  thingSpeakOutput = thingSpeakWorker.makeOutput()
+
+  def publishToThingSpeak(reading):
+    # Runs on the engine's event loop thread, like setSchedule().  Rules
+    # watching a stat such as "temp_f.max" are given the window's stats
+    # here, as the samples do not have them.
+    if aggregator is None:
+      return thingSpeakOutput(reading)
+    window = aggregator.add(reading["quantities"], reading["created_at"])
+    if window is None:
+      return None
+    (windowEnd, summaries) = window
+    if alertEngine:
+      alertEngine.evaluate({"created_at":windowEnd,
+                            "quantities":getStats(summaries)})
+    summary = makeQuantitiesReading(summaries, sensors, windowEnd,
+                                    clo.verbose)
+    if summary is None:
+      return None
+    return thingSpeakOutput(summary)
+
+  engine = CollectorEngine(scheduler.readAll, makeSampleReading,
+                           sampleSeconds)
+  engine.verbose = clo.verbose
+  for sinkWorker in sinkWorkers:
+    sinkWorker.verbose = clo.verbose
+    if sinkWorker is thingSpeakWorker:
+      engine.addOutput(publishToThingSpeak, lossless=True)
+    else:
+      engine.addOutput(sinkWorker.makeOutput(),
+                       lossless=sinkWorker.isLossless())
+  if alertEngine:
+    engine.addOutput(alertEngine.evaluate)
+  if collectorLog:
+    engine.addOutput(lambda reading:
+                       collectorLog.log("reading", reading["created_at"],
+                                        quantities=reading["quantities"]))
+
+  # -f, or an interval set through the control plane, wins over the
+  # config file's update_frequency
+  updateFrequencyOverride = clo.updateFrequency
+
+  def setSchedule(newUpdateFrequency, newSampleInterval):
+    # Runs on the engine's event loop thread.  Turning aggregation off drops
+    # the samples of the window in progress.
+    nonlocal aggregator
+    if not newSampleInterval:
+      aggregator = None
+    elif aggregator is None:
+      aggregator = WindowAggregator(newUpdateFrequency)
+    else:
+      aggregator.setWindowSeconds(newUpdateFrequency)
+    sampleSeconds = min(newSampleInterval or newUpdateFrequency,
+                        newUpdateFrequency)
+    if sampleSeconds != engine.updateFrequency:
+      if aggregator:
+        print("Sampling every %s secs" % sampleSeconds)
+      engine.setUpdateFrequency(sampleSeconds)
+
+  def applyConfig(oldHostConfig, newHostConfig):
+    # Runs on the engine's event loop thread, between readings.  Nothing is
+    # rebuilt, so readings already queued, batched or spooled stay put.
+    print("Applying changes to config block '%s'" % newHostConfig.hostKey)
+
+    newUpdateFrequency = (updateFrequencyOverride
+                          or newHostConfig.updateFrequency)
+    if (not updateFrequencyOverride
+        and newHostConfig.updateFrequency != oldHostConfig.updateFrequency):
+      print("Update frequency is now %s secs"
+            % newHostConfig.updateFrequency)
+    setSchedule(newUpdateFrequency, newHostConfig.data.get("sample_interval"))
+
+    if not getGatewayUrl(clo, oldHostConfig):
+      uploader.batcher.maxBatchSize = min(newHostConfig.batchSize,
+                                          bulkUpdateLimit)
+    uploader.batcher.maxBatchAgeSeconds = newHostConfig.batchMaxAge
+
+    newSensorConfigs = dict((sensorConfig.get("name", "sensor"), sensorConfig)
+                            for sensorConfig in newHostConfig.sensors)
+    for sensor in sensors:
+      if sensor.name in newSensorConfigs:
+        sensor.fields = newSensorConfigs[sensor.name]["fields"]
+    derivedMetrics.configure(newHostConfig.sensors)
+
+    thingSpeakSink.setPublishPolicy(makePublishPolicy(newHostConfig.data))
+
+    if alertEngine and newHostConfig.data.get("alerts", {}).get("rules"):
+      alertEngine.updateRules(makeAlertRules(newHostConfig.data["alerts"]))
+
+    changes = getRestartChanges(oldHostConfig, newHostConfig)
+    if collectorLog:
+      collectorLog.log("config", hostKey=newHostConfig.hostKey,
+                       restartNeeded=changes)
+    if changes:
+      print("Changes to %s take effect after a restart" % ", ".join(changes))
+
+  watcher = ConfigWatcher(clo.configFilename, hostConfig,
+                          lambda oldHostConfig, newHostConfig:
+                            engine.callSoon(applyConfig, oldHostConfig,
+                                            newHostConfig))
+
+  # Control commands run on the control plane's thread and only hand work
+  # to the threads that own it, so they never hold up a sample
+  latestReading = None
+
+  def keepLatest(reading):
+    # Sinks copy a reading before adding to it, so it can be kept as is
+    nonlocal latestReading
+    latestReading = reading
+
+  def setInterval(seconds):
+    nonlocal updateFrequencyOverride
+    updateFrequencyOverride = seconds
+    print("Update frequency is now %s secs, set through the control plane"
+          % seconds)
+    setSchedule(seconds, watcher.hostConfig.data.get("sample_interval"))
+
+  def controlLatest(args):
+    if latestReading is None:
+      raise ControlError("No reading yet")
+    return {"reading":latestReading}
+
+  def controlPublish(args):
+    uploader.flushNow()
+    return {"uploading":uploader.queuedCount()}
+
+  def controlInterval(args):
+    seconds = parseIntervalArgs(args)
+    engine.callSoon(setInterval, seconds)
+    return {"update_frequency":seconds}
+
+  def controlFlush(args):
+    if collectorLog:
+      collectorLog.flush()
+    spool.sync()
+    return {"flushed":["log", "spool"] if collectorLog else ["spool"]}
+
+  control = None
+  if clo.controlSocket or clo.controlSerial or clo.controlStdin:
+    control = ControlPlane({"latest":controlLatest,
+                            "publish":controlPublish,
+                            "interval":controlInterval,
+                            "flush":controlFlush},
+                           socketPath=clo.controlSocket,
+                           serialDevice=clo.controlSerial,
+                           serialBaud=clo.controlBaud,
+                           useStdin=clo.controlStdin)
+    control.verbose = clo.verbose
+    engine.addOutput(keepLatest)
+
+  # Chores that keep their own timers otherwise are done after each sample
+  # when saving power.  The report is printed before the log is written.
+  powerMonitor = PowerMonitor()
+  if isPowerSaving(clo, hostConfig):
+    print("Power saving: uploading, logging and checking the config "
+          "after each sample")
+    engine.addCycleHook(watcher.check)
+  engine.addCycleHook(powerMonitor.check)
+  if isPowerSaving(clo, hostConfig) and collectorLog:
+    collectorLog.setFlushSeconds(None)
+    engine.addCycleHook(collectorLog.flush)
+
+  # First, so a control port that cannot be opened stops the start early
+  if control:
+    control.start()
+    if clo.controlSocket:
+      print("Control socket '%s'" % clo.controlSocket)
+  for sinkWorker in sinkWorkers:
+    sinkWorker.start()
+  if not isPowerSaving(clo, hostConfig):
+    watcher.start()
+  try:
+    engine.run()
+  finally:
+    if control:
+      control.stop(timeout=hostConfig.readTimeout)
+    watcher.stop()
+    scheduler.shutdown()
+    for sinkWorker in sinkWorkers:
+      sinkWorker.stop(timeout=hostConfig.readTimeout)
 
 if (__name__ == '__main__'):
   main(sys.argv[1:])
@@ -0,0 +1,148 @@
+import time
+
+import pytest
+
+from alertEngine import AlertRule, AlertEngine, AlertEvent, SmtpNotifier,\
+  addEvent, makeAlertRules, makeAlertEngine
+from collectorConfig import ConfigError
+from smtpStub import SmtpStub
+
+class RecordingNotifier(object):
+
+  def __init__(self):
+    self.events = []
+
+  def notify(self, event):
+    self.events.append(event)
+
+  def stop(self, timeout=None):
+    pass
+
+@pytest.fixture
+def smtp():
+  stub = SmtpStub().start()
+  yield stub
+  stub.stop()
+
+def makeNotifier(smtp, **options):
+  return SmtpNotifier("frig@example.com", host="127.0.0.1", port=smtp.port,
+                      useSsl=False, **options)
+
+def waitFor(condition):
+  deadline = time.monotonic() + 5
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+def makeEvent(rule, kind="firing", value=40.0, timestamp=0.0):
+  return AlertEvent(kind, rule, value, timestamp)
+
+def test_rule_fires_after_min_duration_and_resolves_with_hysteresis():
+  rule = AlertRule("warm", "frig", "temp_f", above=38.0, hysteresis=1.0,
+                   minDurationSeconds=60, repeatSeconds=600)
+  assert rule.evaluate(39.0, 0) is None
+  assert rule.state == "pending"
+  assert rule.evaluate(39.0, 60).kind == "firing"
+  assert rule.evaluate(39.0, 120) is None
+  assert rule.evaluate(37.5, 180) is None
+  assert rule.evaluate(39.0, 660).kind == "repeat"
+  assert rule.evaluate(37.0, 700).kind == "resolved"
+  assert rule.state == "ok"
+
+def test_short_breach_does_not_fire():
+  rule = AlertRule("cold", "freezer", "temp_f", below=-5.0,
+                   minDurationSeconds=60)
+  assert rule.evaluate(-6.0, 0) is None
+  assert rule.evaluate(-4.0, 30) is None
+  assert rule.evaluate(-6.0, 70) is None
+  assert rule.state == "pending"
+
+def test_engine_feeds_each_rule_its_sensor_and_keeps_state_on_reload():
+  notifier = RecordingNotifier()
+  rules = makeAlertRules({"rules":[{"name":"warm", "sensor":"frig",
+                                    "above":38.0}]})
+  engine = AlertEngine(rules, notifier)
+  engine.evaluate({"created_at":0.0,
+                   "quantities":{"frig":{"temp_f":39.0},
+                                 "freezer":{"temp_f":50.0}}})
+  assert [event.rule.name for event in notifier.events] == ["warm"]
+
+  engine.updateRules(makeAlertRules({"rules":[{"name":"warm",
+                                               "sensor":"frig",
+                                               "above":38.5}]}))
+  engine.evaluate({"created_at":10.0, "quantities":{"frig":{"temp_f":39.0}}})
+  assert len(notifier.events) == 1
+
+def test_reminders_of_a_rule_coalesce_into_the_latest():
+  rule = AlertRule("warm", "frig", "temp_f", above=38.0)
+  events = []
+  for (kind, timestamp) in (("firing", 0), ("repeat", 1), ("repeat", 2)):
+    addEvent(events, makeEvent(rule, kind, timestamp=timestamp))
+  assert [(event.kind, event.timestamp) for event in events] ==\
+    [("firing", 0), ("repeat", 2)]
+
+def test_events_within_coalesce_seconds_share_one_message(smtp):
+  rule = AlertRule("warm", "frig", "temp_f", above=38.0)
+  other = AlertRule("cold", "freezer", "temp_f", below=-5.0)
+  notifier = makeNotifier(smtp, coalesceSeconds=0.3).start()
+  notifier.notify(makeEvent(rule))
+  notifier.notify(makeEvent(other, value=-6.0))
+  assert waitFor(lambda: notifier.sentCount == 1)
+  assert "Subject: WARNING: 2 temperature alerts" in smtp.messages[0][2]
+
+  # The next message goes over the same connection
+  notifier.notify(makeEvent(rule, "resolved", value=36.0))
+  assert waitFor(lambda: notifier.sentCount == 2)
+  assert "Subject: RESOLVED: warm" in smtp.messages[1][2]
+  notifier.stop(5)
+  assert notifier.connectCount == 1
+  assert smtp.connectionCount == 1
+
+def test_max_per_hour_holds_back_further_messages(smtp):
+  rule = AlertRule("warm", "frig", "temp_f", above=38.0)
+  notifier = makeNotifier(smtp, coalesceSeconds=0.01, maxPerHour=1).start()
+  notifier.notify(makeEvent(rule))
+  assert waitFor(lambda: notifier.sentCount == 1)
+  assert notifier.rateLimitWait() > 3500
+
+  notifier.notify(makeEvent(rule, "resolved", value=36.0))
+  time.sleep(0.3)
+  assert len(smtp.messages) == 1
+  # What is held back still goes out when stopping
+  notifier.stop(5)
+  assert len(smtp.messages) == 2
+
+def test_unreachable_server_is_retried(smtp):
+  rule = AlertRule("warm", "frig", "temp_f", above=38.0)
+  port = smtp.port
+  smtp.stop()
+  notifier = SmtpNotifier("frig@example.com", host="127.0.0.1", port=port,
+                          useSsl=False, coalesceSeconds=0.01,
+                          retrySeconds=0.05).start()
+  notifier.notify(makeEvent(rule))
+  assert waitFor(lambda: notifier.retryDelay > 0.05)
+  assert notifier.sentCount == 0
+
+  stub = SmtpStub(port=port).start()
+  try:
+    assert waitFor(lambda: notifier.sentCount == 1)
+    notifier.stop(5)
+    assert len(stub.messages) == 1
+  finally:
+    stub.stop()
+
+def test_rules_without_a_recipient_raise_config_error(tmp_path):
+  alerts = {"rules":[{"name":"warm", "sensor":"frig", "above":38.0}],
+            "smtp":{"credentials_file":str(tmp_path / "missing")}}
+  with pytest.raises(ConfigError) as excinfo:
+    makeAlertEngine({"alerts":alerts})
+  assert "No alert recipient" in str(excinfo.value)
+
+  credentialsFile = tmp_path / "credentials"
+  credentialsFile.write_text("['not', 'a', 'dict']")
+  alerts["smtp"]["credentials_file"] = str(credentialsFile)
+  with pytest.raises(ConfigError):
+    makeAlertEngine({"alerts":alerts})
+
+  credentialsFile.write_text("{'to':'frig@example.com'}")
+  assert makeAlertEngine({"alerts":alerts}).notifier.to == "frig@example.com"
@@ -0,0 +1,79 @@
+import time
+
+from backgroundUploader import BackgroundUploader
+from readingBatcher import ReadingBatcher
+from readingSpool import ReadingSpool
+from thingSpeakClient import ThingSpeakError
+
+class FakeClient(object):
+
+  def __init__(self):
+    self.sent    = []
+    self.failing = False
+
+  def bulkUpdate(self, readings):
+    if self.failing:
+      raise ThingSpeakError("network down")
+    self.sent.extend(reading["seq"] for reading in readings)
+
+  def close(self):
+    pass
+
+def spoolReadings(spool, uploader, count):
+  for i in range(count):
+    reading = {"created_at":1000.0 + i, "field1":float(i)}
+    reading["seq"] = spool.append(reading)
+    uploader.add(reading)
+
+def waitFor(condition):
+  deadline = time.monotonic() + 5
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+def test_sent_readings_are_acknowledged(tmp_path):
+  client = FakeClient()
+  spool = ReadingSpool(str(tmp_path / "x.spool"), capacity=100)
+  uploader = BackgroundUploader(ReadingBatcher(client, maxBatchSize=2),
+                                spool, pollSeconds=0.01).start()
+  spoolReadings(spool, uploader, 4)
+  assert waitFor(lambda: len(spool) == 0)
+  assert client.sent == [1, 2, 3, 4]
+  uploader.stop()
+  spool.close()
+
+def test_readings_dropped_by_the_batcher_stay_in_the_spool(tmp_path):
+  client = FakeClient()
+  client.failing = True
+  spool = ReadingSpool(str(tmp_path / "x.spool"), capacity=100)
+  batcher = ReadingBatcher(client, maxBatchSize=1, maxQueueLength=3)
+  uploader = BackgroundUploader(batcher, spool)
+  spoolReadings(spool, uploader, 5)
+  uploader.drainInbox()
+  assert batcher.flush() == []
+  assert batcher.droppedCount == 2
+
+  client.failing = False
+  flushed = batcher.flush()
+  assert [reading["seq"] for reading in flushed] == [3, 4, 5]
+  uploader.acknowledgeSent(flushed)
+  # 1 and 2 were never sent, so nothing may be acknowledged yet
+  assert [seq for (seq, reading) in spool.pending()] == [1, 2, 3, 4, 5]
+
+  # Once the gap is sent, everything after it is acknowledged with it
+  uploader.acknowledgeSent([reading for (seq, reading) in spool.pending()
+                            if seq < 3])
+  assert spool.pending() == []
+  assert uploader.sentAhead == set()
+  spool.close()
+
+def test_evicted_readings_do_not_hold_back_acknowledgement(tmp_path):
+  spool = ReadingSpool(str(tmp_path / "x.spool"), capacity=3)
+  uploader = BackgroundUploader(ReadingBatcher(FakeClient()), spool)
+  spoolReadings(spool, uploader, 5)
+  # Readings 1 and 2 were evicted from the full spool
+  uploader.acknowledgeSent([{"seq":3}, {"seq":5}])
+  assert [seq for (seq, reading) in spool.pending()] == [4, 5]
+  uploader.acknowledgeSent([{"seq":4}])
+  assert spool.pending() == []
+  spool.close()
@@ -0,0 +1,120 @@
+import copy
+
+import pytest
+
+from collectorConfig import ConfigError, compileConfig, compileHost,\
+  loadConfig, getChannelKeys
+
+def makeBlock(**changes):
+  block = {"channel_id":"1", "write_key":"KEY", "update_frequency":60,
+           "channel_keys":[1, 2],
+           "sensors":[{"name":"frig", "type":"DHT22", "pin":4,
+                       "fields":{1:"temp_f", 2:"humidity"}}]}
+  block.update(copy.deepcopy(changes))
+  return block
+
+def alertsWith(**changes):
+  rule = {"name":"warm", "sensor":"frig", "above":38.0}
+  rule.update(changes)
+  return {"rules":[rule]}
+
+def test_valid_block_gets_defaults():
+  block = compileHost("frig", makeBlock())
+  assert block["batch_size"] > 0
+  assert block["spool_capacity"] > 0
+
+def test_block_without_sensors_gets_the_default_dht22():
+  block = makeBlock(channel_keys=[1, 2, 3])
+  del block["sensors"]
+  sensors = compileHost("frig", block)["sensors"]
+  assert sensors[0]["fields"] == {1:"temp_f", 2:"humidity", 3:"temp_f"}
+
+@pytest.mark.parametrize("block, message", [
+  (["not", "a", "dict"], "must be a dictionary"),
+  (makeBlock(update_frequency=0), "update_frequency"),
+  (makeBlock(update_frequency=True), "update_frequency"),
+  (makeBlock(sample_interval=120), "must not be longer than"),
+  (makeBlock(channel_keys=[9]), "channel_keys"),
+  (makeBlock(sensors=[{"name":"frig", "fields":{3:"temp_f"}}]),
+   "not in its channel_keys"),
+  (makeBlock(sensors=[{"name":"frig", "fields":{1:"pressure"}}]),
+   "unknown quantity"),
+  (makeBlock(sensors=[{"name":"frig", "fields":{1:"temp_f.max"}}]),
+   "unknown quantity"),
+  (makeBlock(sensors=[{"name":"a", "fields":{1:"temp_f"}},
+                      {"name":"a", "fields":{2:"humidity"}}]),
+   "used twice"),
+  (makeBlock(publish_mode="sometimes"), "publish_mode"),
+  (makeBlock(power_save="yes"), "power_save"),
+  (makeBlock(sensors=[["frig", "DHT22"]]), "Each entry of 'sensors'"),
+  (makeBlock(sensors=["frig"]), "of host 'frig' must be a dictionary"),
+  (makeBlock(sinks=["csv"]), "Each entry of 'sinks'"),
+  (makeBlock(sinks=[{"type":"fax"}]), "unknown type"),
+  (makeBlock(sinks=[{"type":"csv", "queue_size":0}]), "queue_size"),
+  (makeBlock(alerts=[]), "alerts of host"),
+  (makeBlock(alerts={"rules":{"name":"warm"}}), "must be a list"),
+  (makeBlock(alerts={"rules":["warm"]}), "must be a dictionary"),
+  (makeBlock(alerts={"rules":[{"sensor":"frig", "above":1}]}),
+   "needs a 'name'"),
+  (makeBlock(alerts=alertsWith(sensor="attic")), "unknown sensor"),
+  (makeBlock(alerts=alertsWith(quantity="pressure")), "does not have"),
+  (makeBlock(alerts=alertsWith(quantity="temp_f.max")), "does not have"),
+  (makeBlock(alerts=alertsWith(quantity="dew_point_f")), "does not have"),
+  (makeBlock(alerts=alertsWith(below=30.0)), "exactly one of"),
+  (makeBlock(alerts=alertsWith(above="38")), "must be a number"),
+  (makeBlock(alerts={"rules":[], "coalesce":-1}), "coalesce"),
+  (makeBlock(alerts={"rules":[], "smtp":{"to":["a@example.com"]}}),
+   "'to' of the alerts smtp config"),
+  ])
+def test_bad_host_block_raises_config_error(block, message):
+  with pytest.raises(ConfigError) as excinfo:
+    compileHost("frig", block)
+  assert message in str(excinfo.value)
+
+def test_stat_quantities_need_a_sample_interval():
+  block = makeBlock(sample_interval=10,
+                    sensors=[{"name":"frig",
+                              "fields":{1:"temp_f", 2:"temp_f.max"}}])
+  assert compileHost("frig", block)["sample_interval"] == 10
+
+def test_alert_quantity_may_be_derived_or_a_stat():
+  block = makeBlock(sample_interval=10,
+                    sensors=[{"name":"frig", "fields":{1:"temp_f"},
+                              "derived":{"dew_point":{}}}],
+                    alerts={"rules":[
+                      {"name":"damp", "sensor":"frig",
+                       "quantity":"dew_point_f", "above":40.0},
+                      {"name":"peak", "sensor":"frig",
+                       "quantity":"temp_f.max", "above":40.0}]})
+  assert len(compileHost("frig", block)["alerts"]["rules"]) == 2
+
+def test_hostname_map_must_name_existing_blocks():
+  with pytest.raises(ConfigError):
+    compileConfig({"hostnameToKeyMap":{"pi":"attic"}, "frig":makeBlock()})
+  compiled = compileConfig({"hostnameToKeyMap":{"pi":"frig"},
+                            "frig":makeBlock()})
+  assert list(compiled["hosts"]) == ["frig"]
+
+def test_load_config_reports_parse_errors_and_caches(tmp_path):
+  configFilename = str(tmp_path / "collector.conf")
+  with open(configFilename, "w") as stream:
+    stream.write("{'frig':")
+  with pytest.raises(ConfigError):
+    loadConfig(configFilename)
+
+  with open(configFilename, "w") as stream:
+    stream.write(repr({"hostnameToKeyMap":{"pi":"frig"},
+                       "frig":makeBlock()}))
+  compiled = loadConfig(configFilename)
+  assert (tmp_path / "collector.conf.cache").exists()
+  assert loadConfig(configFilename) == compiled
+
+def test_channel_keys_come_from_the_host_blocks():
+  compiled = compileConfig({"frig":makeBlock(), "freezer":makeBlock(),
+                            "tester":makeBlock(channel_id="2",
+                                               write_key="KEY2")})
+  assert getChannelKeys(compiled) == {"1":"KEY", "2":"KEY2"}
+  compiled = compileConfig({"frig":makeBlock(),
+                            "freezer":makeBlock(write_key="OTHER")})
+  with pytest.raises(ConfigError):
+    getChannelKeys(compiled)
@@ -0,0 +1,99 @@
+import time
+import asyncio
+
+import pytest
+
+from collectorEngine import CollectorEngine
+
+def makeReading(sample, timestamp):
+  return {"created_at":timestamp, "sample":sample}
+
+def makeEngine(updateFrequency=0.05, readSensor=lambda: 1, **options):
+  return CollectorEngine(readSensor, makeReading, updateFrequency, **options)
+
+def runFor(engine, seconds, during=None):
+  async def main():
+    task = asyncio.ensure_future(engine.main())
+    if during is not None:
+      await asyncio.sleep(seconds / 2)
+      during()
+      await asyncio.sleep(seconds / 2)
+    else:
+      await asyncio.sleep(seconds)
+    task.cancel()
+    try:
+      await task
+    except asyncio.CancelledError:
+      pass
+  asyncio.run(main())
+
+def test_samples_land_on_multiples_of_the_frequency():
+  engine = makeEngine()
+  readings = []
+  engine.addOutput(readings.append)
+  runFor(engine, 0.5)
+  times = [reading["created_at"] for reading in readings]
+  assert len(times) >= 5
+  for (earlier, later) in zip(times, times[1:]):
+    assert later - earlier == pytest.approx(0.05)
+  assert times[0] / 0.05 == pytest.approx(round(times[0] / 0.05))
+  assert engine.sampleCount == len(times)
+
+def test_slow_output_holds_up_neither_sampler_nor_other_outputs(capsys):
+  engine = makeEngine(queueSize=2)
+  fast = []
+  slow = []
+  async def slowOutput(reading):
+    await asyncio.sleep(10)
+    slow.append(reading)
+  def failingOutput(reading):
+    raise RuntimeError("disk full")
+  engine.addOutput(slowOutput)
+  engine.addOutput(failingOutput)
+  engine.addOutput(fast.append)
+  runFor(engine, 0.5)
+  assert len(fast) >= 5 and slow == []
+  # The slow output holds one reading and queues two; the rest dropped
+  assert engine.droppedCount == len(fast) - 3
+  assert "Error msg: disk full" in capsys.readouterr().out
+
+def test_lossless_output_queue_is_not_bounded():
+  engine = makeEngine(queueSize=1)
+  async def stuckOutput(reading):
+    await asyncio.sleep(10)
+  engine.addOutput(stuckOutput, lossless=True)
+  runFor(engine, 0.3)
+  assert engine.droppedCount == 0
+  assert engine.queues[0].qsize() == engine.sampleCount - 1
+
+def test_cycle_hooks_run_after_the_outputs():
+  engine = makeEngine()
+  events = []
+  engine.addOutput(lambda reading: events.append("output"))
+  engine.addCycleHook(lambda: events.append("hook"))
+  runFor(engine, 0.3)
+  assert events[:4] == ["output", "hook", "output", "hook"]
+
+def test_update_frequency_changes_while_running():
+  engine = makeEngine()
+  readings = []
+  engine.addOutput(readings.append)
+  runFor(engine, 1.0,
+         during=lambda: engine.callSoon(engine.setUpdateFrequency, 0.2))
+  times = [reading["created_at"] for reading in readings]
+  assert times[-1] - times[-2] == pytest.approx(0.2)
+  assert times[-1] / 0.2 == pytest.approx(round(times[-1] / 0.2))
+
+def test_overrunning_read_skips_whole_periods():
+  def slowRead():
+    time.sleep(0.12)
+    return 1
+  engine = makeEngine(readSensor=slowRead)
+  readings = []
+  engine.addOutput(readings.append)
+  runFor(engine, 0.6)
+  times = [reading["created_at"] for reading in readings]
+  assert engine.missedCount > 0
+  for (earlier, later) in zip(times, times[1:]):
+    periods = (later - earlier) / 0.05
+    assert periods >= 3 and periods == pytest.approx(round(periods))
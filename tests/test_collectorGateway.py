@@ -0,0 +1,179 @@
+import json
+import time
+import http.client
+
+import pytest
+
+from collectorGateway import CollectorGateway, GatewayChannel, cleanUpdate,\
+  makeGatewaySpoolFileName, makeGatewayInboxFileName
+from thingSpeakStub import ThingSpeakStub
+
+@pytest.fixture
+def stub():
+  stub = ThingSpeakStub().start()
+  yield stub
+  stub.stop()
+
+@pytest.fixture
+def gateway(tmp_path, stub):
+  gateway = CollectorGateway(str(tmp_path / "gw"), {"7":"KEY"},
+                             baseUrl=stub.getBaseUrl(),
+                             port=0, host="127.0.0.1", intervalSeconds=3600,
+                             mergeSeconds=15, lateSeconds=15).start()
+  yield gateway
+  gateway.stop(5)
+
+def post(gateway, channelId, payload):
+  connection = http.client.HTTPConnection("127.0.0.1", gateway.port,
+                                          timeout=5)
+  connection.request("POST", "/channels/%s/bulk_update.json" % channelId,
+                     json.dumps(payload),
+                     {"Content-Type":"application/json"})
+  response = connection.getresponse()
+  body = json.loads(response.read().decode("UTF-8"))
+  connection.close()
+  return (response.status, body)
+
+def waitForUpdates(stub, count):
+  deadline = time.monotonic() + 5
+  while len(stub.updates) < count and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return stub.updates
+
+def test_clean_update_makes_fields_numbers_and_status_text():
+  assert cleanUpdate({"created_at":100, "field1":"71.3", "field2":4,
+                      "field3":None, "status":12, "extra":"x"}) ==\
+    {"created_at":100, "field1":71.3, "field2":4.0, "status":"12"}
+  for update in ({"field1":1.0}, {"created_at":100, "field1":"warm"},
+                 {"created_at":100, "field1":"nan"},
+                 {"created_at":100, "field1":[1]}, ["created_at"]):
+    with pytest.raises((ValueError, KeyError, TypeError)):
+      cleanUpdate(update)
+
+def makeChannel(tmp_path, stub):
+  logFileRoot = str(tmp_path / "gw")
+  return GatewayChannel("7", "KEY", stub.getBaseUrl(),
+                        makeGatewaySpoolFileName(logFileRoot, "7"),
+                        makeGatewayInboxFileName(logFileRoot, "7"),
+                        mergeSeconds=15)
+
+def test_updates_in_one_slot_merge_into_one_row(tmp_path, stub):
+  channel = makeChannel(tmp_path, stub)
+  channel.merge({"created_at":1005.0, "field1":36.0, "status":"frig ok"})
+  channel.merge({"created_at":1012.0, "field3":-2.0,
+                 "status":"freezer ok"})
+  channel.merge({"created_at":1020.0, "field1":37.0})
+  assert len(channel.rows) == 2
+
+  # Only the slot that ended lateSeconds ago is closed
+  assert channel.closeRows(1020 + 14, lateSeconds=15) == 0
+  assert channel.closeRows(1020 + 15, lateSeconds=15) == 1
+  updates = waitForUpdates(stub, 1)
+  assert updates[0]["field1"] == 36.0 and updates[0]["field3"] == -2.0
+  assert updates[0]["status"] == "frig ok; freezer ok"
+
+  assert channel.closeRows(None) == 1
+  assert waitForUpdates(stub, 2)[1]["field1"] == 37.0
+  channel.close(5)
+
+def test_accepted_updates_survive_a_crash_until_their_row_is_spooled(
+    tmp_path, stub):
+  channel = makeChannel(tmp_path, stub)
+  channel.accept([{"created_at":1005.0, "field1":36.0},
+                  {"created_at":1020.0, "field1":37.0}])
+  assert channel.closeRows(1030 + 15, lateSeconds=15) == 1
+  assert len(channel.inbox) == 1
+  # Crash: neither the open row nor the uploader is closed
+  channel.uploader.stop(5)
+  channel.inbox.close()
+  channel.spool.close()
+
+  channel = makeChannel(tmp_path, stub)
+  assert list(channel.rows.values()) == [{"created_at":1020.0,
+                                          "field1":37.0}]
+  assert channel.closeRows(None) == 1
+  assert len(channel.inbox) == 0
+  updates = waitForUpdates(stub, 2)
+  assert [update["field1"] for update in updates] == [36.0, 37.0]
+  channel.close(5)
+
+def test_gateway_accepts_string_fields_and_uploads_them(gateway, stub):
+  (status, body) = post(gateway, "7", {
+    "write_api_key":"KEY",
+    "updates":[{"created_at":1000.0, "field1":"71.3", "status":5},
+               {"created_at":1001.0, "field2":45}]})
+  assert status == 202
+  gateway.closeRows(2000.0)
+  updates = waitForUpdates(stub, 1)
+  assert updates[0]["field1"] == 71.3 and updates[0]["field2"] == 45.0
+  assert updates[0]["status"] == "5"
+  assert stub.requests == ["/channels/7/bulk_update.json"]
+
+@pytest.mark.parametrize("payload", [
+  {"updates":[{"created_at":1000.0, "field1":1.0}]},
+  {"write_api_key":"KEY", "updates":[{"field1":1.0}]},
+  {"write_api_key":"KEY", "updates":[{"created_at":1000.0,
+                                      "field1":"warm"}]},
+  {"write_api_key":"KEY", "updates":[{"created_at":1000.0,
+                                      "field1":{"value":1}}]},
+  {"write_api_key":"KEY", "updates":[17]},
+  {"write_api_key":"KEY", "updates":7},
+  ])
+def test_bad_updates_get_400_and_are_not_merged(gateway, payload):
+  (status, body) = post(gateway, "7", payload)
+  assert status == 400
+  assert "error" in body
+  assert all(not channel.rows for channel in gateway.channels.values())
+
+def test_other_write_key_is_refused(gateway):
+  # Even as the channel's first update, a wrong key does not take over
+  update = {"created_at":1000.0, "field1":1.0}
+  (status, body) = post(gateway, "7", {"write_api_key":"OTHER",
+                                       "updates":[update]})
+  assert status == 401
+  assert gateway.channels == {}
+  assert post(gateway, "7", {"write_api_key":"KEY",
+                             "updates":[update]})[0] == 202
+  assert gateway.channels["7"].client.writeKey == "KEY"
+
+def test_unknown_channel_is_refused(gateway, tmp_path):
+  (status, body) = post(gateway, "8", {"write_api_key":"KEY",
+                                       "updates":[{"created_at":1000.0,
+                                                   "field1":1.0}]})
+  assert status == 404
+  assert gateway.channels == {}
+  assert list(tmp_path.iterdir()) == []
+
+def test_backlog_is_replayed_at_start(tmp_path, stub):
+  channel = makeChannel(tmp_path, stub)
+  channel.accept([{"created_at":1005.0, "field1":36.0}])
+  channel.uploader.stop(5)
+  channel.inbox.close()
+  channel.spool.close()
+
+  gateway = CollectorGateway(str(tmp_path / "gw"), {"7":"KEY", "8":"KEY8"},
+                             baseUrl=stub.getBaseUrl(), port=0,
+                             host="127.0.0.1", intervalSeconds=3600).start()
+  assert list(gateway.channels) == ["7"]
+  gateway.stop(5)
+  assert waitForUpdates(stub, 1)[0]["field1"] == 36.0
+
+def test_failed_flush_leaves_the_flush_loop_running(tmp_path, stub, capsys):
+  gateway = CollectorGateway(str(tmp_path / "gw"), {"7":"KEY"},
+                             baseUrl=stub.getBaseUrl(),
+                             port=0, host="127.0.0.1", intervalSeconds=0.01)
+  calls = []
+  def closeRows(now):
+    calls.append(now)
+    raise RuntimeError("spool full")
+  gateway.closeRows = closeRows
+  gateway.start()
+  deadline = time.monotonic() + 5
+  while len(calls) < 3 and time.monotonic() < deadline:
+    time.sleep(0.01)
+  gateway.stopping.set()
+  gateway.thread.join(5)
+  gateway.server.shutdown()
+  gateway.server.server_close()
+  assert len(calls) >= 3
+  assert "Gateway flush failed:" in capsys.readouterr().out
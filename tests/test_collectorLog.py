@@ -0,0 +1,132 @@
+import io
+import os
+import gzip
+import json
+import time
+import threading
+
+import pytest
+
+from collectorLog import CollectorLog, ConsoleTee, compressLogFile,\
+  findLogFiles, makeLogFileName
+from timeSeriesStore import dayStartOf
+
+@pytest.fixture
+def dayStart():
+  # Start of a fixed day away from DST changes
+  return dayStartOf(time.mktime((2024, 3, 5, 12, 0, 0, 0, 0, -1)))
+
+def readRecords(fileName):
+  opener = gzip.open if fileName.endswith(".gz") else open
+  with opener(fileName, "rt") as stream:
+    return [json.loads(line) for line in stream]
+
+def test_records_go_to_the_file_of_their_own_day(tmp_path, dayStart):
+  root = str(tmp_path / "c")
+  collectorLog = CollectorLog(root, flushSeconds=None)
+  collectorLog.log("reading", dayStart + 86400 - 1, quantities={"t":1})
+  collectorLog.log("console", dayStart + 86400, text="after midnight")
+  collectorLog.flush()
+  collectorLog.stop(5)
+
+  logFiles = findLogFiles(root)
+  assert [dateStamp for (dateStamp, fileName) in logFiles] ==\
+    ["2024-03-05", "2024-03-06"]
+  # The day that was closed is compressed, the current one is not
+  (closedFileName, currentFileName) = [fileName
+                                       for (dateStamp, fileName) in logFiles]
+  assert closedFileName.endswith(".log.gz")
+  assert currentFileName.endswith(".log")
+  assert readRecords(closedFileName) ==\
+    [{"time":dayStart + 86399, "event":"reading", "quantities":{"t":1}}]
+  assert readRecords(currentFileName)[0]["text"] == "after midnight"
+
+def test_day_compressed_before_is_appended_as_another_member(tmp_path):
+  fileName = str(tmp_path / "c.2024-03-05.log")
+  for text in ("first", "second"):
+    with open(fileName, "a") as stream:
+      stream.write(json.dumps({"text":text}) + "\n")
+    compressLogFile(fileName)
+  assert not os.path.exists(fileName)
+  assert not os.path.exists(fileName + ".gz.tmp")
+  assert [record["text"] for record in readRecords(fileName + ".gz")] ==\
+    ["first", "second"]
+
+def test_clock_set_back_appends_to_the_earlier_day(tmp_path, dayStart):
+  root = str(tmp_path / "c")
+  collectorLog = CollectorLog(root, flushSeconds=None)
+  for (offset, text) in ((0, "one"), (86400, "two"), (10, "three")):
+    collectorLog.log("console", dayStart + offset, text=text)
+  collectorLog.flush()
+  collectorLog.log("console", dayStart + 86400 + 5, text="four")
+  collectorLog.flush()
+  collectorLog.stop(5)
+
+  texts = {}
+  for (dateStamp, fileName) in findLogFiles(root):
+    texts.setdefault(dateStamp, set()).update(record["text"] for record
+                                              in readRecords(fileName))
+  assert texts == {"2024-03-05":{"one", "three"},
+                   "2024-03-06":{"two", "four"}}
+  # The earlier day was closed again, so it is all compressed
+  assert [os.path.basename(fileName)
+          for (dateStamp, fileName) in findLogFiles(root)
+          if dateStamp == "2024-03-05"] == ["c.2024-03-05.log.gz"]
+
+def test_concurrent_flushes_write_records_in_order(tmp_path, dayStart):
+  collectorLog = CollectorLog(str(tmp_path / "c"), flushSeconds=None)
+  (writing, release) = (threading.Event(), threading.Event())
+  write = collectorLog.write
+  def slowWrite(lines):
+    writing.set()
+    release.wait(5)
+    write(lines)
+  collectorLog.write = slowWrite
+
+  collectorLog.log("console", dayStart + 1, text="one")
+  first = threading.Thread(target=collectorLog.flush)
+  first.start()
+  assert writing.wait(5)
+  collectorLog.log("console", dayStart + 2, text="two")
+  second = threading.Thread(target=collectorLog.flush)
+  second.start()
+  second.join(0.2)
+  # The second flush waits for the first before taking its batch
+  assert len(collectorLog.records) == 1
+  release.set()
+  first.join(5)
+  second.join(5)
+  collectorLog.stop(5)
+
+  [(dateStamp, fileName)] = findLogFiles(str(tmp_path / "c"))
+  assert [record["text"] for record in readRecords(fileName)] ==\
+    ["one", "two"]
+
+def test_start_archives_earlier_days_and_keeps_within_the_size(tmp_path):
+  root = str(tmp_path / "c")
+  for dateStamp in ("2024-03-01", "2024-03-02", "2024-03-03"):
+    with open(makeLogFileName(root, dateStamp), "w") as stream:
+      stream.write("x" * 1000 + "\n")
+  collectorLog = CollectorLog(root, maxTotalBytes=1500, compress=False)
+  collectorLog.start()
+  collectorLog.stop(5)
+  assert [dateStamp for (dateStamp, fileName) in findLogFiles(root)] ==\
+    ["2024-03-03"]
+
+  collectorLog = CollectorLog(root).start()
+  collectorLog.stop(5)
+  assert [os.path.basename(fileName)
+          for (dateStamp, fileName) in findLogFiles(root)] ==\
+    ["c.2024-03-03.log.gz"]
+
+def test_console_tee_logs_complete_lines(tmp_path):
+  collectorLog = CollectorLog(str(tmp_path / "c"), flushSeconds=None)
+  output = io.StringIO()
+  tee = ConsoleTee(output, collectorLog)
+  tee.write("Uploader flush")
+  tee.write(" failed:\nError msg: ")
+  assert output.getvalue() == "Uploader flush failed:\nError msg: "
+  assert [json.loads(line)["text"]
+          for (timestamp, line) in collectorLog.records] ==\
+    ["Uploader flush failed:"]
+  assert tee.partial == "Error msg: "
@@ -0,0 +1,65 @@
+import http.client
+
+import pytest
+
+from collectorMetrics import MetricsRegistry, MetricsServer
+from collectorSupervisor import scrapeMetric
+
+def test_metrics_render_in_the_exposition_format():
+  registry = MetricsRegistry()
+  registry.counter("reads_total", "Reads", {"sensor":"frig"}).inc(3)
+  registry.gauge("depth", "Queue depth", function=lambda: 7)
+  histogram = registry.histogram("read_seconds", "Read time",
+                                 buckets=(0.1, 1.0))
+  for value in (0.05, 0.1, 0.5, 2.0):
+    histogram.observe(value)
+
+  assert registry.render().splitlines() == [
+    "# HELP depth Queue depth",
+    "# TYPE depth gauge",
+    "depth 7",
+    "# HELP read_seconds Read time",
+    "# TYPE read_seconds histogram",
+    'read_seconds_bucket{le="0.1"} 2',
+    'read_seconds_bucket{le="1.0"} 3',
+    'read_seconds_bucket{le="+Inf"} 4',
+    "read_seconds_sum 2.65",
+    "read_seconds_count 4",
+    "# HELP reads_total Reads",
+    "# TYPE reads_total counter",
+    'reads_total{sensor="frig"} 3']
+
+def test_same_name_and_labels_give_the_same_metric():
+  registry = MetricsRegistry()
+  counter = registry.counter("x_total", "X", {"a":1, "b":2})
+  assert registry.counter("x_total", "X", {"b":2, "a":1}) is counter
+  assert registry.counter("x_total", "X", {"a":2}) is not counter
+  with pytest.raises(AssertionError):
+    registry.gauge("x_total", "X")
+
+def test_failing_gauge_callback_is_left_out():
+  registry = MetricsRegistry()
+  registry.gauge("broken", "Broken", function=lambda: 1 / 0)
+  assert registry.render().splitlines() == ["# HELP broken Broken",
+                                            "# TYPE broken gauge"]
+
+def test_metrics_are_served_on_a_port_and_a_socket(tmp_path):
+  registry = MetricsRegistry()
+  registry.counter("collector_samples_total", "Samples").inc(5)
+  socketPath = str(tmp_path / "c.metrics")
+  server = MetricsServer(registry, port=0, socketPath=socketPath).start()
+  try:
+    connection = http.client.HTTPConnection("127.0.0.1", server.port,
+                                            timeout=5)
+    connection.request("GET", "/metrics")
+    response = connection.getresponse()
+    assert response.status == 200
+    assert b"collector_samples_total 5" in response.read()
+    connection.request("GET", "/other")
+    assert connection.getresponse().status == 404
+    connection.close()
+
+    assert scrapeMetric(socketPath, "collector_samples_total") == 5.0
+  finally:
+    server.stop()
+  assert scrapeMetric(socketPath, "collector_samples_total") is None
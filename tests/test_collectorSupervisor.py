@@ -0,0 +1,158 @@
+import sys
+import time
+
+import pytest
+
+import collectorSupervisor
+from collectorSupervisor import ChildProcess, CollectorSupervisor,\
+  setupCmdLineArgs, makeChildren
+
+def makeChild(tmp_path, code, name="c", stallSeconds=None):
+  return ChildProcess(name, [sys.executable, "-c", code],
+                      stallSeconds=stallSeconds, socketDir=str(tmp_path))
+
+def makeSupervisor(tmp_path, child):
+  return CollectorSupervisor([child],
+                             controlSocket=str(tmp_path / "s.control"),
+                             minBackoffSeconds=0.5, maxBackoffSeconds=2.0,
+                             stableSeconds=60.0, terminateSeconds=5.0)
+
+def waitForExit(child):
+  deadline = time.monotonic() + 10
+  while child.process.poll() is None and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert child.process.poll() is not None
+
+@pytest.fixture
+def supervisors():
+  made = []
+  yield made
+  for supervisor in made:
+    supervisor.stopAll()
+
+def test_child_failing_at_start_backs_off_exponentially(tmp_path,
+                                                        supervisors):
+  child = makeChild(tmp_path, "import sys; sys.exit(3)")
+  supervisor = makeSupervisor(tmp_path, child)
+  supervisors.append(supervisor)
+
+  supervisor.step(0.0)
+  assert child.startCount == 1
+  delays = []
+  now = 0.0
+  for i in range(5):
+    waitForExit(child)
+    now += 1.0
+    supervisor.step(now)
+    assert child.lastExitCode == 3
+    delays.append(child.nextStartTime - now)
+    if child.state == "waiting":
+      supervisor.step(child.nextStartTime - 0.01)
+      assert child.state == "waiting"
+      now = child.nextStartTime
+      supervisor.step(now)
+    assert child.state == "running"
+  assert delays == [0.0, 0.5, 1.0, 2.0, 2.0]
+  assert child.startCount == 6
+
+def test_child_that_ran_stably_restarts_at_once(tmp_path, supervisors):
+  child = makeChild(tmp_path, "import sys; sys.exit(0)")
+  supervisor = makeSupervisor(tmp_path, child)
+  supervisors.append(supervisor)
+  child.backoffSeconds = 2.0
+
+  supervisor.step(0.0)
+  waitForExit(child)
+  supervisor.step(100.0)
+  assert child.state == "running"
+  assert child.startCount == 2
+  assert child.backoffSeconds == 0.5
+
+def test_stalled_child_is_killed_and_restarted(tmp_path, supervisors,
+                                               monkeypatch):
+  samples = {"value":5.0}
+  monkeypatch.setattr(collectorSupervisor, "scrapeMetric",
+                      lambda socketPath, metricName: samples["value"])
+  child = makeChild(tmp_path, "import time; time.sleep(30)",
+                    stallSeconds=30.0)
+  assert child.argv[-2:] == ["--metricsSocket",
+                             str(tmp_path / "c.supervised.metrics")]
+  supervisor = makeSupervisor(tmp_path, child)
+  supervisors.append(supervisor)
+
+  supervisor.step(0.0)
+  supervisor.step(30.0)
+  assert child.lastProgress == (5.0, 30.0)
+  samples["value"] = 6.0
+  supervisor.step(40.0)
+  assert child.lastProgress == (6.0, 40.0)
+  # Unreadable metrics are no progress either
+  samples["value"] = None
+  supervisor.step(50.0)
+  supervisor.step(60.0)
+  assert child.state == "running"
+  supervisor.step(70.0)
+  assert child.state == "stopping"
+  assert child.healthKills == 1
+
+  waitForExit(child)
+  supervisor.step(71.0)
+  assert child.state == "running"
+  assert child.startCount == 2
+
+def test_control_commands(tmp_path, supervisors):
+  child = makeChild(tmp_path, "import time; time.sleep(30)")
+  supervisor = makeSupervisor(tmp_path, child)
+  supervisors.append(supervisor)
+  # Commands go by the monotonic clock, so the steps do too
+  supervisor.step(time.monotonic())
+
+  reply = supervisor.command("status")
+  assert reply["children"][0]["state"] == "running"
+  assert supervisor.command("stop c")["children"][0]["state"] == "stopping"
+  waitForExit(child)
+  supervisor.step(time.monotonic())
+  assert supervisor.command("status c")["children"][0]["state"] == "stopped"
+  assert supervisor.command("start")["children"][0]["state"] == "waiting"
+  supervisor.step(time.monotonic())
+  assert child.state == "running"
+
+  assert "No child named 'd'" in supervisor.command("stop d")["error"]
+  assert "Unknown command" in supervisor.command("reload")["error"]
+  assert supervisor.command(" ") == {"error":"Empty command"}
+
+def test_gateway_child_gets_no_stall_check():
+  (clo, cla) = setupCmdLineArgs(["--stallSeconds", "30",
+                                 "--run", "frig=./temp_to_thing_speak.py",
+                                 "--run", "gw=./temp_to_thing_speak.py "
+                                          "--gateway"])
+  children = dict((child.name, child) for child in makeChildren(clo, cla))
+  assert children["frig"].stallSeconds == 30.0
+  assert "--metricsSocket" in children["frig"].argv
+  assert children["gw"].stallSeconds is None
+  assert "--metricsSocket" not in children["gw"].argv
+
+def test_supervisor_sleeps_until_the_next_event(tmp_path, supervisors,
+                                                monkeypatch):
+  monkeypatch.setattr(collectorSupervisor, "scrapeMetric",
+                      lambda socketPath, metricName: time.monotonic())
+  child = makeChild(tmp_path, "import time; time.sleep(30)",
+                    stallSeconds=30.0)
+  supervisor = makeSupervisor(tmp_path, child)
+  supervisors.append(supervisor)
+  assert supervisor.secondsToNextEvent(5.0) == 0.0
+
+  supervisor.step(0.0)
+  assert supervisor.secondsToNextEvent(1.0) == 29.0
+  supervisor.step(30.0)
+  assert supervisor.secondsToNextEvent(30.0) == 10.0
+  child.stallSeconds = None
+  assert supervisor.secondsToNextEvent(30.0) ==\
+    collectorSupervisor.maxSleepSeconds
+
+  # A command wakes the sleeping supervisor at once
+  start = time.monotonic()
+  supervisor.command("restart c")
+  supervisor.sleep(10.0)
+  assert time.monotonic() - start < 5.0
+  assert supervisor.secondsToNextEvent(time.monotonic()) > 4.0
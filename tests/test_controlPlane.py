@@ -0,0 +1,91 @@
+import os
+import json
+import stat
+import socket
+
+import pytest
+
+from controlPlane import ControlPlane, ControlError, parseIntervalArgs,\
+  maxLineBytes, maxIntervalSeconds
+
+def makeCommands():
+  def echo(args):
+    return {"args":args}
+  def fail(args):
+    raise ControlError("no reading yet")
+  return {"echo":echo, "fail":fail}
+
+@pytest.fixture
+def control(tmp_path):
+  control = ControlPlane(makeCommands(),
+                         socketPath=str(tmp_path / "c.control")).start()
+  yield control
+  control.stop(5)
+
+def connect(control):
+  client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  client.settimeout(5)
+  client.connect(control.socketPath)
+  return client
+
+def readReplies(client, count):
+  data = b""
+  while data.count(b"\n") < count:
+    chunk = client.recv(65536)
+    if not chunk:
+      break
+    data += chunk
+  return [json.loads(line) for line in data.decode("UTF-8").splitlines()]
+
+def test_command_runs_with_its_arguments():
+  control = ControlPlane(makeCommands())
+  assert control.command("echo a b") == {"args":["a", "b"]}
+  assert control.command("  ECHO   x ") == {"args":["x"]}
+
+def test_help_and_unknown_commands():
+  control = ControlPlane(makeCommands())
+  assert control.command("help") == {"commands":["echo", "fail", "help"]}
+  reply = control.command("reboot now")
+  assert reply["error"].startswith("Unknown command 'reboot'")
+
+def test_control_error_becomes_an_error_reply():
+  control = ControlPlane(makeCommands())
+  assert control.command("fail") == {"error":"no reading yet"}
+
+@pytest.mark.parametrize("args", [[], ["soon"], ["0"], ["-5"], ["inf"],
+                                  ["nan"], [str(maxIntervalSeconds + 1)]])
+def test_bad_intervals_are_refused(args):
+  with pytest.raises(ControlError):
+    parseIntervalArgs(args)
+
+def test_interval_in_range_is_accepted():
+  assert parseIntervalArgs(["0.5"]) == 0.5
+  assert parseIntervalArgs([str(maxIntervalSeconds)]) == maxIntervalSeconds
+
+def test_socket_client_gets_one_reply_per_line(control):
+  client = connect(control)
+  client.sendall(b"echo 1\n\necho 2\r\nfail\n")
+  assert readReplies(client, 3) == [{"args":["1"]}, {"args":["2"]},
+                                    {"error":"no reading yet"}]
+  client.close()
+
+def test_line_split_across_sends_is_put_back_together(control):
+  client = connect(control)
+  client.sendall(b"ec")
+  client.sendall(b"ho joined\n")
+  assert readReplies(client, 1) == [{"args":["joined"]}]
+  client.close()
+
+def test_over_long_line_is_dropped_with_an_error(control):
+  client = connect(control)
+  client.sendall(b"x" * (maxLineBytes + 10))
+  reply = readReplies(client, 1)[0]
+  assert "longer than %s bytes" % maxLineBytes in reply["error"]
+  # The connection keeps working for the next command
+  client.sendall(b"\necho after\n")
+  assert readReplies(client, 1) == [{"args":["after"]}]
+  client.close()
+
+def test_socket_is_only_open_to_its_owner(control):
+  mode = os.stat(control.socketPath).st_mode
+  assert stat.S_IMODE(mode) == 0o600
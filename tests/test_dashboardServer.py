@@ -0,0 +1,105 @@
+import json
+import time
+
+import pytest
+
+from dashboardServer import HistoryQuery, ResponseCache, downsample
+from timeSeriesStore import TimeSeriesStore, dayStartOf
+
+@pytest.fixture
+def dayStart():
+  # Start of a fixed day away from DST changes
+  return dayStartOf(time.mktime((2024, 3, 5, 12, 0, 0, 0, 0, -1)))
+
+@pytest.fixture
+def root(tmp_path, dayStart):
+  # One hour of a reading every 2 secs, with a spike at 30 minutes
+  root = str(tmp_path / "c")
+  store = TimeSeriesStore(root, ["frig.temp_f", "frig.humidity"])
+  for i in range(1800):
+    value = 90.0 if i == 900 else 36.0 + (i % 10) / 10.0
+    store.append(dayStart + i * 2, [value, None])
+  store.close()
+  return root
+
+def test_short_series_is_kept_without_missing_values():
+  series = downsample([1.0, 2.0, 3.0], [36.0, None, 37.123],
+                      [35.0, None, 37.0], [37.0, None, 38.0], 10)
+  assert series == {"time":[1.0, 3.0], "value":[36.0, 37.12],
+                    "min":[35.0, 37.0], "max":[37.0, 38.0]}
+
+def test_long_series_keeps_its_ends_and_spikes():
+  times  = [float(i) for i in range(1000)]
+  values = [0.0] * 1000
+  values[501] = 100.0
+  series = downsample(times, values, values, values, 20)
+  assert len(series["time"]) == 20
+  assert series["time"][0] == 0.0 and series["time"][-1] == 999.0
+  # The spike is the point kept from its bucket, and its band
+  assert 100.0 in series["value"]
+  assert max(series["max"]) == 100.0
+  assert series["time"] == sorted(series["time"])
+
+def test_cache_evicts_least_recently_used_and_expired_entries():
+  cache = ResponseCache(maxEntries=2, maxBytes=10)
+  cache.put("a", b"aaa")
+  cache.put("b", b"bbb", expires=100.0)
+  assert cache.get("a", 0.0) == b"aaa"
+  cache.put("c", b"ccc")
+  assert cache.get("b", 0.0) is None
+  assert cache.get("a", 0.0) == b"aaa"
+  cache.put("d", b"dddddddd")
+  assert len(cache) == 1 and cache.size == 8
+  cache.put("e", b"e" * 11)
+  assert cache.get("e", 0.0) is None
+
+  cache.put("f", b"f", expires=100.0)
+  assert cache.get("f", 99.0) == b"f"
+  assert cache.get("f", 100.0) is None
+
+def test_history_is_thinned_to_the_width(root, dayStart):
+  query = HistoryQuery(root)
+  result = json.loads(query.history(dayStart, dayStart + 3600, 400,
+                                    ["frig.temp_f", "frig.humidity"]))
+  assert result["resolution"] == "raw"
+  temps = result["series"]["frig.temp_f"]
+  assert len(temps["time"]) == 400
+  assert max(temps["max"]) == 90.0
+  assert result["series"]["frig.humidity"]["time"] == []
+  query.close()
+
+def test_wide_range_reads_the_rollups(root, dayStart):
+  query = HistoryQuery(root)
+  result = json.loads(query.history(dayStart, dayStart + 86400, 200,
+                                    ["frig.temp_f"]))
+  assert result["resolution"] == "1m"
+  temps = result["series"]["frig.temp_f"]
+  # One point per minute of the hour, fewer than the width
+  assert len(temps["time"]) == 60
+  assert max(temps["max"]) == 90.0
+  query.close()
+
+def test_range_is_clamped_to_the_stored_days(root, dayStart):
+  query = HistoryQuery(root)
+  now = dayStart + 3600
+  assert query.firstDayStart() == dayStart
+  assert query.clampRange(0, dayStart + 60, now) == (dayStart, dayStart + 60)
+  assert query.clampRange(0, now + 10 * 86400, now) ==\
+    (dayStart, now + 86400)
+  assert query.clampRange(now + 5 * 86400, now + 10 * 86400, now) ==\
+    (now + 86400, now + 86400)
+  query.close()
+
+  empty = HistoryQuery(root + "-empty")
+  assert empty.clampRange(0, 100, now) == (100, 100)
+  empty.close()
+
+def test_past_ranges_are_answered_from_the_cache(root, dayStart):
+  query = HistoryQuery(root)
+  body = query.history(dayStart + 0.4, dayStart + 3600.4, 100,
+                       ["frig.temp_f"])
+  # Rounded to whole pixels, this is the same query
+  assert query.history(dayStart, dayStart + 3600, 100,
+                       ["frig.temp_f"]) is body
+  assert list(query.cache.entries.values())[0][1] is None
+  query.close()
@@ -0,0 +1,75 @@
+import pytest
+
+from derivedMetrics import DewPoint, DutyCycle, DoorDetector,\
+  DerivedMetrics, derivedQuantityNames
+
+def feed(metric, temps, step=60.0, humidity=50.0):
+  # Returns the quantities after each sample
+  results = []
+  for (index, temp_c) in enumerate(temps):
+    quantities = {"temp_c":temp_c, "humidity":humidity}
+    metric.update(quantities, index * step)
+    results.append(quantities)
+  return results
+
+def test_dew_point_of_known_conditions():
+  quantities = {"temp_c":20.0, "humidity":50.0}
+  DewPoint({}).update(quantities, 0.0)
+  assert quantities["dew_point_c"] == pytest.approx(9.3, abs=0.1)
+  assert quantities["dew_point_f"] == pytest.approx(48.7, abs=0.2)
+  assert quantities["dew_point_spread_c"] == pytest.approx(10.7, abs=0.1)
+
+  # Saturated air is at its dew point; dry air does not break the log
+  quantities = {"temp_c":3.0, "humidity":100.0}
+  DewPoint({}).update(quantities, 0.0)
+  assert quantities["dew_point_spread_c"] == pytest.approx(0.0, abs=0.01)
+  DewPoint({}).update({"temp_c":3.0, "humidity":0.0}, 0.0)
+
+def test_duty_cycle_follows_the_temperature_trend():
+  # Falling 0.2 C a minute for 30 minutes, then rising for 30, repeated
+  cycle = [5.0 - 0.2 * i for i in range(30)] + [-1.0 + 0.2 * i
+                                                 for i in range(30)]
+  results = feed(DutyCycle({"window":7200, "smoothing":60}), cycle * 6)
+  states = [result["compressor_on"] for result in results]
+  assert states[25] == 1 and states[55] == 0
+  assert results[-1]["duty_cycle"] == pytest.approx(50.0, abs=10.0)
+
+def test_steady_temperature_is_compressor_off():
+  results = feed(DutyCycle({}), [4.0] * 100)
+  assert results[-1] == {"temp_c":4.0, "humidity":50.0, "compressor_on":0,
+                         "duty_cycle":0.0}
+
+def test_door_opening_is_detected_and_its_recovery_timed():
+  temps = [3.0] * 10 + [5.0, 4.5, 4.0, 3.4, 3.1, 3.0]
+  results = feed(DoorDetector({"rise":1.0, "margin":0.5}), temps, step=30.0)
+  assert [result["door_open"] for result in results[8:]] ==\
+    [0, 0, 1, 1, 1, 0, 0, 0]
+  # Opened with the sample before the jump, back within 0.5 C 4 samples on
+  assert results[-1]["door_openings"] == 1
+  assert results[-1]["recovery_seconds"] == 120.0
+
+def test_humid_air_counts_as_an_opening():
+  detector = DoorDetector({})
+  for (index, humidity) in enumerate([50.0] * 5 + [65.0]):
+    quantities = {"temp_c":3.0, "humidity":humidity}
+    detector.update(quantities, index * 30.0)
+  assert quantities["door_openings"] == 1
+
+def test_reload_keeps_the_state_of_unchanged_metrics():
+  configs = [{"name":"frig", "derived":{"door":{}, "duty_cycle":{}}}]
+  derived = DerivedMetrics(configs)
+  (door, duty) = [metric for (key, metric) in derived.metrics["frig"]]
+  derived.configure([{"name":"frig",
+                      "derived":{"door":{}, "duty_cycle":{"window":60}}},
+                     {"name":"attic"}])
+  (newDoor, newDuty) = [metric for (key, metric) in derived.metrics["frig"]]
+  assert newDoor is door and newDuty is not duty
+  assert "attic" not in derived.metrics
+
+  quantities = {"temp_c":3.0, "humidity":50.0}
+  derived.update("frig", quantities, 0.0)
+  assert set(quantities) == set(["temp_c", "humidity"]
+                                + list(derivedQuantityNames(
+                                  {"door":{}, "duty_cycle":{}})))
+  derived.update("attic", quantities, 0.0)
+  assert not DerivedMetrics([{"name":"attic"}])
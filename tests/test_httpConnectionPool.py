@@ -0,0 +1,108 @@
+import select
+import threading
+import http.client
+import socketserver
+
+import pytest
+
+from httpConnectionPool import HttpConnectionPool
+from thingSpeakStub import ThingSpeakStub
+
+class OneShotHandler(socketserver.StreamRequestHandler):
+
+  # Answers one request without "Connection: close" and then hangs up, the
+  # way a server drops a kept-alive client it has idled out.  With mode
+  # "hangUp" it hangs up without answering, with "stall" it never answers
+  # and with "answerThenHangUp" it answers the first request on the
+  # connection and hangs up on the second one after reading it.
+
+  def readRequest(self):
+    length = 0
+    while True:
+      line = self.rfile.readline()
+      if line in (b"", b"\r\n", b"\n"):
+        break
+      if line.lower().startswith(b"content-length:"):
+        length = int(line.split(b":")[1])
+    self.rfile.read(length)
+    self.server.requestCount += 1
+
+  def handle(self):
+    self.readRequest()
+    if self.server.mode in ("answer", "answerThenHangUp"):
+      self.wfile.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+      self.wfile.flush()
+    elif self.server.mode == "stall":
+      self.server.released.wait(5)
+    if self.server.mode == "answerThenHangUp":
+      self.readRequest()
+
+@pytest.fixture
+def oneShotServer():
+  server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), OneShotHandler)
+  server.daemon_threads = True
+  server.requestCount   = 0
+  server.mode           = "answer"
+  server.released       = threading.Event()
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield server
+  server.released.set()
+  server.shutdown()
+  server.server_close()
+
+def makePool(server, **options):
+  return HttpConnectionPool("http://127.0.0.1:%s/api"
+                            % server.server_address[1], **options)
+
+def test_requests_share_one_kept_alive_connection():
+  stub = ThingSpeakStub().start()
+  pool = HttpConnectionPool(stub.getBaseUrl())
+  for i in range(3):
+    (status, body) = pool.request("POST", "/channels/7/bulk_update.json",
+                                  body=b'{"write_api_key":"KEY",'
+                                       b'"updates":[]}',
+                                  headers={"Content-Type":
+                                           "application/json"})
+    assert status == 202
+  assert pool.connectCount == 1
+  assert pool.requestCount == 3
+  pool.close()
+  stub.stop()
+
+def test_connection_dropped_by_the_server_is_not_reused(oneShotServer):
+  pool = makePool(oneShotServer)
+  assert pool.request("GET", "/x") == (200, b"ok")
+  assert len(pool.idle) == 1
+  select.select([pool.idle[0].sock], [], [], 5)
+  # The kept connection is gone by now; a fresh one takes the request
+  assert pool.request("GET", "/x") == (200, b"ok")
+  assert pool.connectCount == 2
+  assert oneShotServer.requestCount == 2
+  pool.close()
+
+def test_request_sent_on_a_kept_connection_is_not_resent(oneShotServer):
+  # The server read the second POST before hanging up, so it may have acted
+  # on it; sending it again could post the same rows twice
+  oneShotServer.mode = "answerThenHangUp"
+  pool = makePool(oneShotServer)
+  assert pool.request("POST", "/x", body=b"rows") == (200, b"ok")
+  with pytest.raises(http.client.RemoteDisconnected):
+    pool.request("POST", "/x", body=b"rows")
+  assert oneShotServer.requestCount == 2
+  assert pool.connectCount == 1
+  assert pool.idle == []
+
+def test_fresh_connection_failing_is_not_retried(oneShotServer):
+  oneShotServer.mode = "hangUp"
+  pool = makePool(oneShotServer)
+  with pytest.raises(http.client.RemoteDisconnected):
+    pool.request("GET", "/x")
+  assert pool.connectCount == 1
+  assert pool.idle == []
+
+def test_slow_response_times_out(oneShotServer):
+  oneShotServer.mode = "stall"
+  pool = makePool(oneShotServer, readTimeout=0.2)
+  with pytest.raises(TimeoutError):
+    pool.request("GET", "/x")
+  assert pool.idle == []
@@ -0,0 +1,71 @@
+import time
+
+import pytest
+
+import powerSaving
+from powerSaving import PowerMonitor, ratesPerHour
+from backgroundUploader import BackgroundUploader
+from readingBatcher import ReadingBatcher
+
+class FakeClient(object):
+
+  def __init__(self):
+    self.sent       = []
+    self.closeCount = 0
+
+  def bulkUpdate(self, readings):
+    self.sent.extend(reading["field1"] for reading in readings)
+
+  def close(self):
+    self.closeCount += 1
+
+def waitFor(condition):
+  deadline = time.monotonic() + 5
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+def test_rates_are_scaled_to_an_hour():
+  assert ratesPerHour((0.0, 0, 0.0), (1800.0, 10, 1.0)) == (20.0, 2.0)
+  # On a clock sped up 60 times, one real minute is a simulated hour
+  assert ratesPerHour((0.0, 0, 0.0), (60.0, 5, 0.5), timeScale=60.0) ==\
+    pytest.approx((5.0, 0.5))
+  # No time passed does not divide by zero
+  ratesPerHour((5.0, 0, 0.0), (5.0, 1, 0.0))
+
+def test_monitor_reports_once_per_period(monkeypatch, capsys):
+  usage = [(0.0, 0, 0.0)]
+  monkeypatch.setattr(powerSaving, "measureUsage", lambda: usage[0])
+  monitor = PowerMonitor(reportSeconds=3600)
+
+  usage[0] = (1800.0, 50, 0.1)
+  monitor.check()
+  assert capsys.readouterr().out == ""
+  # Before the first report the rates are those so far
+  assert monitor.rates() == pytest.approx((100.0, 0.2))
+
+  usage[0] = (3600.0, 60, 0.2)
+  monitor.check()
+  assert capsys.readouterr().out ==\
+    "Power: 60 wakeups/hour, 0.20 CPU secs/hour\n"
+
+  # The rates stay those of the last full period until the next report
+  usage[0] = (5400.0, 1060, 0.2)
+  monitor.check()
+  assert capsys.readouterr().out == ""
+  assert monitor.rates() == (60.0, 0.2)
+
+def test_uploader_without_a_poll_runs_only_when_poked():
+  client = FakeClient()
+  uploader = BackgroundUploader(ReadingBatcher(client, maxBatchSize=1),
+                                pollSeconds=None,
+                                closeAfterUpload=True).start()
+  uploader.add({"created_at":1000.0, "field1":1.0})
+  time.sleep(0.1)
+  assert client.sent == []
+
+  uploader.poke()
+  assert waitFor(lambda: client.sent == [1.0])
+  # The connection is closed after the upload
+  assert waitFor(lambda: client.closeCount == 1)
+  uploader.stop()
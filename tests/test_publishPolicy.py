@@ -0,0 +1,53 @@
+from publishPolicy import DeadbandPolicy, makePublishPolicy
+
+def reading(createdAt, **fields):
+  fields["created_at"] = createdAt
+  return fields
+
+def test_first_reading_is_published():
+  policy = DeadbandPolicy()
+  assert policy.decide(reading(0.0, field1=40.0)) == (True, False)
+
+def test_changes_inside_the_deadband_are_held_back():
+  policy = DeadbandPolicy(deadbands={1:1.0}, heartbeatSeconds=600)
+  policy.decide(reading(0.0, field1=40.0))
+  assert policy.decide(reading(10.0, field1=40.9)) == (False, False)
+  assert policy.decide(reading(20.0, field1=39.1)) == (False, False)
+  # Measured from the value last published, not the previous sample
+  assert policy.decide(reading(30.0, field1=41.0)) == (True, False)
+
+def test_default_deadband_covers_other_fields():
+  policy = DeadbandPolicy(deadbands={1:5.0}, defaultDeadband=0.5)
+  policy.decide(reading(0.0, field1=40.0, field2=50.0))
+  assert policy.decide(reading(10.0, field1=44.0, field2=50.4))[0] is False
+  assert policy.decide(reading(20.0, field1=44.0, field2=50.5))[0] is True
+
+def test_heartbeat_publishes_an_unchanged_value():
+  policy = DeadbandPolicy(heartbeatSeconds=600)
+  policy.decide(reading(0.0, field1=40.0))
+  assert policy.decide(reading(599.0, field1=40.0))[0] is False
+  assert policy.decide(reading(600.0, field1=40.0))[0] is True
+  assert policy.decide(reading(700.0, field1=40.0))[0] is False
+
+def test_threshold_crossing_is_urgent_in_both_directions():
+  policy = DeadbandPolicy(deadbands={1:10.0}, thresholds={1:[38.0]})
+  policy.decide(reading(0.0, field1=37.0))
+  assert policy.decide(reading(10.0, field1=37.9)) == (False, False)
+  assert policy.decide(reading(20.0, field1=38.1)) == (True, True)
+  assert policy.decide(reading(30.0, field1=37.5)) == (True, True)
+
+def test_state_carries_over_to_a_replacement_policy():
+  policy = DeadbandPolicy(heartbeatSeconds=600)
+  policy.decide(reading(0.0, field1=40.0))
+  replacement = DeadbandPolicy(heartbeatSeconds=600)
+  replacement.takeStateFrom(policy)
+  assert replacement.decide(reading(10.0, field1=40.1))[0] is False
+
+def test_make_publish_policy_from_the_host_block():
+  assert makePublishPolicy({}) is None
+  assert makePublishPolicy({"publish_mode":"every"}) is None
+  policy = makePublishPolicy({"publish_mode":"deadband", "heartbeat":60,
+                              "deadband":{2:0.25}, "thresholds":{1:[5, 1]}})
+  assert policy.heartbeatSeconds == 60
+  assert policy.deadbands == {2:0.25}
+  assert policy.thresholds == {1:[1, 5]}
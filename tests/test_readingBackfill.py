@@ -0,0 +1,101 @@
+import math
+import types
+import statistics
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from readingBackfill import makeSlots, mapFields, skippedFields,\
+  readRawSegment, makeUpdates, formatCreatedAts
+from derivedMetrics import DewPoint
+from timeSeriesStore import TimeSeriesStore
+
+columns = ["frig.temp_c", "frig.humidity"]
+
+def makeSensor(fields, name="frig"):
+  return types.SimpleNamespace(name=name, fields=fields)
+
+def makeRows():
+  # Two 60-second slots: three rows, then two with a missing temperature
+  times  = np.array([0.0, 20.0, 40.0, 60.0, 80.0])
+  values = np.array([[2.0, 40.0], [4.0, 50.0], [6.0, 60.0],
+                     [np.nan, 70.0], [10.0, 80.0]])
+  return (times, values)
+
+def mapSlots(fields):
+  (times, values) = makeRows()
+  (slotTimes, inverse) = makeSlots(np, times, 60)
+  assert slotTimes.tolist() == [0.0, 60.0]
+  return mapFields(np, columns, values, [makeSensor(fields)], inverse,
+                   len(slotTimes))
+
+def test_plain_quantities_map_row_by_row_without_slots():
+  (times, values) = makeRows()
+  (slotTimes, inverse) = makeSlots(np, times, None)
+  assert inverse is None
+  fields = mapFields(np, columns, values,
+                     [makeSensor({1:"temp_c", 2:"temp_f", 3:"humidity"})])
+  assert fields[1].tolist()[:3] == [2.0, 4.0, 6.0]
+  assert math.isnan(fields[1][3])
+  assert fields[2].tolist()[0] == pytest.approx(35.6)
+  assert fields[3].tolist() == [40.0, 50.0, 60.0, 70.0, 80.0]
+
+def test_plain_quantity_in_a_slot_is_its_mean():
+  fields = mapSlots({1:"temp_c", 2:"humidity"})
+  assert fields[1].tolist() == [4.0, 10.0]
+  assert fields[2].tolist() == [50.0, 75.0]
+
+def test_stat_fields_match_the_window_aggregator():
+  fields = mapSlots({1:"temp_c.min", 2:"temp_c.max", 3:"temp_c.count",
+                     4:"temp_c.last", 5:"humidity.stddev",
+                     6:"temp_f.mean"})
+  assert fields[1].tolist() == [2.0, 10.0]
+  assert fields[2].tolist() == [6.0, 10.0]
+  assert fields[3].tolist() == [3.0, 1.0]
+  assert fields[4].tolist() == [6.0, 10.0]
+  assert fields[5].tolist() == [round(statistics.stdev([40, 50, 60]), 2),
+                                round(statistics.stdev([70, 80]), 2)]
+  assert fields[6].tolist() == [39.2, 50.0]
+
+def test_one_sample_slot_has_no_spread():
+  fields = mapSlots({1:"temp_c.stddev"})
+  assert fields[1].tolist() == [2.0, 0.0]
+
+def test_dew_point_matches_the_derived_metric():
+  fields = mapFields(np, columns, np.array([[3.5, 62.0]]),
+                     [makeSensor({1:"dew_point_f", 2:"dew_point_c"})])
+  quantities = {"temp_c":3.5, "humidity":62.0}
+  DewPoint({}).update(quantities, 0.0)
+  assert fields[1][0] == round(quantities["dew_point_f"], 2)
+  assert fields[2][0] == round(quantities["dew_point_c"], 2)
+
+def test_stateful_and_unknown_fields_are_skipped():
+  sensor = makeSensor({1:"temp_f", 2:"duty_cycle", 3:"door_openings",
+                       4:"pressure"})
+  fields = mapFields(np, columns, np.array([[3.0, 50.0]]), [sensor])
+  assert list(fields) == [1]
+  assert skippedFields([sensor]) == [("frig", 2, "duty_cycle"),
+                                     ("frig", 3, "door_openings"),
+                                     ("frig", 4, "pressure")]
+
+def test_missing_sensor_columns_give_empty_fields():
+  fields = mapFields(np, columns, np.array([[3.0, 50.0]]),
+                     [makeSensor({5:"temp_c"}, name="attic")])
+  assert math.isnan(fields[5][0])
+  assert makeUpdates(formatCreatedAts(np, np.array([0.0])), fields) ==\
+    [{"created_at":"1970-01-01T00:00:00Z"}]
+
+def test_raw_segment_reads_back_as_arrays(tmp_path):
+  root = str(tmp_path / "x")
+  store = TimeSeriesStore(root, columns)
+  store.append(86400 * 365 + 0.5, [3.25, None])
+  store.append(86400 * 365 + 2.5, [3.5, 51.0])
+  fileName = store.raw.fileName
+  store.close()
+
+  (times, values, segmentColumns) = readRawSegment(np, fileName)
+  assert segmentColumns == columns
+  assert times.tolist() == [86400 * 365 + 0.5, 86400 * 365 + 2.5]
+  assert values[:, 0].tolist() == [3.25, 3.5]
+  assert math.isnan(values[0, 1]) and values[1, 1] == 51.0
@@ -0,0 +1,82 @@
+import pytest
+
+from readingBatcher import ReadingBatcher
+from thingSpeakClient import ThingSpeakError, bulkUpdateLimit
+
+class FakeClient(object):
+
+  def __init__(self):
+    self.batches = []
+    self.failing = False
+
+  def bulkUpdate(self, readings):
+    if self.failing:
+      raise ThingSpeakError("network down")
+    self.batches.append(list(readings))
+
+def makeReading(createdAt):
+  return {"created_at":createdAt, "field1":1.0}
+
+def test_flush_is_due_once_the_batch_is_full():
+  batcher = ReadingBatcher(FakeClient(), maxBatchSize=3,
+                           maxBatchAgeSeconds=3600)
+  for i in range(2):
+    batcher.add(makeReading(100.0 + i))
+  assert not batcher.flushDue(now=101.0)
+  batcher.add(makeReading(102.0))
+  assert batcher.flushDue(now=102.0)
+
+def test_flush_is_due_once_the_oldest_reading_is_old_enough():
+  batcher = ReadingBatcher(FakeClient(), maxBatchSize=10,
+                           maxBatchAgeSeconds=60)
+  assert not batcher.flushDue(now=1000.0)
+  batcher.add(makeReading(100.0))
+  assert not batcher.flushDue(now=159.0)
+  assert batcher.flushDue(now=160.0)
+
+def test_batch_size_is_capped_at_the_bulk_update_limit():
+  batcher = ReadingBatcher(FakeClient(), maxBatchSize=bulkUpdateLimit + 100)
+  assert batcher.maxBatchSize == bulkUpdateLimit
+  with pytest.raises(AssertionError):
+    ReadingBatcher(FakeClient(), maxBatchSize=0)
+
+def test_backlog_is_sent_in_chunks_of_the_bulk_update_limit():
+  client = FakeClient()
+  batcher = ReadingBatcher(client, maxBatchSize=10)
+  for i in range(bulkUpdateLimit * 2 + 5):
+    batcher.add(makeReading(float(i)))
+  flushed = batcher.flush(now=0.0)
+  assert len(flushed) == bulkUpdateLimit * 2 + 5
+  assert [len(batch) for batch in client.batches] ==\
+    [bulkUpdateLimit, bulkUpdateLimit, 5]
+  assert len(batcher) == 0
+
+def test_full_queue_drops_the_oldest():
+  batcher = ReadingBatcher(FakeClient(), maxQueueLength=3)
+  for i in range(5):
+    batcher.add(makeReading(float(i)))
+  assert len(batcher) == 3
+  assert batcher.droppedCount == 2
+  assert batcher.queue[0]["created_at"] == 2.0
+
+def test_failed_flush_keeps_readings_and_backs_off():
+  client = FakeClient()
+  batcher = ReadingBatcher(client, maxBatchSize=1, retrySeconds=10,
+                           maxRetrySeconds=40)
+  client.failing = True
+  batcher.add(makeReading(0.0))
+  assert batcher.flush(now=0.0) == []
+  assert len(batcher) == 1
+  assert not batcher.networkUp
+  assert 8.0 <= batcher.nextRetryTime <= 12.0
+  assert not batcher.flushDue(now=7.0)
+
+  delays = []
+  for attempt in range(4):
+    batcher.flush(now=0.0)
+    delays.append(batcher.retryDelay)
+  assert delays == [20, 40, 40, 40]
+
+  client.failing = False
+  assert batcher.flushIfDue(now=100.0) == [makeReading(0.0)]
+  assert batcher.networkUp
@@ -0,0 +1,119 @@
+import json
+import time
+import asyncio
+import threading
+
+import pytest
+
+from readingSinks import ReadingSink, SinkWorker, makeSpillFileName
+from collectorEngine import CollectorEngine
+
+class RecordingSink(ReadingSink):
+
+  def __init__(self, name):
+    self.name    = name
+    self.written = []
+    self.open    = threading.Event()
+    self.open.set()
+
+  def writeBatch(self, readings):
+    # Holds the worker up while closed, like a sink stuck on the network
+    self.open.wait(5)
+    self.written.extend(reading["seq"] for reading in readings)
+
+def makeReading(seq):
+  return {"created_at":1000.0 + seq, "seq":seq}
+
+def waitFor(condition):
+  deadline = time.monotonic() + 5
+  while not condition() and time.monotonic() < deadline:
+    time.sleep(0.01)
+  return condition()
+
+def test_drop_oldest_keeps_the_newest_readings():
+  sink = RecordingSink("drop")
+  worker = SinkWorker(sink, queueSize=3)
+  for seq in range(1, 6):
+    worker.put(makeReading(seq))
+  worker.start()
+  worker.stop(5)
+  assert sink.written == [3, 4, 5]
+
+def test_block_waits_for_room_without_dropping():
+  sink = RecordingSink("block")
+  sink.open.clear()
+  worker = SinkWorker(sink, queueSize=2, backpressure="block",
+                      maxBatch=1).start()
+  output = worker.makeOutput()
+
+  async def feed():
+    for seq in range(1, 7):
+      await output(makeReading(seq))
+
+  async def main():
+    task = asyncio.ensure_future(feed())
+    await asyncio.sleep(0.2)
+    # One reading is stuck in the sink, two fill the queue and the fourth
+    # waits for room
+    assert not task.done()
+    sink.open.set()
+    await asyncio.wait_for(task, 5)
+
+  asyncio.run(main())
+  worker.stop(5)
+  assert sink.written == [1, 2, 3, 4, 5, 6]
+
+def test_spill_keeps_order_and_survives_a_restart(tmp_path):
+  spillFileName = makeSpillFileName(str(tmp_path / "x"), "spill")
+  sink = RecordingSink("spill")
+  worker = SinkWorker(sink, queueSize=2, backpressure="spill",
+                      spillFileName=spillFileName)
+  for seq in range(1, 6):
+    worker.put(makeReading(seq))
+  with open(spillFileName) as stream:
+    assert [json.loads(line)["seq"] for line in stream] == [3, 4, 5]
+  # Never started: stop() keeps the queue ahead of the spilled readings
+  worker.stop()
+  with open(spillFileName) as stream:
+    assert [json.loads(line)["seq"] for line in stream] == [1, 2, 3, 4, 5]
+
+  sink = RecordingSink("spill")
+  worker = SinkWorker(sink, queueSize=2, backpressure="spill",
+                      spillFileName=spillFileName).start()
+  worker.put(makeReading(6))
+  assert waitFor(lambda: len(sink.written) == 6)
+  worker.stop(5)
+  assert sink.written == [1, 2, 3, 4, 5, 6]
+
+def test_engine_never_drops_for_a_blocking_sink():
+  worker = SinkWorker(RecordingSink("engine"), backpressure="block")
+  engine = CollectorEngine(None, None, 60, queueSize=2)
+  engine.addOutput(lambda reading: None)
+  engine.addOutput(worker.makeOutput(), lossless=worker.isLossless())
+
+  async def main():
+    engine.queues = engine.makeQueues()
+    for seq in range(1, 6):
+      engine.enqueue(makeReading(seq))
+    return [readingQueue.qsize() for readingQueue in engine.queues]
+
+  assert asyncio.run(main()) == [2, 5]
+  assert engine.droppedCount == 3
+
+def test_mqtt_sink_publishes_each_reading():
+  pytest.importorskip("paho.mqtt.client")
+  from mqttStub import MqttStub
+  from readingSinks import MqttSink
+  stub = MqttStub().start()
+  sink = MqttSink("127.0.0.1", "home/frig", port=stub.port, qos=1)
+  worker = SinkWorker(sink).start()
+  worker.put({"created_at":0.0, "field1":38.5,
+              "quantities":{"frig":{"temp_f":38.5}}})
+  assert waitFor(lambda: len(stub.messages) == 1)
+  worker.stop(5)
+  stub.stop()
+  (topic, payload) = stub.messages[0]
+  assert topic == "home/frig"
+  assert json.loads(payload) == {"created_at":"1970-01-01T00:00:00Z",
+                                 "fields":{"field1":38.5},
+                                 "sensors":{"frig":{"temp_f":38.5}}}
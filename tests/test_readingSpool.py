@@ -0,0 +1,111 @@
+import struct
+import zlib
+
+from readingSpool import ReadingSpool, headerFormat, headerSize,\
+  recordFormats, recordSizes, statusBytes
+
+def makeReading(i):
+  return {"created_at":1000.0 + i, "field1":i * 1.5, "field3":-i,
+          "status":"reading %s" % i}
+
+def test_pending_returns_unacknowledged_readings_in_order(tmp_path):
+  spool = ReadingSpool(str(tmp_path / "x.spool"), capacity=100)
+  seqs = [spool.append(makeReading(i)) for i in range(5)]
+  assert seqs == [1, 2, 3, 4, 5]
+  spool.acknowledge(2)
+
+  pending = spool.pending()
+  assert [seq for (seq, reading) in pending] == [3, 4, 5]
+  assert pending[0][1] == {"created_at":1002.0, "seq":3, "field1":3.0,
+                           "field3":-2.0, "status":"reading 2"}
+  assert len(spool) == 3
+  spool.close()
+
+def test_replay_after_reopen_resumes_after_acknowledged(tmp_path):
+  fileName = str(tmp_path / "x.spool")
+  spool = ReadingSpool(fileName, capacity=100)
+  for i in range(6):
+    spool.append(makeReading(i))
+  spool.acknowledge(4)
+  spool.close()
+
+  spool = ReadingSpool(fileName, capacity=100)
+  assert [reading["created_at"] for (seq, reading) in spool.pending()] ==\
+    [1004.0, 1005.0]
+  assert spool.append(makeReading(6)) == 7
+  spool.close()
+
+def test_acknowledge_never_moves_backwards(tmp_path):
+  spool = ReadingSpool(str(tmp_path / "x.spool"), capacity=100)
+  for i in range(4):
+    spool.append(makeReading(i))
+  spool.acknowledge(3)
+  spool.acknowledge(1)
+  assert [seq for (seq, reading) in spool.pending()] == [4]
+  spool.acknowledge(99)
+  assert spool.pending() == []
+  spool.close()
+
+def test_full_ring_evicts_the_oldest(tmp_path):
+  spool = ReadingSpool(str(tmp_path / "x.spool"), capacity=4)
+  for i in range(7):
+    spool.append(makeReading(i))
+  assert [seq for (seq, reading) in spool.pending()] == [4, 5, 6, 7]
+  assert spool.evictedCount == 3
+  spool.close()
+
+def test_torn_record_is_skipped_on_replay(tmp_path):
+  fileName = str(tmp_path / "x.spool")
+  spool = ReadingSpool(fileName, capacity=100)
+  for i in range(3):
+    spool.append(makeReading(i))
+  offset = spool.slotOffset(2)
+  spool.close()
+
+  with open(fileName, "r+b") as stream:
+    stream.seek(offset + 12)
+    stream.write(b"\xff\xff\xff\xff")
+
+  spool = ReadingSpool(fileName, capacity=100)
+  assert [seq for (seq, reading) in spool.pending()] == [1, 3]
+  spool.close()
+
+def test_capacity_change_migrates_unsent_readings(tmp_path):
+  fileName = str(tmp_path / "x.spool")
+  spool = ReadingSpool(fileName, capacity=100)
+  for i in range(5):
+    spool.append(makeReading(i))
+  spool.acknowledge(1)
+  spool.close()
+
+  spool = ReadingSpool(fileName, capacity=3)
+  assert [reading["created_at"] for (seq, reading) in spool.pending()] ==\
+    [1002.0, 1003.0, 1004.0]
+  spool.close()
+
+def test_long_status_is_cut_short(tmp_path):
+  spool = ReadingSpool(str(tmp_path / "x.spool"), capacity=10)
+  spool.append({"created_at":1.0, "field1":1.0, "status":"x" * 1000})
+  (seq, reading) = spool.pending()[0]
+  assert reading["status"] == "x" * statusBytes
+  spool.close()
+
+def test_version_1_spool_is_carried_over(tmp_path):
+  # A spool written before records held the status
+  fileName = str(tmp_path / "x.spool")
+  data = struct.pack(headerFormat, b"TSPL", 1, recordSizes[1], 10, 2)
+  data += struct.pack("<I", zlib.crc32(data))
+  with open(fileName, "wb") as stream:
+    stream.write(data.ljust(headerSize, b"\0"))
+    for seq in (1, 2, 3):
+      record = struct.pack(recordFormats[1], seq, 100.0 + seq, 1, 0,
+                           *([seq * 2.0] + [0.0] * 7))
+      stream.seek(headerSize + seq * recordSizes[1])
+      stream.write(record + struct.pack("<I", zlib.crc32(record)))
+
+  spool = ReadingSpool(fileName, capacity=10)
+  assert [(reading["created_at"], reading["field1"])
+          for (seq, reading) in spool.pending()] == [(102.0, 4.0),
+                                                     (103.0, 6.0)]
+  assert spool.version == 2
+  spool.close()
@@ -0,0 +1,69 @@
+import pytest
+
+from sensorBackends import SyntheticSensor, SyntheticSensorError,\
+  ReplaySensor, DHTSensor, makeSensor, makeSensors
+
+def readAll(sensor, count):
+  samples = []
+  for i in range(count):
+    try:
+      samples.append(sensor.read())
+    except SyntheticSensorError:
+      samples.append("raised")
+  return samples
+
+def test_synthetic_readings_only_depend_on_the_seed():
+  first  = readAll(SyntheticSensor("a", {}, rate=10, seed=3), 50)
+  second = readAll(SyntheticSensor("b", {}, rate=10, seed=3), 50)
+  assert first == second
+  assert first != readAll(SyntheticSensor("a", {}, rate=10, seed=4), 50)
+  for (humidity, temp_c) in first:
+    assert 2.0 < temp_c < 6.0 and 40.0 < humidity < 50.0
+
+def test_synthetic_failures_are_missing_values_or_exceptions():
+  samples = readAll(SyntheticSensor("a", {}, failureRate=0.5, seed=1), 400)
+  failed = [sample for sample in samples
+            if sample == "raised" or sample == (None, None)]
+  assert 150 < len(failed) < 250
+  assert "raised" in failed and (None, None) in failed
+
+def test_replay_plays_the_file_back_and_loops(tmp_path):
+  fileName = str(tmp_path / "r.csv")
+  with open(fileName, "w") as stream:
+    stream.write("# created_at,humidity,temp_c\n"
+                 "1000,45.0,3.5\n"
+                 "1002,,3.6\n")
+  sensor = ReplaySensor("r", {}, fileName)
+  assert readAll(sensor, 3) == [(45.0, 3.5), (None, 3.6), (45.0, 3.5)]
+
+  sensor = ReplaySensor("r", {}, fileName, loop=False)
+  assert readAll(sensor, 3) == [(45.0, 3.5), (None, 3.6), (None, None)]
+
+def test_make_sensor_applies_overrides_and_keeps_the_config():
+  config = {"name":"frig", "type":"DHT22", "pin":17,
+            "fields":{1:"temp_f", 2:"dew_point_f.max"},
+            "derived":{"dew_point":{}}}
+  sensor = makeSensor(config)
+  assert isinstance(sensor, DHTSensor)
+  assert sensor.minReadInterval == 2.0
+  assert sensor.describe() == "frig(DHT22 on GPIO 17)"
+
+  sensor = makeSensor(config, {"type":"synthetic", "rate":5})
+  assert isinstance(sensor, SyntheticSensor)
+  assert sensor.minReadInterval == 0.2
+  assert sensor.config["pin"] == 17
+
+def test_make_sensor_refuses_unknown_quantities_and_types():
+  with pytest.raises(AssertionError):
+    makeSensor({"name":"frig", "fields":{1:"pressure"}})
+  with pytest.raises(AssertionError):
+    makeSensor({"name":"frig", "type":"DHT99", "fields":{1:"temp_f"}})
+
+def test_make_sensors_defaults_to_one_dht22():
+  (sensor,) = makeSensors({})
+  assert (sensor.name, sensor.pin) == ("dht22", 4)
+  assert sensor.fields == {1:"temp_f", 2:"humidity", 3:"temp_f",
+                           4:"humidity"}
+  with pytest.raises(AssertionError):
+    makeSensors({"sensors":[{"name":"a", "fields":{1:"temp_f"}},
+                            {"name":"b", "fields":{1:"humidity"}}]})
@@ -0,0 +1,84 @@
+import time
+
+from sensorReader import SampleFilter, SensorReader, makeSensorReader
+
+class ScriptedSensor(object):
+
+  # Returns the scripted samples in turn; an exception in the script is
+  # raised instead
+
+  def __init__(self, samples, minReadInterval=0.0):
+    self.name            = "scripted"
+    self.samples         = list(samples)
+    self.minReadInterval = minReadInterval
+    self.readCount       = 0
+
+  def read(self):
+    self.readCount += 1
+    sample = self.samples.pop(0)
+    if isinstance(sample, Exception):
+      raise sample
+    return sample
+
+  def describe(self):
+    return "scripted"
+
+def test_filter_rejects_missing_and_out_of_range_samples():
+  sampleFilter = SampleFilter()
+  assert sampleFilter.check((None, 3.0), 0.0) == "missing"
+  assert sampleFilter.check((45.0, None), 0.0) == "missing"
+  assert sampleFilter.check((45.0, 0.0), 0.0) is None
+  assert sampleFilter.check((45.0, 85.0), 0.0) == "range"
+  assert sampleFilter.check((101.0, 3.0), 0.0) == "range"
+
+def test_spike_is_rejected_until_it_persists():
+  sampleFilter = SampleFilter(maxTempRate=0.5, spikeLimit=2)
+  sampleFilter.accept((45.0, 3.0), 0.0)
+  # Two seconds allow a change of 1 degree
+  assert sampleFilter.check((45.0, 3.9), 2.0) is None
+  assert sampleFilter.check((45.0, 20.0), 2.0) == "spike"
+  assert sampleFilter.check((45.0, 20.0), 4.0) == "spike"
+  # Still there: a real step change
+  assert sampleFilter.check((45.0, 20.0), 6.0) is None
+
+def test_median_of_the_last_samples_is_reported():
+  sampleFilter = SampleFilter(maxTempRate=None, maxHumidityRate=None,
+                              medianOf=3)
+  assert sampleFilter.accept((40.0, 3.0), 0.0) == (40.0, 3.0)
+  assert sampleFilter.accept((50.0, 5.0), 2.0) == (45.0, 4.0)
+  assert sampleFilter.accept((44.0, 4.5), 4.0) == (44.0, 4.5)
+  assert sampleFilter.accept((60.0, 9.0), 6.0) == (50.0, 5.0)
+
+def test_reader_retries_until_a_sample_passes(capsys):
+  sensor = ScriptedSensor([(None, None), RuntimeError("checksum"),
+                           (45.0, 85.0), (45.0, 3.5), (46.0, 3.6)])
+  reader = SensorReader(sensor, maxAttempts=5)
+  assert reader.read() == (45.0, 3.5)
+  assert reader.lastAttempts == 4
+  assert "checksum" in capsys.readouterr().out
+
+def test_reader_gives_up_after_max_attempts():
+  sensor = ScriptedSensor([(None, None)] * 4 + [(45.0, 3.5)])
+  reader = SensorReader(sensor, maxAttempts=3)
+  assert reader.read() == (None, None)
+  assert sensor.readCount == 3
+  # The next read starts with a fresh set of attempts
+  assert reader.read() == (45.0, 3.5)
+  assert reader.lastAttempts == 2
+
+def test_reader_only_retries_within_its_budget():
+  sensor = ScriptedSensor([(None, None)] * 5, minReadInterval=0.2)
+  reader = makeSensorReader(sensor, {"read_budget":0.3, "max_attempts":5})
+  start = time.monotonic()
+  assert reader.read() == (None, None)
+  # The second attempt fits after 0.2 secs, a third would end past 0.3
+  assert sensor.readCount == 2
+  assert time.monotonic() - start < 0.3
+
+def test_first_read_waits_out_the_minimum_interval():
+  sensor = ScriptedSensor([(45.0, 3.5), (45.0, 3.5)], minReadInterval=0.2)
+  reader = SensorReader(sensor, readBudgetSeconds=0.05)
+  reader.read()
+  start = time.monotonic()
+  assert reader.read() == (45.0, 3.5)
+  assert time.monotonic() - start >= 0.19
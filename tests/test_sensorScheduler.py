@@ -0,0 +1,52 @@
+import time
+import threading
+
+from sensorScheduler import SensorScheduler
+
+class SlowSensor(object):
+
+  def __init__(self, name, seconds, sample=(45.0, 3.5)):
+    self.name            = name
+    self.seconds         = seconds
+    self.sample          = sample
+    self.minReadInterval = 0.0
+    self.active          = 0
+    self.maxActive       = 0
+    self.lock            = threading.Lock()
+
+  def read(self):
+    with self.lock:
+      self.active += 1
+      self.maxActive = max(self.maxActive, self.active)
+    time.sleep(self.seconds)
+    with self.lock:
+      self.active -= 1
+    return self.sample
+
+  def describe(self):
+    return self.name
+
+def test_all_sensors_are_read_by_name():
+  scheduler = SensorScheduler([SlowSensor("frig", 0.0, (45.0, 3.5)),
+                               SlowSensor("freezer", 0.0, (60.0, -18.0))])
+  assert scheduler.readAll() == {"frig":(45.0, 3.5),
+                                 "freezer":(60.0, -18.0)}
+  scheduler.shutdown()
+
+def test_slow_sensor_does_not_hold_up_the_others():
+  scheduler = SensorScheduler([SlowSensor("a", 0.3), SlowSensor("b", 0.3)])
+  start = time.monotonic()
+  scheduler.readAll()
+  assert time.monotonic() - start < 0.5
+  scheduler.shutdown()
+
+def test_one_sensor_is_never_read_twice_at_once():
+  sensor = SlowSensor("a", 0.05)
+  scheduler = SensorScheduler([sensor, SlowSensor("b", 0.0)], maxWorkers=2)
+  threads = [threading.Thread(target=scheduler.readAll) for i in range(4)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join(5)
+  assert sensor.maxActive == 1
+  scheduler.shutdown()
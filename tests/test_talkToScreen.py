@@ -0,0 +1,55 @@
+import pytest
+
+import talkToScreen
+from talkToScreen import TalkToScreen
+
+screenList = """There are screens on:
+\t12345.PIComms\t(Detached)
+\t2301.other\t(Attached)
+2 Sockets in /run/screen/S-pi.
+"""
+
+@pytest.fixture
+def calls(monkeypatch):
+  # Stands in for the screen command, recording every call
+  calls = []
+  def checkOutput(cmdList):
+    calls.append(cmdList)
+    return screenList.encode("UTF-8")
+  def checkCall(cmdList):
+    calls.append(cmdList)
+  monkeypatch.setattr(talkToScreen, "check_output", checkOutput)
+  monkeypatch.setattr(talkToScreen, "check_call", checkCall)
+  monkeypatch.setattr(TalkToScreen, "sessionCache", None)
+  monkeypatch.setattr(TalkToScreen, "sessionCacheTime", 0.0)
+  return calls
+
+def listCalls(calls):
+  return [cmdList for cmdList in calls if cmdList == ["screen", "-ls"]]
+
+def test_session_names_are_parsed_from_the_screen_list(calls):
+  assert TalkToScreen.getSessions() == {"PIComms", "other"}
+
+def test_screen_list_is_only_forked_once_while_fresh(calls):
+  screen = TalkToScreen.createWithName("PIComms")
+  for i in range(3):
+    assert screen.screenAlreadyRunning()
+  assert len(listCalls(calls)) == 1
+
+  TalkToScreen.sessionCacheTime -= TalkToScreen.sessionCacheSeconds + 1
+  assert screen.screenAlreadyRunning()
+  assert len(listCalls(calls)) == 2
+
+def test_start_and_exit_keep_the_cache_current(calls):
+  screen = TalkToScreen.createWithName("frig")
+  screen.startScreen()
+  assert ["screen", "-h", "5000", "-dmS", "frig"] in calls
+  assert screen.screenAlreadyRunning()
+
+  screen.executeCmdsInScreen(["date", "./temp_to_thing_speak.py\n"])
+  assert calls[-1] == ["screen", "-S", "frig", "-X", "stuff",
+                       "date\n./temp_to_thing_speak.py\n"]
+
+  screen.exitScreen()
+  assert not screen.screenAlreadyRunning()
+  assert len(listCalls(calls)) == 1
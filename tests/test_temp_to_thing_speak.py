@@ -0,0 +1,45 @@
+import types
+
+from temp_to_thing_speak import makeChannelReading, getStats
+
+def makeSensor(name, fields):
+  return types.SimpleNamespace(name=name, fields=fields)
+
+sensors = [makeSensor("frig", {1:"temp_f", 2:"humidity"}),
+           makeSensor("freezer", {3:"temp_f"})]
+
+def test_all_sensors_go_into_one_reading():
+  reading = makeChannelReading({"frig":(45.0, 3.0), "freezer":(60.0, 0.0)},
+                               sensors, 1000.0)
+  assert reading["created_at"] == 1000.0
+  assert (reading["field1"], reading["field2"], reading["field3"]) ==\
+    (37.4, 45.0, 32.0)
+  assert "frig temp_f = 37.40(F)" in reading["status"]
+  assert "freezer temp_f = 32.00(F)" in reading["status"]
+
+def test_failed_sensor_leaves_its_fields_out():
+  reading = makeChannelReading({"frig":(45.0, 3.0), "freezer":(None, None)},
+                               sensors, 1000.0)
+  assert "field3" not in reading
+  assert list(reading["quantities"]) == ["frig"]
+  assert reading["samples"]["freezer"] == (None, None)
+
+  assert makeChannelReading({"frig":(None, 3.0), "freezer":(60.0, None)},
+                            sensors, 1000.0) is None
+
+def test_window_sample_leaves_out_stat_fields():
+  windowSensors = [makeSensor("frig", {1:"temp_f", 2:"temp_f.max"}),
+                   makeSensor("freezer", {3:"temp_f.min"})]
+  reading = makeChannelReading({"frig":(45.0, 3.0), "freezer":(60.0, 0.0)},
+                               windowSensors, 1000.0, windowSample=True)
+  assert reading["field1"] == 37.4
+  assert "field2" not in reading and "field3" not in reading
+  # A sample is kept for the local outputs even when all its fields are stats
+  reading = makeChannelReading({"frig":(None, None), "freezer":(60.0, 0.0)},
+                               windowSensors, 1000.0, windowSample=True)
+  assert list(reading["quantities"]) == ["freezer"]
+
+def test_get_stats_keeps_only_stat_quantities():
+  assert getStats({"frig":{"temp_f":37.0, "temp_f.max":38.0,
+                           "temp_f.count":3}}) ==\
+    {"frig":{"temp_f.max":38.0, "temp_f.count":3}}
@@ -0,0 +1,64 @@
+import pytest
+
+from readingBatcher import ReadingBatcher
+from thingSpeakClient import ThingSpeakBulkClient, ThingSpeakError,\
+  makeReading, formatCreatedAt, parseCreatedAt
+from thingSpeakStub import ThingSpeakStub
+
+@pytest.fixture
+def stub():
+  stub = ThingSpeakStub().start()
+  yield stub
+  stub.stop()
+
+def test_channel_dict_becomes_a_reading():
+  assert makeReading({1:71.3, 2:45.0, "status":"ok"}, 1000.0) ==\
+    {"created_at":1000.0, "field1":71.3, "field2":45.0, "status":"ok"}
+
+def test_created_at_round_trips():
+  assert formatCreatedAt(1692288000.0) == "2023-08-17T16:00:00Z"
+  assert parseCreatedAt("2023-08-17T16:00:00Z") == 1692288000.0
+  assert parseCreatedAt(1692288000) == 1692288000.0
+
+def test_bulk_update_sends_only_thingspeak_keys(stub):
+  client = ThingSpeakBulkClient("7", "KEY", baseUrl=stub.getBaseUrl())
+  client.bulkUpdate([{"created_at":1692288000.0, "field1":71.3,
+                      "status":"ok", "seq":12},
+                     {"created_at":1692288015.0, "field2":45.0}])
+  assert stub.requests == ["/channels/7/bulk_update.json"]
+  assert stub.updates == [{"created_at":"2023-08-17T16:00:00Z",
+                           "field1":71.3, "status":"ok"},
+                          {"created_at":"2023-08-17T16:00:15Z",
+                           "field2":45.0}]
+  client.close()
+
+def test_refused_and_unreachable_updates_raise(stub):
+  client = ThingSpeakBulkClient("7", "KEY", baseUrl=stub.getBaseUrl())
+  stub.offline = True
+  with pytest.raises(ThingSpeakError) as excinfo:
+    client.bulkUpdate([{"created_at":0.0, "field1":1.0}])
+  assert "HTTP status 503" in str(excinfo.value)
+  client.close()
+
+  stub.stop()
+  client = ThingSpeakBulkClient("7", "KEY", baseUrl=stub.getBaseUrl())
+  with pytest.raises(ThingSpeakError):
+    client.bulkUpdate([{"created_at":0.0, "field1":1.0}])
+  client.close()
+
+def test_backlog_kept_while_offline_goes_out_in_order(stub):
+  client = ThingSpeakBulkClient("7", "KEY", baseUrl=stub.getBaseUrl())
+  batcher = ReadingBatcher(client)
+  stub.offline = True
+  for i in range(5):
+    batcher.add({"created_at":1000.0 + i, "field1":float(i)})
+    batcher.flush()
+  assert stub.updates == []
+
+  # The backlog goes out in one request once the stub is back
+  stub.offline = False
+  assert len(batcher.flush()) == 5
+  assert [update["field1"] for update in stub.updates] ==\
+    [0.0, 1.0, 2.0, 3.0, 4.0]
+  assert len(stub.requests) == 1
+  client.close()
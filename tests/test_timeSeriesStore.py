@@ -0,0 +1,146 @@
+import time
+import struct
+
+import pytest
+
+from timeSeriesStore import TimeSeriesStore, Segment, dayStartOf,\
+  dateStampOf, headerSize, missingValue
+
+@pytest.fixture
+def dayStart():
+  # Start of a fixed day away from DST changes
+  return dayStartOf(time.mktime((2024, 3, 5, 12, 0, 0, 0, 0, -1)))
+
+def test_raw_query_returns_the_samples(tmp_path, dayStart):
+  store = TimeSeriesStore(str(tmp_path / "x"), ["frig", "freezer"])
+  store.append(dayStart + 10.5, [36.25, -2.0])
+  store.append(dayStart + 12.5, [None, -2.5])
+  result = store.query(dayStart, dayStart + 60)
+  assert result == {"time":[dayStart + 10.5, dayStart + 12.5],
+                    "frig":[36.25, None], "freezer":[-2.0, -2.5]}
+  store.close()
+
+def test_minute_rollups_hold_min_max_and_mean(tmp_path, dayStart):
+  store = TimeSeriesStore(str(tmp_path / "x"), ["frig"])
+  for (offset, value) in ((0, 36.0), (20, 38.0), (40, 40.0), (61, 30.0),
+                          (130, 1.0)):
+    store.append(dayStart + offset, [value])
+  result = store.query(dayStart, dayStart + 180, resolution="1m")
+  # The bucket being filled is not written yet
+  assert result["time"] == [dayStart, dayStart + 60]
+  assert result["frig"] == {"min":[36.0, 30.0], "max":[40.0, 30.0],
+                            "mean":[38.0, 30.0]}
+  store.close()
+
+def test_hour_rollup_sum_does_not_overflow(tmp_path, dayStart):
+  # 72000 samples of 320.00 sum to 2.3e9 once scaled, past the int32 limit
+  store = TimeSeriesStore(str(tmp_path / "x"), ["t"])
+  for i in range(72000):
+    store.append(dayStart + i * 0.05, [320.0])
+  store.append(dayStart + 3600, [0.0])
+  result = store.query(dayStart, dayStart + 3600, resolution="1h")
+  assert result["t"]["mean"] == [320.0]
+  store.close()
+
+def test_rollups_are_rebuilt_after_a_restart(tmp_path, dayStart):
+  root = str(tmp_path / "x")
+  store = TimeSeriesStore(root, ["frig"])
+  store.append(dayStart, [36.0])
+  store.append(dayStart + 30, [38.0])
+  store.close()
+
+  store = TimeSeriesStore(root, ["frig"])
+  store.append(dayStart + 50, [40.0])
+  store.append(dayStart + 70, [0.0])
+  result = store.query(dayStart, dayStart + 60, resolution="1m")
+  assert result["frig"]["mean"] == [38.0]
+  assert result["frig"]["max"] == [40.0]
+  store.close()
+
+def test_sensor_change_moves_the_day_over(tmp_path, dayStart):
+  root = str(tmp_path / "x")
+  store = TimeSeriesStore(root, ["frig", "freezer"])
+  store.append(dayStart, [36.0, -2.0])
+  store.append(dayStart + 30, [37.0, -3.0])
+  store.close()
+
+  store = TimeSeriesStore(root, ["freezer", "attic"])
+  store.append(dayStart + 60, [-4.0, 70.0])
+  store.append(dayStart + 120, [-5.0, 71.0])
+  result = store.query(dayStart, dayStart + 120)
+  assert result["freezer"] == [-2.0, -3.0, -4.0]
+  assert result["attic"] == [None, None, 70.0]
+  rollup = store.query(dayStart, dayStart + 120, resolution="1m")
+  assert rollup["freezer"]["mean"] == [-2.5, -4.0]
+  assert rollup["attic"]["mean"] == [None, 70.0]
+  store.close()
+
+def test_other_processes_see_new_records_and_replaced_segments(tmp_path,
+                                                              dayStart):
+  root = str(tmp_path / "x")
+  writer = TimeSeriesStore(root, ["frig"])
+  reader = TimeSeriesStore(root, [])
+  writer.append(dayStart, [36.0])
+  writer.flush()
+  segment = reader.getSegment(dateStampOf(dayStart), "raw")
+  assert segment.count == 1
+  writer.close()
+
+  writer = TimeSeriesStore(root, ["frig", "attic"])
+  writer.append(dayStart + 10, [37.0, 70.0])
+  writer.flush()
+  segment.refresh()
+  assert segment.columns == ["frig", "attic"]
+  assert segment.count == 2
+  writer.close()
+  reader.close()
+
+def test_version_1_rollups_are_still_read(tmp_path, dayStart):
+  # A closed day written with 32-bit sums
+  fileName = str(tmp_path / "x.2024-03-05.1h.tsd")
+  segment = Segment(fileName, ["frig"], 4, dayStart, 3600, writable=True)
+  segment.close()
+  with open(fileName, "r+b") as stream:
+    stream.seek(4)
+    stream.write(struct.pack("<HH", 1, 16))
+    stream.seek(headerSize)
+    stream.write(struct.pack("<IhhiI", 0, 3600, 3800, 3700 * 10, 10))
+    stream.seek(8)
+    stream.write(struct.pack("<I", 1))
+
+  store = TimeSeriesStore(str(tmp_path / "x"), [])
+  result = store.query(dayStart, dayStart + 7200, ["frig"], resolution="1h")
+  assert result["frig"] == {"min":[36.0], "max":[38.0], "mean":[37.0]}
+  store.close()
+
+def test_values_are_clamped_to_the_int16_range(tmp_path, dayStart):
+  store = TimeSeriesStore(str(tmp_path / "x"), ["t"])
+  store.append(dayStart, [1000.0])
+  store.append(dayStart + 1, [-1000.0])
+  result = store.query(dayStart, dayStart + 2)
+  assert result["t"] == [327.67, (missingValue + 1) / 100.0]
+  store.close()
+
+@pytest.fixture
+def denver(monkeypatch):
+  monkeypatch.setenv("TZ", "America/Denver")
+  time.tzset()
+  yield
+  monkeypatch.undo()
+  time.tzset()
+
+def test_long_dst_day_is_opened_once(tmp_path, denver):
+  # 2025-11-02 has 25 hours in Denver
+  dayStart = dayStartOf(time.mktime((2025, 11, 2, 12, 0, 0, 0, 0, -1)))
+  store = TimeSeriesStore(str(tmp_path / "s"), ["frig.temp_f"])
+  opened = []
+  openDay = store.openDay
+  store.openDay = lambda timestamp: (opened.append(timestamp),
+                                     openDay(timestamp))
+  for offset in range(0, 25 * 3600, 60):
+    store.append(dayStart + offset, [36.0])
+  assert len(opened) == 1
+  store.append(dayStart + 25 * 3600, [37.0])
+  assert len(opened) == 2
+  assert store.dateStamp == "2025-11-03"
+  store.close()
@@ -0,0 +1,77 @@
+import statistics
+
+import pytest
+
+from windowAggregator import WindowAggregator, RunningStats, isQuantity,\
+  splitQuantity
+
+def test_running_stats_match_the_statistics_module():
+  values = [36.1, 36.4, 37.0, 36.8, 35.9, 36.2]
+  stats = RunningStats()
+  for value in values:
+    stats.add(value)
+  summary = stats.summary()
+  assert summary["mean"] == pytest.approx(statistics.mean(values))
+  assert summary["stddev"] == pytest.approx(statistics.stdev(values))
+  assert (summary["min"], summary["max"]) == (35.9, 37.0)
+  assert (summary["count"], summary["last"]) == (6, 36.2)
+
+def test_single_sample_has_no_spread():
+  stats = RunningStats()
+  stats.add(5.0)
+  assert stats.stddev() == 0.0
+
+def test_window_closes_with_its_last_sample():
+  aggregator = WindowAggregator(30)
+  assert aggregator.add({"frig":{"temp_f":36.0}}, 1000.0) is None
+  assert aggregator.windowEnd == 1020
+  assert aggregator.add({"frig":{"temp_f":38.0}}, 1010.0) is None
+  (windowEnd, summaries) = aggregator.add({"frig":{"temp_f":40.0}}, 1020.0)
+  assert windowEnd == 1020
+  frig = summaries["frig"]
+  assert frig["temp_f"] == pytest.approx(38.0)
+  assert frig["temp_f.mean"] == pytest.approx(38.0)
+  assert (frig["temp_f.min"], frig["temp_f.max"]) == (36.0, 40.0)
+  assert (frig["temp_f.count"], frig["temp_f.last"]) == (3, 40.0)
+  assert frig["temp_f.stddev"] == pytest.approx(2.0)
+
+  # The next sample starts a fresh window
+  assert aggregator.add({"frig":{"temp_f":1.0}}, 1030.0) is None
+  assert aggregator.windowEnd == 1050
+
+def test_missed_window_end_closes_the_window_on_the_next_sample():
+  aggregator = WindowAggregator(30)
+  aggregator.add({"frig":{"temp_f":36.0}}, 1000.0)
+  (windowEnd, summaries) = aggregator.add({"frig":{"temp_f":50.0}}, 1025.0)
+  assert windowEnd == 1020
+  assert summaries["frig"]["temp_f.count"] == 1
+  # The late sample is the first of the next window
+  (windowEnd, summaries) = aggregator.add({"frig":{"temp_f":52.0}}, 1050.0)
+  assert windowEnd == 1050
+  assert summaries["frig"]["temp_f.mean"] == pytest.approx(51.0)
+
+def test_sensors_without_samples_are_left_out():
+  aggregator = WindowAggregator(10)
+  aggregator.add({"frig":{"temp_f":36.0}, "freezer":{"temp_f":0.0}}, 5.0)
+  aggregator.close()
+  aggregator.add({"frig":{"temp_f":37.0}}, 15.0)
+  (windowEnd, summaries) = aggregator.add({}, 20.0)
+  assert list(summaries) == ["frig"]
+
+def test_new_window_length_applies_from_the_next_window():
+  aggregator = WindowAggregator(30)
+  aggregator.add({"frig":{"temp_f":36.0}}, 1000.0)
+  aggregator.setWindowSeconds(60)
+  assert aggregator.windowEnd == 1020
+  aggregator.add({"frig":{"temp_f":36.0}}, 1020.0)
+  aggregator.add({"frig":{"temp_f":36.0}}, 1030.0)
+  assert aggregator.windowEnd == 1080
+
+def test_stat_quantities_are_only_known_when_aggregating():
+  assert splitQuantity("temp_f.max") == ("temp_f", "max")
+  assert splitQuantity("temp_f") == ("temp_f", None)
+  assert isQuantity("temp_f", False)
+  assert not isQuantity("temp_f.max", False)
+  assert isQuantity("temp_f.max", True)
+  assert not isQuantity("temp_f.median", True)
+  assert not isQuantity("pressure", True)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Minimal ThingSpeak bulk-update client.  Readings are dictionaries in the
+# shape ThingSpeak expects for one entry of a bulk update, except that
+# "created_at" holds seconds since the epoch:
+#
+#   {"created_at":1692288000.0, "field1":71.3, "field2":45.2, "status":"..."}
+
+import json
+import time
+
+from httpConnectionPool import HttpConnectionPool,\
+  defaultConnectTimeoutSeconds, defaultReadTimeoutSeconds
+from collectorMetrics import registry
+
+uploadSeconds = registry.histogram(
+  "thingspeak_upload_seconds", "Time taken by one bulk update request")
+uploadFailures = registry.counter(
+  "thingspeak_upload_failures_total", "Bulk update requests that failed")
+uploadTimeouts = registry.counter(
+  "thingspeak_upload_timeouts_total", "Bulk update requests that timed out")
+readingsUploaded = registry.counter(
+  "thingspeak_readings_uploaded_total", "Readings accepted by ThingSpeak")
+
+defaultBaseUrl = "https://api.thingspeak.com"
+
+# Keys of a reading that are sent to ThingSpeak.  Anything else, e.g. the
+# spool sequence number, stays local.
+updateKeys = tuple(["created_at"] + ["field%d" % i for i in range(1, 9)] +
+                   ["status", "latitude", "longitude", "elevation"])
+
+# ThingSpeak rejects bulk updates with more entries than this on free accounts
+bulkUpdateLimit = 960
+
+class ThingSpeakError(Exception):
+  def __init__(self, value):
+    self.value = value
+  def __str__(self):
+    return repr(self.value)
+
+def makeReading(channelDict, timestamp=None):
+  if timestamp is None:
+    timestamp = time.time()
+
+  reading = {"created_at":timestamp}
+  for key, value in channelDict.items():
+    if isinstance(key, int):
+      reading["field%d" % key] = value
+    else:
+      reading[key] = value
+
+  return reading
+
+def formatCreatedAt(timestamp):
+  return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+def parseCreatedAt(createdAt):
+  # Seconds since the epoch from a formatCreatedAt() string or a number
+  import calendar
+  if isinstance(createdAt, (int, float)):
+    return float(createdAt)
+  return float(calendar.timegm(time.strptime(createdAt,
+                                             "%Y-%m-%dT%H:%M:%SZ")))
+
+class ThingSpeakBulkClient(object):
+
+  def __init__(self, channelId, writeKey,
+               baseUrl=defaultBaseUrl,
+               connectTimeout=defaultConnectTimeoutSeconds,
+               readTimeout=defaultReadTimeoutSeconds):
+    self.channelId = channelId
+    self.writeKey  = writeKey
+    self.baseUrl   = baseUrl.rstrip("/")
+    self.pool      = HttpConnectionPool(self.baseUrl,
+                                        connectTimeout=connectTimeout,
+                                        readTimeout=readTimeout)
+    self.verbose   = False
+
+  def getBulkUpdatePath(self):
+    return "/channels/%s/bulk_update.json" % self.channelId
+
+  def getBulkUpdateUrl(self):
+    return self.baseUrl + self.getBulkUpdatePath()
+
+  def makePayload(self, readings):
+    updates = []
+    for reading in readings:
+      update = dict((key, reading[key]) for key in updateKeys
+                    if key in reading)
+      update["created_at"] = formatCreatedAt(reading["created_at"])
+      updates.append(update)
+
+    return {"write_api_key":self.writeKey, "updates":updates}
+
+  def bulkUpdate(self, readings):
+    assert len(readings) <= bulkUpdateLimit,\
+      "bulkUpdate() called with %s readings, limit is %s" %\
+      (len(readings), bulkUpdateLimit)
+
+    return self.postPayload(self.makePayload(readings))
+
+  def postPayload(self, payload):
+    # Sends a payload built by makePayload(), or one with the same layout
+    # built some other way, e.g. by readingBackfill.py
+    import http.client
+    count = len(payload["updates"])
+    body = json.dumps(payload).encode("UTF-8")
+    headers = {"Content-Type":"application/json"}
+
+    if self.verbose:
+      print("POST %s (%s readings)" % (self.getBulkUpdateUrl(), count))
+
+    start = time.perf_counter()
+    try:
+      (status, responseBody) = self.pool.request("POST",
+                                                 self.getBulkUpdatePath(),
+                                                 body=body, headers=headers)
+    except (OSError, http.client.HTTPException) as e:
+      uploadFailures.inc()
+      if isinstance(e, TimeoutError):
+        uploadTimeouts.inc()
+      raise ThingSpeakError("Bulk update failed: %s" % e)
+    finally:
+      uploadSeconds.observe(time.perf_counter() - start)
+
+    if status not in (200, 202):
+      uploadFailures.inc()
+      raise ThingSpeakError("Bulk update failed with HTTP status %s" % status)
+
+    readingsUploaded.inc(count)
+
+    return responseBody
+
+  def close(self):
+    self.pool.close()
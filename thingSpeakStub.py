@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the ThingSpeak bulk-update endpoint.  Used to exercise
+# the uploader without touching the real service, e.g.
+#
+#   ./thingSpeakStub.py --port 8080 &
+#   ./temp_to_thing_speak.py --thingspeakUrl http://localhost:8080
+
+import sys
+import json
+import time
+import random
+import threading
+from optparse import OptionParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+defaultPort = 8080
+
+class ThingSpeakStubHandler(BaseHTTPRequestHandler):
+
+  protocol_version        = "HTTP/1.1"
+  disable_nagle_algorithm = True
+
+  def do_POST(self):
+    stub = self.server.stub
+    length = int(self.headers.get("Content-Length", 0))
+    body = self.rfile.read(length)
+
+    if stub.delaySeconds:
+      time.sleep(stub.delaySeconds)
+
+    if not self.path.endswith("/bulk_update.json"):
+      self.sendJson(404, {"error":"Unknown path '%s'" % self.path})
+      return
+
+    if stub.offline or random.random() < stub.failRate:
+      self.sendJson(503, {"error":"Service unavailable"})
+      return
+
+    try:
+      payload = json.loads(body.decode("UTF-8"))
+      updates = payload["updates"]
+    except (ValueError, KeyError) as e:
+      self.sendJson(400, {"error":str(e)})
+      return
+
+    stub.recordRequest(self.path, payload)
+    self.sendJson(202, {"success":True})
+
+  def sendJson(self, status, obj):
+    body = json.dumps(obj).encode("UTF-8")
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    if self.server.stub.verbose:
+      BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ThingSpeakStub(object):
+
+  def __init__(self, port=0, host="127.0.0.1"):
+    self.host         = host
+    self.port         = port
+    self.failRate     = 0.0
+    self.delaySeconds = 0.0
+    self.offline      = False
+    self.verbose      = False
+    self.requests     = []
+    self.updates      = []
+    self.lock         = threading.Lock()
+    self.server       = None
+    self.thread       = None
+
+  def getBaseUrl(self):
+    return "http://%s:%s" % (self.host, self.port)
+
+  def recordRequest(self, path, payload):
+    with self.lock:
+      self.requests.append(path)
+      self.updates.extend(payload["updates"])
+    if self.verbose:
+      print("%s: %s updates" % (path, len(payload["updates"])))
+
+  def start(self):
+    self.server = ThreadingHTTPServer((self.host, self.port),
+                                      ThingSpeakStubHandler)
+    self.server.daemon_threads = True
+    self.server.stub = self
+    self.port = self.server.server_address[1]
+    self.thread = threading.Thread(target=self.server.serve_forever,
+                                   daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self):
+    if self.server:
+      self.server.shutdown()
+      self.server.server_close()
+      self.server = None
+
+def setupCmdLineArgs(cmdLineArgs):
+  usage = """\
+usage: %prog [-h|--help] [options]
+       where:
+         -h|--help to see options
+"""
+  parser = OptionParser(usage)
+  help="Verbose mode."
+  parser.add_option("-v", "--verbose",
+                    action="store_true",
+                    default=False,
+                    dest="verbose",
+                    help=help)
+  help="Port to listen on.  Default is %s" % defaultPort
+  parser.add_option("-p", "--port",
+                    action="store", type="int",
+                    default=defaultPort,
+                    dest="port",
+                    help=help)
+  help="Fraction of requests, 0.0 to 1.0, answered with HTTP 503"
+  parser.add_option("-f", "--failRate",
+                    action="store", type="float",
+                    default=0.0,
+                    dest="failRate",
+                    help=help)
+  help="Seconds to wait before answering each request"
+  parser.add_option("-d", "--delaySeconds",
+                    action="store", type="float",
+                    default=0.0,
+                    dest="delaySeconds",
+                    help=help)
+
+  (cmdLineOptions, cmdLineArgs) = parser.parse_args(cmdLineArgs)
+
+  if len(cmdLineArgs) != 0:
+    parser.error("All command-line arguments require a flag. "+\
+                 "Found the following without flags: %s" % cmdLineArgs)
+
+  return (cmdLineOptions, cmdLineArgs)
+
+def main(cmdLineArgs):
+  (clo, cla) = setupCmdLineArgs(cmdLineArgs)
+
+  stub = ThingSpeakStub(port=clo.port)
+  stub.failRate     = clo.failRate
+  stub.delaySeconds = clo.delaySeconds
+  stub.verbose      = clo.verbose
+  stub.start()
+  print("ThingSpeak stand-in listening on %s" % stub.getBaseUrl())
+
+  try:
+    while True:
+      time.sleep(3600)
+  except KeyboardInterrupt:
+    stub.stop()
+
+if (__name__ == '__main__'):
+  main(sys.argv[1:])
@@ -0,0 +1,546 @@
+#!/usr/bin/env python3
+
+# Compact local history of sensor readings.  Each day gets three segment
+# files next to the collector's daily log files:
+#
+#   <logFileRoot>.2015-08-17.raw.tsd   every sample
+#   <logFileRoot>.2015-08-17.1m.tsd    1-minute min/max/mean rollups
+#   <logFileRoot>.2015-08-17.1h.tsd    1-hour min/max/mean rollups
+#
+# A segment is a small header followed by an array of fixed-width records,
+# memory-mapped and grown by doubling.  A raw record is the time as
+# milliseconds since local midnight (uint32) plus one int16 per column
+# holding value * 100, so two columns cost 8 bytes a sample instead of the
+# ~60 bytes of the printed status line.  Missing values are stored as
+# missingValue.  Rollup records hold min, max, sum and count per column.
+# The sum is 64 bits wide: an hour of 1-second samples of 90.0 already
+# overflows 32 bits.  Version 1 segments, with 32-bit sums, are still read.
+#
+# All records are made of 4-byte aligned fields, so queries read a whole
+# column with a strided memoryview instead of unpacking records one by one,
+# and find the time range with a binary search over the mapped file.  A
+# 64-bit sum is read as its two 32-bit halves.  Timestamps are assumed not
+# to go backwards within a day.
+#
+# When the sensors change during a day, by a config reload or a restart,
+# the day's samples so far are copied over to a raw segment with the new
+# columns and the day's rollups are rebuilt from them.
+
+import os
+import json
+import time
+import mmap
+import struct
+import bisect
+
+segmentMagic   = b"TSDS"
+segmentVersion = 2
+readableVersions = (1, 2)
+headerSize     = 512
+
+# magic, version, record size, record count, day start, bucket width,
+# length of the JSON list of column names that follows
+headerFormat   = "<4sHHIqIH"
+countOffset    = 8
+
+valueScale     = 100
+missingValue   = -32768
+initialRecords = 4096
+
+rollupWidths = {"1m":60, "1h":3600}
+
+def dayStartOf(timestamp):
+  localTime = time.localtime(timestamp)
+  return int(time.mktime((localTime.tm_year, localTime.tm_mon,
+                          localTime.tm_mday, 0, 0, 0, 0, 0, -1)))
+
+def dateStampOf(timestamp):
+  return time.strftime("%Y-%m-%d", time.localtime(timestamp))
+
+def makeSegmentFileName(root, dateStamp, resolution):
+  return "%s.%s.%s.tsd" % (root, dateStamp, resolution)
+
+def rawRecordWords(columnCount):
+  # uint32 time plus int16 values, padded to a multiple of 4 bytes
+  return 1 + (columnCount + 1) // 2
+
+def rollupRecordWords(columnCount):
+  # uint32 bucket start, then per column int16 min, int16 max, int64 sum and
+  # uint32 count
+  return 1 + 4 * columnCount
+
+def rollupFieldWords(version):
+  # Words per column of the rollup records of a segment of version
+  return 3 if version == 1 else 4
+
+def scaleValue(value):
+  if value is None:
+    return missingValue
+  scaled = int(round(value * valueScale))
+  return max(missingValue + 1, min(32767, scaled))
+
+class Segment(object):
+
+  def __init__(self, fileName, columns=None, recordWords=None,
+               dayStart=None, width=0, writable=False,
+               initialCapacity=initialRecords):
+    self.fileName = fileName
+    self.writable = writable
+
+    if writable and not os.path.exists(fileName):
+      self.create(columns, recordWords, dayStart, width, initialCapacity)
+
+    mode = os.O_RDWR if writable else os.O_RDONLY
+    self.fd = os.open(fileName, mode)
+    self.mapFile(os.fstat(self.fd).st_size)
+    self.readHeader()
+
+  def create(self, columns, recordWords, dayStart, width, initialCapacity):
+    names = json.dumps(columns).encode("UTF-8")
+    header = struct.pack(headerFormat, segmentMagic, segmentVersion,
+                         recordWords * 4, 0, dayStart, width, len(names))
+    header += names
+    assert len(header) <= headerSize,\
+      "Too many columns for one segment: %s" % columns
+
+    tmpFileName = self.fileName + ".tmp"
+    with open(tmpFileName, "wb") as stream:
+      stream.write(header.ljust(headerSize, b"\0"))
+      stream.truncate(headerSize + initialCapacity * recordWords * 4)
+    os.replace(tmpFileName, self.fileName)
+
+  def mapFile(self, size):
+    access = mmap.ACCESS_WRITE if self.writable else mmap.ACCESS_READ
+    self.size = size
+    self.map  = mmap.mmap(self.fd, size, access=access)
+
+  def readHeader(self):
+    length = struct.calcsize(headerFormat)
+    (magic, version, recordSize, count, dayStart, width, namesLength) =\
+      struct.unpack_from(headerFormat, self.map, 0)
+    assert magic == segmentMagic and version in readableVersions,\
+      "'%s' is not a time-series segment" % self.fileName
+
+    self.version     = version
+    self.recordSize  = recordSize
+    self.recordWords = recordSize // 4
+    self.count       = count
+    self.dayStart    = dayStart
+    self.width       = width
+    self.columns     = json.loads(bytes(self.map[length:length+namesLength]))
+    self.capacity    = (self.size - headerSize) // recordSize
+
+    # A crash can leave the stored count behind the records actually written
+    # or, if the header page made it to disk and the records did not, ahead
+    # of them.  Neither matters for a read-only look at a closed day.
+    self.count = min(self.count, self.capacity)
+
+  def refresh(self):
+    # For a read-only look at a segment another process is still appending
+    # to: picks up the records added since, remapping if the file grew, or
+    # reopening it if the writer replaced it after a change of sensors
+    status = os.fstat(self.fd)
+    try:
+      replaced = os.stat(self.fileName).st_ino != status.st_ino
+    except FileNotFoundError:
+      replaced = False
+    if replaced:
+      self.map.close()
+      os.close(self.fd)
+      self.fd = os.open(self.fileName, os.O_RDONLY)
+      self.mapFile(os.fstat(self.fd).st_size)
+      self.readHeader()
+      return
+    size = status.st_size
+    if size != self.size:
+      self.map.close()
+      self.mapFile(size)
+      self.capacity = (size - headerSize) // self.recordSize
+    (count,) = struct.unpack_from("<I", self.map, countOffset)
+    self.count = min(count, self.capacity)
+
+  def grow(self):
+    newSize = headerSize + max(self.capacity * 2, initialRecords) *\
+      self.recordSize
+    self.map.flush()
+    self.map.close()
+    os.ftruncate(self.fd, newSize)
+    self.mapFile(newSize)
+    self.capacity = (newSize - headerSize) // self.recordSize
+
+  def appendWords(self, packFormat, *values):
+    if self.count == self.capacity:
+      self.grow()
+    struct.pack_into(packFormat, self.map,
+                     headerSize + self.count * self.recordSize, *values)
+    self.count += 1
+    struct.pack_into("<I", self.map, countOffset, self.count)
+
+  def dropLast(self):
+    self.count -= 1
+    struct.pack_into("<I", self.map, countOffset, self.count)
+
+  def lastRecord(self, packFormat):
+    if not self.count:
+      return None
+    return struct.unpack_from(packFormat, self.map,
+                              headerSize + (self.count - 1) * self.recordSize)
+
+  def findRange(self, startOffset, endOffset):
+    # Index range of records whose time (first word) is in
+    # [startOffset, endOffset)
+    with memoryview(self.map) as view:
+      with view[headerSize:headerSize + self.count * self.recordSize]\
+             .cast("I") as words:
+        times = words[0::self.recordWords]
+        first = bisect.bisect_left(times, startOffset)
+        last  = bisect.bisect_left(times, endOffset)
+        times.release()
+    return (first, last)
+
+  def readColumn(self, first, last, word, typeCode="I", half=0):
+    # Returns the values of one field of records [first, last) as a list.
+    # word is the field's 4-byte word within the record; for int16 fields
+    # half selects the low (0) or high (1) half of the word.
+    if last <= first:
+      return []
+    start = headerSize + first * self.recordSize
+    end   = headerSize + last * self.recordSize
+    with memoryview(self.map) as view:
+      with view[start:end].cast(typeCode) as words:
+        if typeCode == "h":
+          column = words[word * 2 + half::self.recordWords * 2]
+        else:
+          column = words[word::self.recordWords]
+        values = column.tolist()
+        column.release()
+    return values
+
+  def flush(self):
+    if self.writable:
+      self.map.flush()
+
+  def close(self):
+    if self.map is not None:
+      self.flush()
+      self.map.close()
+      self.map = None
+      os.close(self.fd)
+
+class RollupAccumulator(object):
+
+  # Running min/max/sum/count per column for the bucket being filled
+
+  def __init__(self, columnCount, width):
+    self.columnCount = columnCount
+    self.width       = width
+    self.bucketStart = None
+    self.reset()
+
+  def reset(self):
+    self.mins   = [None] * self.columnCount
+    self.maxs   = [None] * self.columnCount
+    self.sums   = [0] * self.columnCount
+    self.counts = [0] * self.columnCount
+
+  def add(self, scaledValues):
+    for (i, value) in enumerate(scaledValues):
+      if value == missingValue:
+        continue
+      if self.counts[i] == 0:
+        self.mins[i] = value
+        self.maxs[i] = value
+      elif value < self.mins[i]:
+        self.mins[i] = value
+      elif value > self.maxs[i]:
+        self.maxs[i] = value
+      self.sums[i]   += value
+      self.counts[i] += 1
+
+  def packValues(self):
+    values = [self.bucketStart]
+    for i in range(self.columnCount):
+      if self.counts[i]:
+        values.extend((self.mins[i], self.maxs[i], self.sums[i],
+                       self.counts[i]))
+      else:
+        values.extend((missingValue, missingValue, 0, 0))
+    return values
+
+class TimeSeriesStore(object):
+
+  def __init__(self, root, columns, maxReaders=64):
+    # maxReaders caps the read-only maps of other days kept open
+    self.root       = root
+    self.maxReaders = maxReaders
+    self.columns    = list(columns)
+    valueSlots      = (rawRecordWords(len(columns)) - 1) * 2
+    self.rawFormat  = "<I%dh" % valueSlots
+    self.rollFormat = "<I" + "hhqI" * len(columns)
+    self.padding    = [missingValue] * (valueSlots - len(columns))
+    self.dateStamp  = None
+    self.dayStart   = None
+    self.dayEnd     = None
+    self.raw        = None
+    self.rollups    = {}
+    self.accums     = {}
+    self.readers    = {}
+
+  def segmentFileName(self, dateStamp, resolution):
+    return makeSegmentFileName(self.root, dateStamp, resolution)
+
+  def openDay(self, timestamp):
+    self.closeDay()
+    self.dateStamp = dateStampOf(timestamp)
+    self.dayStart  = dayStartOf(timestamp)
+    # 25 hours on is the next day even across a DST change
+    self.dayEnd    = dayStartOf(self.dayStart + 25 * 3600)
+
+    self.raw = Segment(self.segmentFileName(self.dateStamp, "raw"),
+                       self.columns, rawRecordWords(len(self.columns)),
+                       self.dayStart, 0, writable=True)
+    if self.raw.columns != self.columns:
+      print("Segment '%s' has columns %s, moving its %s samples over to %s"
+            % (self.raw.fileName, self.raw.columns, self.raw.count,
+               self.columns))
+      self.raw = self.convertRaw(self.raw)
+
+    for (resolution, width) in rollupWidths.items():
+      segment = self.openRollup(resolution, width)
+      if segment.columns != self.columns or\
+         segment.version != segmentVersion:
+        # Left from before a change of sensors or of the record layout;
+        # recoverBucket() rebuilds the whole day from the raw records
+        segment.close()
+        os.unlink(segment.fileName)
+        segment = self.openRollup(resolution, width)
+      self.rollups[resolution] = segment
+      self.accums[resolution]  = RollupAccumulator(len(self.columns), width)
+      self.recoverBucket(resolution)
+
+  def openRollup(self, resolution, width):
+    return Segment(self.segmentFileName(self.dateStamp, resolution),
+                   self.columns, rollupRecordWords(len(self.columns)),
+                   self.dayStart, width, writable=True,
+                   initialCapacity=25 * 3600 // width)
+
+  def convertRaw(self, old):
+    # Copies the records of a raw segment with other columns into one with
+    # self.columns, which then takes its place.  Columns that were dropped
+    # are lost, new ones are missing in the records so far.
+    oldFormat = "<I%dh" % ((old.recordWords - 1) * 2)
+    records   = [struct.unpack_from(oldFormat, old.map,
+                                    headerSize + index * old.recordSize)
+                 for index in range(old.count)]
+    positions = [old.columns.index(column) + 1 if column in old.columns
+                 else None for column in self.columns]
+    old.close()
+
+    newFileName = old.fileName + ".new"
+    if os.path.exists(newFileName):
+      os.unlink(newFileName)
+    new = Segment(newFileName, self.columns,
+                  rawRecordWords(len(self.columns)), self.dayStart, 0,
+                  writable=True,
+                  initialCapacity=max(initialRecords, len(records)))
+    for record in records:
+      values = [missingValue if position is None else record[position]
+                for position in positions]
+      new.appendWords(self.rawFormat, record[0], *(values + self.padding))
+    new.close()
+    os.replace(newFileName, old.fileName)
+    return Segment(old.fileName, writable=True)
+
+  def recoverBucket(self, resolution):
+    # After a restart, rebuild the bucket being filled from the raw records.
+    # The last rollup record may be a partial bucket written at shutdown, so
+    # it is dropped and rebuilt from raw along with anything after it.
+    segment = self.rollups[resolution]
+    last    = segment.lastRecord(self.rollFormat)
+    startMs = 0
+    if last is not None:
+      startMs = last[0] * 1000
+      segment.dropLast()
+
+    (first, end) = self.raw.findRange(startMs, 2**32 - 1)
+    for index in range(first, end):
+      record = struct.unpack_from(self.rawFormat, self.raw.map,
+                                  headerSize + index * self.raw.recordSize)
+      self.addToRollup(resolution, record[0] // 1000,
+                       record[1:1 + len(self.columns)])
+
+  def closeDay(self):
+    if self.raw is None:
+      return
+    for resolution in rollupWidths:
+      self.closeBucket(resolution)
+      self.rollups[resolution].close()
+    self.raw.close()
+    self.raw     = None
+    self.rollups = {}
+    self.accums  = {}
+
+  def closeBucket(self, resolution):
+    accum = self.accums[resolution]
+    if accum.bucketStart is not None and any(accum.counts):
+      self.rollups[resolution].appendWords(self.rollFormat,
+                                           *accum.packValues())
+    accum.bucketStart = None
+    accum.reset()
+
+  def addToRollup(self, resolution, secondsOfDay, scaledValues):
+    accum = self.accums[resolution]
+    bucketStart = secondsOfDay - secondsOfDay % accum.width
+    if accum.bucketStart != bucketStart:
+      self.closeBucket(resolution)
+      accum.bucketStart = bucketStart
+    accum.add(scaledValues)
+
+  def append(self, timestamp, values):
+    # values holds one number (or None) per column, in column order
+    if self.dayStart is None or not (self.dayStart <= timestamp
+                                     < self.dayEnd):
+      self.openDay(timestamp)
+
+    offsetMs = int((timestamp - self.dayStart) * 1000)
+    scaled   = [scaleValue(value) for value in values]
+    self.raw.appendWords(self.rawFormat, offsetMs, *(scaled + self.padding))
+
+    secondsOfDay = offsetMs // 1000
+    for resolution in rollupWidths:
+      self.addToRollup(resolution, secondsOfDay, scaled)
+
+  def flush(self):
+    if self.raw is not None:
+      self.raw.flush()
+      for segment in self.rollups.values():
+        segment.flush()
+
+  def close(self):
+    self.closeDay()
+    for segment in self.readers.values():
+      segment.close()
+    self.readers = {}
+
+  def getSegment(self, dateStamp, resolution):
+    if dateStamp == self.dateStamp:
+      if resolution == "raw":
+        return self.raw
+      return self.rollups[resolution]
+
+    fileName = self.segmentFileName(dateStamp, resolution)
+    segment  = self.readers.get(fileName)
+    if segment is None:
+      if not os.path.exists(fileName):
+        return None
+      # Closed days never change, so their read-only maps are kept open.
+      # A small cap keeps the number of open files bounded.
+      if len(self.readers) >= self.maxReaders:
+        self.readers.pop(next(iter(self.readers))).close()
+      segment = Segment(fileName)
+      self.readers[fileName] = segment
+    elif dateStamp >= dateStampOf(time.time() - 3600):
+      # Today's files, and yesterday's just after midnight, may still be
+      # written by a collector in another process
+      segment.refresh()
+    return segment
+
+  def daysBetween(self, start, end):
+    day = dayStartOf(start)
+    while day < end:
+      yield (dateStampOf(day), day)
+      # Step past DST changes by going to noon of the next day
+      day = dayStartOf(day + 36 * 3600)
+
+  def chooseResolution(self, start, end, maxPoints, sampleSeconds=2.0):
+    seconds = end - start
+    if seconds / 60.0 > maxPoints:
+      return "1h"
+    if seconds / sampleSeconds > maxPoints:
+      return "1m"
+    return "raw"
+
+  def query(self, start, end, columns=None, resolution="raw",
+            maxPoints=2000):
+    # Returns {"time":[...], column:[...]} for raw data, or
+    # {"time":[...], column:{"min":[...], "max":[...], "mean":[...]}} for the
+    # "1m" and "1h" rollups.  resolution "auto" picks the finest resolution
+    # that gives roughly maxPoints points or fewer.  Missing values are None.
+    # A rollup bucket is only written once it is complete, so rollup results
+    # stop at the last complete minute or hour.
+    if columns is None:
+      columns = self.columns
+    if resolution == "auto":
+      resolution = self.chooseResolution(start, end, maxPoints)
+    assert resolution == "raw" or resolution in rollupWidths,\
+      "Unknown resolution '%s'" % resolution
+
+    result = {"time":[]}
+    for column in columns:
+      if resolution == "raw":
+        result[column] = []
+      else:
+        result[column] = {"min":[], "max":[], "mean":[]}
+
+    for (dateStamp, dayStart) in self.daysBetween(start, end):
+      segment = self.getSegment(dateStamp, resolution)
+      if segment is None or not segment.count:
+        continue
+      startMs = max(0, int((start - dayStart) * 1000))
+      endMs   = max(0, int((end - dayStart) * 1000))
+      if resolution != "raw":
+        startMs = startMs // 1000
+        endMs   = endMs // 1000
+      (first, last) = segment.findRange(startMs, endMs)
+      if first >= last:
+        continue
+
+      offsets = segment.readColumn(first, last, 0)
+      if resolution == "raw":
+        result["time"].extend(dayStart + offset / 1000.0
+                              for offset in offsets)
+      else:
+        result["time"].extend(dayStart + offset for offset in offsets)
+
+      for column in columns:
+        # Days from before a sensor was added have no column for it
+        if column not in segment.columns:
+          gap = [None] * len(offsets)
+          if resolution == "raw":
+            result[column].extend(gap)
+          else:
+            for stat in ("min", "max", "mean"):
+              result[column][stat].extend(gap)
+          continue
+        index = segment.columns.index(column)
+        if resolution == "raw":
+          word = 1 + index // 2
+          values = segment.readColumn(first, last, word, "h", index % 2)
+          result[column].extend(None if value == missingValue
+                                else value / valueScale
+                                for value in values)
+        else:
+          fieldWords = rollupFieldWords(segment.version)
+          word   = 1 + fieldWords * index
+          mins   = segment.readColumn(first, last, word, "h", 0)
+          maxs   = segment.readColumn(first, last, word, "h", 1)
+          if fieldWords == 3:
+            sums = segment.readColumn(first, last, word + 1, "i")
+          else:
+            lows  = segment.readColumn(first, last, word + 1, "I")
+            highs = segment.readColumn(first, last, word + 2, "i")
+            sums  = [(high << 32) + low for (low, high) in zip(lows, highs)]
+          counts = segment.readColumn(first, last, word + fieldWords - 1,
+                                      "I")
+          stats  = result[column]
+          for (low, high, total, count) in zip(mins, maxs, sums, counts):
+            if count:
+              stats["min"].append(low / valueScale)
+              stats["max"].append(high / valueScale)
+              stats["mean"].append(total / count / valueScale)
+            else:
+              stats["min"].append(None)
+              stats["max"].append(None)
+              stats["mean"].append(None)
+
+    return result
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Windowed aggregation of samples.  With "sample_interval" in a host block
+# the collector reads its sensors every sample_interval seconds, but still
+# publishes once every update_frequency seconds: a summary of all samples
+# of the window instead of the single sample taken at its end.
+#
+#   "update_frequency":1800,
+#   "sample_interval":10,
+#   "sensors":[{"name":"frig", "type":"DHT22", "pin":4,
+#               "fields":{1:"temp_f", 2:"humidity", 3:"temp_f.max",
+#                         4:"temp_f.stddev"}}],
+#
+# A field can publish any of min, max, mean, stddev, count and last of a
+# quantity, as "<quantity>.<stat>".  A plain quantity publishes the mean.
+# Only the ThingSpeak upload is summarized: the local store, the log and
+# the alert rules still get every sample, and a rule watching a stat, e.g.
+# "temp_f.max", is checked once per window.  A DHT22 can be read at most
+# every 2 secs.
+#
+# Windows are (end - update_frequency, end], ending on wall-clock multiples
+# of update_frequency like the samples themselves, so the sample taken at
+# the end of a window is the last one in it and the summary goes out right
+# after it.  Each quantity keeps a running count, mean and sum of squared
+# deviations (Welford's method) plus min, max and last, so a window costs
+# the same few numbers per quantity however many samples it holds.
+
+import math
+
+from sensorBackends import quantityNames
+from collectorMetrics import registry
+
+statNames = ("min", "max", "mean", "stddev", "count", "last")
+
+windowsClosed = registry.counter(
+  "collector_windows_closed_total", "Aggregation windows summarized")
+samplesAggregated = registry.counter(
+  "collector_window_samples_total", "Samples added to aggregation windows")
+
+def splitQuantity(quantity):
+  # "temp_f.max" -> ("temp_f", "max"); "temp_f" -> ("temp_f", None)
+  (name, dot, stat) = quantity.partition(".")
+  return (name, stat if dot else None)
+
+def isQuantity(quantity, aggregated, names=quantityNames):
+  # Whether a sensor field may publish quantity, one of names or a stat of
+  # one.  Stats are only known when the host aggregates.
+  (name, stat) = splitQuantity(quantity)
+  if name not in names:
+    return False
+  return stat is None or (aggregated and stat in statNames)
+
+class RunningStats(object):
+
+  def __init__(self):
+    self.reset()
+
+  def reset(self):
+    self.count = 0
+    self.mean  = 0.0
+    self.m2    = 0.0
+    self.min   = None
+    self.max   = None
+    self.last  = None
+
+  def add(self, value):
+    self.count += 1
+    delta = value - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (value - self.mean)
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+    self.last = value
+
+  def stddev(self):
+    # Sample standard deviation; 0.0 for a single sample
+    if self.count < 2:
+      return 0.0
+    return math.sqrt(self.m2 / (self.count - 1))
+
+  def summary(self):
+    return {"min":self.min, "max":self.max, "mean":self.mean,
+            "stddev":self.stddev(), "count":self.count, "last":self.last}
+
+class WindowAggregator(object):
+
+  def __init__(self, windowSeconds):
+    self.windowSeconds = windowSeconds
+    self.windowEnd     = None
+    self.stats         = {}
+
+  def windowEndOf(self, timestamp):
+    # The small slack keeps a sample stamped a rounding error past a window
+    # end in that window
+    return (math.ceil(timestamp / self.windowSeconds - 1e-9)
+            * self.windowSeconds)
+
+  def setWindowSeconds(self, windowSeconds):
+    # The current window keeps its end; the next one has the new length
+    self.windowSeconds = windowSeconds
+
+  def add(self, quantitiesBySensor, timestamp):
+    # quantitiesBySensor is {sensorName:{quantity:value}} for the sensors
+    # that delivered a usable sample.  Returns (windowEnd, summaries) once
+    # a window is complete, else None.
+    closed = None
+    if self.windowEnd is not None and timestamp > self.windowEnd + 1e-6:
+      # The window's last sample was missed, e.g. because a read overran,
+      # so this sample starts the next window and the summary goes out now
+      closed = self.close()
+    if self.windowEnd is None:
+      self.windowEnd = self.windowEndOf(timestamp)
+
+    samplesAggregated.inc()
+    for (sensorName, quantities) in quantitiesBySensor.items():
+      sensorStats = self.stats.setdefault(sensorName, {})
+      for (quantity, value) in quantities.items():
+        if quantity not in sensorStats:
+          sensorStats[quantity] = RunningStats()
+        sensorStats[quantity].add(value)
+
+    if closed is None and timestamp >= self.windowEnd - 1e-6:
+      closed = self.close()
+    return closed
+
+  def close(self):
+    # Returns (windowEnd, summaries) and starts an empty window.  summaries
+    # is {sensorName:{quantity:value, "<quantity>.<stat>":value}}, with the
+    # plain quantity holding the mean, for the sensors with samples.
+    summaries = {}
+    for (sensorName, sensorStats) in self.stats.items():
+      quantities = {}
+      for (quantity, stats) in sensorStats.items():
+        if not stats.count:
+          continue
+        quantities[quantity] = stats.mean
+        for (stat, value) in stats.summary().items():
+          quantities["%s.%s" % (quantity, stat)] = value
+        stats.reset()
+      if quantities:
+        summaries[sensorName] = quantities
+
+    windowEnd = self.windowEnd
+    self.windowEnd = None
+    windowsClosed.inc()
+    return (windowEnd, summaries)